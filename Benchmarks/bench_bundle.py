@@ -0,0 +1,153 @@
+"""
+Measures moving many tiny files one request each and in bundles.
+
+    python Benchmarks/bench_bundle.py --files 50000 --size 1K --rtt-ms 20
+
+Starts Server/server.py and, with --rtt-ms, a proxy in front of it that
+delays every byte by half the round trip time in each direction. Uploads
+--files files of about --size bytes (different content in each scenario,
+so nothing is deduplicated) with Client/batch.py one file per request and
+then in bundles, and downloads them back the same two ways, with
+--concurrency requests in flight. Reports files per second.
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # make the project root importable
+
+from Client import batch
+from Client.client_core import AsyncClient
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Server", "server.py")
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Delay:
+    """
+    TCP proxy that delays everything it forwards by ``rtt / 2`` seconds in each direction.
+    """
+
+    def __init__(self, upstream_port, rtt):
+        self.upstream_port = upstream_port
+        self.rtt = rtt
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _handle(self, client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection("127.0.0.1", self.upstream_port)
+        try:
+            await asyncio.gather(self._pump(client_reader, server_writer), self._pump(server_reader, client_writer),
+                                 return_exceptions=True)
+        except asyncio.CancelledError:
+            pass  # the benchmark is over
+
+    async def _pump(self, reader, writer):
+        queue = asyncio.Queue()  # (when to forward, data), in order
+
+        async def forward():
+            while True:
+                due, data = await queue.get()
+                if data is None:
+                    return
+                await asyncio.sleep(max(0.0, due - time.perf_counter()))
+                writer.write(data)
+                await writer.drain()
+
+        forwarder = asyncio.get_running_loop().create_task(forward())
+        try:
+            while True:
+                data = await reader.read(64 << 10)
+                if not data:
+                    break
+                queue.put_nowait((time.perf_counter() + self.rtt / 2, data))
+        finally:
+            queue.put_nowait((0.0, None))
+            await asyncio.gather(forwarder, return_exceptions=True)
+            writer.close()
+
+
+def make_files(directory, count, size, seed):
+    os.makedirs(directory)
+    rng = random.Random(seed)
+    paths = []
+    for index in range(count):
+        path = os.path.join(directory, f"file{index:06}.txt")
+        with open(path, "wb") as file:
+            file.write(rng.randbytes(rng.randrange(size // 2, size * 3 // 2 + 1)))
+        paths.append(path)
+    return paths
+
+
+async def timed(label, operation, count):
+    started = time.perf_counter()
+    results = await operation
+    elapsed = time.perf_counter() - started
+    failed = sum(not result.ok for result in results)
+    print(f"{label:26} {elapsed:8.2f} {count / elapsed:10.0f} {failed:>7}")
+
+
+async def run(args):
+    port, notification_port = free_port(), free_port()
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        server = subprocess.Popen([sys.executable, SERVER_SCRIPT, "--port", str(port), "--notification-port",
+                                   str(notification_port), "--storage", os.path.join(directory, "storage")],
+                                  cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            await asyncio.sleep(1)
+            if args.rtt_ms:
+                port = await Delay(port, args.rtt_ms / 1000).start()
+            print(f"{args.files} files of about {args.size} bytes, {args.rtt_ms:g} ms round trip, "
+                  f"{args.concurrency} requests in flight")
+            print(f"{'scenario':26} {'seconds':>8} {'files/s':>10} {'failed':>7}")
+            for bundle in (False, True):
+                label = "bundled" if bundle else "one per request"
+                paths = make_files(os.path.join(directory, label), args.files, args.size, bundle)
+                client = AsyncClient("127.0.0.1", port, "bundle" if bundle else "single",
+                                     notification_port=notification_port, compression=[])
+                await client.connect()
+                await timed(f"upload {label}", batch.upload_many(client, paths, args.concurrency, bundle=bundle),
+                            args.files)
+                names = [f"{client.username}_{os.path.basename(path)}" for path in paths]
+                save_directory = os.path.join(directory, label + " downloads")
+                await timed(f"download {label}", batch.download_many(client, names, save_directory,
+                                                                     args.concurrency, bundle=bundle), args.files)
+                await client.disconnect()
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=5000, help="files per scenario")
+    parser.add_argument("--size", type=parse_size, default=parse_size("1K"), help="average bytes per file")
+    parser.add_argument("--rtt-ms", type=float, default=0, help="emulated round trip time (0: no proxy)")
+    parser.add_argument("--concurrency", type=int, default=batch.DEFAULT_CONCURRENCY, help="requests in flight")
+    parser.add_argument("--dir", default=None, help="scratch directory for the test files")
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Measures repeat downloads of unchanged files with and without the client's download cache.
+
+    python Benchmarks/bench_cache.py --files 20 --size 16M --rtt-ms 20
+
+Starts Server/server.py (behind the delaying proxy of bench_bundle.py with
+--rtt-ms), uploads --files files of --size bytes and downloads each of them
+--repeats times, once with a plain client and once with a client that has a
+DownloadCache (the first download of every file fills it; the later ones
+are revalidated). Reports the average time per download.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # make the project root importable
+
+from Benchmarks.bench_bundle import SERVER_SCRIPT, Delay, free_port, parse_size
+from Client.cache import DownloadCache
+from Client.client_core import AsyncClient
+
+
+async def timed_downloads(client, names, save_directory, repeats):
+    os.makedirs(save_directory, exist_ok=True)
+    times = []
+    for _ in range(repeats):
+        for name in names:
+            started = time.perf_counter()
+            await client.download(name, save_directory)
+            times.append(time.perf_counter() - started)
+    return times
+
+
+async def run(args):
+    port, notification_port = free_port(), free_port()
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        server = subprocess.Popen([sys.executable, SERVER_SCRIPT, "--port", str(port), "--notification-port",
+                                   str(notification_port), "--storage", os.path.join(directory, "storage")],
+                                  cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            await asyncio.sleep(1)
+            if args.rtt_ms:
+                port = await Delay(port, args.rtt_ms / 1000).start()
+            uploader = AsyncClient("127.0.0.1", port, "bench", notification_port=notification_port, compression=[])
+            await uploader.connect()
+            names = []
+            for index in range(args.files):
+                path = os.path.join(directory, f"file{index:04}.bin")
+                with open(path, "wb") as file:
+                    file.write(os.urandom(args.size))
+                await uploader.upload(path)
+                names.append(f"bench_{os.path.basename(path)}")
+            await uploader.disconnect()
+
+            print(f"{args.files} files of {args.size} bytes, {args.repeats} downloads each, "
+                  f"{args.rtt_ms:g} ms round trip")
+            print(f"{'scenario':14} {'first ms':>9} {'repeat ms':>10}")
+            cache = DownloadCache(os.path.join(directory, "cache"), args.files * args.size)
+            for label, options in (("no cache", {}), ("cache", {"cache": cache})):
+                client = AsyncClient("127.0.0.1", port, label.replace(" ", "-"), notification_port=notification_port,
+                                     compression=[], **options)
+                await client.connect()
+                times = await timed_downloads(client, names, os.path.join(directory, label), args.repeats)
+                await client.disconnect()
+                first, repeats = times[:args.files], times[args.files:]
+                repeat_ms = sum(repeats) / len(repeats) * 1000 if repeats else 0.0
+                print(f"{label:14} {sum(first) / len(first) * 1000:9.1f} {repeat_ms:10.1f}")
+            print(f"cache: {cache.hits} hits, {cache.misses} misses")
+            cache.close()
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=10, help="distinct files downloaded")
+    parser.add_argument("--size", type=parse_size, default=parse_size("8M"), help="bytes per file")
+    parser.add_argument("--repeats", type=int, default=5, help="downloads of every file")
+    parser.add_argument("--rtt-ms", type=float, default=0, help="emulated round trip time (0: no proxy)")
+    parser.add_argument("--dir", default=None, help="scratch directory for the test files")
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
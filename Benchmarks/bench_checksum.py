@@ -0,0 +1,156 @@
+"""
+Measures what end-to-end checksums cost a transfer.
+
+    python Benchmarks/bench_checksum.py --size 256M --link-mbit 0,1000
+
+Starts Server/server.py in a subprocess and uploads (without announced
+digests, so the client hashes while it sends) and downloads a random file
+with the client's verification off and on. --link-mbit lists the links to
+try: 0 connects directly, anything else goes through a throttling proxy.
+Reports the best of --repeat runs, the client's CPU seconds and the
+throughput lost to hashing. The server hashes uploads either way, since its
+blob names are their digests.
+"""
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # make the project root importable
+
+from Client.client_core import AsyncClient
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Server", "server.py")
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Link:
+    """
+    TCP proxy that limits each direction to ``rate`` bytes per second.
+    """
+
+    def __init__(self, upstream_port, rate):
+        self.upstream_port = upstream_port
+        self.rate = rate
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _handle(self, client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection("127.0.0.1", self.upstream_port)
+        try:
+            await asyncio.gather(self._pump(client_reader, server_writer), self._pump(server_reader, client_writer),
+                                 return_exceptions=True)
+        except asyncio.CancelledError:
+            pass  # the benchmark is over
+
+    async def _pump(self, reader, writer):
+        started, moved = time.perf_counter(), 0
+        try:
+            while True:
+                data = await reader.read(64 << 10)
+                if not data:
+                    break
+                moved += len(data)
+                delay = started + moved / self.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    started, moved = time.perf_counter(), 0  # idle time is not credit for a burst later
+                writer.write(data)
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+async def measure(port, notification_port, path, directory, verify, repeat):
+    """
+    Returns the best (seconds, client CPU seconds) of ``repeat`` uploads and of as many downloads.
+    """
+    client = AsyncClient("127.0.0.1", port, f"bench-{verify}", notification_port=notification_port, compression=[],
+                         verify=verify)
+    await client.connect()
+    best = {"up": (float("inf"), 0.0), "down": (float("inf"), 0.0)}
+    try:
+        for _ in range(repeat):
+            for direction in ("up", "down"):
+                started, cpu = time.perf_counter(), cpu_seconds()
+                if direction == "up":
+                    await client.upload(path, dedupe=False)
+                else:
+                    os.remove(await client.download(f"{client.username}_{os.path.basename(path)}", directory,
+                                                    resume=False))
+                best[direction] = min(best[direction], (time.perf_counter() - started, cpu_seconds() - cpu))
+    finally:
+        await client.disconnect()
+    return best
+
+
+async def run(args):
+    port, notification_port = free_port(), free_port()
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        server = subprocess.Popen([sys.executable, SERVER_SCRIPT, "--port", str(port), "--notification-port",
+                                   str(notification_port), "--storage", os.path.join(directory, "storage")],
+                                  cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            await asyncio.sleep(1)
+            path = os.path.join(directory, "random.bin")
+            with open(path, "wb") as file:
+                for offset in range(0, args.size, 1 << 20):
+                    file.write(os.urandom(min(1 << 20, args.size - offset)))
+            print(f"{args.size >> 20} MiB per transfer, best of {args.repeat}")
+            print(f"{'link':>10} {'direction':9} {'plain MB/s':>10} {'verified':>10} {'cpu s':>6} {'cpu s':>6} "
+                  f"{'overhead':>8}")
+            for mbit in args.link_mbit:
+                link_port = port
+                if mbit:
+                    link_port = await Link(port, mbit * 1e6 / 8).start()
+                plain = await measure(link_port, notification_port, path, directory, False, args.repeat)
+                verified = await measure(link_port, notification_port, path, directory, True, args.repeat)
+                for direction in ("up", "down"):
+                    (plain_seconds, plain_cpu), (verified_seconds, verified_cpu) = plain[direction], verified[direction]
+                    print(f"{f'{mbit:g} Mbit' if mbit else 'direct':>10} {direction:9} "
+                          f"{args.size / plain_seconds / 1e6:10.1f} {args.size / verified_seconds / 1e6:10.1f} "
+                          f"{plain_cpu:6.2f} {verified_cpu:6.2f} {1 - plain_seconds / verified_seconds:8.1%}")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=parse_size, default=parse_size("256M"), help="bytes per transfer")
+    parser.add_argument("--link-mbit", default="0,1000", help="comma separated link bandwidths, 0 for direct")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement; the fastest counts")
+    parser.add_argument("--dir", default=None, help="scratch directory for the test files")
+    args = parser.parse_args(argv)
+    args.link_mbit = [float(mbit) for mbit in args.link_mbit.split(",") if mbit]
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
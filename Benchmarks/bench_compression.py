@@ -0,0 +1,160 @@
+"""
+Measures on-the-wire compression over a bandwidth-limited link.
+
+    python Benchmarks/bench_compression.py --size 64M --link-mbit 100
+
+Starts Server/server.py in a subprocess and puts a throttling TCP proxy in
+front of it that emulates a WAN link of --link-mbit in each direction. For
+every dataset (generated log text and random bytes) and every codec (none,
+then each registered one) a client uploads the file and downloads it again.
+Reports wall time, effective throughput and the bytes that crossed the link;
+random data is expected to be sent uncompressed whatever was offered.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # make the project root importable
+
+from Client.client_core import AsyncClient
+from Common.compression import CODECS
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Server", "server.py")
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_logs(path, size):
+    with open(path, "wb") as file:
+        line = 0
+        while file.tell() < size:
+            file.write(b"".join(b"2024-05-%02d 12:%02d:%02d INFO worker-%d request id=%08x path=/api/v1/items/%d "
+                                b"status=%d bytes=%d\n" % (line % 28 + 1, line % 60, line * 7 % 60, line % 16,
+                                                           line * 2654435761 % (1 << 32), line % 5000,
+                                                           (200, 200, 200, 404, 500)[line % 5], line * 37 % 100000)
+                                for line in range(line, line + 10000)))
+            line += 10000
+        file.truncate(size)
+
+
+def make_random(path, size):
+    with open(path, "wb") as file:
+        for offset in range(0, size, 1 << 20):
+            file.write(os.urandom(min(1 << 20, size - offset)))
+
+
+class Link:
+    """
+    TCP proxy that limits each direction to ``rate`` bytes per second and counts the bytes it moves.
+    """
+
+    def __init__(self, upstream_port, rate):
+        self.upstream_port = upstream_port
+        self.rate = rate
+        self.sent = {"up": 0, "down": 0}
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _handle(self, client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection("127.0.0.1", self.upstream_port)
+        try:
+            await asyncio.gather(self._pump(client_reader, server_writer, "up"),
+                                 self._pump(server_reader, client_writer, "down"), return_exceptions=True)
+        except asyncio.CancelledError:
+            pass  # the benchmark is over
+
+    async def _pump(self, reader, writer, direction):
+        started, moved = time.perf_counter(), 0
+        try:
+            while True:
+                data = await reader.read(64 << 10)
+                if not data:
+                    break
+                moved += len(data)
+                self.sent[direction] += len(data)
+                delay = started + moved / self.rate - time.perf_counter()  # stay on the link's schedule
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    started, moved = time.perf_counter(), 0  # idle time is not credit for a burst later
+                writer.write(data)
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+async def run(args):
+    port, notification_port = free_port(), free_port()
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        command = [sys.executable, SERVER_SCRIPT, "--port", str(port), "--notification-port", str(notification_port),
+                   "--storage", os.path.join(directory, "storage")]
+        if args.compress_at_rest:
+            command += ["--compress-at-rest", args.compress_at_rest]
+        server = subprocess.Popen(command, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            await asyncio.sleep(1)
+            link = Link(port, args.link_mbit * 1e6 / 8)
+            link_port = await link.start()
+            datasets = {"logs": make_logs, "random": make_random}
+            print(f"{args.size >> 20} MiB per transfer over a {args.link_mbit} Mbit/s link")
+            print(f"{'dataset':8} {'offered':7} {'direction':9} {'seconds':>8} {'MB/s':>8} {'wire MB':>8} {'ratio':>6}")
+            for dataset, make in datasets.items():
+                path = os.path.join(directory, dataset)
+                make(path, args.size)
+                for codec in [None, *args.codecs]:
+                    client = AsyncClient("127.0.0.1", link_port, f"{dataset}-{codec}",
+                                         compression=[codec] if codec else [])
+                    await client.connect()
+                    for direction in ("up", "down"):
+                        before = link.sent[direction]
+                        started = time.perf_counter()
+                        if direction == "up":
+                            await client.upload(path, dedupe=False)
+                        else:
+                            downloaded = await client.download(f"{client.username}_{dataset}", directory, resume=False)
+                            os.remove(downloaded)
+                        elapsed = time.perf_counter() - started
+                        wire = link.sent[direction] - before
+                        print(f"{dataset:8} {str(codec):7} {direction:9} "
+                              f"{elapsed:8.2f} {args.size / elapsed / 1e6:8.1f} {wire / 1e6:8.1f} "
+                              f"{args.size / wire:6.2f}")
+                    await client.disconnect()
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=parse_size, default=parse_size("64M"), help="bytes per dataset")
+    parser.add_argument("--link-mbit", type=float, default=100, help="emulated link bandwidth per direction")
+    parser.add_argument("--codecs", default=",".join(CODECS), help="comma separated codecs to compare with none")
+    parser.add_argument("--compress-at-rest", choices=sorted(CODECS), default=None,
+                        help="start the server with compressed blob storage")
+    parser.add_argument("--dir", default=None, help="scratch directory for the test files")
+    args = parser.parse_args(argv)
+    args.codecs = [codec for codec in args.codecs.split(",") if codec]
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Compares the server's download send paths over loopback TCP.
+
+    python Benchmarks/bench_download.py --sizes 4K,1M,64M,1G,4G
+
+For every file size it serves the same file with
+
+  legacy    the original loop: file.read(4096) + sendall per chunk
+  buffered  AsyncConnection.sendfile(zero_copy=False), 256 KiB read/send loop
+  sendfile  AsyncConnection.sendfile(), kernel zero-copy via os.sendfile
+
+and reports throughput (MB/s) and sender CPU time per GB. Small files are
+sent repeatedly so every measurement moves at least --min-bytes.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # make the project root importable
+
+from Common.transport import AsyncConnection
+
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+METHODS = ("legacy", "buffered", "sendfile")
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def format_size(size):
+    for suffix, unit in (("G", 1 << 30), ("M", 1 << 20), ("K", 1 << 10)):
+        if size >= unit and size % unit == 0:
+            return f"{size // unit}{suffix}"
+    return str(size)
+
+
+def make_file(directory, size):
+    path = os.path.join(directory, f"bench_{size}.bin")
+    block = os.urandom(1 << 20)
+    with open(path, "wb") as file:
+        remaining = size
+        while remaining:
+            remaining -= file.write(block[:min(remaining, len(block))])
+    with open(path, "rb") as file:  # warm the page cache so every method reads from memory
+        while file.read(1 << 20):
+            pass
+    return path
+
+
+def drain(sock, expected, done):
+    buffer = memoryview(bytearray(1 << 20))
+    received = 0
+    while received < expected:
+        count = sock.recv_into(buffer)
+        if not count:
+            break
+        received += count
+    done.append(received)
+
+
+async def send_legacy(loop, sock, file, size):
+    file.seek(0)
+    while chunk := file.read(4096):
+        await loop.sock_sendall(sock, chunk)
+
+
+async def send_rounds(method, sock, path, size, rounds):
+    loop = asyncio.get_running_loop()
+    conn = AsyncConnection(loop, sock)
+    with open(path, "rb") as file:
+        for _ in range(rounds):
+            if method == "legacy":
+                await send_legacy(loop, sock, file, size)
+            else:
+                await conn.sendfile(file, 0, size, zero_copy=(method == "sendfile"))
+
+
+def measure(method, path, size, rounds):
+    listener = socket.create_server(("127.0.0.1", 0))
+    receiver = socket.create_connection(listener.getsockname())
+    sender, _ = listener.accept()
+    listener.close()
+    sender.setblocking(False)
+
+    done = []
+    drainer = threading.Thread(target=drain, args=(receiver, size * rounds, done))
+    drainer.start()
+    cpu_start, wall_start = time.thread_time(), time.perf_counter()
+    asyncio.run(send_rounds(method, sender, path, size, rounds))
+    cpu, wall = time.thread_time() - cpu_start, time.perf_counter() - wall_start
+    sender.close()
+    drainer.join()
+    receiver.close()
+    if done[0] != size * rounds:
+        raise RuntimeError(f"{method}: receiver got {done[0]} of {size * rounds} bytes")
+
+    total = size * rounds
+    return total / wall / 1e6, cpu / (total / (1 << 30))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="4K,64K,1M,16M,256M,1G,4G", help="comma separated file sizes")
+    parser.add_argument("--methods", default=",".join(METHODS), help="comma separated send paths to compare")
+    parser.add_argument("--min-bytes", type=parse_size, default=parse_size("256M"),
+                        help="repeat small files until at least this much data is sent")
+    parser.add_argument("--dir", default=None, help="scratch directory for the test files")
+    args = parser.parse_args()
+
+    methods = [method.strip() for method in args.methods.split(",")]
+    scratch = tempfile.mkdtemp(prefix="bench_download_", dir=args.dir)
+    print(f"{'size':>6} {'method':>9} {'MB/s':>10} {'CPU s/GB':>10}")
+    try:
+        for size in (parse_size(text) for text in args.sizes.split(",")):
+            if shutil.disk_usage(scratch).free < size + (1 << 30):
+                print(f"{format_size(size):>6} skipped: not enough free disk space in {scratch}")
+                continue
+            path = make_file(scratch, size)
+            rounds = max(1, -(-args.min_bytes // size))
+            for method in methods:
+                throughput, cpu_per_gb = measure(method, path, size, rounds)
+                print(f"{format_size(size):>6} {method:>9} {throughput:>10.1f} {cpu_per_gb:>10.3f}")
+            os.remove(path)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
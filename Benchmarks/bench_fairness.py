@@ -0,0 +1,133 @@
+"""
+Measures how interactive requests fare while another client saturates the server.
+
+    python Benchmarks/bench_fairness.py --bulk-size 64M --streams 8 --duration 10
+
+Starts Server/server.py once per scenario: without limits, then with the
+--shaped server options (rate limits, admission limits). In each, a bulk
+client keeps --streams uploads and downloads of a --bulk-size file going
+on one connection, while an interactive client, on a connection of its
+own, loops LIST, a small upload and a DELETE. Reports the interactive
+latencies (p50/p99) and the throughput the bulk client got.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # make the project root importable
+
+from Client.client_core import AsyncClient, ServerError
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Server", "server.py")
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+SMALL_SIZE = 16 << 10  # bytes of the interactive client's uploads
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q * len(values)) - 1))] if values else float("nan")
+
+
+async def bulk(client, path, deadline, save_directory, index, moved):
+    """
+    Alternates uploads and downloads of the bulk file until the deadline.
+    """
+    name = f"bulk{index}.bin"
+    while time.time() < deadline:
+        try:
+            await client.upload(path, name, dedupe=False)
+            os.remove(await client.download(f"{client.username}_{name}", save_directory, resume=False))
+        except ServerError:
+            await asyncio.sleep(0.1)  # refused as busy
+            continue
+        moved[0] += 2 * os.path.getsize(path)
+
+
+async def interactive(client, path, deadline, latencies):
+    """
+    Loops LIST, a small upload and its DELETE until the deadline, timing each.
+    """
+    while time.time() < deadline:
+        for operation, call in (("list", lambda: client.list_page(limit=100)),
+                                ("upload", lambda: client.upload(path, "small.bin", dedupe=False)),
+                                ("delete", lambda: client.delete(f"{client.username}_small.bin"))):
+            started = time.perf_counter()
+            await call()
+            latencies[operation].append(time.perf_counter() - started)
+
+
+async def scenario(args, directory, server_args, bulk_path, small_path):
+    port, notification_port = free_port(), free_port()
+    storage, downloads = tempfile.mkdtemp(dir=directory), tempfile.mkdtemp(dir=directory)
+    server = subprocess.Popen([sys.executable, SERVER_SCRIPT, "--port", str(port), "--notification-port",
+                               str(notification_port), "--storage", storage, *server_args], cwd=directory,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    heavy = AsyncClient("127.0.0.1", port, "bulk", notification_port=notification_port, compression=[])
+    light = AsyncClient("127.0.0.1", port, "light", notification_port=notification_port, compression=[])
+    latencies = {"list": [], "upload": [], "delete": []}
+    moved = [0]
+    try:
+        await asyncio.sleep(1)
+        await heavy.connect()
+        await light.connect()
+        deadline = time.time() + args.duration
+        started = time.perf_counter()
+        await asyncio.gather(interactive(light, small_path, deadline, latencies),
+                             *(bulk(heavy, bulk_path, deadline, downloads, index, moved) for index in range(args.streams)))
+        elapsed = time.perf_counter() - started
+    finally:
+        await heavy.disconnect()
+        await light.disconnect()
+        server.terminate()
+        server.wait()
+    return latencies, moved[0] / elapsed
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        bulk_path = os.path.join(directory, "bulk.bin")
+        small_path = os.path.join(directory, "small.bin")
+        with open(bulk_path, "wb") as file:
+            file.write(os.urandom(args.bulk_size))
+        with open(small_path, "wb") as file:
+            file.write(os.urandom(SMALL_SIZE))
+        print(f"{args.streams} bulk transfers of {args.bulk_size >> 20} MiB against one interactive client")
+        print(f"{'scenario':>10} {'op':>7} {'count':>6} {'p50 ms':>8} {'p99 ms':>8} {'bulk MB/s':>10}")
+        for label, server_args in (("unlimited", []), ("shaped", args.shaped.split())):
+            latencies, throughput = await scenario(args, directory, server_args, bulk_path, small_path)
+            for operation, values in latencies.items():
+                print(f"{label:>10} {operation:>7} {len(values):>6} {percentile(values, 0.5) * 1000:8.1f} "
+                      f"{percentile(values, 0.99) * 1000:8.1f} {throughput / 1e6:10.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bulk-size", type=parse_size, default=parse_size("64M"), help="bytes of the bulk file")
+    parser.add_argument("--streams", type=int, default=8, help="bulk transfers in flight at once")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per scenario")
+    parser.add_argument("--shaped", default="--client-rate-mb 200 --max-client-transfers 4",
+                        help="server options of the shaped scenario")
+    parser.add_argument("--dir", default=None, help="scratch directory for the test files")
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Measures what creating and looking up a blob costs as the store grows, in the
+flat layout of older versions and in fan-out directories.
+
+    python Benchmarks/bench_layout.py --files 1000000 --dir /mnt/scratch
+
+For each layout, creates --files empty blob files in a scratch directory
+(on the file system to measure; --dir) in --steps steps, and after every
+step times creating the next batch, looking up blobs that exist and blobs
+that do not (the lookups of upload dedupe), one file system call each.
+Reports microseconds per operation against the number of files stored,
+then how long listing the whole store takes (what a sweep or a backup
+scan does).
+"""
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # make the project root importable
+
+from Server.blob_store import BlobStore
+
+SAMPLES = 2000  # operations timed after every step
+
+
+def digest(number):
+    return hashlib.sha256(number.to_bytes(8, "big")).hexdigest()
+
+
+def create(path):
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)  # as BlobStore.add does for a new fan-out directory
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    os.close(fd)
+
+
+def timed(operation, numbers):
+    started = time.perf_counter()
+    for number in numbers:
+        operation(number)
+    return (time.perf_counter() - started) / len(numbers) * 1e6
+
+
+def run_layout(layout, args, directory):
+    root = os.path.join(directory, layout)
+    store = BlobStore(root, lambda digest: True)
+    place = store.flat_path if layout == "flat" else store.path
+    rng = random.Random(1)
+    stored = 0
+    step = args.files // args.steps
+    print(f"{layout}:")
+    print(f"{'files':>10} {'create us':>10} {'hit us':>8} {'miss us':>8}")
+    for _ in range(args.steps):
+        for number in range(stored, stored + step - SAMPLES):
+            create(place(digest(number)))
+        batch = range(stored + step - SAMPLES, stored + step)
+        create_us = timed(lambda number: create(place(digest(number))), batch)
+        stored += step
+        hit_us = timed(lambda number: os.path.exists(place(digest(number))),
+                       [rng.randrange(stored) for _ in range(SAMPLES)])
+        miss_us = timed(lambda number: os.path.exists(place(digest(number))),
+                        [args.files + rng.randrange(stored) for _ in range(SAMPLES)])
+        print(f"{stored:>10} {create_us:10.1f} {hit_us:8.1f} {miss_us:8.1f}")
+    started = time.perf_counter()
+    listed = sum(1 for entry in store._entries(root, 2))
+    print(f"listing {listed} files took {time.perf_counter() - started:.2f} s")
+    shutil.rmtree(root)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=200000, help="blob files stored at the end")
+    parser.add_argument("--steps", type=int, default=5, help="measurements as the store fills up")
+    parser.add_argument("--dir", default=None, help="scratch directory on the file system to measure")
+    args = parser.parse_args(argv)
+    if args.files // args.steps <= SAMPLES:
+        parser.error(f"--files must be more than {SAMPLES} per step")
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        for layout in ("flat", "sharded"):
+            run_layout(layout, args, directory)
+
+
+if __name__ == "__main__":
+    main()
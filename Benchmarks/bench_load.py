@@ -0,0 +1,409 @@
+"""
+Load test for the file server: many scripted clients running a mixed workload.
+
+    python Benchmarks/bench_load.py --clients 32 --duration 20 --save-baseline local
+    python Benchmarks/bench_load.py --clients 32 --duration 20 --compare local
+
+Starts Server/server.py headless on localhost (with its metrics endpoint)
+and runs --clients clients, spread over --processes client processes, for
+--duration seconds. Every client loops: it picks an operation by the --mix
+weights (upload=3,download=5,list=1,delete=1 means 30% uploads, ...), runs
+it and records its latency. Uploads pick a file size by the --sizes
+weights and download, delete and list work on the client's own files.
+Uploaded content repeats (one random file per size), so identical chunks
+end up as one blob, but every byte is still received, hashed, written and
+synced by the server.
+
+Reports per operation the count, errors, p50/p99 latency and throughput;
+for the server its CPU time and peak memory, in total and per connection,
+and the request latencies it measured itself (from /metrics.json); and the
+CPU the client processes used.
+
+To see how the server scales over cores, compare runs with --server-args
+"--workers N": the server's CPU and memory then include its workers, and
+the server-side latencies are those of worker 0.
+
+--save-baseline NAME stores the results in Benchmarks/baselines/NAME.json.
+--compare NAME prints every figure next to that baseline and exits with 1
+if any of them is worse by more than --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # make the project root importable
+
+from Client.client_core import AsyncClient, ServerError
+from Common.protocol import ProtocolError
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+SERVER_SCRIPT = os.path.join(os.path.dirname(BENCHMARKS), "Server", "server.py")
+BASELINE_DIRECTORY = os.path.join(BENCHMARKS, "baselines")
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+OPERATIONS = ("upload", "download", "list", "delete")
+RSS_SAMPLE_INTERVAL = 0.25  # seconds between samples of the server's memory
+LIST_LIMIT = 100  # files per LIST request
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def parse_weights(text, parse_key=str):
+    """
+    Parses "key=weight,key=weight" into {key: weight}.
+    """
+    weights = {}
+    for item in text.split(","):
+        key, _, weight = item.partition("=")
+        weights[parse_key(key)] = float(weight or 1)
+    return weights
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile of ``values`` (sorted), or None if there are none.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, round(q * len(values)) - 1))]
+
+
+def process_stats(pid):
+    """
+    Returns (CPU seconds, resident MiB) of a process and its descendants (the
+    worker processes of a server started with --workers), from /proc; (None,
+    None) elsewhere.
+    """
+    cpu_ticks = resident_pages = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/stat") as file:
+                fields = file.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{current}/statm") as file:
+                pages = int(file.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            if current == pid:
+                return None, None
+            continue  # exited meanwhile
+        cpu_ticks += int(fields[11]) + int(fields[12])
+        resident_pages += pages
+        try:
+            with open(f"/proc/{current}/task/{current}/children") as file:
+                pending += [int(child) for child in file.read().split()]
+        except OSError:
+            pass
+    return cpu_ticks / os.sysconf("SC_CLK_TCK"), resident_pages * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+
+
+# ------------------------------------------------------------------ clients (in worker processes)
+
+async def run_client(index, args, files, directory, barrier, deadline_holder):
+    """
+    Runs one scripted client until the deadline. Returns {operation: [latencies, errors, bytes]}.
+    """
+    rng = random.Random(args.seed * 100003 + index)
+    operations, weights = list(args.mix), list(args.mix.values())
+    sizes, size_weights = list(args.sizes), list(args.sizes.values())
+    results = {operation: [[], 0, 0] for operation in OPERATIONS}
+    save_directory = os.path.join(directory, f"client{index}")
+    os.makedirs(save_directory, exist_ok=True)
+    client = AsyncClient("127.0.0.1", args.port, f"load{index}", notification_port=args.notification_port,
+                         compression=args.compression)
+    await client.connect()
+    own = []  # (remote name, size) of this client's stored files
+    uploads = 0
+    try:
+        await barrier()
+        deadline = deadline_holder[0]
+        while time.time() < deadline:
+            operation = rng.choices(operations, weights)[0]
+            if operation in ("download", "delete") and not own:
+                operation = "upload"  # nothing stored yet
+            moved = 0
+            started = time.perf_counter()
+            try:
+                if operation == "upload":
+                    size = rng.choices(sizes, size_weights)[0]
+                    name = f"file{uploads}.bin"
+                    uploads += 1
+                    await client.upload(files[size], remote_name=name, dedupe=False)
+                    own.append((name, size))
+                    moved = size
+                elif operation == "download":
+                    name, size = rng.choice(own)
+                    os.remove(await client.download(f"{client.username}_{name}", save_directory, resume=False))
+                    moved = size
+                elif operation == "list":
+                    await client.list_page(owner=client.username, limit=LIST_LIMIT)
+                else:
+                    name, size = own.pop(rng.randrange(len(own)))
+                    await client.delete(f"{client.username}_{name}")
+            except (OSError, ServerError, ProtocolError):
+                results[operation][1] += 1
+                if not client.connected:
+                    break
+                continue
+            results[operation][0].append(time.perf_counter() - started)
+            results[operation][2] += moved
+    finally:
+        await client.disconnect()
+    return results
+
+
+def client_process(args, indexes, files, directory, barrier, start_time, output):
+    """
+    Worker process: runs the clients ``indexes`` on one event loop and puts their merged results on ``output``.
+    """
+    async def main():
+        loop = asyncio.get_running_loop()
+        deadline = [None]
+        connected = asyncio.Event()
+        waiting = [len(indexes)]
+
+        async def wait_for_start():
+            waiting[0] -= 1
+            if not waiting[0]:  # every client of this process is connected: join the other processes
+                await loop.run_in_executor(None, barrier.wait)
+                deadline[0] = start_time.value + args.duration
+                connected.set()
+            await connected.wait()
+
+        return await asyncio.gather(*(run_client(index, args, files, directory, wait_for_start, deadline)
+                                      for index in indexes))
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime
+    merged = {operation: [[], 0, 0] for operation in OPERATIONS}
+    for results in asyncio.run(main()):
+        for operation, (latencies, errors, moved) in results.items():
+            merged[operation][0] += latencies
+            merged[operation][1] += errors
+            merged[operation][2] += moved
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    output.put({"operations": merged, "cpu_seconds": usage.ru_utime + usage.ru_stime - cpu,
+                "max_rss_mb": usage.ru_maxrss / 1024})  # ru_maxrss is in KiB on Linux
+
+
+# ------------------------------------------------------------------ driver
+
+def run(args):
+    """
+    Runs the load test and returns its results as a JSON-ready dict.
+    """
+    args.port, args.notification_port, metrics_port = free_port(), free_port(), free_port()
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        files = {}
+        for size in args.sizes:
+            files[size] = os.path.join(directory, f"data{size}.bin")
+            with open(files[size], "wb") as file:
+                for offset in range(0, size, 1 << 20):
+                    file.write(os.urandom(min(1 << 20, size - offset)))
+
+        command = [sys.executable, SERVER_SCRIPT, "--port", str(args.port), "--notification-port",
+                   str(args.notification_port), "--storage", os.path.join(directory, "storage"),
+                   "--metrics-port", str(metrics_port)] + args.server_args
+        server = subprocess.Popen(command, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            time.sleep(1)
+            idle_cpu, idle_rss = process_stats(server.pid)
+
+            context = multiprocessing.get_context("spawn")  # no inherited event loop or sockets
+            barrier = context.Barrier(args.processes + 1)
+            start_time = context.Value("d", 0.0)
+            output = context.Queue()
+            workers = [context.Process(target=client_process, args=(args, list(range(index, args.clients,
+                                                                                      args.processes)),
+                                                                   files, directory, barrier, start_time, output))
+                       for index in range(args.processes)]
+            for worker in workers:
+                worker.start()
+            barrier.wait(timeout=60)  # every client is connected
+            start_time.value = started = time.time()
+            start_cpu, connected_rss = process_stats(server.pid)
+            peak_rss = connected_rss
+            while time.time() < started + args.duration:
+                time.sleep(RSS_SAMPLE_INTERVAL)
+                cpu, rss = process_stats(server.pid)
+                if rss is not None:
+                    peak_rss = max(peak_rss, rss)
+            reports = [output.get(timeout=args.duration + 600) for _ in workers]
+            elapsed = time.time() - started  # includes the operations still running at the deadline
+            end_cpu, rss = process_stats(server.pid)
+            for worker in workers:
+                worker.join()
+            with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics.json") as response:
+                metrics = json.load(response)
+        finally:
+            server.terminate()
+            server.wait()
+
+    results = {"config": {"clients": args.clients, "processes": args.processes, "duration": args.duration,
+                          "mix": args.mix, "sizes": {str(size): weight for size, weight in args.sizes.items()},
+                          "compression": args.compression, "server_args": args.server_args, "seed": args.seed},
+               "elapsed": elapsed, "operations": {}}
+    total_count = total_bytes = 0
+    for operation in OPERATIONS:
+        latencies = sorted(latency for report in reports for latency in report["operations"][operation][0])
+        errors = sum(report["operations"][operation][1] for report in reports)
+        moved = sum(report["operations"][operation][2] for report in reports)
+        total_count += len(latencies)
+        total_bytes += moved
+        results["operations"][operation] = {
+            "count": len(latencies), "errors": errors, "ops_per_s": len(latencies) / elapsed,
+            "mb_per_s": moved / elapsed / 1e6,
+            "p50_ms": None if not latencies else percentile(latencies, 0.5) * 1000,
+            "p99_ms": None if not latencies else percentile(latencies, 0.99) * 1000}
+    results["total"] = {"ops_per_s": total_count / elapsed, "mb_per_s": total_bytes / elapsed / 1e6}
+    if start_cpu is not None:
+        results["server"] = {"cpu_seconds": end_cpu - start_cpu, "cpu_percent": (end_cpu - start_cpu) / elapsed * 100,
+                             "cpu_ms_per_op": (end_cpu - start_cpu) * 1000 / max(1, total_count),
+                             "cpu_ms_per_connection_s": (end_cpu - start_cpu) * 1000 / elapsed / args.clients,
+                             "rss_mb_idle": idle_rss, "rss_mb_peak": peak_rss,
+                             "rss_kb_per_connection": (connected_rss - idle_rss) * 1024 / args.clients}
+    client_cpu = sum(report["cpu_seconds"] for report in reports)
+    results["clients"] = {"cpu_seconds": client_cpu, "cpu_ms_per_connection_s": client_cpu * 1000 / elapsed / args.clients,
+                          "rss_mb_peak_per_process": max(report["max_rss_mb"] for report in reports)}
+    results["server_latency"] = {}
+    for sample in metrics.get("fileserver_request_seconds", {}).get("values", ()):
+        if sample["count"]:
+            results["server_latency"][sample["labels"]["command"]] = {
+                "count": sample["count"], "p50_ms": sample["p50"] * 1000, "p99_ms": sample["p99"] * 1000}
+    return results
+
+
+def report(results):
+    config = results["config"]
+    print(f"{config['clients']} clients in {config['processes']} processes for {results['elapsed']:.1f} s, "
+          f"mix {config['mix']}, sizes {config['sizes']}")
+    print(f"{'operation':10} {'count':>7} {'errors':>6} {'ops/s':>8} {'MB/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for operation, figures in results["operations"].items():
+        print(f"{operation:10} {figures['count']:7} {figures['errors']:6} {figures['ops_per_s']:8.1f} "
+              f"{figures['mb_per_s']:8.1f} {_ms(figures['p50_ms'])} {_ms(figures['p99_ms'])}")
+    print(f"{'total':10} {'':7} {'':6} {results['total']['ops_per_s']:8.1f} {results['total']['mb_per_s']:8.1f}")
+    server = results.get("server")
+    if server:
+        print(f"server: {server['cpu_percent']:.0f}% CPU, {server['cpu_ms_per_op']:.2f} ms CPU per operation, "
+              f"{server['cpu_ms_per_connection_s']:.1f} ms CPU per connection-second; RSS {server['rss_mb_idle']:.0f} "
+              f"MiB idle, {server['rss_mb_peak']:.0f} MiB peak, {server['rss_kb_per_connection']:.0f} KiB per "
+              f"connection")
+    clients = results["clients"]
+    print(f"clients: {clients['cpu_seconds']:.1f} CPU s, {clients['cpu_ms_per_connection_s']:.1f} ms CPU per "
+          f"connection-second, {clients['rss_mb_peak_per_process']:.0f} MiB peak per process")
+    for command, figures in sorted(results["server_latency"].items()):
+        print(f"server-side {command:12} {figures['count']:7} requests, p50 {figures['p50_ms']:.1f} ms, "
+              f"p99 {figures['p99_ms']:.1f} ms")
+
+
+def figures(results):
+    """
+    Flattens the comparable figures: name -> (value, True if higher is better).
+    """
+    flat = {}
+    for operation, values in results["operations"].items():
+        for key in ("ops_per_s", "mb_per_s"):
+            if operation in ("upload", "download") or key == "ops_per_s":
+                flat[f"{operation}.{key}"] = (values[key], True)
+        for key in ("p50_ms", "p99_ms"):
+            flat[f"{operation}.{key}"] = (values[key], False)
+    flat["total.ops_per_s"] = (results["total"]["ops_per_s"], True)
+    flat["total.mb_per_s"] = (results["total"]["mb_per_s"], True)
+    for key in ("cpu_ms_per_op", "rss_mb_peak", "rss_kb_per_connection"):
+        if key in results.get("server", {}):
+            flat[f"server.{key}"] = (results["server"][key], False)
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the results next to a baseline. Returns the names of the figures that regressed.
+    """
+    if baseline["config"] != results["config"]:
+        print("warning: the baseline was run with a different configuration:", baseline["config"])
+    current, previous = figures(results), figures(baseline)
+    regressions = []
+    print(f"{'figure':28} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, (value, higher_is_better) in current.items():
+        old = previous.get(name, (None,))[0]
+        if value is None or not old:
+            continue
+        change = value / old - 1
+        worse = -change if higher_is_better else change
+        flag = "  REGRESSION" if worse > tolerance else ""
+        if flag:
+            regressions.append(name)
+        print(f"{name:28} {old:10.2f} {value:10.2f} {change:+8.1%}{flag}")
+    return regressions
+
+
+def _ms(value):
+    return f"{value:8.1f}" if value is not None else f"{'-':>8}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="client processes the clients are spread over (default: up to the CPU count)")
+    parser.add_argument("--duration", type=float, default=15, help="seconds of load")
+    parser.add_argument("--mix", default="upload=3,download=5,list=1,delete=1", help="operation weights")
+    parser.add_argument("--sizes", default="16K=5,256K=3,4M=2,32M=0.2", help="upload file sizes and their weights")
+    parser.add_argument("--compression", default="", help="codecs the clients offer, comma separated")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the clients' random choices")
+    parser.add_argument("--server-args", default="", help="extra Server/server.py options, space separated")
+    parser.add_argument("--dir", default=None, help="scratch directory for the server's storage and test files")
+    parser.add_argument("--save-baseline", metavar="NAME", help="store the results as a baseline")
+    parser.add_argument("--compare", metavar="NAME", help="compare the results with a stored baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative change that counts as a regression")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON instead of tables")
+    args = parser.parse_args(argv)
+    args.mix = {operation: weight for operation, weight in parse_weights(args.mix).items() if weight}
+    if not set(args.mix) <= set(OPERATIONS):
+        parser.error(f"--mix operations are {', '.join(OPERATIONS)}")
+    args.sizes = parse_weights(args.sizes, parse_size)
+    args.compression = [codec for codec in args.compression.split(",") if codec]
+    args.server_args = args.server_args.split()
+    args.processes = max(1, min(args.clients, args.processes or os.cpu_count() or 1))
+
+    baseline = None
+    if args.compare:
+        with open(os.path.join(BASELINE_DIRECTORY, args.compare + ".json")) as file:
+            baseline = json.load(file)
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIRECTORY, exist_ok=True)
+        path = os.path.join(BASELINE_DIRECTORY, args.save_baseline + ".json")
+        with open(path, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"baseline saved to {path}")
+    if baseline is not None and compare(results, baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
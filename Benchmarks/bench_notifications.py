@@ -0,0 +1,147 @@
+"""
+Measures notification fan-out: one server, many subscribers, a stream of uploads.
+
+    python Benchmarks/bench_notifications.py --subscribers 10000 --events 50
+
+Starts Server/server.py in a subprocess, opens --subscribers notification
+connections subscribed to "uploads" (a --stalled fraction of them never
+read) and uploads --events small files. Every upload is published to all
+subscribers. Reports how long the uploads took (publishing must not wait
+for subscribers), deliveries per second and the delivery latency from
+publish to receipt.
+"""
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # make the project root importable
+
+from Client.client_core import AsyncClient
+from Common import protocol
+from Common.transport import AsyncConnection
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Server", "server.py")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float("nan")
+
+
+async def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def subscribe(loop, port, index):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    await loop.sock_connect(sock, ("127.0.0.1", port))
+    conn = AsyncConnection(loop, sock)
+    await conn.send_message(protocol.SUBSCRIBE, {"username": f"sub{index}", "topics": ["uploads"]})
+    opcode, reply = await conn.read_message()
+    if opcode != protocol.OK:
+        raise RuntimeError(reply.get("message"))
+    return conn
+
+
+async def receive(conn, expected, latencies, stats):
+    while stats["received"] < stats["target"]:
+        opcode, fields = await conn.read_message()
+        if opcode != protocol.NOTIFY:
+            continue
+        if fields.get("event") == "dropped":
+            stats["dropped"] += fields["count"]
+            continue
+        latencies.append(time.time() - fields["time"])
+        stats["received"] += fields.get("count", 1)
+        expected -= fields.get("count", 1)
+        if expected <= 0:
+            return
+
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    port, notification_port = free_port(), free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        server = subprocess.Popen([sys.executable, SERVER_SCRIPT, "--port", str(port), "--notification-port",
+                                   str(notification_port), "--storage", os.path.join(directory, "storage")],
+                                  cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        connections = []
+        try:
+            await wait_for_port(port)
+            started = time.perf_counter()
+            for first in range(0, args.subscribers, args.connect_batch):
+                batch = range(first, min(first + args.connect_batch, args.subscribers))
+                connections += await asyncio.gather(*(subscribe(loop, notification_port, i) for i in batch))
+            print(f"subscribed {len(connections)} in {time.perf_counter() - started:.2f}s")
+
+            stalled = int(len(connections) * args.stalled)
+            readers = connections[stalled:]
+            latencies = []
+            stats = {"received": 0, "dropped": 0, "target": len(readers) * args.events}
+            receivers = [loop.create_task(receive(conn, args.events, latencies, stats)) for conn in readers]
+
+            payload = os.path.join(directory, "event.txt")
+            with open(payload, "w") as file:
+                file.write("x")
+            client = AsyncClient("127.0.0.1", port, "publisher")
+            await client.connect()
+            started = time.perf_counter()
+            for index in range(args.events):
+                await client.upload(payload, f"file{index}.txt", dedupe=False)
+            upload_time = time.perf_counter() - started
+            done, pending = await asyncio.wait(receivers, timeout=args.timeout)
+            delivery_time = time.perf_counter() - started
+            for task in pending:
+                task.cancel()
+            await client.disconnect()
+
+            latencies.sort()
+            print(f"{args.events} uploads in {upload_time:.2f}s ({args.events / upload_time:.1f}/s), "
+                  f"{stalled} stalled subscribers")
+            print(f"delivered {stats['received']} of {stats['target']} notifications in {delivery_time:.2f}s "
+                  f"({stats['received'] / delivery_time:,.0f}/s), dropped {stats['dropped']}")
+            print(f"latency p50 {percentile(latencies, 0.5) * 1000:.1f} ms  p99 {percentile(latencies, 0.99) * 1000:.1f} ms"
+                  f"  max {(latencies[-1] if latencies else float('nan')) * 1000:.1f} ms")
+        finally:
+            for conn in connections:
+                conn.close()
+            server.terminate()
+            server.wait()
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            print(f"server CPU {usage.ru_utime + usage.ru_stime:.2f}s, "
+                  f"benchmark CPU {time.process_time():.2f}s (subscribers are read in this process)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--subscribers", type=int, default=10000)
+    parser.add_argument("--events", type=int, default=50, help="uploads, each published to every subscriber")
+    parser.add_argument("--stalled", type=float, default=0.1, help="fraction of subscribers that never read")
+    parser.add_argument("--connect-batch", type=int, default=500, help="subscriptions opened concurrently")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for deliveries")
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
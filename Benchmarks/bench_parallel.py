@@ -0,0 +1,133 @@
+"""
+Measures parallel multi-connection transfers of one large file.
+
+    python Benchmarks/bench_parallel.py --size 256M --per-connection-mbit 100 --link-mbit 800
+
+A single TCP connection over a long fat path is limited by its window, not
+by the link. The benchmark emulates that with a proxy in front of the
+server that caps every connection at --per-connection-mbit and all of them
+together at --link-mbit. It uploads and downloads the same file with 1, 2,
+4 and 8 connections and with the autotuner, and reports the throughput and,
+for the autotuner, the connection count it settled on.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # make the project root importable
+
+from Client.client_core import AsyncClient
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Server", "server.py")
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Path:
+    """
+    TCP proxy that limits every connection to ``connection_rate`` and all
+    connections together to ``link_rate`` bytes per second, in each direction.
+    """
+
+    def __init__(self, upstream_port, connection_rate, link_rate):
+        self.upstream_port = upstream_port
+        self.connection_rate = connection_rate
+        self.link_rate = link_rate
+        self.link_free = {"up": 0.0, "down": 0.0}  # when the shared link can take the next byte
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _handle(self, client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection("127.0.0.1", self.upstream_port)
+        try:
+            await asyncio.gather(self._pump(client_reader, server_writer, "up"),
+                                 self._pump(server_reader, client_writer, "down"), return_exceptions=True)
+        except asyncio.CancelledError:
+            pass  # the benchmark is over
+
+    async def _pump(self, reader, writer, direction):
+        free = 0.0  # when this connection can take the next byte
+        try:
+            while True:
+                data = await reader.read(64 << 10)
+                if not data:
+                    break
+                now = time.perf_counter()
+                free = max(free, now) + len(data) / self.connection_rate
+                self.link_free[direction] = max(self.link_free[direction], now) + len(data) / self.link_rate
+                delay = max(free, self.link_free[direction]) - now
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                writer.write(data)
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+async def run(args):
+    port, notification_port = free_port(), free_port()
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        server = subprocess.Popen([sys.executable, SERVER_SCRIPT, "--port", str(port), "--notification-port",
+                                   str(notification_port), "--storage", os.path.join(directory, "storage")],
+                                  cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            await asyncio.sleep(1)
+            path = Path(port, args.per_connection_mbit * 1e6 / 8, args.link_mbit * 1e6 / 8)
+            path_port = await path.start()
+            source = os.path.join(directory, "source.bin")
+            with open(source, "wb") as file:
+                for offset in range(0, args.size, 1 << 20):
+                    file.write(os.urandom(min(1 << 20, args.size - offset)))
+            print(f"{args.size >> 20} MiB, {args.per_connection_mbit} Mbit/s per connection, "
+                  f"{args.link_mbit} Mbit/s link")
+            print(f"{'connections':12} {'upload MB/s':>12} {'download MB/s':>14}")
+            for parallel in [1, 2, 4, 8, True]:
+                client = AsyncClient("127.0.0.1", path_port, f"user{parallel}", compression=[])
+                await client.connect()
+                started = time.perf_counter()
+                await client.upload(source, dedupe=False, parallel=parallel)
+                upload = args.size / (time.perf_counter() - started) / 1e6
+                up_level = client.parallel_level
+                started = time.perf_counter()
+                downloaded = await client.download(f"user{parallel}_source.bin", directory, resume=False,
+                                                   parallel=parallel)
+                download = args.size / (time.perf_counter() - started) / 1e6
+                os.remove(downloaded)
+                label = f"auto ({up_level}/{client.parallel_level})" if parallel is True else str(parallel)
+                print(f"{label:12} {upload:12.1f} {download:14.1f}")
+                await client.disconnect()
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=parse_size, default=parse_size("256M"), help="bytes of the test file")
+    parser.add_argument("--per-connection-mbit", type=float, default=100, help="throughput cap of one connection")
+    parser.add_argument("--link-mbit", type=float, default=800, help="throughput cap of all connections together")
+    parser.add_argument("--dir", default=None, help="scratch directory for the test file")
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
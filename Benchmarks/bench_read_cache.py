@@ -0,0 +1,129 @@
+"""
+Measures the server's read cache under a herd of downloads of one file.
+
+    python Benchmarks/bench_read_cache.py --size 64M --clients 16 --compress-at-rest zlib
+
+Starts Server/server.py in a subprocess once with the read cache off and
+once with it on, uploads a compressible file, then has --clients clients
+download it at the same time, --rounds times over. Reports the aggregate
+download throughput, the latency of the slowest download of a round and
+the cache statistics the server logs when it shuts down.
+"""
+import argparse
+import asyncio
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # make the project root importable
+
+from Client.client_core import AsyncClient
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Server", "server.py")
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+STATS_LINE = re.compile(r"Read cache: (\d+) hits, (\d+) misses \(([\d.]+)% hit ratio\), (\d+) coalesced, (\d+) loads")
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def write_test_file(path, size):
+    """
+    Writes ``size`` bytes of log-like text, half random so it compresses about as well as real logs.
+    """
+    with open(path, "wb") as file:
+        line = 0
+        while file.tell() < size:
+            block = b"".join(b"%d 2024-01-01T00:00:00 INFO request id=%s\n" % (line + i, os.urandom(12).hex().encode())
+                             for i in range(4096))
+            file.write(block[:size - file.tell()])
+            line += 4096
+
+
+async def herd(port, notification_port, path, directory, clients, rounds):
+    """
+    Returns (seconds of every round, slowest download of every round).
+    """
+    uploader = AsyncClient("127.0.0.1", port, "owner", notification_port=notification_port, compression=[])
+    await uploader.connect()
+    await uploader.upload(path, dedupe=False)
+    await uploader.disconnect()
+    herd_clients = [AsyncClient("127.0.0.1", port, f"reader{index}", notification_port=notification_port,
+                                compression=[]) for index in range(clients)]
+    await asyncio.gather(*(client.connect() for client in herd_clients))
+    rounds_seconds, slowest = [], []
+    try:
+        for _ in range(rounds):
+            started = time.perf_counter()
+
+            async def download(index, client):
+                save_directory = os.path.join(directory, str(index))
+                os.makedirs(save_directory, exist_ok=True)
+                os.remove(await client.download(f"owner_{os.path.basename(path)}", save_directory, resume=False))
+                return time.perf_counter() - started
+
+            latencies = await asyncio.gather(*(download(index, client) for index, client in enumerate(herd_clients)))
+            rounds_seconds.append(time.perf_counter() - started)
+            slowest.append(max(latencies))
+    finally:
+        await asyncio.gather(*(client.disconnect() for client in herd_clients))
+    return rounds_seconds, slowest
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        path = os.path.join(directory, "hot.log")
+        write_test_file(path, args.size)
+        print(f"{args.size >> 20} MiB file, {args.clients} clients, {args.rounds} rounds, "
+              f"stored {args.compress_at_rest or 'uncompressed'}")
+        print(f"{'cache':>6} {'MB/s':>8} {'slowest s':>9} {'hit ratio':>9} {'loads':>6} {'coalesced':>9}")
+        for cache_mb in (0, args.cache_mb):
+            port, notification_port = free_port(), free_port()
+            command = [sys.executable, SERVER_SCRIPT, "--port", str(port), "--notification-port",
+                       str(notification_port), "--storage", os.path.join(directory, f"storage{cache_mb}"),
+                       "--read-cache-mb", str(cache_mb)]
+            if args.compress_at_rest:
+                command += ["--compress-at-rest", args.compress_at_rest]
+            server = subprocess.Popen(command, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                      text=True)
+            try:
+                await asyncio.sleep(1)
+                rounds_seconds, slowest = await herd(port, notification_port, path, directory, args.clients,
+                                                     args.rounds)
+            finally:
+                server.terminate()
+                _, log = server.communicate()
+            stats = STATS_LINE.search(log)
+            hit_ratio, loads, coalesced = (f"{stats.group(3)}%", stats.group(5), stats.group(4)) if stats else ("?",) * 3
+            throughput = args.size * args.clients * args.rounds / sum(rounds_seconds) / 1e6
+            print(f"{f'{cache_mb}M' if cache_mb else 'off':>6} {throughput:8.1f} {max(slowest):9.2f} {hit_ratio:>9} "
+                  f"{loads:>6} {coalesced:>9}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=parse_size, default=parse_size("64M"), help="bytes of the hot file")
+    parser.add_argument("--clients", type=int, default=16, help="clients downloading the file at the same time")
+    parser.add_argument("--rounds", type=int, default=3, help="times every client downloads the file")
+    parser.add_argument("--cache-mb", type=int, default=128, help="read cache size of the cached run")
+    parser.add_argument("--compress-at-rest", default=None, help="codec the server stores blobs with")
+    parser.add_argument("--dir", default=None, help="scratch directory for the test files")
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Measures replication to read-only replicas and reads spread over them, all on localhost.
+
+    python Benchmarks/bench_replication.py --replicas 2 --files 500 --size 256K --clients 8
+
+Starts a primary Server/server.py and --replicas replicas of it, uploads
+--files files of --size bytes to the primary and reports how long the
+replicas take to catch up with them, then how long a small upload takes to
+become visible on every replica (replication lag). Finally --clients
+clients at once download all the files, first from the primary alone and
+then spread over the replicas, and reports the throughput of each.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # make the project root importable
+
+from Benchmarks.bench_bundle import SERVER_SCRIPT, free_port, parse_size
+from Client import batch
+from Client.client_core import AsyncClient
+
+LAG_SAMPLES = 20
+
+
+def start_server(directory, name, replica_of=None):
+    port, notification_port = free_port(), free_port()
+    command = [sys.executable, SERVER_SCRIPT, "--port", str(port), "--notification-port", str(notification_port),
+               "--storage", os.path.join(directory, name)]
+    if replica_of is not None:
+        command += ["--replica-of", f"127.0.0.1:{replica_of}"]
+    process = subprocess.Popen(command, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return process, port, notification_port
+
+
+async def connected(port, notification_port, username, **options):
+    client = AsyncClient("127.0.0.1", port, username, notification_port=notification_port, compression=[], **options)
+    await client.connect()
+    return client
+
+
+async def wait_for(replicas, name):
+    """
+    Returns once every replica lists ``name``.
+    """
+    for replica in replicas:
+        while not (await replica.list_page(prefix=name))[0]:
+            await asyncio.sleep(0.001)
+
+
+async def read_all(port, notification_port, replicas, names, directory, args):
+    clients = [await connected(port, notification_port, f"reader{index}", replicas=replicas,
+                               connections=args.concurrency) for index in range(args.clients)]
+    started = time.perf_counter()
+    results = await asyncio.gather(*(batch.download_many(client, names, os.path.join(directory, f"reader{index}"),
+                                                         args.concurrency)
+                                     for index, client in enumerate(clients)))
+    elapsed = time.perf_counter() - started
+    for client in clients:
+        await client.disconnect()
+    failed = sum(not result.ok for client_results in results for result in client_results)
+    files = len(names) * args.clients
+    return elapsed, files / elapsed, files * args.size / elapsed / 1e6, failed
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        processes = []
+        try:
+            primary, port, notification_port = start_server(directory, "primary")
+            processes.append(primary)
+            replica_ports = []
+            for index in range(args.replicas):
+                process, replica_port, _ = start_server(directory, f"replica{index}", replica_of=port)
+                processes.append(process)
+                replica_ports.append(replica_port)
+            await asyncio.sleep(1.5)
+
+            writer = await connected(port, notification_port, "bench")
+            paths = []
+            for index in range(args.files):
+                path = os.path.join(directory, f"file{index:05}.bin")
+                with open(path, "wb") as file:
+                    file.write(os.urandom(args.size))
+                paths.append(path)
+            names = [f"bench_{os.path.basename(path)}" for path in paths]
+            replicas = [await connected(replica_port, notification_port, "bench") for replica_port in replica_ports]
+            started = time.perf_counter()
+            await batch.upload_many(writer, paths, args.concurrency)
+            uploaded = time.perf_counter() - started
+            await wait_for(replicas, names[-1])
+            print(f"{args.files} files of {args.size} bytes uploaded in {uploaded:.2f} s; {args.replicas} replicas "
+                  f"caught up {time.perf_counter() - started - uploaded:.2f} s later")
+
+            lags = []
+            path = os.path.join(directory, "lag.bin")
+            for sample in range(LAG_SAMPLES):
+                with open(path, "wb") as file:
+                    file.write(os.urandom(4096))
+                await writer.upload(path, f"lag{sample}.bin")
+                committed = time.perf_counter()
+                await wait_for(replicas, f"bench_lag{sample}.bin")
+                lags.append(time.perf_counter() - committed)
+            print(f"replication lag of a 4 KiB upload: median {statistics.median(lags) * 1000:.1f} ms, "
+                  f"max {max(lags) * 1000:.1f} ms")
+            for client in [writer] + replicas:
+                await client.disconnect()
+
+            print(f"{args.clients} clients downloading every file, {args.concurrency} at a time each:")
+            print(f"{'read from':24} {'seconds':>8} {'files/s':>9} {'MB/s':>8} {'failed':>7}")
+            addresses = [("127.0.0.1", replica_port) for replica_port in replica_ports]
+            for label, spread in (("primary", []), (f"{args.replicas} replicas", addresses)):
+                elapsed, files_per_second, megabytes, failed = await read_all(
+                    port, notification_port, spread, names, os.path.join(directory, label), args)
+                print(f"{label:24} {elapsed:8.2f} {files_per_second:9.0f} {megabytes:8.1f} {failed:>7}")
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replicas", type=int, default=2, help="replicas of the primary")
+    parser.add_argument("--files", type=int, default=200, help="files uploaded and read")
+    parser.add_argument("--size", type=parse_size, default=parse_size("256K"), help="bytes per file")
+    parser.add_argument("--clients", type=int, default=8, help="clients reading at once")
+    parser.add_argument("--concurrency", type=int, default=batch.DEFAULT_CONCURRENCY, help="files in flight per client")
+    parser.add_argument("--dir", default=None, help="scratch directory for the servers and files")
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Measures what re-uploading an edited file costs with and without delta transfer.
+
+    python Benchmarks/bench_sync.py --size 64M
+
+Starts Server/server.py in a subprocess, and for every kind of edit
+(bytes inserted near the start, small overwrites scattered over the file,
+data appended) uploads the original file, edits a copy and uploads that
+over it: sending every chunk, sending only the chunks the server lacks
+(dedupe) and sending those as a delta against the stored copy. Reports the
+bytes that crossed the wire (from the server's metrics) and the time.
+Compression is off, so the bytes reflect the transfer method alone.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # make the project root importable
+
+from Client.client_core import AsyncClient
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Server", "server.py")
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+MODES = {"whole": {"dedupe": False}, "dedupe": {"dedupe": True}, "delta": {"dedupe": True, "delta": True}}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def edit(source, target, kind, rng):
+    """
+    Writes an edited copy of ``source`` to ``target``.
+    """
+    with open(source, "rb") as file:
+        data = bytearray(file.read())
+    if kind == "insert":
+        data[4096:4096] = os.urandom(100)
+    elif kind == "scatter":
+        for _ in range(10):
+            position = rng.randrange(len(data) - 100)
+            data[position:position + 100] = os.urandom(100)
+    else:
+        data += os.urandom(100_000)
+    with open(target, "wb") as file:
+        file.write(data)
+
+
+def received_bytes(metrics_port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics.json") as response:
+        values = json.load(response)["fileserver_bytes_total"]["values"]
+    return sum(value["value"] for value in values if value["labels"]["direction"] == "received")
+
+
+async def run(args):
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        original = os.path.join(directory, "original.bin")
+        with open(original, "wb") as file:
+            file.write(os.urandom(args.size))
+        port, notification_port, metrics_port = free_port(), free_port(), free_port()
+        server = subprocess.Popen([sys.executable, SERVER_SCRIPT, "--port", str(port), "--notification-port",
+                                   str(notification_port), "--storage", os.path.join(directory, "storage"),
+                                   "--metrics-port", str(metrics_port)], cwd=directory, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL)
+        client = AsyncClient("127.0.0.1", port, "bench", notification_port=notification_port, compression=[])
+        try:
+            await asyncio.sleep(1)
+            await client.connect()
+            print(f"{args.size >> 20} MiB file of random data")
+            print(f"{'edit':>8} {'mode':>7} {'wire MB':>9} {'seconds':>8}")
+            for kind in ("insert", "scatter", "append"):
+                edited = os.path.join(directory, f"{kind}.bin")
+                edit(original, edited, kind, rng)
+                for mode, options in MODES.items():
+                    name = f"{kind}-{mode}.bin"
+                    await client.upload(original, name, dedupe=False)
+                    before = received_bytes(metrics_port)
+                    started = time.perf_counter()
+                    await client.upload(edited, name, **options)
+                    elapsed = time.perf_counter() - started
+                    sent = received_bytes(metrics_port) - before
+                    print(f"{kind:>8} {mode:>7} {sent / 1e6:9.3f} {elapsed:8.2f}")
+                    await client.delete(f"bench_{name}")
+        finally:
+            await client.disconnect()
+            server.terminate()
+            server.wait()
+        shutil.rmtree(os.path.join(directory, "storage"), ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=parse_size, default=parse_size("64M"), help="bytes of the test file")
+    parser.add_argument("--dir", default=None, help="scratch directory for the test files")
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
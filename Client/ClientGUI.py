@@ -1,54 +1,37 @@
 import tkinter as tk  # import the tkinter library for creating the GUI.
 from tkinter import messagebox, filedialog  # import specific modules for pop-up dialogs and file selection.
-import socket  # import the socket library to enable TCP/IP communication.
 import threading  # import the threading library to handle operations without blocking the GUI.
 import os  # for file system operations.
-import json  # for encoding and decoding JSON data.
+import sys  # to make the project root importable.
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Client.cache import DownloadCache  # copies of downloaded files, revalidated with the server.
+from Client.client_core import ServerError, SyncClient  # multiplexed connection to the server.
 
 # client variables
-client_socket = None  # main socket for communication with the server.
+client = None  # connection to the server; uploads, downloads and lists can run on it at the same time.
 server_address = None  # storing server's IP address and port.
 username = None  # the username provided by the client.
 connected = False  # to track the connection status.
-notification_socket = None  # to handle real-time notifications from the server.
 
 
 def connect_notification_socket():
     """
-    connects the client to the server's notification socket to listen
+    subscribes to notifications about the client's own files and logs them in the GUI
     """
-    global notification_socket
     try:
-        ip, _ = server_address  # extract the IP address from the server_address
-        notification_socket = socket.socket(socket.AF_INET,
-                                            socket.SOCK_STREAM)  # create a new TCP socket for notifications
-        notification_socket.connect((ip, 9001))  # connect to the server's notification port (9001)
-        threading.Thread(target=listen_for_notifications,
-                         daemon=True).start()  # start a thread to listen for notifications
-        notification_socket.sendall(username.encode())  # send the username to the server for identification
+        client.subscribe(["my-files"], on_notification=lambda notification: log_message(notification["message"]))
     except Exception as e:
         messagebox.showerror("Error",
                              f"Failed to connect to notification socket: {e}")  # if the connection fails, display an error message
 
 
-def listen_for_notifications():
-    """
-    listens for notifications from the server and logs them to the GUI.
-    """
-    while True:
-        try:
-            notification_message = notification_socket.recv(
-                1024).decode()  # receive a notification message from the server.
-            log_message(notification_message)  # log the received message in the GUI.
-        except:
-            break  # Exit the loop if the notification socket is closed.
-
-
 def connect_to_server():
     """
     Establishes a connection to the server and sends the username based on connection
     """
-    global client_socket, server_address, username, connected
+    global client, server_address, username, connected
     try:
         ip = ip_entry.get().strip()  # get the server's IP address from the GUI input
         port = port_entry.get().strip()  # get the server's port from the GUI input
@@ -63,17 +46,18 @@ def connect_to_server():
             messagebox.showerror("Error", "Port must be a valid number.")  # if the port is invalid, error occurs.
             return
 
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # create a new TCP socket for communication.
         server_address = (ip, int(port))  # create a tuple of the server's IP and port.
-        client_socket.connect(server_address)  # establish a connection to the server using the socket.
-        client_socket.sendall(username_input.encode())  # Send the username to the server for identification.
-        response = client_socket.recv(1024).decode()  # receiving of the server's response.
-
-        # check for errors in response.
-        if "ERROR" in response:
-            messagebox.showerror("Error", response)  # show an error if the server rejects the connection.
-            client_socket.close()  # Closing the connection if connection is rejected
+        client = SyncClient(ip, int(port), username_input, on_disconnect=server_disconnected,
+                            cache=DownloadCache())  # a file downloaded again unchanged is copied from the cache
+        try:
+            client.connect()  # connect and send the username to the server for identification.
+        except ServerError as e:
+            messagebox.showerror("Error", f"ERROR: {e}")  # the server rejected the connection.
+            client.close()  # Closing the connection if connection is rejected
             return
+        except Exception:
+            client.close()  # stop the client's event loop before reporting the failure
+            raise
 
         username = username_input  # set the username, if the connection is successful
         connected = True  # Since it is connected now, connect variable became True
@@ -88,6 +72,13 @@ def connect_to_server():
                              f"Failed to connect to server: {str(e)}")  # display an error message if the connection fails.
 
 
+def server_disconnected(message):
+    """
+    Called when the server closes the session (e.g. the server is stopping).
+    """
+    log_message(f"Server: {message}")
+
+
 def upload_file_thread():
     """
     Starts a thread to upload file in GUI.
@@ -99,11 +90,10 @@ def disconnect_from_server():
     """
     Disconnects the client from the server
     """
-    global client_socket, connected
+    global connected
     try:
         if connected:  # Check if the client is connected to the server.
-            client_socket.sendall("DISCONNECT".encode())  # notify the server about disconnection.
-            client_socket.close()  # Close the socket connection.
+            client.close()  # notify the server about disconnection and close the connection.
             connected = False  # Update the connection status as false since it is disconnecting from the server
             log_message("Disconnected from server.")  # log the disconnection in the GUI.
             connect_button.config(state="normal")
@@ -118,38 +108,19 @@ def upload_file():
     """
     try:
         file_path = filedialog.askopenfilename(title="Select File to Upload")  # it opens a file selection
-        print(file_path)
         if not file_path:  # Check if the user canceled the file selection.
             log_message("No file selected for upload.")
             return
 
-        filename = os.path.basename(file_path)  # it extracts the filename
-        client_socket.sendall("UPLOAD".encode())  # notifies the server about the upload.
-
-        client_socket.sendall(filename.encode())  # Send the filename to the server
-        print(filename, file_path)
-
-        # Handle the server's acknowledgment.
-        ack = client_socket.recv(1024).decode()
-        print(ack)
-        if ack == "Override":
+        result = client.upload(file_path)  # runs on its own stream, other transfers can continue meanwhile
+        if result["status"] == "Override":
             log_message(
                 "The existing file was overwritten.")  # logging a message if the server overwrites an existing file.
-        elif ack == "New":
-            log_message("New file saved.")  # Log if the server saves a new file.
+        elif result["status"] == "Unchanged":
+            log_message("The server already has this file.")  # identical checksum, nothing was sent
         else:
-            log_message(
-                "Error: Unexpected server response.")  # logging an error message for unexpected server responses
-            return
-        print("ok0")
-        with open(file_path, "rb") as file:  # Open the selected file in binary read mode, to analyze the file
-            while chunk := file.read(4096):  # it reads the file in chunks of 4096 bytes.
-                client_socket.sendall(chunk)  # Send each chunk to the server.
-        print("ok1")
-        client_socket.sendall(b"EOFe")  # lastly it sends an end-of-file marker to the server.
-
-        log_message(client_socket.recv(1024).decode())  # log the server's response after the upload is complete
-        print("ok2")
+            log_message("New file saved.")  # Log if the server saves a new file.
+        log_message(result["message"])  # log the server's response after the upload is complete
     except Exception as e:
         log_message(
             f"Error during file upload: {e}")  # logging any error message if error occurs during the file upload.
@@ -164,9 +135,7 @@ def request_file_list():
             messagebox.showerror("Error", "You must connect to a server first.")
             return
 
-        client_socket.sendall("LIST".encode())  # send a command to request the file list from the server.
-        response = client_socket.recv(4096).decode()  # it receives the server's response containing the file list
-        file_list = json.loads(response)  # Decode the JSON-encoded file list
+        file_list = client.list_files()  # it receives the server's response containing the file list
         log_message(f"Available files: {file_list}")  # Log the available files
     except Exception as e:
         log_message(
@@ -178,7 +147,7 @@ def download_file():
     Downloads a file from the server to the client's local machine.
     """
     try:
-        if not connected or client_socket is None:  # it ensures the client is connected.
+        if not connected or client is None:  # it ensures the client is connected.
             messagebox.showerror("Error", "You must connect to the server first.")
             return
 
@@ -193,28 +162,15 @@ def download_file():
             log_message("Download canceled by user.")
             return
 
-        client_socket.sendall("DOWNLOAD".encode())  # notification of the server about the download request
-        client_socket.sendall(filename.encode())  # Send the filename to the server.
-
-        response = client_socket.recv(1024).decode()  # it receives the server's acknowledgment.
-        if response != "FILENAME RECEIVED":  # check if the server acknowledges the filename
-            log_message(f"Error: {response}")  ###logging any error message if error occurs during the file upload
-            return
-
-        file_path = os.path.join(save_path, filename)  # file_path variable, full path, for saving the downloaded file
-        with open(file_path, "wb") as file:  # it opens the file in binary write mode.
-            while True:
-                data = client_socket.recv(4096)  # it again receives file data in chunks
-                if data.endswith(b"EOFe"):  # it checks for the end-of-file marker
-                    file.write(data[:-4])  # it writes the data excluding the EOF marker
-                    break
-                file.write(data)  # write the received data to the file
-
+        file_path = client.download(filename, save_path)  # it receives the file into the selected directory
         log_message(f"File '{filename}' downloaded successfully to '{file_path}'.")  # it logs the successful download.
+    except ServerError as e:
+        log_message(f"Error: {e}")  # logging any error message sent by the server
     except Exception as e:
         log_message(
             f"Error during file download: {str(e)}")  ##logging any error message if error occurs during the file upload
 
+
 def download_file_thread():
     """
     Starts a thread to handle the file download operation
@@ -237,11 +193,7 @@ def delete_file():
             messagebox.showerror("Error", "Filename must be provided.")
             return
 
-        client_socket.sendall("DELETE".encode())  # it notifies the server about the delete request
-        client_socket.sendall(filename.encode())  # it sends the filename to the server
-
-        response = client_socket.recv(1024).decode()  # it receives the server's response.
-        log_message(response)  # logging of the server's response
+        log_message(client.delete(filename))  # logging of the server's response
     except Exception as e:
         log_message(f"Error during file deletion: {str(e)}")  # Log any error that occurs during the operation.
 
@@ -0,0 +1,291 @@
+"""
+Batch operations for scripts and the command line client.
+
+upload_many(), download_many() and delete_many() run one operation per
+item with up to ``concurrency`` of them in flight on one AsyncClient. The
+requests are pipelined over the client's multiplexed connection(s): a
+new request goes out while earlier ones are still transferring, and with
+``AsyncClient(connections=N)`` they are spread over N connections of the
+session. Items are taken from the input lazily, so a batch of tens of
+thousands of files never has more than ``concurrency`` of them open.
+
+With ``bundle``, uploads of small files and downloads go out in bundles
+(see Common/protocol.py): up to BUNDLE_FILES files in one request, and for
+uploads one catalog transaction, so tens of thousands of tiny files are
+not limited by round trips. A bundle is retried as a whole, and every file
+in it still gets its own BatchResult.
+
+Failures that are likely to pass (a lost connection, data corrupted in
+transit, a server at its transfer limit) are retried with exponential backoff; if the session itself was
+lost the client reconnects first. Every item ends in a BatchResult and one
+failure never stops the batch.
+"""
+import asyncio
+import fnmatch
+import glob
+import os
+import random
+import time
+
+from Client.client_core import ServerBusy, ServerError
+from Common import protocol
+from Common.chunks import CHUNK_SIZE
+
+DEFAULT_CONCURRENCY = 16  # operations in flight at once
+BUNDLE_FILES = 256  # files per bundle; fewer, larger bundles save round trips but leave less to run in parallel
+BUNDLE_FILE_SIZE = CHUNK_SIZE  # larger files are uploaded on their own
+BUNDLE_BYTES = 32 << 20  # bytes of files in one upload bundle, which the client holds in memory
+RETRYABLE = (ConnectionError, asyncio.TimeoutError, protocol.ProtocolError, ServerBusy)  # worth another attempt
+
+
+class RetryPolicy:
+    """
+    How often and how patiently an operation is retried: attempt n waits
+    ``base_delay * 2**(n-1)`` seconds (at most ``max_delay``), with up to
+    ``jitter`` of that added at random so a batch does not retry in lockstep.
+    """
+
+    def __init__(self, attempts=4, base_delay=0.5, max_delay=15.0, jitter=0.5):
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * (1 + random.uniform(0, self.jitter))
+
+
+class BatchResult:
+    """
+    Outcome of one item of a batch: ``value`` is what the operation
+    returned, or ``error`` the exception of its last attempt.
+    """
+
+    __slots__ = ("item", "value", "error", "attempts", "seconds")
+
+    def __init__(self, item, value=None, error=None, attempts=1, seconds=0.0):
+        self.item = item
+        self.value = value
+        self.error = error
+        self.attempts = attempts
+        self.seconds = seconds
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        outcome = f"error={self.error!r}" if self.error is not None else f"value={self.value!r}"
+        return f"BatchResult({self.item!r}, {outcome}, attempts={self.attempts})"
+
+
+async def with_retries(client, operation, policy=None):
+    """
+    Returns ``await operation()``, retrying after RETRYABLE errors until the
+    policy's attempts are used up. Reconnects ``client`` before an attempt
+    if its connection was lost. A ServerError (the server refused) is not
+    retried, unless it is ServerBusy.
+    """
+    policy = policy or RetryPolicy()
+    attempt = 1
+    while True:
+        try:
+            if not client.connected:
+                await client.disconnect()  # stop the old connection's tasks before opening a new one
+                try:
+                    await client.connect()
+                except ServerError as e:
+                    raise ConnectionError(f"reconnecting failed: {e}")  # e.g. the old session is not gone yet
+            return await operation()
+        except RETRYABLE:
+            if attempt >= policy.attempts:
+                raise
+        await asyncio.sleep(policy.delay(attempt))
+        attempt += 1
+
+
+async def connect(client, policy=None):
+    """
+    Connects ``client``, retrying with backoff like with_retries() (e.g. while
+    the server still holds a session of the username that was just lost).
+    """
+    await with_retries(client, lambda: asyncio.sleep(0), policy)
+
+
+async def run_batch(client, items, operation, concurrency=DEFAULT_CONCURRENCY, retry=None, on_result=None):
+    """
+    Runs ``await operation(item)`` for every item, ``concurrency`` at a
+    time, with retries. ``on_result(result)`` is called as each item
+    finishes. Returns the BatchResults in the order the items finished.
+    """
+    iterator = iter(items)
+    results = []
+
+    async def worker():
+        for item in iterator:  # shared by the workers: each item is taken once
+            started = time.perf_counter()
+            attempts = 0
+
+            async def attempt():
+                nonlocal attempts
+                attempts += 1
+                return await operation(item)
+
+            try:
+                result = BatchResult(item, value=await with_retries(client, attempt, retry))
+            except Exception as e:  # one item's failure, whatever it is, must not end the batch
+                result = BatchResult(item, error=e)
+            result.attempts = attempts
+            result.seconds = time.perf_counter() - started
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    return results
+
+
+async def run_bundled(client, items, operation, bundle_operation, concurrency=DEFAULT_CONCURRENCY, retry=None,
+                      on_result=None):
+    """
+    run_batch() over items some of which are bundles (lists of items):
+    ``await bundle_operation(bundle)`` returns the value of each of its
+    items, or an exception for an item that failed on its own. Returns,
+    and passes to ``on_result``, one BatchResult per item either way.
+    """
+    results = []
+
+    def unbundle(result):
+        if not isinstance(result.item, list):
+            values = [(result.item, result.value, result.error)]
+        elif not result.ok:
+            values = [(item, None, result.error) for item in result.item]
+        else:
+            values = [(item, None, value) if isinstance(value, Exception) else (item, value, None)
+                      for item, value in zip(result.item, result.value)]
+        for item, value, error in values:
+            results.append(BatchResult(item, value, error, result.attempts, result.seconds))
+            if on_result is not None:
+                on_result(results[-1])
+
+    async def run(item):
+        return await (bundle_operation(item) if isinstance(item, list) else operation(item))
+
+    await run_batch(client, items, run, concurrency, retry, unbundle)
+    return results
+
+
+def upload_bundles(paths, files=BUNDLE_FILES, size=BUNDLE_BYTES):
+    """
+    Yields the items of ``paths`` with the files of at most BUNDLE_FILE_SIZE
+    grouped into bundles of up to ``files`` files and ``size`` bytes.
+    """
+    bundle, bundle_size = [], 0
+    for item in paths:
+        try:
+            file_size = os.path.getsize(item[0] if isinstance(item, tuple) else item)
+        except OSError:
+            file_size = None
+        if file_size is None or file_size > BUNDLE_FILE_SIZE:
+            yield item  # on its own; a file that cannot be read fails alone, not its bundle
+            continue
+        if len(bundle) >= files or bundle_size + file_size > size:
+            yield bundle
+            bundle, bundle_size = [], 0
+        bundle.append(item)
+        bundle_size += file_size
+    if bundle:
+        yield bundle
+
+
+async def upload_many(client, paths, concurrency=DEFAULT_CONCURRENCY, retry=None, on_result=None, dedupe=True,
+                      parallel=False, bundle=False):
+    """
+    Uploads local files, each under its base name. ``paths`` may be any
+    iterable (e.g. a generator from expand_paths()); items are file paths or
+    (file path, remote name) pairs. With ``bundle``, small files are sent in
+    bundles; the remote names of a bundle must differ.
+    """
+    async def upload(item):
+        path, remote_name = item if isinstance(item, tuple) else (item, None)
+        return await client.upload(path, remote_name, dedupe=dedupe, parallel=parallel)
+
+    if bundle:
+        return await run_bundled(client, upload_bundles(paths), upload, client.upload_bundle, concurrency, retry,
+                                 on_result)
+    return await run_batch(client, paths, upload, concurrency, retry, on_result)
+
+
+async def download_many(client, filenames, save_directory, concurrency=DEFAULT_CONCURRENCY, retry=None,
+                        on_result=None, parallel=False, bundle=False):
+    """
+    Downloads files by their server names into ``save_directory``. A retry
+    resumes from what the failed attempt had already written. With
+    ``bundle``, files are requested BUNDLE_FILES at a time, without resuming
+    or ``parallel``.
+    """
+    os.makedirs(save_directory, exist_ok=True)
+
+    async def download(filename):
+        return await client.download(filename, save_directory, resume=True, parallel=parallel)
+
+    async def download_bundle(names):
+        return [ServerError(result["error"]) if "error" in result else result["path"]
+                for result in await client.download_bundle(names, save_directory)]
+
+    if bundle:
+        filenames = list(filenames)
+        bundles = [filenames[start:start + BUNDLE_FILES] for start in range(0, len(filenames), BUNDLE_FILES)]
+        return await run_bundled(client, bundles, download, download_bundle, concurrency, retry, on_result)
+    return await run_batch(client, filenames, download, concurrency, retry, on_result)
+
+
+async def delete_many(client, filenames, concurrency=DEFAULT_CONCURRENCY, retry=None, on_result=None):
+    """
+    Deletes files by their server names (only the client's own files can be deleted).
+    """
+    return await run_batch(client, filenames, client.delete, concurrency, retry, on_result)
+
+
+def expand_paths(patterns, recursive=False):
+    """
+    Yields the regular files that local ``patterns`` name: plain paths,
+    globs (``**`` matches directories at any depth) and directories, whose
+    files are included when ``recursive`` (otherwise a directory is
+    skipped). Each file is yielded once, in a stable order.
+    """
+    seen = set()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        for match in matches:
+            if os.path.isdir(match):
+                if not recursive:
+                    continue
+                for directory, subdirectories, files in os.walk(match):
+                    subdirectories.sort()
+                    for name in sorted(files):
+                        path = os.path.join(directory, name)
+                        if path not in seen and os.path.isfile(path):
+                            seen.add(path)
+                            yield path
+            elif match not in seen:
+                seen.add(match)
+                yield match  # a missing file is yielded too, so it shows up as a failed item
+
+
+async def match_remote(client, patterns, owner=None):
+    """
+    Returns the server names matching shell-style ``patterns`` (names
+    without wildcards are taken as they are), listing only the part of the
+    catalog each pattern's literal prefix allows.
+    """
+    names = []
+    for pattern in patterns:
+        if not glob.has_magic(pattern):
+            names.append(pattern)
+            continue
+        prefix = pattern[:min(pattern.find(c) for c in "*?[" if c in pattern)]
+        files = await client.list_files(owner=owner, prefix=prefix or None)
+        names += [entry["file"] for entry in files if fnmatch.fnmatchcase(entry["file"], pattern)]
+    return list(dict.fromkeys(names))
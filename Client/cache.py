@@ -0,0 +1,166 @@
+"""
+Persistent cache of downloaded files for the client.
+
+A DownloadCache keeps a copy of every file AsyncClient(cache=...)
+downloads, keyed by the server and the file's server name, with the
+version the server reported for it (its ETag: it changes whenever the
+content does) and its checksum. The next download of that file sends the
+version as "if_none_match"; if the server's copy is still the same, the
+server answers "Not Modified" without any data and the cached copy is
+copied into place, so a repeat fetch of an unchanged file costs one round
+trip and a local copy.
+
+The copies live in one directory with an SQLite index, so several clients
+and processes can share a cache. It holds at most ``max_bytes``: storing a
+copy evicts the least recently used ones until the rest fit. A copy whose
+size or modification time changed behind the cache's back is not trusted
+and is dropped.
+"""
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "fileserver")
+DEFAULT_CACHE_SIZE = 1 << 30  # bytes of cached copies
+INDEX_FILE = "index.db"  # inside the cache directory
+COPY_BUFFER_SIZE = 1 << 20  # bytes per read when a cached copy is copied out
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    checksum TEXT,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_by_used ON entries (used);
+"""
+
+
+class DownloadCache:
+    """
+    Copies of downloaded files in ``directory``, at most ``max_bytes`` of
+    them. Keys identify a server file ("host:port/name"). The methods block
+    on the disk (AsyncClient calls them in an executor) and may be called
+    from several threads at once.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, max_bytes=DEFAULT_CACHE_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0  # downloads answered from the cache after the server confirmed the version
+        self.misses = 0  # downloads the cache had no current copy for (stored afterwards)
+        self._lock = threading.Lock()  # one connection, shared by the threads
+        self.db = sqlite3.connect(os.path.join(directory, INDEX_FILE), isolation_level=None, check_same_thread=False,
+                                  timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def version(self, key):
+        """
+        Returns the version of the cached copy of ``key``, or None if there is no intact copy.
+        """
+        with self._lock:
+            row = self.db.execute("SELECT version, size, mtime_ns FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            stat = os.stat(self._path(key))
+        except OSError:
+            stat = None
+        if stat is None or (stat.st_size, stat.st_mtime_ns) != (row[1], row[2]):
+            self.discard(key)  # evicted by another process, or changed behind the cache's back
+            return None
+        return row[0]
+
+    def copy_to(self, key, version, destination):
+        """
+        Copies the cached copy of ``key`` to ``destination`` (replacing it
+        atomically) if it still has ``version``, and marks it used. Returns
+        False if it was evicted or replaced meanwhile.
+        """
+        with self._lock:
+            row = self.db.execute("SELECT size, mtime_ns FROM entries WHERE key = ? AND version = ?",
+                                  (key, version)).fetchone()
+        if row is None:
+            return False
+        temp_path = f"{destination}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(self._path(key), "rb") as source:
+                # store() replaces the file before it updates the row: only a file that is the row's copy will do,
+                # and once open it stays that copy however often it is replaced
+                stat = os.fstat(source.fileno())
+                if (stat.st_size, stat.st_mtime_ns) != tuple(row):
+                    return False
+                with open(temp_path, "wb") as target:
+                    shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+        except FileNotFoundError:
+            return False
+        with self._lock:
+            self.db.execute("UPDATE entries SET used = ? WHERE key = ? AND version = ?", (time.time(), key, version))
+        os.replace(temp_path, destination)
+        self.hits += 1
+        return True
+
+    def store(self, key, path, version, checksum=None):
+        """
+        Keeps a copy of the file at ``path`` as ``key`` at ``version`` and
+        evicts the least recently used copies over the cap. A file larger
+        than the whole cache is not kept.
+        """
+        self.misses += 1
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            self.discard(key)  # an older version must not be taken for this one
+            return
+        cached_path = self._path(key)
+        temp_path = f"{cached_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(path, temp_path)
+        os.replace(temp_path, cached_path)
+        stat = os.stat(cached_path)
+        with self._lock:
+            self.db.execute("INSERT OR REPLACE INTO entries (key, version, checksum, size, mtime_ns, used) "
+                            "VALUES (?, ?, ?, ?, ?, ?)", (key, version, checksum, size, stat.st_mtime_ns, time.time()))
+            self._evict()
+
+    def _evict(self):
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.db.execute("SELECT key, size FROM entries ORDER BY used").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._remove_quietly(self._path(key))
+            total -= size
+
+    def discard(self, key):
+        with self._lock:
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self._remove_quietly(self._path(key))
+
+    @staticmethod
+    def _remove_quietly(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def size(self):
+        """
+        Bytes of cached copies.
+        """
+        with self._lock:
+            return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
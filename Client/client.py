@@ -0,0 +1,217 @@
+"""
+Command line client for scripts and bulk transfers.
+
+    python Client/client.py --port 9000 --username alice upload 'photos/**/*.jpg' reports/ --recursive
+    python Client/client.py --port 9000 --username alice download 'bob_*.csv' --output inbox/
+    python Client/client.py --port 9000 --username alice list --owner bob
+    python Client/client.py --port 9000 --username alice delete 'alice_tmp-*'
+    python Client/client.py --port 9000 --username alice sync ~/reports --delete
+
+Local arguments of upload are paths, globs (quote them; ``**`` recurses)
+and, with --recursive, directories. Remote arguments of download and delete
+are server names or globs over them. Files are moved --concurrency at a
+time over --connections connections, and failed transfers are retried
+with backoff. The exit status is 1 if any file failed. With --bundle, small
+files are uploaded and files are downloaded many to a request (see
+Client/batch.py), which is much faster for large numbers of tiny files.
+With --cache, downloads keep a copy of every file (see Client/cache.py)
+and files that have not changed on the server since are copied from it.
+With --replica (once per replica of the server), downloads and listings
+are spread over the replicas.
+
+sync mirrors a directory (see Client/sync.py): files unchanged since the
+last sync are skipped without being read, changed files are sent as deltas
+against the server's copy, and --delete removes server files that are gone
+locally.
+
+The username must not be connected elsewhere (e.g. in the GUI) at the same time.
+"""
+import argparse
+import asyncio
+import fnmatch
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # make the project root importable
+
+from Client import batch
+from Client.cache import DEFAULT_CACHE_DIRECTORY, DEFAULT_CACHE_SIZE, DownloadCache
+from Client.client_core import DEFAULT_COMPRESSION, AsyncClient, ServerError
+from Client.sync import STATE_FILE, sync_directory
+from Common.protocol import DEFAULT_NOTIFICATION_PORT
+from Common.transport import parse_address
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1", help="server address")
+    parser.add_argument("--port", type=int, required=True, help="server port")
+    parser.add_argument("--notification-port", type=int, default=DEFAULT_NOTIFICATION_PORT,
+                        help="server notification port")
+    parser.add_argument("--username", required=True, help="name to connect as")
+    parser.add_argument("--replica", type=parse_address, action="append", default=[], metavar="HOST:PORT",
+                        help="read-only replica of the server to spread downloads and listings over (repeatable)")
+    parser.add_argument("--connections", type=int, default=4, help="connections the transfers are spread over")
+    parser.add_argument("--concurrency", type=int, default=batch.DEFAULT_CONCURRENCY, help="files in flight at once")
+    parser.add_argument("--retries", type=int, default=3, help="extra attempts for a file after a transient failure")
+    parser.add_argument("--parallel", type=int, default=0,
+                        help="connections per large file (0: one, as part of the batch)")
+    parser.add_argument("--no-compression", action="store_true", help="never compress transfers")
+    parser.add_argument("--no-verify", action="store_true", help="skip the client's end-to-end checksums")
+    parser.add_argument("--quiet", action="store_true", help="only print failures and the summary")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    upload = commands.add_parser("upload", help="upload local files")
+    upload.add_argument("paths", nargs="+", help="files, globs or (with --recursive) directories")
+    upload.add_argument("--recursive", "-r", action="store_true", help="upload the files inside directories")
+    upload.add_argument("--no-dedupe", action="store_true", help="send every chunk, even those the server has")
+    upload.add_argument("--bundle", action="store_true", help="send small files many to a request")
+
+    download = commands.add_parser("download", help="download files by server name or glob")
+    download.add_argument("names", nargs="+", help="server names or globs over them")
+    download.add_argument("--output", "-o", default=".", help="directory to save the files in")
+    download.add_argument("--owner", default=None, help="only match files of this user")
+    download.add_argument("--bundle", action="store_true", help="request files many at a time (no resuming)")
+    download.add_argument("--cache", default=None, help=f"download cache directory (e.g. {DEFAULT_CACHE_DIRECTORY})")
+    download.add_argument("--cache-mb", type=int, default=DEFAULT_CACHE_SIZE >> 20, help="size of the download cache")
+
+    listing = commands.add_parser("list", help="list stored files")
+    listing.add_argument("patterns", nargs="*", help="globs the names must match")
+    listing.add_argument("--owner", default=None, help="only files of this user")
+    listing.add_argument("--sort", choices=("name", "modified"), default="name")
+    listing.add_argument("--json", action="store_true", help="print one JSON object per file")
+
+    delete = commands.add_parser("delete", help="delete your own files by server name or glob")
+    delete.add_argument("names", nargs="+", help="server names or globs over them")
+
+    sync = commands.add_parser("sync", help="mirror a local directory to the server")
+    sync.add_argument("directory", help="directory to mirror")
+    sync.add_argument("--prefix", default=None, help="server names start with this (default: the directory's name)")
+    sync.add_argument("--delete", action="store_true", help="delete server files that are gone locally")
+    sync.add_argument("--no-delta", action="store_true", help="send changed chunks whole instead of as deltas")
+    sync.add_argument("--state", default=None, help=f"state index (default: DIRECTORY/{STATE_FILE})")
+    return parser.parse_args(argv)
+
+
+class Progress:
+    """
+    Prints one line per finished file and keeps the totals for the summary.
+    """
+
+    def __init__(self, verb, quiet=False):
+        self.verb = verb
+        self.quiet = quiet
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0  # files a sync found unchanged without reading them
+        self.bytes = 0
+        self.started = time.perf_counter()
+
+    def __call__(self, result):
+        item = result.item[0] if isinstance(result.item, tuple) else result.item
+        retried = f" after {result.attempts} attempts" if result.attempts > 1 else ""
+        if not result.ok:
+            self.failed += 1
+            print(f"FAILED {item}: {result.error}{retried}", file=sys.stderr)
+            return
+        status = result.value.get("status") if isinstance(result.value, dict) else None
+        if status == "Skipped":
+            self.skipped += 1
+            return
+        self.succeeded += 1
+        size = 0
+        if self.verb in ("uploaded", "downloaded", "synced") and status != "Deleted":
+            path = result.value if self.verb == "downloaded" else item
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.bytes += size
+        if not self.quiet:
+            detail = f" ({status})" if status else ""
+            if status and result.value.get("copied_bytes"):
+                detail = f" ({status}, {result.value['copied_bytes']} bytes reused from the server's copy)"
+            print(f"{self.verb} {item}{detail}{retried}")
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        skipped = f"{self.skipped} unchanged, " if self.skipped else ""
+        print(f"{self.succeeded} {self.verb}, {skipped}{self.failed} failed, {self.bytes / 1e6:.1f} MB in "
+              f"{elapsed:.1f} s ({self.bytes / 1e6 / max(elapsed, 1e-9):.1f} MB/s, "
+              f"{self.succeeded / max(elapsed, 1e-9):.1f} files/s)", file=sys.stderr)
+
+
+def unique_names(paths):
+    """
+    Pairs every path with its remote name; a second file with a name already used is reported and skipped.
+    """
+    used = {}
+    for path in paths:
+        name = os.path.basename(path)
+        if name in used:
+            print(f"SKIPPED {path}: '{name}' is already uploaded from {used[name]}", file=sys.stderr)
+            continue
+        used[name] = path
+        yield path, name
+
+
+async def run(args):
+    cache = DownloadCache(args.cache, args.cache_mb << 20) if getattr(args, "cache", None) else None
+    client = AsyncClient(args.host, args.port, args.username, notification_port=args.notification_port,
+                         compression=[] if args.no_compression else DEFAULT_COMPRESSION, verify=not args.no_verify,
+                         connections=args.connections, cache=cache, replicas=args.replica)
+    retry = batch.RetryPolicy(attempts=args.retries + 1)
+    parallel = args.parallel or False
+    await batch.connect(client, retry)
+    try:
+        if args.command == "list":
+            for entry in await client.list_files(owner=args.owner, sort=args.sort):
+                if args.patterns and not any(fnmatch.fnmatchcase(entry["file"], pattern) for pattern in args.patterns):
+                    continue
+                if args.json:
+                    print(json.dumps(entry))
+                else:
+                    modified = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["modified"]))
+                    print(f"{entry['size']:>14} {modified} {entry['file']}")
+            return 0
+        if args.command == "upload":
+            progress = Progress("uploaded", args.quiet)
+            await batch.upload_many(client, unique_names(batch.expand_paths(args.paths, args.recursive)),
+                                    args.concurrency, retry, progress, dedupe=not args.no_dedupe, parallel=parallel,
+                                    bundle=args.bundle)
+        elif args.command == "sync":
+            progress = Progress("synced", args.quiet)
+            await sync_directory(client, args.directory, args.prefix, args.concurrency, retry, progress,
+                                 delete=args.delete, delta=not args.no_delta, parallel=parallel,
+                                 state_path=args.state)
+        elif args.command == "download":
+            progress = Progress("downloaded", args.quiet)
+            names = await batch.match_remote(client, args.names, args.owner)
+            await batch.download_many(client, names, args.output, args.concurrency, retry, progress,
+                                      parallel=parallel, bundle=args.bundle)
+        else:
+            progress = Progress("deleted", args.quiet)
+            names = await batch.match_remote(client, args.names, args.username)
+            await batch.delete_many(client, names, args.concurrency, retry, progress)
+        progress.summary()
+        if cache is not None and not args.quiet:
+            print(f"{cache.hits} files from the download cache, {cache.misses} fetched", file=sys.stderr)
+        return 1 if progress.failed else 0
+    finally:
+        await client.disconnect()
+        if cache is not None:
+            cache.close()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        sys.exit(asyncio.run(run(args)))
+    except (OSError, ServerError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        sys.exit(2)
+    except KeyboardInterrupt:
+        sys.exit(130)
+
+
+if __name__ == "__main__":
+    main()
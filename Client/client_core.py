@@ -0,0 +1,1012 @@
+"""
+Client side of the file server protocol.
+
+AsyncClient keeps one multiplexed connection to the server. Every call opens
+its own stream, so uploads, downloads, LIST and DELETE can run concurrently
+(``asyncio.gather``) over the same socket. SyncClient runs an AsyncClient on
+a private event loop thread so blocking code such as the Tkinter GUI can
+call it from any thread.
+
+Transfers are compressed when both sides support a codec from the client's
+``compression`` list and the data compresses: the client samples files it
+uploads, the server samples files it sends.
+
+upload() and download() with ``parallel`` move one large file over several
+connections of the same session (see Client/parallel.py); the extra
+connections are opened on demand and reused. With ``connections`` above 1,
+ordinary requests are spread over that many connections of the session as
+well (each new request goes to the least busy one), which Client/batch.py
+uses to move many files at once.
+
+With a ``cache`` (Client/cache.py), download() keeps a copy of every file it
+fetches and later only asks the server whether that copy is still current.
+
+With ``replicas`` (addresses of read-only replicas of the server, see
+Server/replication.py), downloads and LISTs go to the replicas in turn
+while uploads and deletes go to the server. Every read names the client's
+latest change, so a replica answers it only once it has that change; a
+replica that is behind or unreachable is passed over for the server.
+"""
+import asyncio
+import hashlib
+import os
+import socket
+import threading
+
+from Client.parallel import ConcurrencyTuner, run_parallel, split_ranges
+from Common import compression, protocol
+from Common.chunks import CHUNK_SIZE, ChunkManifest, RangeWriter, chunk_digests, file_checksum, range_digest
+from Common.delta import MIN_DELTA_SIZE, SIGNATURE, SignatureIndex, block_size_for, chunk_blocks, encode_delta
+from Common.fileio import DEFAULT_BUFFER_SIZE, BufferPool, preallocate
+from Common.multiplex import Multiplexer, StreamCancelled
+from Common.transport import AsyncConnection
+
+MANIFEST_FLUSH_CHUNKS = 64  # save download progress every this many completed chunks
+DEFAULT_COMPRESSION = ("zlib",)  # codecs offered for transfers, in order of preference
+COMPRESS_BLOCK = CHUNK_SIZE  # bytes of a file compressed at a time during an upload; one chunk, hashed on the way
+
+
+class ServerError(Exception):
+    """
+    The server refused a request; the message is the server's explanation.
+    """
+
+
+class ServerBusy(ServerError):
+    """
+    The server is running as many transfers as it admits, or restarting the
+    worker process of this user; the request may succeed later.
+    """
+
+
+class ReplicaBehind(ServerError):
+    """
+    A replica has not applied the client's latest change yet; the primary has it.
+    """
+
+
+class BundleWriter:
+    """
+    Writes the data of a bundle download, the contents of ``files`` (the
+    server's entries for them) back to back, into a ``<name>.part`` file per
+    file, and moves each into place as soon as it is complete and matches
+    its checksum. Has the write() and remaining of a RangeWriter.
+    """
+
+    def __init__(self, files, save_directory, verify=True):
+        self.files = files
+        self.save_directory = save_directory
+        self.verify = verify
+        self.remaining = sum(entry["size"] for entry in files)
+        self.paths = {}  # server name -> local path of every file moved into place
+        self._position = -1  # index in files of the file being written
+        self._fd = None
+        self._writer = None
+        self._next_file()
+
+    def _part_path(self):
+        return os.path.join(self.save_directory, self.files[self._position]["file"]) + ".part"
+
+    def _next_file(self):
+        while self._position + 1 < len(self.files):
+            self._position += 1
+            entry = self.files[self._position]
+            manifest = ChunkManifest(entry["size"], source=entry["version"])
+            self._fd = os.open(self._part_path(), os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0),
+                               0o644)
+            preallocate(self._fd, entry["size"])
+            self._writer = RangeWriter(self._fd, [[0, entry["size"]]], manifest, self.verify)
+            if self._writer.remaining:
+                return
+            self._finish_file()  # empty: complete already
+
+    def _finish_file(self):
+        entry = self.files[self._position]
+        os.close(self._fd)
+        self._fd = None
+        part_path = self._part_path()
+        digests = self._writer.manifest.digests
+        if self.verify and entry.get("checksum") is not None and file_checksum(digests) != entry["checksum"]:
+            os.remove(part_path)
+            raise protocol.ProtocolError(f"'{entry['file']}' does not match its checksum; the data was corrupted")
+        file_path = part_path[:-len(".part")]
+        os.replace(part_path, file_path)
+        self.paths[entry["file"]] = file_path
+
+    def write(self, view):
+        """
+        Writes ``view`` and returns the number of newly completed chunks.
+        """
+        if len(view) > self.remaining:
+            raise ValueError("more data than the bundle's files")
+        completed = 0
+        while view:
+            count = min(len(view), self._writer.remaining)
+            completed += self._writer.write(view[:count])
+            view = view[count:]
+            self.remaining -= count
+            if not self._writer.remaining:
+                self._finish_file()
+                self._next_file()
+        return completed
+
+    def close(self):
+        """
+        Drops the file that was being written, if the download stopped short.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            os.remove(self._part_path())
+
+
+class AsyncClient:
+    """
+    Connection to one server for one username.
+    """
+
+    def __init__(self, host, port, username, buffer_size=DEFAULT_BUFFER_SIZE, on_disconnect=None,
+                 notification_port=protocol.DEFAULT_NOTIFICATION_PORT, compression=DEFAULT_COMPRESSION, verify=True,
+                 connections=1, cache=None, replicas=()):
+        self.host = host
+        self.port = port
+        self.notification_port = notification_port
+        self.username = username
+        self.on_disconnect = on_disconnect  # callback(message) when the server closes the session
+        self.compression = list(compression or ())  # codec names offered to the server; empty disables compression
+        self.verify = verify  # hash transfers for end-to-end checks; False saves the client's CPU on trusted links
+        self.connections = max(1, connections)  # connections of the session that requests are spread over
+        self.cache = cache  # Client/cache.py DownloadCache that download() revalidates copies in, or None
+        # clients of the same user on the read-only replicas; reads are spread over those connected
+        self.replicas = [AsyncClient(replica_host, replica_port, username, buffer_size,
+                                     notification_port=notification_port, compression=compression, verify=verify,
+                                     connections=connections) for replica_host, replica_port in replicas]
+        self.change = 0  # latest change of the server's log this client made; replicas must have it to serve a read
+        self.after_change = 0  # on a replica's client: the change its reads wait for
+        self._turn = 0  # next replica to read from
+        self.buffer_pool = BufferPool(buffer_size)
+        self.mux = None
+        self.session = None  # token from WELCOME that admits extra data connections
+        self.parallel_level = None  # connection count the tuner settled on last time
+        self._reader = None
+        self._listener = None  # task reading the notification connection
+        self._data_connections = []  # (multiplexer, reader task) of extra connections for parallel transfers
+        self._pool_lock = asyncio.Lock()
+
+    @property
+    def connected(self):
+        return self.mux is not None and not self.mux.closed
+
+    async def connect(self):
+        conn, response = await self._open_connection({"username": self.username})
+        self.session = response.get("session")
+        self.mux = Multiplexer(conn, self.buffer_pool, first_stream_id=1, on_control=self._on_control)
+        self._reader = asyncio.get_running_loop().create_task(self._read_frames(self.mux))
+        await asyncio.gather(*(self._connect_replica(replica) for replica in self.replicas))
+        return response.get("message")
+
+    @staticmethod
+    async def _connect_replica(replica):
+        try:
+            await replica.connect()
+        except (OSError, ServerError):
+            pass  # reads go to the others, or to the server
+
+    async def _open_connection(self, hello):
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # small requests must not wait for delayed ACKs
+        try:
+            await loop.sock_connect(sock, (self.host, self.port))
+            conn = AsyncConnection(loop, sock)
+            await conn.send_message(protocol.HELLO, hello)
+            opcode, response = await conn.read_message()
+        except BaseException:
+            sock.close()
+            raise
+        if opcode != protocol.WELCOME:
+            sock.close()
+            message = response.get("message", "connection rejected")
+            raise (ServerBusy if message.startswith("SERVER BUSY") else ServerError)(message)
+        return conn, response
+
+    @staticmethod
+    async def _read_frames(mux):
+        try:
+            await mux.run()
+        except (ConnectionError, protocol.ProtocolError):
+            pass  # pending calls fail with StreamCancelled
+        finally:
+            mux.conn.close()
+
+    async def _connection(self, slot):
+        """
+        Multiplexer for worker ``slot`` of a parallel transfer: the main
+        connection for slot 0, otherwise an extra connection of this session,
+        opened on first use.
+        """
+        if slot == 0:
+            return self.mux
+        async with self._pool_lock:
+            while len(self._data_connections) < slot:
+                self._data_connections.append(None)
+            if self._data_connections[slot - 1] is None or self._data_connections[slot - 1][0].closed:
+                conn, response = await self._open_connection({"username": self.username, "session": self.session})
+                mux = Multiplexer(conn, self.buffer_pool, first_stream_id=1)
+                self._data_connections[slot - 1] = (mux, asyncio.get_running_loop().create_task(self._read_frames(mux)))
+            return self._data_connections[slot - 1][0]
+
+    async def _pooled(self):
+        """
+        Multiplexer for a new request: the least busy of the first
+        ``connections`` connections, opening another one while every open
+        one already has requests in flight.
+        """
+        candidates = [self.mux] + [connection[0] if connection and not connection[0].closed else None
+                                   for connection in self._data_connections[:self.connections - 1]]
+        candidates += [None] * (self.connections - len(candidates))
+        slot = min((slot for slot, mux in enumerate(candidates) if mux is not None),
+                   key=lambda slot: len(candidates[slot].streams))
+        if candidates[slot].streams and None in candidates:
+            try:
+                return await self._connection(candidates.index(None))
+            except (OSError, ServerError):
+                pass  # the connections that are open will do
+        return candidates[slot]
+
+    def _tuner(self, parallel):
+        if parallel is True:
+            return ConcurrencyTuner(start=self.parallel_level or 1)
+        return ConcurrencyTuner(start=parallel, maximum=parallel)
+
+    def _on_control(self, opcode, fields):
+        if opcode == protocol.DISCONNECT and self.on_disconnect is not None:
+            self.on_disconnect(fields.get("message", "DISCONNECTING"))
+
+    async def disconnect(self):
+        for replica in self.replicas:
+            if replica.connected:
+                await replica.disconnect()
+        for mux in [self.mux] + [connection[0] for connection in self._data_connections if connection]:
+            if mux is not None and not mux.closed:
+                try:
+                    await mux.send_control(protocol.DISCONNECT)
+                except OSError:
+                    pass
+        readers = [connection[1] for connection in self._data_connections if connection]
+        self._data_connections = []
+        for task in (self._reader, self._listener, *readers):
+            if task is not None:
+                task.cancel()  # stop reading before the socket is closed underneath the loop
+                await asyncio.gather(task, return_exceptions=True)
+
+    async def subscribe(self, topics=("my-files",), on_notification=None):
+        """
+        Opens the notification connection and subscribes to ``topics``
+        ("my-files", "uploads", "deletes"). ``on_notification(fields)`` is
+        called for every notification; fields["message"] is a readable text.
+        """
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, (self.host, self.notification_port))
+            conn = AsyncConnection(loop, sock)
+            await conn.send_message(protocol.SUBSCRIBE, {"username": self.username, "topics": list(topics)})
+            opcode, reply = await conn.read_message()
+        except BaseException:
+            sock.close()
+            raise
+        if opcode != protocol.OK:
+            sock.close()
+            raise ServerError(reply.get("message", "subscription rejected"))
+        self._listener = loop.create_task(self._listen(conn, on_notification))
+        return reply.get("topics")
+
+    @staticmethod
+    async def _listen(conn, on_notification):
+        try:
+            while True:
+                opcode, fields = await conn.read_message()
+                if opcode == protocol.NOTIFY and on_notification is not None:
+                    on_notification(fields)
+        except (ConnectionError, protocol.ProtocolError):
+            pass
+        finally:
+            conn.close()
+
+    async def _request(self, opcode, fields, end=True, mux=None):
+        if self.mux is None or self.mux.closed:
+            raise ConnectionError("not connected to a server")
+        mux = mux or (self.mux if self.connections == 1 else await self._pooled())
+        if mux.closed:
+            raise ConnectionError("not connected to a server")
+        if self.after_change and opcode in (protocol.LIST, protocol.DOWNLOAD):
+            fields = dict(fields, after_change=self.after_change)
+        stream = mux.open_stream()
+        await stream.send_message(opcode, fields, end=end)
+        return stream
+
+    def _check(self, opcode, reply):
+        if opcode == protocol.ERROR:
+            message = reply.get("message", "request failed")
+            if message.startswith("REPLICA BEHIND"):
+                raise ReplicaBehind(message)
+            raise (ServerBusy if message.startswith("SERVER BUSY") else ServerError)(message)
+        if "change" in reply:
+            self.change = max(self.change, reply["change"])  # a write committed: later reads must see it
+        return reply
+
+    async def _read(self, operation):
+        """
+        Runs ``operation(client)`` on the client of the next connected replica,
+        or on this one if there is none or the replica cannot answer it (it
+        went away, or has not caught up with this client's changes).
+        """
+        connected = [replica for replica in self.replicas if replica.connected]
+        if connected:
+            replica = connected[self._turn % len(connected)]
+            self._turn += 1
+            replica.after_change = self.change
+            try:
+                return await operation(replica)
+            except (OSError, StreamCancelled, ReplicaBehind):
+                pass
+        return await operation(self)
+
+    # ------------------------------------------------------------------ requests
+
+    async def upload(self, file_path, remote_name=None, dedupe=True, parallel=False, delta=False):
+        """
+        Uploads a local file. Only the chunks the server is missing are sent:
+        those of an interrupted earlier upload of the same file and, with
+        ``dedupe``, any chunk whose content the server already stores.
+        The data is compressed on the wire if it compresses (see compression).
+        ``parallel`` spreads the data over several connections: a number of
+        connections, or True to let a ConcurrencyTuner choose.
+        ``delta`` (with ``dedupe``, not ``parallel``) sends the missing chunks
+        as a delta against the server's stored copy of the file, so content
+        that only moved, e.g. behind an insertion, is not sent again (see
+        Common/delta.py); files under MIN_DELTA_SIZE are sent as they are.
+
+        The server checks every chunk against its SHA-256: with ``dedupe``
+        the digests are announced up front (and a file whose checksum matches
+        the stored one is not sent at all); otherwise they are computed while
+        the data is sent and follow it in a TRAILER.
+        Returns {"status": "New"|"Override"|"Unchanged", "message": ..., "resumed_bytes": ...,
+        "deduplicated_bytes": ..., "copied_bytes": ..., "compression": codec or None, "checksum": ...}.
+        """
+        filename = remote_name or os.path.basename(file_path)
+        loop = asyncio.get_running_loop()
+        with open(file_path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            request = {"filename": filename, "size": stat.st_size, "source": f"{stat.st_size}:{stat.st_mtime_ns}"}
+            if dedupe:
+                request["chunks"] = await loop.run_in_executor(None, chunk_digests, file_path)
+                request["checksum"] = file_checksum(request["chunks"])
+                if delta and not parallel and stat.st_size >= MIN_DELTA_SIZE:
+                    request["delta"] = block_size_for(stat.st_size)
+            if self.compression and await loop.run_in_executor(None, self._compressible, file.fileno(), stat.st_size):
+                request["compression"] = self.compression
+            if parallel:
+                request["parallel"] = True
+            stream = await self._request(protocol.UPLOAD, request, end=False)
+            try:
+                opcode, flags, ack = await stream.receive_message()
+                self._check(opcode, ack)
+                if ack.get("status") == "Unchanged":
+                    return {"status": "Unchanged", "message": ack.get("message"), "resumed_bytes": 0,
+                            "deduplicated_bytes": 0, "copied_bytes": 0, "compression": None,
+                            "checksum": ack.get("checksum")}
+                missing = ack["missing"]
+                codec = ack.get("compression")
+                hashed = [] if self.verify and not dedupe else None  # hash the chunks as they go out instead
+                try:
+                    if ack.get("delta") is not None:
+                        index = await self._receive_signatures(stream, ack["delta"])
+                        await self._send_delta(stream, file, missing, index, stat.st_size, codec)
+                    elif ack.get("upload_id") is not None:
+                        await self._upload_parallel(stream, file, missing, codec, ack["upload_id"], parallel,
+                                                    hashed is not None)
+                    elif codec is not None:
+                        await self._send_compressed(stream, file, missing, codec, digests=hashed)
+                    else:
+                        await self._send_ranges(stream, file, missing, digests=hashed)
+                except StreamCancelled:
+                    pass  # the server gave up on the stream; its reason is waiting in the inbox
+                opcode, flags, reply = await stream.receive_message()
+                return {"status": ack.get("status"), "message": self._check(opcode, reply).get("message"),
+                        "resumed_bytes": ack.get("resumed_bytes", 0),
+                        "deduplicated_bytes": ack.get("deduplicated_bytes", 0),
+                        "copied_bytes": reply.get("copied_bytes", 0), "compression": codec,
+                        "checksum": reply.get("checksum")}
+            finally:
+                stream.close()
+
+    async def upload_bundle(self, files):
+        """
+        Uploads many small files in one request, each under its base name.
+        ``files`` are file paths or (file path, remote name) pairs, at most
+        protocol.MAX_BUNDLE_FILES of them. The files are read into memory, so
+        a bundle is meant for small files (Client/batch.py groups them). As
+        with upload(dedupe=True), chunks the server has and unchanged files
+        are not sent; the server stores all the files at once, or none.
+        Returns {"status", "deduplicated_bytes"} for each file, in order.
+        """
+        items = [item if isinstance(item, tuple) else (item, os.path.basename(item)) for item in files]
+        if not 0 < len(items) <= protocol.MAX_BUNDLE_FILES:
+            raise ValueError(f"a bundle holds 1 to {protocol.MAX_BUNDLE_FILES} files")
+
+        def read_files():
+            contents = []
+            for path, name in items:
+                with open(path, "rb") as file:
+                    contents.append(file.read())
+            return contents, [[hashlib.sha256(data[start:start + CHUNK_SIZE]).hexdigest()
+                               for start in range(0, len(data), CHUNK_SIZE)] for data in contents]
+
+        loop = asyncio.get_running_loop()
+        contents, digests = await loop.run_in_executor(None, read_files)
+        request = {"bundle": [{"filename": name, "size": len(data), "chunks": chunks}
+                              for (path, name), data, chunks in zip(items, contents, digests)]}
+        step = max(1, len(contents) // compression.SAMPLE_COUNT)
+        samples = [data[:compression.SAMPLE_SIZE] for data in contents[::step]]
+        if self.compression and await loop.run_in_executor(None, compression.compressible, samples):
+            request["compression"] = self.compression
+        stream = await self._request(protocol.UPLOAD, request, end=False)
+        try:
+            opcode, flags, ack = await stream.receive_message()
+            self._check(opcode, ack)
+            data = b"".join(contents[position][start:end] for position, entry in enumerate(ack["files"])
+                            for start, end in entry["missing"])
+            if ack.get("compression"):
+                data = await loop.run_in_executor(None, compression.compress, ack["compression"], data)
+            try:
+                await stream.send_data(data, end=True)
+            except StreamCancelled:
+                pass  # the server gave up on the stream; its reason is waiting in the inbox
+            opcode, flags, reply = await stream.receive_message()
+            self._check(opcode, reply)
+            return [{"status": entry["status"], "deduplicated_bytes": 0 if entry["status"] == "Unchanged"
+                     else len(data) - sum(end - start for start, end in entry["missing"])}
+                    for entry, data in zip(ack["files"], contents)]
+        finally:
+            stream.close()
+
+    async def _upload_parallel(self, stream, file, missing, codec, upload_id, parallel, trailers):
+        """
+        Sends the missing ranges as part streams spread over the session's
+        connections, then ends the upload's own stream so the server commits.
+        """
+        tuner = self._tuner(parallel)
+
+        async def transfer(slot, part, progress):
+            part_stream = await self._request(protocol.UPLOAD, {"upload_id": upload_id, "ranges": [part]}, end=False,
+                                              mux=await self._connection(slot))
+            hashed = [] if trailers else None
+            try:
+                try:
+                    if codec is not None:
+                        await self._send_compressed(part_stream, file, [part], codec, progress, hashed)
+                    else:
+                        await self._send_ranges(part_stream, file, [part], progress, hashed)
+                except StreamCancelled:
+                    pass  # the reason is waiting in the inbox
+                opcode, flags, reply = await part_stream.receive_message()
+                self._check(opcode, reply)
+            finally:
+                part_stream.close()
+
+        try:
+            await run_parallel(split_ranges(missing), transfer, tuner)
+        except BaseException as e:
+            if stream.cancelled:
+                raise  # the server ended the upload; its reason is waiting on the stream
+            await stream.cancel()  # the server keeps the parts that arrived for a resume
+            if isinstance(e, StreamCancelled):
+                raise ConnectionError(f"part of the upload was abandoned: {e}") from None
+            raise
+        if parallel is True:
+            self.parallel_level = tuner.best_level
+        await stream.send_data(b"", end=True)
+
+    @staticmethod
+    async def _receive_signatures(stream, base):
+        """
+        Reads the block signatures of the server's stored copy (of its chunks
+        the new version does not reuse) that follow the OK of a delta upload
+        and returns them indexed for the scanner.
+        """
+        block_size, size = base["block_size"], base["size"]
+        blocks = chunk_blocks(base["chunks"], base["chunk_size"], block_size, size)
+        expected = len(blocks) * SIGNATURE.size
+        signatures = bytearray()
+        while len(signatures) < expected:
+            opcode, flags, piece = await stream.receive()
+            if opcode != protocol.DATA or flags & protocol.FLAG_END_STREAM:
+                raise StreamCancelled("the server ended the upload")  # its reason is waiting in the inbox
+            signatures += piece
+            stream.consumed(piece)
+        if len(signatures) != expected:
+            raise protocol.ProtocolError("the server sent more block signatures than its file has blocks")
+        return await asyncio.get_running_loop().run_in_executor(None, SignatureIndex, bytes(signatures), block_size,
+                                                                size, blocks)
+
+    @staticmethod
+    async def _send_delta(stream, file, ranges, index, size, codec):
+        """
+        Sends the byte ranges of ``file`` as a delta against ``index``,
+        compressed if ``codec`` is set. A worker thread encodes (and
+        compresses) the next scan window while the current one is sent.
+        """
+        loop = asyncio.get_running_loop()
+        encoder = compression.Encoder(codec) if codec else None
+        windows = encode_delta(file.fileno(), ranges, index, size)
+
+        def next_window():
+            operations = next(windows, (None,))[0]
+            if operations is None or encoder is None:
+                return operations
+            return encoder.compress(operations)
+
+        pending = loop.run_in_executor(None, next_window)
+        while True:
+            data = await pending
+            if data is None:
+                break
+            pending = loop.run_in_executor(None, next_window)
+            try:
+                if data:
+                    await stream.send_data(data, end=False)
+            except BaseException:
+                await asyncio.gather(pending, return_exceptions=True)  # the file must not close under the encoder
+                raise
+        await stream.send_data(encoder.compress(b"", final=True) if encoder is not None else b"", end=True)
+
+    @staticmethod
+    def _compressible(fd, size):
+        return compression.compressible(compression.sample_file(fd, [(0, size)]))
+
+    @staticmethod
+    async def _send_ranges(stream, file, ranges, progress=None, digests=None):
+        """
+        Sends the byte ranges of ``file`` with sendfile, a chunk at a time. If
+        ``digests`` is a list, a worker thread hashes each chunk while it is
+        being sent, the digests are appended to it and the stream ends with
+        their checksum in a TRAILER.
+        """
+        loop = asyncio.get_running_loop()
+        chunks = [(position, min(end, position + CHUNK_SIZE))
+                  for start, end in ranges for position in range(start, end, CHUNK_SIZE)]
+        if not chunks and digests is None:
+            await stream.send_data(b"", end=True)
+        for index, (start, end) in enumerate(chunks):
+            hashing = loop.run_in_executor(None, range_digest, file.fileno(), start, end) if digests is not None \
+                else None
+            try:
+                await stream.send_file(file, start, end - start, end=digests is None and index == len(chunks) - 1)
+            except BaseException:
+                if hashing is not None:
+                    await asyncio.gather(hashing, return_exceptions=True)  # the file must not close under it
+                raise
+            if hashing is not None:
+                digests.append(await hashing)
+            if progress is not None:
+                progress(end - start)
+        if digests is not None:
+            await stream.send_message(protocol.TRAILER, {"checksum": file_checksum(digests)}, end=True)
+
+    @staticmethod
+    async def _send_compressed(stream, file, ranges, codec, progress=None, digests=None):
+        """
+        Sends the byte ranges of ``file`` as one compressed stream. The next
+        block is read and compressed in a worker thread while the current one
+        is sent. ``digests`` works as for _send_ranges(); a block is a chunk.
+        """
+        loop = asyncio.get_running_loop()
+        encoder = compression.Encoder(codec)
+        blocks = [(position, min(end, position + COMPRESS_BLOCK))
+                  for start, end in ranges for position in range(start, end, COMPRESS_BLOCK)]
+
+        def read_block(index):
+            start, end = blocks[index]
+            data = os.pread(file.fileno(), end - start, start)
+            digest = hashlib.sha256(data).hexdigest() if digests is not None else None
+            return encoder.compress(data, final=index == len(blocks) - 1), digest
+
+        pending = loop.run_in_executor(None, read_block, 0)
+        for index in range(len(blocks)):
+            data, digest = await pending
+            last = index == len(blocks) - 1
+            if not last:
+                pending = loop.run_in_executor(None, read_block, index + 1)
+            if data or last:
+                try:
+                    await stream.send_data(data, end=last and digests is None)
+                except BaseException:
+                    if not last:
+                        await asyncio.gather(pending, return_exceptions=True)  # the encoder must not outlive the file
+                    raise
+            if digests is not None:
+                digests.append(digest)
+            if progress is not None:
+                progress(blocks[index][1] - blocks[index][0])
+        if digests is not None:
+            await stream.send_message(protocol.TRAILER, {"checksum": file_checksum(digests)}, end=True)
+
+    async def download(self, filename, save_directory, resume=True, parallel=False):
+        """
+        Downloads a file into ``save_directory`` and returns the local path.
+
+        The data is written to ``<name>.part`` with a chunk manifest beside it.
+        If a download is interrupted, the next call asks the server for the
+        missing ranges only, as long as the server's copy has not changed.
+        ``parallel`` works as for upload(); every connection writes its ranges
+        straight into the preallocated file with positional writes.
+
+        Chunks are hashed as they are written and the result is checked
+        against the server's file checksum before the file is moved into place.
+
+        With a ``cache``, the request names the version of the cached copy and
+        an unchanged file is copied from the cache instead of transferred.
+        """
+        file_path = os.path.join(save_directory, filename)
+        if self.cache is None:
+            await self._read(lambda client: client._download(filename, file_path, resume, parallel))
+            return file_path
+        loop = asyncio.get_running_loop()
+        key = f"{self.host}:{self.port}/{filename}"
+        cached = await loop.run_in_executor(None, self.cache.version, key)
+        reply = await self._read(lambda client: client._download(filename, file_path, resume, parallel, cached))
+        if reply.get("status") == "Not Modified":
+            if await loop.run_in_executor(None, self.cache.copy_to, key, cached, file_path):
+                return file_path
+            # evicted or replaced since the lookup
+            reply = await self._read(lambda client: client._download(filename, file_path, resume, parallel))
+        try:
+            await loop.run_in_executor(None, self.cache.store, key, file_path, reply["version"], reply.get("checksum"))
+        except OSError:
+            pass  # a full or unwritable cache must not fail a download that succeeded
+        return file_path
+
+    async def _download(self, filename, file_path, resume, parallel, if_none_match=None):
+        """
+        Downloads ``filename`` to ``file_path`` unless the server's version is
+        ``if_none_match``. Returns the server's reply.
+        """
+        part_path = file_path + ".part"
+        manifest_path = part_path + ".json"
+        manifest = ChunkManifest.load(manifest_path) if resume and os.path.exists(part_path) else None
+        if parallel:
+            reply = await self._download_parallel(filename, part_path, manifest_path, manifest, parallel, if_none_match)
+            if reply.get("status") != "Not Modified":
+                os.replace(part_path, file_path)
+                if os.path.exists(manifest_path):
+                    os.remove(manifest_path)
+            return reply
+
+        request = {"filename": filename}
+        if manifest is not None:
+            request.update(version=manifest.source, ranges=manifest.missing_ranges())
+        if self.compression:
+            request["compression"] = self.compression
+        if if_none_match is not None:
+            request["if_none_match"] = if_none_match
+
+        stream = await self._request(protocol.DOWNLOAD, request)
+        try:
+            opcode, flags, reply = await stream.receive_message()
+            self._check(opcode, reply)
+            if reply.get("status") == "Not Modified":
+                return reply  # the stream ended with the reply
+            manifest, fd = self._open_part_file(part_path, manifest, reply)
+            try:
+                decoder = compression.Decoder(reply["compression"]) if reply.get("compression") else None
+                await self._receive_ranges(stream, RangeWriter(fd, reply["ranges"], manifest, self.verify), manifest,
+                                           manifest_path, decoder)
+            except BaseException:
+                manifest.save(manifest_path)  # keep what arrived for the next attempt
+                if not stream.cancelled:
+                    await stream.cancel()
+                raise
+            finally:
+                os.close(fd)
+            self._check_download(manifest, reply, part_path, manifest_path)
+            os.replace(part_path, file_path)
+            if os.path.exists(manifest_path):
+                os.remove(manifest_path)
+            return reply
+        finally:
+            stream.close()
+
+    @staticmethod
+    def _check_download(manifest, reply, part_path, manifest_path):
+        """
+        Compares the digests of a completed download with the server's file
+        checksum. On a mismatch the partial file is dropped, so the next
+        attempt starts over. Chunks an older client received carry no digest
+        and cannot be checked.
+        """
+        checksum = reply.get("checksum")
+        if checksum is None or not all(manifest.digests) or file_checksum(manifest.digests) == checksum:
+            return
+        for path in (part_path, manifest_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise protocol.ProtocolError("download does not match the file's checksum; the data was corrupted")
+
+    @staticmethod
+    def _open_part_file(part_path, manifest, reply):
+        """
+        Returns the manifest and an fd to write the download into, starting over if the file is new or changed.
+        """
+        if manifest is None or manifest.source != reply["version"]:
+            manifest = ChunkManifest(reply["size"], source=reply["version"])
+            fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+            preallocate(fd, manifest.size)
+        else:
+            fd = os.open(part_path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+        return manifest, fd
+
+    async def _download_parallel(self, filename, part_path, manifest_path, manifest, parallel, if_none_match=None):
+        # an empty first request looks up the size and version (and is the one the owner is notified of)
+        request = {"filename": filename, "ranges": []}
+        if if_none_match is not None:
+            request["if_none_match"] = if_none_match
+        stream = await self._request(protocol.DOWNLOAD, request)
+        try:
+            opcode, flags, reply = await stream.receive_message()
+            self._check(opcode, reply)
+            if reply.get("status") == "Not Modified":
+                return reply
+            opcode, flags, piece = await stream.receive()  # the empty DATA frame that ends the stream
+            if opcode == protocol.DATA:
+                stream.consumed(piece)
+        finally:
+            stream.close()
+        version = reply["version"]
+        manifest, fd = self._open_part_file(part_path, manifest, reply)
+        tuner = self._tuner(parallel)
+
+        async def transfer(slot, part, progress):
+            request = {"filename": filename, "version": version, "ranges": [part], "part": True}
+            if self.compression:
+                request["compression"] = self.compression
+            part_stream = await self._request(protocol.DOWNLOAD, request, mux=await self._connection(slot))
+            try:
+                opcode, flags, reply = await part_stream.receive_message()
+                self._check(opcode, reply)
+                if reply["version"] != version or reply["ranges"] != [part]:
+                    raise protocol.ProtocolError(f"'{filename}' changed during the download")
+                decoder = compression.Decoder(reply["compression"]) if reply.get("compression") else None
+                await self._receive_ranges(part_stream, RangeWriter(fd, [part], manifest, self.verify), manifest,
+                                           manifest_path, decoder, progress)
+            except BaseException:
+                if not part_stream.cancelled:
+                    await part_stream.cancel()
+                raise
+            finally:
+                part_stream.close()
+
+        try:
+            await run_parallel(split_ranges(manifest.missing_ranges()), transfer, tuner)
+        except BaseException:
+            manifest.save(manifest_path)  # keep what arrived for the next attempt
+            raise
+        finally:
+            os.close(fd)
+        if parallel is True:
+            self.parallel_level = tuner.best_level
+        self._check_download(manifest, reply, part_path, manifest_path)
+        return reply
+
+    async def _receive_ranges(self, stream, writer, manifest, manifest_path, decoder=None, progress=None):
+        unsaved_chunks = 0
+        while True:
+            opcode, flags, piece = await stream.receive()
+            if opcode != protocol.DATA:
+                self._check(opcode, piece)
+                raise protocol.ProtocolError(f"unexpected {protocol.OPCODE_NAMES[opcode]} during download")
+            try:
+                if decoder is None:
+                    unsaved_chunks += writer.write(piece)
+                    if progress is not None:
+                        progress(len(piece))
+                else:
+                    decoder.feed(piece)
+                    while True:
+                        data = decoder.read()
+                        if not data:
+                            break
+                        unsaved_chunks += writer.write(memoryview(data))
+                        if progress is not None:
+                            progress(len(data))
+            except ValueError as e:
+                raise protocol.ProtocolError(str(e))
+            finally:
+                stream.consumed(piece)
+            if unsaved_chunks >= MANIFEST_FLUSH_CHUNKS and manifest is not None:
+                manifest.save(manifest_path)
+                unsaved_chunks = 0
+            if flags & protocol.FLAG_END_STREAM:
+                if writer.remaining:
+                    raise protocol.ProtocolError(f"download ended {writer.remaining} bytes early")
+                if decoder is not None and not decoder.eof:
+                    raise protocol.ProtocolError("compressed download ended before the end of its stream")
+                return
+
+    async def download_bundle(self, filenames, save_directory):
+        """
+        Downloads many files in one request into ``save_directory``, at most
+        protocol.MAX_BUNDLE_FILES of them. Each file is checked against the
+        server's checksum and moved into place as soon as its data is in;
+        unlike download(), an interrupted bundle is not resumed.
+        Returns {"file", "path"}, or {"file", "error"} for a file the server
+        could not send, for each name in order.
+        """
+        return await self._read(lambda client: client._download_bundle(filenames, save_directory))
+
+    async def _download_bundle(self, filenames, save_directory):
+        if not 0 < len(filenames) <= protocol.MAX_BUNDLE_FILES:
+            raise ValueError(f"a bundle holds 1 to {protocol.MAX_BUNDLE_FILES} files")
+        request = {"bundle": list(filenames)}
+        if self.compression:
+            request["compression"] = self.compression
+        stream = await self._request(protocol.DOWNLOAD, request)
+        writer = None
+        try:
+            opcode, flags, reply = await stream.receive_message()
+            self._check(opcode, reply)
+            try:
+                writer = BundleWriter([entry for entry in reply["files"] if "error" not in entry], save_directory,
+                                      self.verify)
+                decoder = compression.Decoder(reply["compression"]) if reply.get("compression") else None
+                await self._receive_ranges(stream, writer, None, None, decoder)
+            except BaseException:
+                if not stream.cancelled:
+                    await stream.cancel()
+                raise
+        finally:
+            if writer is not None:
+                writer.close()
+            stream.close()
+        return [{"file": entry["file"], "error": entry["error"]} if "error" in entry
+                else {"file": entry["file"], "path": writer.paths[entry["file"]]} for entry in reply["files"]]
+
+    async def read_range(self, filename, offset, length):
+        """
+        Returns ``length`` bytes of a server file starting at ``offset``.
+        """
+        return await self._read(lambda client: client._read_range(filename, offset, length))
+
+    async def _read_range(self, filename, offset, length):
+        stream = await self._request(protocol.DOWNLOAD, {"filename": filename, "ranges": [[offset, offset + length]]})
+        try:
+            opcode, flags, reply = await stream.receive_message()
+            self._check(opcode, reply)
+            data = bytearray()
+            while True:
+                opcode, flags, piece = await stream.receive()
+                if opcode != protocol.DATA:
+                    self._check(opcode, piece)
+                    raise protocol.ProtocolError(f"unexpected {protocol.OPCODE_NAMES[opcode]} during download")
+                data += piece
+                stream.consumed(piece)
+                if flags & protocol.FLAG_END_STREAM:
+                    return bytes(data)
+        finally:
+            stream.close()
+
+    async def list_page(self, owner=None, prefix=None, modified_after=None, modified_before=None, sort="name",
+                        limit=None, cursor=None):
+        """
+        Returns (files, cursor) for one page of the server's catalog. Pass the
+        cursor back (with the same filters) for the next page; it is None
+        after the last one.
+        """
+        request = {"owner": owner, "prefix": prefix, "modified_after": modified_after,
+                   "modified_before": modified_before, "sort": sort, "limit": limit, "cursor": cursor}
+        request = {key: value for key, value in request.items() if value is not None}
+        return await self._read(lambda client: client._list_page(request))
+
+    async def _list_page(self, request):
+        stream = await self._request(protocol.LIST, request)
+        try:
+            files = []
+            while True:  # the page arrives in several frames; the last one carries the cursor
+                opcode, flags, reply = await stream.receive_message()
+                files += self._check(opcode, reply)["files"]
+                if flags & protocol.FLAG_END_STREAM:
+                    return files, reply.get("cursor")
+        finally:
+            stream.close()
+
+    async def list_files(self, **filters):
+        """
+        Returns every file matching ``filters`` (see list_page), page by page.
+        """
+        files, cursor = await self.list_page(**filters)
+        while cursor is not None:
+            page, cursor = await self.list_page(cursor=cursor, **filters)
+            files += page
+        return files
+
+    async def delete(self, filename):
+        stream = await self._request(protocol.DELETE, {"filename": filename})
+        try:
+            opcode, flags, reply = await stream.receive_message()
+            return self._check(opcode, reply).get("message")
+        finally:
+            stream.close()
+
+
+class SyncClient:
+    """
+    Blocking facade over AsyncClient. Calls from several threads run
+    concurrently on the shared connection.
+    """
+
+    def __init__(self, host, port, username, **options):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self.client = AsyncClient(host, port, username, **options)
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def run(self, coro):
+        """
+        Runs a coroutine on the client's event loop and returns its result,
+        e.g. ``run(batch.upload_many(client.client, paths))``.
+        """
+        return self._run(coro)
+
+    @property
+    def connected(self):
+        return self.client.connected
+
+    def connect(self):
+        return self._run(self.client.connect())
+
+    def subscribe(self, topics=("my-files",), on_notification=None):
+        """
+        Subscribes to notifications; ``on_notification`` runs on the client's event loop thread.
+        """
+        return self._run(self.client.subscribe(topics, on_notification))
+
+    def upload(self, file_path, remote_name=None, dedupe=True, parallel=False, delta=False):
+        return self._run(self.client.upload(file_path, remote_name, dedupe, parallel, delta))
+
+    def download(self, filename, save_directory, resume=True, parallel=False):
+        return self._run(self.client.download(filename, save_directory, resume, parallel))
+
+    def upload_bundle(self, files):
+        return self._run(self.client.upload_bundle(files))
+
+    def download_bundle(self, filenames, save_directory):
+        return self._run(self.client.download_bundle(filenames, save_directory))
+
+    def read_range(self, filename, offset, length):
+        return self._run(self.client.read_range(filename, offset, length))
+
+    def list_page(self, **options):
+        return self._run(self.client.list_page(**options))
+
+    def list_files(self, **filters):
+        return self._run(self.client.list_files(**filters))
+
+    def delete(self, filename):
+        return self._run(self.client.delete(filename))
+
+    def close(self):
+        """
+        Disconnects and stops the private event loop.
+        """
+        try:
+            self._run(self.client.disconnect())
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
@@ -0,0 +1,106 @@
+"""
+Parallel transfer of one large file over several connections.
+
+The file's byte ranges are cut into parts of PART_SIZE (a multiple of the
+chunk size, so a part never shares a chunk with another) and a pool of
+workers, one per connection, takes parts off a shared queue. How many
+workers run is up to a ConcurrencyTuner, which measures the throughput
+while the transfer runs and adds connections only as long as that helps.
+"""
+import asyncio
+import collections
+import time
+
+from Common.chunks import CHUNK_SIZE
+
+PART_SIZE = 8 * CHUNK_SIZE  # bytes per part request
+MAX_CONNECTIONS = 8
+TUNE_INTERVAL = 1.0  # seconds of transfer behind each throughput measurement
+TUNE_GAIN = 1.1  # another connection must add at least 10% throughput to stay
+
+
+def split_ranges(ranges, part_size=PART_SIZE):
+    """
+    Cuts chunk-aligned [start, end] ranges into parts of at most ``part_size`` bytes.
+    """
+    return [[position, min(end, position + part_size)]
+            for start, end in ranges for position in range(start, end, part_size)]
+
+
+class ConcurrencyTuner:
+    """
+    Hill-climbs the number of connections: measures the throughput at the
+    current level for TUNE_INTERVAL, moves one connection up while each step
+    gains at least TUNE_GAIN, and settles on the best level once a step does
+    not pay off. With ``start == maximum`` the level is simply fixed.
+    """
+
+    def __init__(self, start=1, maximum=MAX_CONNECTIONS):
+        self.level = max(1, min(start, maximum))
+        self.maximum = maximum
+        self.best_rate, self.best_level = 0.0, self.level
+        self.settled = self.level >= maximum
+        self._started = time.monotonic()
+        self._bytes = 0
+
+    def record(self, count):
+        """
+        Counts ``count`` transferred bytes; returns the level to run at from now on.
+        """
+        self._bytes += count
+        now = time.monotonic()
+        elapsed = now - self._started
+        if self.settled or elapsed < TUNE_INTERVAL:
+            return self.level
+        rate = self._bytes / elapsed
+        if rate >= self.best_rate * TUNE_GAIN:
+            self.best_rate, self.best_level = rate, self.level
+            if self.level < self.maximum:
+                self.level += 1
+            else:
+                self.settled = True
+        else:
+            self.level = self.best_level  # the last connection added nothing
+            self.settled = True
+        self._started, self._bytes = now, 0
+        return self.level
+
+
+async def run_parallel(parts, transfer, tuner):
+    """
+    Runs ``await transfer(slot, part, progress)`` for every part, with up to
+    ``tuner.level`` slots busy at once. ``transfer`` reports moved bytes with
+    ``progress(count)``; a slot above the current level stops after its part.
+    The first failure cancels the other slots and is raised.
+    """
+    loop = asyncio.get_running_loop()
+    queue = collections.deque(parts)
+    workers = {}  # slot -> task
+
+    async def work(slot):
+        while queue and slot < tuner.level:
+            await transfer(slot, queue.popleft(), progress)
+
+    def fill():
+        for slot in range(tuner.level):
+            if slot not in workers and queue:
+                workers[slot] = loop.create_task(work(slot))
+
+    def progress(count):
+        level = tuner.level
+        if tuner.record(count) > level:
+            fill()
+
+    fill()
+    try:
+        while workers:
+            done, pending = await asyncio.wait(workers.values(), return_when=asyncio.FIRST_COMPLETED)
+            for slot, task in list(workers.items()):
+                if task in done:
+                    del workers[slot]
+                    task.result()
+            fill()  # parts left behind by a slot that stopped when the level went down
+    finally:
+        for task in workers.values():
+            task.cancel()
+        await asyncio.gather(*workers.values(), return_exceptions=True)
@@ -0,0 +1,180 @@
+"""
+Mirrors a local directory to the server.
+
+Every regular file under the directory is stored as
+``<prefix>/<relative path>`` with "%" and "/" escaped (server names cannot
+contain a path separator), so ``photos/2024/a.jpg`` synced from ``photos``
+becomes ``photos%2F2024%2Fa.jpg``. The prefix defaults to the directory's
+name.
+
+A sync does as little work as it can:
+
+  * a state index beside the files (STATE_FILE) remembers the size,
+    modification time and checksum of every file as it was last synced.
+    A file whose size and mtime still match, and whose server copy still
+    has that checksum (one LIST of the prefix tells), is skipped without
+    being read;
+  * any other file is uploaded with dedupe, so chunks the server already
+    has are not sent, and as a delta against the server's copy, so of the
+    chunks that changed only the changed bytes are sent (Common/delta.py);
+  * with ``delete``, server files under the prefix that are gone locally
+    are deleted.
+
+Like git, the index does not trust a file modified within
+RACY_SECONDS of being synced: it could change again without its mtime
+moving, so it is checked again next time.
+"""
+import json
+import os
+import time
+
+from Client import batch
+
+STATE_FILE = ".fileserver-sync.json"
+STATE_FLUSH = 256  # synced files between saves of the state index
+RACY_SECONDS = 2  # files modified this recently when they were synced are not trusted by the index
+
+
+def remote_name(prefix, relative_path):
+    """
+    Server name of a file: ``prefix/relative path`` with "%" and "/" escaped.
+    """
+    path = "/".join(part for part in (prefix, relative_path.replace(os.sep, "/")) if part)
+    return path.replace("%", "%25").replace("/", "%2F")
+
+
+class SyncState:
+    """
+    The state index of one synced directory: relative path -> [size,
+    mtime_ns, checksum] as last synced to ``target``. An index written for
+    another target (server, user or prefix) is not used.
+    """
+
+    def __init__(self, path, target):
+        self.path = path
+        self.target = target
+        self.files = {}
+
+    @classmethod
+    def load(cls, path, target):
+        state = cls(path, target)
+        try:
+            with open(path) as file:
+                data = json.load(file)
+            if data.get("target") == target:
+                state.files = {name: list(entry) for name, entry in data["files"].items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass  # no usable index: every file is checked
+        return state
+
+    def save(self):
+        """
+        Writes the index atomically (temp file + rename).
+        """
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump({"target": self.target, "files": self.files}, file)
+        os.replace(temp_path, self.path)
+
+    def unchanged(self, relative_path, stat, stored):
+        """
+        Tells whether a file can be skipped: it still has the size and mtime
+        it was synced with and the server's copy still has that content.
+        """
+        known = self.files.get(relative_path)
+        return known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns] and stored is not None \
+            and stored["size"] == stat.st_size and stored["checksum"] == known[2]
+
+    def record(self, relative_path, stat, checksum, synced):
+        """
+        Remembers a file as synced at ``synced`` (time.time_ns() before it
+        was read), unless it was modified too shortly before to be trusted.
+        """
+        if checksum and stat.st_mtime_ns < synced - RACY_SECONDS * 10 ** 9:
+            self.files[relative_path] = [stat.st_size, stat.st_mtime_ns, checksum]
+        else:
+            self.files.pop(relative_path, None)
+
+
+def local_files(directory, state_path=None):
+    """
+    Yields (path, relative path) of the regular files under ``directory``, in
+    a stable order, leaving out the state index.
+    """
+    skipped = {os.path.abspath(path) for path in (state_path, (state_path or "") + ".tmp") if state_path}
+    for root, subdirectories, files in os.walk(directory):
+        subdirectories.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if os.path.isfile(path) and os.path.abspath(path) not in skipped:
+                yield path, os.path.relpath(path, directory)
+
+
+async def sync_directory(client, directory, prefix=None, concurrency=batch.DEFAULT_CONCURRENCY, retry=None,
+                         on_result=None, delete=False, delta=True, parallel=False, state_path=None):
+    """
+    Mirrors ``directory`` to the server under ``prefix`` (default: the
+    directory's name). ``delta`` sends changed files as deltas against
+    their server copies; ``parallel`` is used for files the server does not
+    have yet. Returns the BatchResults: an upload's value is what upload()
+    returned, or {"status": "Skipped"} for a file the index vouches for; a
+    deleted file's is {"status": "Deleted"}.
+    """
+    directory = os.path.abspath(directory)
+    prefix = os.path.basename(directory) if prefix is None else prefix.strip("/")
+    state_path = state_path or os.path.join(directory, STATE_FILE)
+    state = SyncState.load(state_path, f"{client.host}:{client.port}/{client.username}/{prefix}")
+    owner_prefix = f"{client.username}_"
+    listing = f"{owner_prefix}{remote_name(prefix, '')}%2F" if prefix else owner_prefix
+    remote = {entry["file"][len(owner_prefix):]: entry
+              for entry in await batch.with_retries(client, lambda: client.list_files(owner=client.username,
+                                                                                        prefix=listing), retry)}
+    seen = set()  # relative paths found locally
+    unsaved = 0
+
+    def items():
+        for path, relative_path in local_files(directory, state_path):
+            seen.add(relative_path)
+            yield path, relative_path
+
+    async def sync_file(item):
+        path, relative_path = item
+        name = remote_name(prefix, relative_path)
+        stored = remote.get(name)
+        synced = time.time_ns()
+        stat = os.stat(path)
+        if state.unchanged(relative_path, stat, stored):
+            return {"status": "Skipped"}
+        result = await client.upload(path, name, delta=delta and stored is not None,
+                                     parallel=parallel if stored is None else False)
+        after = os.stat(path)
+        changed = (after.st_size, after.st_mtime_ns) != (stat.st_size, stat.st_mtime_ns)  # edited while being sent
+        state.record(relative_path, after, None if changed else result.get("checksum"), synced)
+        return result
+
+    def synced(result):
+        nonlocal unsaved
+        unsaved += 1
+        if unsaved >= STATE_FLUSH:
+            state.save()
+            unsaved = 0
+        if on_result is not None:
+            on_result(result)
+
+    try:
+        results = await batch.run_batch(client, items(), sync_file, concurrency, retry, synced)
+        for relative_path in list(state.files):
+            if relative_path not in seen:
+                del state.files[relative_path]  # deleted locally
+    finally:
+        state.save()
+    if delete:
+        local_names = {remote_name(prefix, relative_path) for relative_path in seen}
+        gone = [owner_prefix + name for name in sorted(remote) if name not in local_names]
+
+        async def delete_file(stored_name):
+            await client.delete(stored_name)
+            return {"status": "Deleted"}
+
+        results += await batch.run_batch(client, gone, delete_file, concurrency, retry, on_result)
+    return results
@@ -0,0 +1,121 @@
+"""
+The client's download cache: revalidation, eviction and copies replaced
+while they are being read.
+"""
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from Client.cache import DownloadCache
+from Client.client_core import ServerError
+from Common import protocol
+from Server.testing import ask, connected, serving, write_file
+
+
+@pytest.fixture(autouse=True)
+def scratch_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the server looks for an older version's catalog in the working directory
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = DownloadCache(str(tmp_path / "cache"), max_bytes=100)
+    yield cache
+    cache.close()
+
+
+def test_copy_of_the_current_version(cache, tmp_path):
+    cache.store("server/a", write_file(tmp_path / "a", b"version one"), "v1")
+    assert cache.version("server/a") == "v1"
+    assert not cache.copy_to("server/a", "v0", str(tmp_path / "out"))
+    assert cache.copy_to("server/a", "v1", str(tmp_path / "out"))
+    assert (tmp_path / "out").read_bytes() == b"version one" and cache.hits == 1
+
+
+def test_least_recently_used_copies_are_evicted(cache, tmp_path):
+    for key in ("a", "b"):
+        cache.store(key, write_file(tmp_path / key, key.encode() * 40), "v1")
+    cache.copy_to("a", "v1", str(tmp_path / "out"))  # "b" is now the least recently used
+    cache.store("c", write_file(tmp_path / "c", b"c" * 40), "v1")
+    assert [cache.version(key) for key in "abc"] == ["v1", None, "v1"] and cache.size() == 80
+    cache.store("a", write_file(tmp_path / "big", b"x" * 101), "v2")  # larger than the cache
+    assert cache.version("a") is None  # and the older version is not taken for it
+
+
+def test_tampered_copy_is_not_trusted(cache, tmp_path):
+    cache.store("a", write_file(tmp_path / "a", b"original"), "v1")
+    with open(cache._path("a"), "ab") as file:
+        file.write(b" and more")
+    assert cache.version("a") is None and cache.size() == 0
+
+
+def test_copy_replaced_before_its_row_is_refused(cache, tmp_path):
+    cache.store("a", write_file(tmp_path / "a", b"version one"), "v1")
+    time.sleep(0.01)
+    os.replace(write_file(tmp_path / "new", b"version two"), cache._path("a"))  # what store() does first
+    assert not cache.copy_to("a", "v1", str(tmp_path / "out"))
+    assert not os.path.exists(tmp_path / "out")
+
+
+def test_concurrent_store_and_copy(tmp_path):
+    cache = DownloadCache(str(tmp_path / "cache"))
+    contents = {version: version.encode() * 50000 for version in ("v1", "v2")}
+    sources = {version: write_file(tmp_path / version, data) for version, data in contents.items()}
+    cache.store("a", sources["v1"], "v1")
+    stop, copied, wrong = threading.Event(), [], []
+
+    def replace():
+        while not stop.is_set():
+            for version in contents:
+                cache.store("a", sources[version], version)
+
+    def read(index):
+        destination = str(tmp_path / f"out{index}")
+        while not stop.is_set():
+            for version in contents:
+                if cache.copy_to("a", version, destination):
+                    copied.append(version)
+                    with open(destination, "rb") as file:
+                        if file.read() != contents[version]:
+                            wrong.append(version)
+
+    threads = [threading.Thread(target=replace)] + [threading.Thread(target=read, args=(index,)) for index in range(2)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.5)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    cache.close()
+    assert copied and not wrong
+
+
+def test_unchanged_file_is_copied_from_the_cache(tmp_path):
+    async def scenario():
+        async with serving(str(tmp_path)) as server:
+            async with connected(server) as client:
+                await client.upload(write_file(tmp_path / "a.txt", b"cached"))
+                opcode, reply = await ask(client, protocol.DOWNLOAD, {"filename": "alice_a.txt"})
+                opcode, reply = await ask(client, protocol.DOWNLOAD, {"filename": "alice_a.txt",
+                                                                      "if_none_match": reply["version"]})
+                assert opcode == protocol.OK and reply["status"] == "Not Modified"
+
+            cache = DownloadCache(str(tmp_path / "cache"))
+            os.makedirs(tmp_path / "down")
+            try:
+                async with connected(server, cache=cache) as client:
+                    for _ in range(2):
+                        await client.download("alice_a.txt", str(tmp_path / "down"))
+                    assert (cache.hits, cache.misses) == (1, 1)
+                    await client.upload(write_file(tmp_path / "a.txt", b"changed"))
+                    path = await client.download("alice_a.txt", str(tmp_path / "down"))
+                    assert open(path, "rb").read() == b"changed" and cache.misses == 2
+                    with pytest.raises(ServerError):
+                        await client.download("alice_missing.txt", str(tmp_path / "down"))
+            finally:
+                cache.close()
+
+    asyncio.run(scenario())
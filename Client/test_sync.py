@@ -0,0 +1,96 @@
+"""
+Directory sync: remote names, the state index and its racy-mtime rule, and
+syncs against a FileServer on localhost.
+"""
+import asyncio
+import os
+import random
+import time
+
+import pytest
+
+from Client import sync
+from Client.sync import SyncState
+from Common.chunks import CHUNK_SIZE
+from Server.testing import connected, serving
+
+
+@pytest.fixture(autouse=True)
+def scratch_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the server looks for an older version's catalog in the working directory
+
+
+def test_remote_names_escape_separators():
+    assert sync.remote_name("photos", os.path.join("2024", "a.jpg")) == "photos%2F2024%2Fa.jpg"
+    assert sync.remote_name("", "100%.txt") == "100%25.txt"
+
+
+def test_recently_modified_files_are_not_trusted(tmp_path):
+    path = tmp_path / "a.txt"
+    path.write_bytes(b"hello")
+    now = time.time_ns()
+    state = SyncState(str(tmp_path / "state.json"), "target")
+    stored = {"size": 5, "checksum": "abc"}
+
+    state.record("a.txt", os.stat(path), "abc", now)  # modified just now: its mtime may not move on the next edit
+    assert not state.unchanged("a.txt", os.stat(path), stored)
+
+    old = now - (sync.RACY_SECONDS + 1) * 10 ** 9
+    os.utime(path, ns=(old, old))
+    state.record("a.txt", os.stat(path), "abc", now)
+    assert state.unchanged("a.txt", os.stat(path), stored)
+    assert not state.unchanged("a.txt", os.stat(path), dict(stored, checksum="other"))  # changed on the server
+    assert not state.unchanged("a.txt", os.stat(path), None)
+    os.utime(path, ns=(old + 1, old + 1))
+    assert not state.unchanged("a.txt", os.stat(path), stored)
+
+
+def test_index_is_only_used_for_its_target(tmp_path):
+    state = SyncState(str(tmp_path / "state.json"), "server/alice/docs")
+    state.files["a.txt"] = [5, 1, "abc"]
+    state.save()
+    assert SyncState.load(state.path, "server/alice/docs").files == {"a.txt": [5, 1, "abc"]}
+    assert SyncState.load(state.path, "server/bob/docs").files == {}
+    (tmp_path / "state.json").write_text("not json")
+    assert SyncState.load(state.path, "server/alice/docs").files == {}
+
+
+def age(directory, seconds):
+    """
+    Moves the mtime of every file under ``directory`` ``seconds`` into the past.
+    """
+    for path, relative_path in sync.local_files(directory):
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns - seconds * 10 ** 9))
+
+
+def test_sync_uploads_only_what_changed(tmp_path):
+    docs = tmp_path / "docs"
+    os.makedirs(docs / "sub")
+    big = random.Random(1).randbytes(2 * CHUNK_SIZE)
+    (docs / "big.bin").write_bytes(big)
+    (docs / "sub" / "note.txt").write_bytes(b"note")
+    (docs / "gone.txt").write_bytes(b"soon deleted")
+    age(docs, sync.RACY_SECONDS + 1)  # else the index does not trust them yet
+
+    async def scenario():
+        async with serving(str(tmp_path)) as server, connected(server) as client:
+            first = await sync.sync_directory(client, str(docs))
+            assert all(result.ok for result in first) and len(first) == 3
+            second = await sync.sync_directory(client, str(docs))
+            assert {result.value["status"] for result in second} == {"Skipped"}
+
+            edited = big[:1000] + b"edit" + big[1000:]  # shifts everything behind it
+            (docs / "big.bin").write_bytes(edited)
+            os.remove(docs / "gone.txt")
+            third = await sync.sync_directory(client, str(docs), delete=True)
+            results = {result.value["status"]: result.value for result in third}
+            assert "Deleted" in results and results["Skipped"]
+            uploaded = next(value for value in results.values() if value["status"] not in ("Skipped", "Deleted"))
+            assert uploaded["copied_bytes"] >= len(big) - CHUNK_SIZE // 2  # sent as a delta
+            names = {file["file"] for file in await client.list_files()}
+            assert names == {"alice_docs%2Fbig.bin", "alice_docs%2Fsub%2Fnote.txt"}
+            return await client.read_range("alice_docs%2Fbig.bin", 0, len(edited)), edited
+
+    stored, edited = asyncio.run(scenario())
+    assert stored == edited
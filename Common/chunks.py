@@ -0,0 +1,203 @@
+"""
+Chunk bookkeeping for resumable transfers.
+
+A transfer is split into fixed-size chunks. A ChunkManifest remembers which
+chunks of a partial file are complete (and their SHA-256 digests) and is
+saved next to it, so an interrupted upload or download can continue with
+only the missing byte ranges.
+
+Every chunk is hashed once, by whoever touches its bytes during a transfer.
+A file's checksum is derived from its chunk digests (file_checksum), so it
+needs no second pass over the data, and chunks that arrive out of order, on
+other connections or not at all (deduplicated) still add up to it.
+"""
+import hashlib
+import json
+import os
+
+from Common.fileio import pwrite_all
+
+CHUNK_SIZE = 1 << 20  # 1 MiB
+
+
+class ChunkManifest:
+    """
+    Completion bitmap for one partial file.
+    """
+
+    def __init__(self, size, chunk_size=CHUNK_SIZE, source=None, owner=None):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.source = source  # identifies what is being transferred; a mismatch means start over
+        self.owner = owner  # user a partial upload belongs to (server side), if recorded
+        self.chunk_count = -(-size // chunk_size)
+        self.received = bytearray(self.chunk_count)
+        self.digests = [None] * self.chunk_count  # hex SHA-256 of received chunks, where known
+
+    def chunk_range(self, index):
+        start = index * self.chunk_size
+        return start, min(start + self.chunk_size, self.size)
+
+    def mark(self, index, digest=None):
+        self.received[index] = 1
+        if digest is not None:
+            self.digests[index] = digest
+
+    def unmark(self, index):
+        self.received[index] = 0
+        self.digests[index] = None
+
+    def complete(self):
+        return all(self.received)
+
+    def received_bytes(self):
+        return sum(end - start for start, end in self._runs(1))
+
+    def missing_ranges(self):
+        """
+        Returns the byte ranges [start, end) that still have to be transferred.
+        """
+        return [[start, end] for start, end in self._runs(0)]
+
+    def _runs(self, value):
+        runs = []
+        index = 0
+        while index < self.chunk_count:
+            if self.received[index] != value:
+                index += 1
+                continue
+            first = index
+            while index < self.chunk_count and self.received[index] == value:
+                index += 1
+            runs.append((self.chunk_range(first)[0], self.chunk_range(index - 1)[1]))
+        return runs
+
+    # ------------------------------------------------------------------ persistence
+
+    def to_json(self):
+        received = [[start // self.chunk_size, -(-end // self.chunk_size)] for start, end in self._runs(1)]
+        data = {"size": self.size, "chunk_size": self.chunk_size, "source": self.source, "received": received}
+        if self.owner is not None:
+            data["owner"] = self.owner
+        if any(self.digests):
+            data["digests"] = self.digests
+        return data
+
+    @classmethod
+    def from_json(cls, data):
+        manifest = cls(data["size"], data["chunk_size"], data.get("source"), data.get("owner"))
+        for first, last in data.get("received", []):
+            manifest.received[first:last] = b"\x01" * (last - first)
+        if "digests" in data:
+            manifest.digests = list(data["digests"])
+        return manifest
+
+    def save(self, path):
+        """
+        Writes the manifest atomically (temp file + rename).
+        """
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(self.to_json(), file)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns the saved manifest, or None if there is none (or it is unreadable).
+        """
+        try:
+            with open(path) as file:
+                return cls.from_json(json.load(file))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+
+def file_checksum(digests):
+    """
+    Checksum of a whole file: BLAKE2b-256 over the binary SHA-256 digests of its chunks, in order.
+    """
+    return hashlib.blake2b(b"".join(bytes.fromhex(digest) for digest in digests), digest_size=32).hexdigest()
+
+
+def range_digest(fd, start, end):
+    """
+    Returns the hex SHA-256 of bytes [start, end) of an open file.
+    """
+    digest = hashlib.sha256()
+    while start < end:
+        data = os.pread(fd, end - start, start)
+        if not data:
+            raise EOFError("file ended before the range did")
+        digest.update(data)
+        start += len(data)
+    return digest.hexdigest()
+
+
+def chunk_digests(path, chunk_size=CHUNK_SIZE):
+    """
+    Returns the hex SHA-256 of every chunk of a local file.
+    """
+    digests = []
+    buffer = memoryview(bytearray(chunk_size))
+    with open(path, "rb", buffering=0) as file:
+        while True:
+            count = file.readinto(buffer)
+            if not count:
+                break
+            while count < chunk_size:  # short reads only happen at end of file, but be exact
+                more = file.readinto(buffer[count:])
+                if not more:
+                    break
+                count += more
+            digests.append(hashlib.sha256(buffer[:count]).hexdigest())
+    return digests
+
+
+class RangeWriter:
+    """
+    Places a stream of bytes that covers ``ranges`` (in order) at the right
+    offsets of a file, hashes every chunk on the way (unless ``verify`` is
+    False) and marks it in ``manifest`` with its digest once it is filled.
+    Ranges must start on chunk boundaries, as missing_ranges() returns them.
+    """
+
+    def __init__(self, fd, ranges, manifest, verify=True):
+        self.fd = fd
+        self.manifest = manifest
+        self.ranges = [tuple(r) for r in ranges if r[1] > r[0]]
+        self.remaining = sum(end - start for start, end in self.ranges)
+        self._index = 0
+        self._position = self.ranges[0][0] if self.ranges else 0
+        self._hash = hashlib.sha256() if verify else None  # of the chunk being filled
+
+    def write(self, view):
+        """
+        Writes ``view`` and returns the number of newly completed chunks.
+        """
+        if len(view) > self.remaining:
+            raise ValueError("more data than the requested ranges")
+        completed = 0
+        chunk_size = self.manifest.chunk_size
+        while view:
+            end = self.ranges[self._index][1]
+            chunk_end = min(end, (self._position // chunk_size + 1) * chunk_size)  # the file's last chunk may be short
+            count = min(len(view), chunk_end - self._position)
+            pwrite_all(self.fd, view[:count], self._position)
+            if self._hash is not None:
+                self._hash.update(view[:count])
+            self._position += count
+            self.remaining -= count
+            view = view[count:]
+            if self._position == chunk_end:
+                if self._hash is None:
+                    self.manifest.mark((chunk_end - 1) // chunk_size)
+                else:
+                    self.manifest.mark((chunk_end - 1) // chunk_size, self._hash.hexdigest())
+                    self._hash = hashlib.sha256()
+                completed += 1
+                if self._position == end and self._index + 1 < len(self.ranges):
+                    self._index += 1
+                    self._position = self.ranges[self._index][0]
+        return completed
+
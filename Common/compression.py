@@ -0,0 +1,194 @@
+"""
+Streaming compression for file transfers and stored blobs.
+
+A transfer is compressed as one stream: the sender runs every byte of the
+DATA it would otherwise send through one compressor and the receiver feeds
+the DATA frames to the matching decompressor, so flow control and frame
+sizes count wire bytes. Which codec (if any) a transfer uses is negotiated
+per request: the client offers codec names in order of preference and the
+server answers with the one it picked, or None.
+
+Codecs are looked up by name in CODECS. zlib and lzma from the standard
+library are registered here; register_codec() adds others, e.g. a wrapper
+around a third-party library.
+
+Data that is already compressed (archives, media) would only cost CPU, so
+senders sample it first: compressible() compresses a few small samples with
+fast zlib and compression is used only if they shrink noticeably.
+"""
+import lzma
+import os
+import zlib
+
+ZLIB_LEVEL = 6
+LZMA_PRESET = 1  # lzma's fastest preset still compresses text far better than zlib
+DECODE_LIMIT = 1 << 20  # most bytes one Decoder.read() returns, however well the input compressed
+SAMPLE_SIZE = 64 << 10  # bytes per compressibility sample
+SAMPLE_COUNT = 8  # samples taken across a file
+MIN_SAVINGS = 0.1  # compress only if the samples shrink by at least this fraction
+
+
+class Codec:
+    """
+    A named compression format. ``compressor()`` returns an object with
+    compress(data) and flush(); ``decompressor()`` one with the
+    decompress(data, max_length), needs_input, eof and unused_data of
+    lzma.LZMADecompressor. ``errors`` are the exceptions it raises on corrupt input.
+    """
+
+    def __init__(self, name, compressor, decompressor, errors=()):
+        self.name = name
+        self.compressor = compressor
+        self.decompressor = decompressor
+        self.errors = tuple(errors)
+
+
+CODECS = {}  # name -> Codec
+
+
+def register_codec(name, compressor, decompressor, errors=()):
+    CODECS[name] = Codec(name, compressor, decompressor, errors)
+
+
+class _ZlibDecompressor:
+    """
+    zlib.decompressobj behind the needs_input interface of lzma and bz2.
+    """
+
+    def __init__(self):
+        self._obj = zlib.decompressobj()
+        self.needs_input = True
+
+    @property
+    def eof(self):
+        return self._obj.eof
+
+    @property
+    def unused_data(self):
+        return self._obj.unused_data
+
+    def decompress(self, data, max_length=-1):
+        if not data:
+            data = self._obj.unconsumed_tail
+        out = self._obj.decompress(data, max(max_length, 0))
+        # a full output buffer may leave more output inside zlib even when all input was taken
+        self.needs_input = not self._obj.unconsumed_tail and (max_length <= 0 or len(out) < max_length)
+        return out
+
+
+register_codec("zlib", lambda: zlib.compressobj(ZLIB_LEVEL), _ZlibDecompressor, (zlib.error,))
+register_codec("lzma", lambda: lzma.LZMACompressor(preset=LZMA_PRESET), lzma.LZMADecompressor, (lzma.LZMAError,))
+
+
+def negotiate(offered):
+    """
+    Picks the first codec in the peer's ``offered`` list that is registered here, or None.
+    """
+    if not isinstance(offered, list):
+        return None
+    return next((name for name in offered if isinstance(name, str) and name in CODECS), None)
+
+
+def compress(codec, data):
+    packed = CODECS[codec].compressor()
+    return packed.compress(data) + packed.flush()
+
+
+def decompress(codec, data):
+    return Decoder(codec).read_all(data)
+
+
+def compressible(samples):
+    """
+    Tells whether data like ``samples`` (a list of bytes-like objects) is
+    worth compressing. Estimates the entropy by compressing the samples with
+    zlib's fastest level, which costs a few milliseconds for a whole file.
+    """
+    size = sum(len(sample) for sample in samples)
+    if not size:
+        return False
+    packed = sum(len(zlib.compress(sample, 1)) for sample in samples)
+    return packed <= size * (1 - MIN_SAVINGS)
+
+
+def sample_file(fd, ranges, sample_size=SAMPLE_SIZE, count=SAMPLE_COUNT):
+    """
+    Reads up to ``count`` samples spread evenly over the byte ``ranges`` of a file.
+    """
+    total = sum(end - start for start, end in ranges)
+    samples = []
+    for index in range(min(count, -(-total // sample_size))):
+        position = total * index // count  # offset within the concatenated ranges
+        for start, end in ranges:
+            if position < end - start:
+                samples.append(os.pread(fd, min(sample_size, end - start - position), start + position))
+                break
+            position -= end - start
+    return samples
+
+
+class Encoder:
+    """
+    Compresses one transfer, block by block.
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+        self._obj = CODECS[codec].compressor()
+
+    def compress(self, data, final=False):
+        """
+        Returns the compressed bytes ready to send; ``final`` ends the stream.
+        """
+        out = self._obj.compress(data)
+        return out + self._obj.flush() if final else out
+
+
+class Decoder:
+    """
+    Decompresses one transfer. Output comes back in pieces of at most
+    DECODE_LIMIT bytes, so a small frame that expands enormously cannot
+    exhaust memory. Corrupt input and data after the end of the stream raise
+    ValueError.
+    """
+
+    def __init__(self, codec):
+        self.codec = CODECS[codec]
+        self._obj = self.codec.decompressor()
+        self._input = None
+
+    @property
+    def eof(self):
+        return self._obj.eof
+
+    def feed(self, data):
+        if self._obj.eof and len(data):
+            raise ValueError("data after the end of the compressed stream")
+        self._input = data if len(data) else None
+
+    def read(self, limit=DECODE_LIMIT):
+        """
+        Returns the next piece of output, or b"" once the fed data is used up.
+        """
+        if self._input is None and (self._obj.needs_input or self._obj.eof):
+            return b""
+        data, self._input = (b"" if self._input is None else self._input), None
+        try:
+            out = self._obj.decompress(data, limit)
+        except self.codec.errors as e:
+            raise ValueError(f"corrupt {self.codec.name} stream: {e}")
+        if self._obj.eof and self._obj.unused_data:
+            raise ValueError("data after the end of the compressed stream")
+        return out
+
+    def read_all(self, data):
+        self.feed(data)
+        pieces = []
+        while True:
+            piece = self.read()
+            if not piece:
+                break
+            pieces.append(piece)
+        if not self.eof:
+            raise ValueError(f"truncated {self.codec.name} stream")
+        return b"".join(pieces)
@@ -0,0 +1,296 @@
+"""
+Delta transfer: sending a new version of a file as changes against the copy
+the server already stores, in the manner of rsync.
+
+The stored copy is cut into blocks of ``block_size`` bytes and the server
+sends one signature per block: a weak checksum that can be rolled along a
+file a byte at a time, and a strong one (truncated SHA-256) that confirms a
+match. The client slides a block-sized window over the data it has to
+send, and wherever the weak checksum of the window is one of the stored
+blocks' and the strong one agrees, it sends "copy block k" instead of the
+bytes. Everything between matches goes as literal data. Matches are found
+at any byte offset, so an insertion only costs the inserted bytes, not the
+rest of the file shifted behind it.
+
+The weak checksum of a window is the sum of WEIGHTS[byte] over its bytes: a
+fixed pseudo-random 16-bit weight per byte value, so that windows differing
+in a few bytes rarely collide, and rolling it is a subtraction of prefix
+sums. The client computes the prefix sums and tests every offset of a scan
+window with C-level itertools and operator calls, never a Python loop per
+byte; only candidate offsets are hashed.
+
+The delta itself is a byte stream of operations (it may be split across DATA
+frames anywhere and compressed like any upload):
+
+    b"C" | first block (I) | block count (I)     copy blocks of the stored copy
+    b"L" | length (I) | length bytes            literal data
+"""
+import hashlib
+import itertools
+import operator
+import os
+import struct
+import zlib
+
+MIN_BLOCK_SIZE = 2 << 10
+MAX_BLOCK_SIZE = 64 << 10
+MIN_DELTA_SIZE = 64 << 10  # smaller files are sent whole: a round trip for signatures costs more than they save
+SCAN_WINDOW = 512 << 10  # offsets tested per pass of the scanner; its prefix sums take ~40 bytes per byte
+
+FIRST_SCAN = 4  # blocks' worth of offsets scanned after a match before the scan widens, up to the window
+SPARSE_AFTER = 4 << 20  # bytes without a match after which the scanner only probes the start of each window
+
+SIGNATURE = struct.Struct("!I16s")  # weak checksum, strong checksum of one block
+COPY = struct.Struct("!cII")  # b"C", first block, block count
+LITERAL = struct.Struct("!cI")  # b"L", length
+
+# WEIGHTS[value] is added to the weak checksum for every byte of that value; part of the wire format
+WEIGHTS = tuple(int.from_bytes(hashlib.sha256(bytes([value])).digest()[:2], "big") for value in range(256))
+_HIGH = bytes(weight >> 8 for weight in WEIGHTS)  # translate tables: sum(WEIGHTS) = 256 * sum(high) + sum(low)
+_LOW = bytes(weight & 0xFF for weight in WEIGHTS)
+
+
+def block_size_for(size):
+    """
+    Block size for a file of ``size`` bytes: the largest power of two not
+    above its square root (rsync's rule of thumb), within MIN_ and MAX_BLOCK_SIZE.
+    Block sizes divide CHUNK_SIZE, so no block spans two stored chunks.
+    """
+    block_size = 1 << max(0, round(size ** 0.5).bit_length() - 1)
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def valid_block_size(block_size):
+    return isinstance(block_size, int) and MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE \
+        and not block_size & (block_size - 1)
+
+
+def weak_checksum(data):
+    data = bytes(data)
+    return (_byte_sum(data.translate(_HIGH)) << 8) + _byte_sum(data.translate(_LOW))
+
+
+def _byte_sum(data):
+    # the low half of zlib.adler32 is 1 + the sum of the bytes modulo 65521, which is exact for up to 256
+    # bytes; adding those up is several times faster than sum() over the bytes
+    view = memoryview(data)
+    return sum(zlib.adler32(view[start:start + 256]) & 0xFFFF for start in range(0, len(view), 256)) \
+        - -(-len(view) // 256)
+
+
+def strong_checksum(data):
+    return hashlib.sha256(data).digest()[:16]
+
+
+def block_signatures(data, block_size):
+    """
+    Returns the packed signatures of the blocks of ``data`` (the last one may be short).
+    """
+    view = memoryview(data)
+    high, low = (memoryview(bytes(view).translate(table)) for table in (_HIGH, _LOW))
+    return b"".join(SIGNATURE.pack((_byte_sum(high[start:start + block_size]) << 8)
+                                   + _byte_sum(low[start:start + block_size]),
+                                   strong_checksum(view[start:start + block_size]))
+                    for start in range(0, len(view), block_size))
+
+
+def chunk_blocks(chunks, chunk_size, block_size, size):
+    """
+    Indexes of the blocks that make up the given chunks of a file of ``size`` bytes.
+    """
+    per_chunk = chunk_size // block_size
+    count = -(-size // block_size)
+    return [block for chunk in chunks for block in range(chunk * per_chunk, min(count, (chunk + 1) * per_chunk))]
+
+
+class SignatureIndex:
+    """
+    The signatures of a stored file, indexed for the scanner: of all its
+    blocks, or of the blocks listed in ``blocks``, in that order.
+    """
+
+    def __init__(self, signatures, block_size, size, blocks=None):
+        self.block_size = block_size
+        self.size = size  # of the stored file
+        self.count = -(-size // block_size)
+        if blocks is None:
+            blocks = range(self.count)
+        if len(signatures) != len(blocks) * SIGNATURE.size:
+            raise ValueError(f"expected {len(blocks)} block signatures, got {len(signatures) // SIGNATURE.size}")
+        self.blocks = {}  # weak checksum -> {strong checksum: block index} of the full blocks
+        self.strong = {}  # strong checksum -> block index of the full blocks
+        self.tail = None  # (length, weak, strong, index) of a short last block
+        for index, (weak, strong) in zip(blocks, SIGNATURE.iter_unpack(signatures)):
+            length = min(block_size, size - index * block_size)
+            if length < block_size:
+                self.tail = (length, weak, strong, index)
+            else:
+                self.blocks.setdefault(weak, {}).setdefault(strong, index)
+                self.strong.setdefault(strong, index)
+
+    def candidates(self, data, start, count):
+        """
+        Returns (offset, weak checksum) for every offset in [start, start +
+        count) at which the block-sized window of ``data`` has the weak
+        checksum of a stored block.
+        """
+        block_size = self.block_size
+        sums = list(itertools.accumulate(map(WEIGHTS.__getitem__, data[start:start + count + block_size - 1]),
+                                         initial=0))
+        weak = map(operator.sub, itertools.islice(sums, block_size, None), sums)
+        hits = itertools.compress(itertools.count(), map(self.blocks.__contains__, weak))
+        return [(start + offset, sums[offset + block_size] - sums[offset]) for offset in hits]
+
+    def match(self, window, weak=None):
+        """
+        Index of the stored block ``window`` is a copy of, or None. Without
+        its ``weak`` checksum the strong one is looked up among all blocks.
+        """
+        if weak is None:
+            return self.strong.get(strong_checksum(window))
+        return self.blocks[weak].get(strong_checksum(window))
+
+
+def _pread(fd, start, end):
+    pieces = []
+    while start < end:
+        data = os.pread(fd, end - start, start)
+        if not data:
+            raise EOFError("file ended before the range did")
+        pieces.append(data)
+        start += len(data)
+    return b"".join(pieces)
+
+
+def encode_delta(fd, ranges, index, size, window=SCAN_WINDOW):
+    """
+    Encodes byte ``ranges`` of an open file of ``size`` bytes as a delta
+    against the stored file ``index`` describes. Yields (operations, bytes
+    matched, bytes covered) for every scan window, so the caller can send
+    one while the next is computed. A match never crosses a range boundary.
+    """
+    block_size = index.block_size
+    unmatched = 0  # bytes scanned since the last match
+    following = False  # the last block matched, so the next one probably does too
+    for start, end in ranges:
+        position = start
+        while position < end:
+            data = _pread(fd, position, min(end, position + window + block_size - 1))
+            view = memoryview(data)
+            offsets = max(0, min(window, len(data) - block_size + 1))  # window starts tested in this pass
+            operations = bytearray()
+            matched = 0
+            literal = 0  # start of the bytes not yet encoded
+            copy = None  # [first block, count] of a run of consecutive blocks not yet encoded
+
+            def flush(until):
+                nonlocal copy
+                if copy is not None:
+                    operations.extend(COPY.pack(b"C", *copy))
+                    copy = None
+                if literal < until:
+                    operations.extend(LITERAL.pack(b"L", until - literal))
+                    operations.extend(view[literal:until])
+
+            def copied(at, block, length):
+                nonlocal copy, literal, matched, unmatched, following
+                if at == literal and copy is not None and copy[0] + copy[1] == block:
+                    copy[1] += 1
+                else:
+                    flush(at)
+                    copy = [block, 1]
+                literal = at + length
+                matched += length
+                unmatched = 0
+                following = True
+
+            offset = 0
+            scan = FIRST_SCAN * block_size
+            while offset < offsets and index.blocks:
+                if following:
+                    # right after a match the next block usually follows unchanged: try it before scanning
+                    block = index.match(view[offset:offset + block_size])
+                    if block is not None:
+                        copied(offset, block, block_size)
+                        offset = literal
+                        continue
+                    following = False
+                count = min(scan, offsets - offset)
+                for candidate, weak in index.candidates(data, offset, count):
+                    block = index.match(view[candidate:candidate + block_size], weak)
+                    if block is not None:
+                        copied(candidate, block, block_size)
+                        offset = literal
+                        scan = FIRST_SCAN * block_size
+                        break
+                else:
+                    unmatched += count
+                    if unmatched < SPARSE_AFTER:
+                        offset += count
+                        scan = min(2 * scan, window)  # a long change: scan further ahead at a time
+                    else:
+                        # nothing matched for long (new or rewritten data): only probe once per window, so
+                        # unrelated data is not scanned offset by offset while shifted old data is still found
+                        offset = offsets
+                        scan = FIRST_SCAN * block_size
+            covered = max(literal, offsets)
+            if position + len(data) == end:  # nothing follows in this range
+                covered = len(data)
+                if end == size and index.tail is not None:  # the stored file's short last block can only end a file
+                    length, weak, strong, block = index.tail
+                    at = len(data) - length
+                    if at >= literal and weak_checksum(view[at:]) == weak and strong_checksum(view[at:]) == strong:
+                        copied(at, block, length)
+            flush(covered)
+            yield bytes(operations), matched, covered
+            position += covered
+
+
+class DeltaParser:
+    """
+    Splits a delta stream, fed in arbitrary pieces, into operations:
+    ("copy", start, end) for a byte range of the stored file and
+    ("literal", view) for (a piece of) literal data.
+    """
+
+    def __init__(self, block_size, size):
+        self.block_count = -(-size // block_size)
+        self.block_size = block_size
+        self.size = size  # of the stored file
+        self._header = bytearray()
+        self._literal = 0  # bytes of the current literal still to come
+
+    @property
+    def pending(self):
+        """
+        True in the middle of an operation.
+        """
+        return bool(self._header or self._literal)
+
+    def feed(self, view):
+        operations = []
+        view = memoryview(view)
+        while view:
+            if self._literal:
+                count = min(self._literal, len(view))
+                operations.append(("literal", view[:count]))
+                self._literal -= count
+                view = view[count:]
+                continue
+            if not self._header and view[0] not in b"CL":
+                raise ValueError(f"unknown delta operation {bytes(view[:1])!r}")
+            wanted = (COPY if (self._header[:1] or view[:1]) == b"C" else LITERAL).size - len(self._header)
+            self._header += view[:wanted]
+            view = view[wanted:]
+            if self._header[:1] == b"L" and len(self._header) == LITERAL.size:
+                self._literal = LITERAL.unpack(self._header)[1]
+                self._header.clear()
+                if not self._literal:
+                    raise ValueError("empty delta literal")
+            elif len(self._header) == COPY.size:
+                tag, first, count = COPY.unpack(self._header)
+                self._header.clear()
+                if count < 1 or first + count > self.block_count:
+                    raise ValueError(f"delta copies blocks {first}..{first + count - 1} of {self.block_count}")
+                operations.append(("copy", first * self.block_size, min(self.size, (first + count) * self.block_size)))
+        return operations
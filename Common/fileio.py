@@ -0,0 +1,73 @@
+"""
+Disk-side helpers for the transfer paths: reusable receive buffers, file
+preallocation and complete writes from a memoryview.
+"""
+import os
+
+DEFAULT_BUFFER_SIZE = 1 << 20  # 1 MiB: one recv_into/write pair per MiB moved
+
+
+class BufferPool:
+    """
+    Hands out fixed-size bytearray buffers and takes them back for reuse, so a
+    busy server does not allocate a fresh buffer for every transfer.
+    """
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, max_idle=64):
+        self.buffer_size = buffer_size
+        self.max_idle = max_idle  # buffers kept around when nobody is using them
+        self._idle = []
+
+    def acquire(self):
+        """
+        Returns a writable memoryview of ``buffer_size`` bytes.
+        """
+        if self._idle:
+            return memoryview(self._idle.pop())
+        return memoryview(bytearray(self.buffer_size))
+
+    def release(self, view):
+        """
+        Takes back a buffer from acquire(); any slice of it will do.
+        """
+        buffer = view.obj
+        if len(self._idle) < self.max_idle and len(buffer) == self.buffer_size:
+            self._idle.append(buffer)
+
+
+def preallocate(fd, size):
+    """
+    Reserves ``size`` bytes for the file behind ``fd`` up front so concurrent
+    uploads do not interleave their extents on disk. Returns False when the
+    platform or filesystem cannot do it; the write path works either way.
+    """
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+        return True
+    except OSError:
+        return False  # e.g. EOPNOTSUPP on filesystems without fallocate
+
+
+def write_all(fd, view):
+    """
+    Writes the whole memoryview to ``fd``, retrying short writes.
+    """
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def pwrite_all(fd, view, offset):
+    """
+    Writes the whole memoryview at ``offset`` without moving a shared file position.
+    """
+    if not hasattr(os, "pwrite"):  # Windows: no positional writes
+        os.lseek(fd, offset, os.SEEK_SET)
+        write_all(fd, view)
+        return
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
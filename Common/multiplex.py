@@ -0,0 +1,334 @@
+"""
+Stream multiplexing over one AsyncConnection.
+
+A Multiplexer owns the connection's read side: its run() loop reads every
+frame, hands DATA payloads (in pooled buffers) and control messages to the
+Stream they belong to, and applies WINDOW_UPDATE credit. All writes go
+through the multiplexer's write lock one frame at a time, so frames from
+concurrent streams interleave but never tear.
+
+Rules on top of protocol.py:
+
+* The client opens streams with odd ids; the server only answers them.
+* ERROR and CANCEL abandon a stream in both directions, so a sender stops
+  as soon as the peer reports a failure.
+* DATA credit is returned in batches once a quarter of the window has been
+  consumed, which keeps WINDOW_UPDATE traffic to a few frames per window.
+* Control frames waiting for the write lock go before waiting DATA frames,
+  so a LIST reply or a WINDOW_UPDATE is never stuck behind a frame of every
+  transfer on the connection.
+"""
+import asyncio
+import collections
+import contextlib
+
+from Common import protocol
+from Common.protocol import (CANCEL, CONTROL_STREAM, DATA, DISCONNECT, ERROR, FLAG_END_STREAM, INITIAL_WINDOW,
+                             MAX_DATA_FRAME, REQUEST_OPCODES, WINDOW_UPDATE, ProtocolError)
+
+WINDOW_UPDATE_THRESHOLD = INITIAL_WINDOW // 4  # consumed bytes that trigger a WINDOW_UPDATE
+
+
+class StreamCancelled(ConnectionError):
+    """
+    Raised when the peer abandoned the stream or the connection went away.
+    """
+
+
+class WriteLock:
+    """
+    Mutex over a connection's writes with two classes of waiters: urgent
+    ones (control frames) get the lock before any bulk one (DATA).
+    """
+
+    def __init__(self):
+        self.locked = False
+        self._waiters = (collections.deque(), collections.deque())  # urgent, bulk
+
+    @contextlib.asynccontextmanager
+    async def hold(self, urgent=False):
+        if self.locked:
+            future = asyncio.get_running_loop().create_future()
+            queue = self._waiters[0 if urgent else 1]
+            queue.append(future)
+            try:
+                await future  # release() hands the lock over by resolving it
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._release()  # handed over just as the wait was cancelled
+                else:
+                    with contextlib.suppress(ValueError):
+                        queue.remove(future)
+                raise
+        else:
+            self.locked = True
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        for queue in self._waiters:
+            while queue:
+                future = queue.popleft()
+                if not future.done():
+                    future.set_result(None)
+                    return
+        self.locked = False
+
+
+class Stream:
+    """
+    One request/response exchange on a multiplexed connection.
+    """
+
+    def __init__(self, mux, stream_id):
+        self.mux = mux
+        self.id = stream_id
+        self.inbox = asyncio.Queue()  # (opcode, flags, payload); payload is a memoryview for DATA, else a dict
+        self.send_window = INITIAL_WINDOW  # DATA bytes we may still send before the peer grants more
+        self.recv_window = INITIAL_WINDOW  # DATA bytes the peer may still send us
+        self.cancelled = False  # peer sent ERROR/CANCEL or the connection closed
+        self.failed = False  # we answered with ERROR
+        self._window_open = asyncio.Event()
+        self._window_open.set()
+        self._unacknowledged = 0  # consumed bytes not yet returned with WINDOW_UPDATE
+
+    # ------------------------------------------------------------------ receiving
+
+    async def receive(self):
+        """
+        Returns the next (opcode, flags, payload) sent by the peer on this stream.
+        """
+        item = await self.inbox.get()
+        if item is None:
+            raise StreamCancelled("connection closed")
+        return item
+
+    async def receive_message(self):
+        """
+        Returns the next control message as (opcode, flags, fields).
+        """
+        opcode, flags, payload = await self.receive()
+        if opcode == DATA:
+            self.consumed(payload)
+            raise ProtocolError("unexpected DATA frame")
+        return opcode, flags, payload
+
+    def consumed(self, piece):
+        """
+        Returns a DATA buffer to the pool and credits the peer for its bytes.
+        """
+        self.mux.buffer_pool.release(piece)
+        self.recv_window += len(piece)
+        self._unacknowledged += len(piece)
+        if self._unacknowledged >= WINDOW_UPDATE_THRESHOLD and not self.cancelled:
+            increment, self._unacknowledged = self._unacknowledged, 0
+            self.mux.post(protocol.encode_message(WINDOW_UPDATE, {"increment": increment}, stream_id=self.id))
+
+    # ------------------------------------------------------------------ sending
+
+    async def reserve(self, wanted):
+        """
+        Waits for send credit and takes up to ``wanted`` bytes of it.
+        Returns 0 if the stream was abandoned.
+        """
+        while True:
+            if self.cancelled or self.mux.closed:
+                return 0
+            if self.send_window > 0:
+                granted = min(wanted, self.send_window)
+                self.send_window -= granted
+                return granted
+            self._window_open.clear()
+            await self._window_open.wait()
+
+    async def send_message(self, opcode, fields=None, end=False):
+        flags = FLAG_END_STREAM if end else 0
+        await self.mux.send(protocol.encode_message(opcode, fields, flags, self.id))
+
+    async def send_error(self, message):
+        self.failed = True
+        await self.send_message(ERROR, {"message": message}, end=True)
+
+    async def send_data(self, data, end=True):
+        """
+        Sends ``data`` as flow-controlled DATA frames.
+        """
+        view = memoryview(data)
+        while True:
+            count = await self._reserve_frame(len(view))
+            last = count == len(view)
+            await self.mux.send_frame(protocol.pack_header(DATA, count, FLAG_END_STREAM if end and last else 0, self.id),
+                                      view[:count])
+            view = view[count:]
+            if last:
+                return
+
+    async def send_file(self, file, offset, count, end=True, zero_copy=True):
+        """
+        Sends ``count`` bytes of ``file`` as flow-controlled DATA frames, with sendfile.
+        """
+        while True:
+            size = await self._reserve_frame(count)
+            last = size == count
+            flags = FLAG_END_STREAM if end and last else 0
+            await self.mux.send_file_frame(protocol.pack_header(DATA, size, flags, self.id), file, offset, size,
+                                           zero_copy)
+            offset += size
+            count -= size
+            if last:
+                return
+
+    async def _reserve_frame(self, remaining):
+        if remaining == 0:
+            return 0  # an empty DATA frame still marks the end of the payload
+        count = await self.reserve(min(remaining, MAX_DATA_FRAME))
+        if not count:
+            raise StreamCancelled(f"stream {self.id} was cancelled")
+        return count
+
+    async def cancel(self):
+        if not self.cancelled and not self.mux.closed:
+            self.cancelled = True
+            await self.send_message(CANCEL, end=True)
+        self.close()
+
+    def close(self):
+        """
+        Forgets the stream; late frames for it are ignored. Unread DATA goes back to the pool.
+        """
+        self.mux.streams.pop(self.id, None)
+        while not self.inbox.empty():
+            item = self.inbox.get_nowait()
+            if item is not None and item[0] == DATA:
+                self.mux.buffer_pool.release(item[2])
+
+    # ------------------------------------------------------------------ called by the reader loop
+
+    def _add_window(self, increment):
+        self.send_window += increment
+        self._window_open.set()
+
+    def _abandon(self):
+        self.cancelled = True
+        self._window_open.set()
+
+
+class Multiplexer:
+    """
+    Demultiplexes frames of one connection onto Streams and serializes writes.
+    """
+
+    def __init__(self, conn, buffer_pool, first_stream_id=None, on_request=None, on_control=None):
+        self.conn = conn
+        self.buffer_pool = buffer_pool  # DATA payloads are read into these buffers
+        self.on_request = on_request  # callback(stream) for streams the peer opens
+        self.on_control = on_control  # callback(opcode, fields) for stream 0 frames
+        self.streams = {}
+        self.closed = False
+        self.write_lock = WriteLock()
+        self._next_stream_id = first_stream_id  # None: this side never opens streams
+        self._posted = set()
+
+    def open_stream(self):
+        stream = Stream(self, self._next_stream_id)
+        self._next_stream_id += 2
+        self.streams[stream.id] = stream
+        return stream
+
+    # ------------------------------------------------------------------ writing
+
+    async def send(self, frame):
+        async with self.write_lock.hold(urgent=True):
+            await self.conn.send(frame)
+
+    async def send_frame(self, header, payload):
+        async with self.write_lock.hold():
+            await self.conn.send(header)
+            if payload:
+                await self.conn.send(payload)
+
+    async def send_file_frame(self, header, file, offset, count, zero_copy=True):
+        async with self.write_lock.hold():
+            await self.conn.send(header)
+            if count:
+                await self.conn.sendfile(file, offset, count, zero_copy=zero_copy)
+
+    def post(self, frame):
+        """
+        Sends a small frame in the background (used for WINDOW_UPDATE).
+        """
+        task = asyncio.get_running_loop().create_task(self._send_posted(frame))
+        self._posted.add(task)
+        task.add_done_callback(self._posted.discard)
+
+    async def _send_posted(self, frame):
+        try:
+            await self.send(frame)
+        except OSError:
+            pass  # the reader loop notices the broken connection and cleans up
+
+    async def send_control(self, opcode, fields=None):
+        await self.send(protocol.encode_message(opcode, fields, stream_id=CONTROL_STREAM))
+
+    # ------------------------------------------------------------------ reading
+
+    async def run(self):
+        """
+        Reads frames until the peer disconnects. Returns after a DISCONNECT
+        frame; raises ConnectionError if the connection drops.
+        """
+        try:
+            while True:
+                opcode, flags, stream_id, length = await self.conn.read_header()
+                if opcode == DATA:
+                    await self._read_data(flags, stream_id, length)
+                    continue
+
+                fields = protocol.decode_message(await self.conn.read_payload(length))
+                if stream_id == CONTROL_STREAM:
+                    if self.on_control is not None:
+                        self.on_control(opcode, fields)
+                    if opcode == DISCONNECT:
+                        return
+                    continue
+
+                stream = self.streams.get(stream_id)
+                if opcode == WINDOW_UPDATE:
+                    if stream is not None:
+                        stream._add_window(fields.get("increment", 0))
+                    continue
+                if stream is None:
+                    if opcode in REQUEST_OPCODES and self.on_request is not None and stream_id % 2 == 1:
+                        stream = self.streams[stream_id] = Stream(self, stream_id)
+                        stream.inbox.put_nowait((opcode, flags, fields))
+                        self.on_request(stream)
+                    continue  # otherwise a late frame for a stream we already closed
+                if opcode in (ERROR, CANCEL):
+                    stream._abandon()
+                stream.inbox.put_nowait((opcode, flags, fields))
+        finally:
+            self.closed = True
+            for stream in list(self.streams.values()):
+                stream._abandon()
+                stream.inbox.put_nowait(None)  # wake anyone waiting in receive()
+
+    async def _read_data(self, flags, stream_id, length):
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            await self.conn.discard(length)  # the stream was already closed on our side
+            return
+        if length > stream.recv_window:
+            raise ProtocolError(f"stream {stream_id} exceeded its flow control window")
+        stream.recv_window -= length
+        if length == 0:
+            stream.inbox.put_nowait((DATA, flags, memoryview(b"")))
+            return
+        remaining = length
+        while remaining:
+            buffer = self.buffer_pool.acquire()
+            piece = buffer[:min(remaining, len(buffer))]
+            await self.conn.readinto(piece)
+            remaining -= len(piece)
+            stream.inbox.put_nowait((DATA, flags if not remaining else flags & ~FLAG_END_STREAM, piece))
@@ -0,0 +1,154 @@
+"""
+Wire format shared by the client and the server.
+
+Every message is a frame: a fixed header followed by ``length`` payload bytes.
+
+    magic (2s) | version (B) | opcode (B) | flags (H) | stream id (I) | length (Q)
+
+Control messages carry a small JSON object as payload. File contents travel
+in DATA frames whose 64-bit length is the exact number of bytes that follow,
+so the receiver never scans the payload for a marker and reads exactly that
+many bytes into a preallocated buffer.
+
+Stream 0 carries the connection handshake and DISCONNECT. Every request opens
+its own stream (the client picks odd ids), so one connection can carry
+several uploads, downloads and LISTs at once. The last frame a side sends on
+a stream has FLAG_END_STREAM set. DATA is flow controlled per stream: a
+sender may have at most INITIAL_WINDOW unacknowledged bytes in flight and the
+receiver returns credit with WINDOW_UPDATE as it consumes them.
+
+A client may open extra data connections that join its session (HELLO with
+the session token from WELCOME) to move one large file over several TCP
+connections. A parallel upload is announced with "parallel" on one stream;
+the server's OK carries an upload_id, the byte ranges arrive as UPLOAD part
+streams naming it, and the announcing stream ends with an empty DATA frame
+once every part is in. A parallel download is a set of ranged DOWNLOADs.
+
+Transfers are checked end to end with chunk digests. An upload either
+announces the SHA-256 of every chunk up front, or ends each stream's DATA
+with a TRAILER carrying the checksum of the chunks it sent; a download's
+OK carries the file checksum for the client to compare.
+
+An upload with "delta" (a block size) and announced chunks asks to send
+its data as a delta against the stored file of that name (Common/delta.py).
+If there is one, the server's OK carries "delta" and is followed by DATA
+frames with the block signatures of the stored chunks the new version does
+not reuse; the client's DATA is then the delta's operations instead of the
+missing ranges themselves.
+
+A DOWNLOAD with "if_none_match" (a version, as an earlier download's OK
+carried it) asks only for changes: if the file still has that version, the
+server answers with an OK whose "status" is "Not Modified" and which ends
+the stream without any DATA, so a client with a cached copy revalidates it
+in one round trip. The owner is not told of such a download.
+
+A bundle moves many small files in one request, so a batch of them is not
+limited by round trips. An UPLOAD with "bundle" (a list of {"filename",
+"size", "chunks"}) is answered with every file's status and missing ranges;
+its DATA is the missing ranges of all the files back to back, and the
+server commits the files in one catalog transaction before its final OK. A
+DOWNLOAD with "bundle" (a list of names) is answered with every file's size,
+version and checksum (or an error), followed by the contents of the files
+found, back to back, as one stream. A bundle names at most MAX_BUNDLE_FILES
+files.
+
+A replica (Server/replication.py) follows a primary's catalog with
+REPLICATE requests, each asking for the changes after the last one it
+applied; the primary answers as soon as there are any, or after "wait"
+seconds with none. Replicas serve LIST and DOWNLOAD and refuse UPLOAD and
+DELETE with an ERROR starting with "READ ONLY". The final OK of an upload
+or delete on the primary carries "change", the position of its log that
+includes it; a LIST or DOWNLOAD with "after_change" is answered by a
+replica only once it has applied that change, or refused with an ERROR
+starting with "REPLICA BEHIND", so a client reads its own writes.
+
+A server running as many transfers as it admits refuses an UPLOAD or
+DOWNLOAD with an ERROR whose message starts with "SERVER BUSY"; unlike other
+refusals it is worth retrying later. A server of several worker processes
+answers a HELLO the same way while the worker of that username restarts.
+"""
+import json
+import struct
+
+MAGIC = b"FS"
+PROTOCOL_VERSION = 2
+
+HEADER = struct.Struct("!2sBBHIQ")
+HEADER_SIZE = HEADER.size
+
+CONTROL_STREAM = 0  # stream id of connection-level frames
+DEFAULT_NOTIFICATION_PORT = 9001  # separate port for SUBSCRIBE/NOTIFY connections
+INITIAL_WINDOW = 4 << 20  # per-stream DATA credit before the first WINDOW_UPDATE
+MAX_DATA_FRAME = 1 << 20  # largest DATA payload a sender puts in one frame, so streams interleave
+
+# flags
+FLAG_END_STREAM = 0x0001  # last frame the sender will send on this stream
+
+MAX_CONTROL_PAYLOAD = 1 << 20  # JSON messages larger than this are rejected
+MAX_BUNDLE_FILES = 1000  # files in one bundle request, so its request and replies stay far below that
+
+# opcodes
+HELLO = 0x01  # client -> server: {"username", "session"?}; a session token opens an extra data connection
+WELCOME = 0x02  # server -> client: username accepted, {"session"}
+DISCONNECT = 0x03  # either side: the connection is closing
+WINDOW_UPDATE = 0x04  # {"increment"}: the receiver consumed DATA, the sender may send that much more
+CANCEL = 0x05  # either side: abandon the stream
+SUBSCRIBE = 0x06  # notification connection, client -> server: {"username", "topics"}
+NOTIFY = 0x07  # notification connection, server -> client: {"event", "message", ...}
+UPLOAD = 0x10  # {"filename", "size", "source"?, "chunks"?, "checksum"?, "compression"?, "parallel"?, "delta"?},
+#                 or {"upload_id", "ranges"}, or {"bundle", "compression"?}
+LIST = 0x11  # {"owner"?, "prefix"?, "modified_after"?, "modified_before"?, "sort"?, "limit"?, "cursor"?}
+DELETE = 0x12  # {"filename"}
+DOWNLOAD = 0x13  # {"filename", "ranges"?, "version"?, "compression"?, "part"?, "if_none_match"?},
+#                   or {"bundle", "compression"?}
+REPLICATE = 0x14  # replica -> primary: {"after", "log"?, "wait"?}; OK {"log", "head", "changes"}
+DATA = 0x20  # raw file bytes
+TRAILER = 0x21  # {"checksum"}: ends an upload stream's DATA; file_checksum() of the chunk digests it carried
+OK = 0x30  # request accepted / completed, JSON details
+ERROR = 0x31  # {"message"}
+
+OPCODE_NAMES = {
+    HELLO: "HELLO", WELCOME: "WELCOME", DISCONNECT: "DISCONNECT", WINDOW_UPDATE: "WINDOW_UPDATE", CANCEL: "CANCEL",
+    SUBSCRIBE: "SUBSCRIBE", NOTIFY: "NOTIFY",
+    UPLOAD: "UPLOAD", LIST: "LIST", DELETE: "DELETE", DOWNLOAD: "DOWNLOAD", REPLICATE: "REPLICATE",
+    DATA: "DATA", TRAILER: "TRAILER", OK: "OK", ERROR: "ERROR",
+}
+REQUEST_OPCODES = frozenset((UPLOAD, LIST, DELETE, DOWNLOAD, REPLICATE))  # frames that open a new stream
+
+
+class ProtocolError(Exception):
+    """
+    Raised when the peer sends something that is not a valid frame.
+    """
+
+
+def pack_header(opcode, length, flags=0, stream_id=CONTROL_STREAM):
+    return HEADER.pack(MAGIC, PROTOCOL_VERSION, opcode, flags, stream_id, length)
+
+
+def unpack_header(data):
+    """
+    Returns (opcode, flags, stream_id, length) for a HEADER_SIZE-byte header.
+    """
+    magic, version, opcode, flags, stream_id, length = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ProtocolError("bad frame magic")
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"unsupported protocol version {version}")
+    if opcode not in OPCODE_NAMES:
+        raise ProtocolError(f"unknown opcode {opcode:#x}")
+    return opcode, flags, stream_id, length
+
+
+def encode_message(opcode, fields=None, flags=0, stream_id=CONTROL_STREAM):
+    """
+    Builds a complete control frame with a JSON payload.
+    """
+    payload = json.dumps(fields).encode() if fields is not None else b""
+    return pack_header(opcode, len(payload), flags, stream_id) + payload
+
+
+def decode_message(payload):
+    if not payload:
+        return {}
+    return json.loads(payload)
@@ -0,0 +1,43 @@
+"""
+Chunk manifests (Common/chunks.py), which let an interrupted transfer resume.
+"""
+from Common.chunks import CHUNK_SIZE, ChunkManifest, file_checksum
+
+SIZE = 3 * CHUNK_SIZE + 100
+
+
+def test_missing_ranges_merge_adjacent_chunks():
+    manifest = ChunkManifest(SIZE)
+    assert manifest.missing_ranges() == [[0, SIZE]]
+    manifest.mark(1, "11" * 32)
+    assert manifest.missing_ranges() == [[0, CHUNK_SIZE], [2 * CHUNK_SIZE, SIZE]]
+    assert manifest.received_bytes() == CHUNK_SIZE
+    assert not manifest.complete()
+
+
+def test_last_chunk_is_short():
+    manifest = ChunkManifest(SIZE)
+    assert manifest.chunk_range(3) == (3 * CHUNK_SIZE, SIZE)
+
+
+def test_saved_manifest_resumes(tmp_path):
+    path = str(tmp_path / "upload.part.json")
+    manifest = ChunkManifest(SIZE, source="laptop:/data/file.bin", owner="alice")
+    manifest.mark(0, "00" * 32)
+    manifest.mark(2, "22" * 32)
+    manifest.save(path)
+
+    resumed = ChunkManifest.load(path)
+    assert (resumed.size, resumed.source, resumed.owner) == (SIZE, "laptop:/data/file.bin", "alice")
+    assert resumed.missing_ranges() == [[CHUNK_SIZE, 2 * CHUNK_SIZE], [3 * CHUNK_SIZE, SIZE]]
+    for index in (1, 3):
+        resumed.mark(index, f"{index}{index}" * 32)
+    assert resumed.complete()
+    assert file_checksum(resumed.digests) == file_checksum([f"{index}{index}" * 32 for index in range(4)])
+
+
+def test_unreadable_manifest_is_ignored(tmp_path):
+    path = tmp_path / "upload.part.json"
+    assert ChunkManifest.load(str(path)) is None
+    path.write_text("{not json")
+    assert ChunkManifest.load(str(path)) is None
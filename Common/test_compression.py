@@ -0,0 +1,60 @@
+"""
+Codec negotiation and the streaming Encoder/Decoder.
+"""
+import os
+
+import pytest
+
+from Common import compression
+from Common.compression import Decoder, Encoder
+
+
+def test_negotiate_picks_the_first_known_codec():
+    assert compression.negotiate(["brotli", "lzma", "zlib"]) == "lzma"
+    assert compression.negotiate(["brotli"]) is None
+    assert compression.negotiate([]) is None
+    for offered in ("zlib", None, [["zlib"]], {"zlib": 1}):
+        assert compression.negotiate(offered) is None
+
+
+@pytest.mark.parametrize("codec", sorted(compression.CODECS))
+def test_streamed_round_trip(codec):
+    data = b"".join(b"line %d of a log file\n" % number for number in range(20000)) + os.urandom(5000)
+    encoder = Encoder(codec)
+    wire = b"".join(encoder.compress(data[start:start + 7000], final=start + 7000 >= len(data))
+                    for start in range(0, len(data), 7000))
+    assert len(wire) < len(data) // 2
+    decoder, out = Decoder(codec), []
+    for start in range(0, len(wire), 1000):  # frames arrive in arbitrary pieces
+        decoder.feed(wire[start:start + 1000])
+        while piece := decoder.read():
+            out.append(piece)
+    assert decoder.eof and b"".join(out) == data
+
+
+@pytest.mark.parametrize("codec", sorted(compression.CODECS))
+def test_output_is_bounded(codec):
+    decoder = Decoder(codec)
+    decoder.feed(compression.compress(codec, bytes(5 * compression.DECODE_LIMIT)))
+    pieces = []
+    while piece := decoder.read():
+        assert len(piece) <= compression.DECODE_LIMIT
+        pieces.append(piece)
+    assert sum(map(len, pieces)) == 5 * compression.DECODE_LIMIT
+
+
+@pytest.mark.parametrize("codec", sorted(compression.CODECS))
+def test_bad_streams_raise_value_error(codec):
+    packed = compression.compress(codec, b"some text " * 1000)
+    with pytest.raises(ValueError):
+        compression.decompress(codec, packed[:len(packed) // 2])  # truncated
+    with pytest.raises(ValueError):
+        compression.decompress(codec, packed + b"extra")
+    with pytest.raises(ValueError):
+        compression.decompress(codec, b"\xff" * 64)
+
+
+def test_compressible():
+    assert compression.compressible([b"abc" * 10000])
+    assert not compression.compressible([os.urandom(64 << 10)])
+    assert not compression.compressible([])
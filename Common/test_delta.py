@@ -0,0 +1,102 @@
+"""
+Delta encoding against block signatures, and parsing the delta stream back.
+"""
+import os
+import random
+
+import pytest
+
+from Common import delta
+from Common.delta import DeltaParser, SignatureIndex, block_signatures, encode_delta
+
+BLOCK = delta.MIN_BLOCK_SIZE
+
+
+def encoded(tmp_path, old, new, block_size=BLOCK, ranges=None):
+    """
+    Returns (delta stream, bytes matched) of ``new`` against ``old``.
+    """
+    path = tmp_path / "new"
+    path.write_bytes(new)
+    index = SignatureIndex(block_signatures(old, block_size), block_size, len(old))
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        windows = list(encode_delta(fd, ranges or [(0, len(new))], index, len(new), window=4 * block_size))
+    finally:
+        os.close(fd)
+    return b"".join(operations for operations, matched, covered in windows), sum(window[1] for window in windows)
+
+
+def applied(stream, old, block_size=BLOCK, piece=None):
+    parser, out = DeltaParser(block_size, len(old)), bytearray()
+    for start in range(0, len(stream), piece or max(1, len(stream))):
+        for operation in parser.feed(stream[start:start + (piece or len(stream))]):
+            out += old[operation[1]:operation[2]] if operation[0] == "copy" else operation[1]
+    assert not parser.pending
+    return bytes(out)
+
+
+def test_matches_are_found_at_shifted_offsets(tmp_path):
+    old = random.Random(1).randbytes(20 * BLOCK)
+    new = old[:3 * BLOCK + 5] + b"inserted" + old[3 * BLOCK + 5:10 * BLOCK] + old[11 * BLOCK:]  # insert and cut
+    stream, matched = encoded(tmp_path, old, new)
+    assert applied(stream, old) == new
+    assert matched >= len(new) - 3 * BLOCK  # only the blocks around the edits go as literals
+    assert len(stream) < 3 * BLOCK
+
+
+def test_short_tail_block_ends_the_file(tmp_path):
+    old = random.Random(2).randbytes(5 * BLOCK + 100)
+    stream, matched = encoded(tmp_path, old, b"!" + old)  # the whole file shifted by one byte
+    assert applied(stream, old) == b"!" + old and matched == len(old)
+    moved = old[-100:] + old[:-100] + b"end"  # the tail block's bytes, but not at the end
+    stream, matched = encoded(tmp_path, old, moved)
+    assert applied(stream, old) == moved and matched == len(old) - 100
+
+
+def test_unrelated_data_is_sent_as_literals(tmp_path):
+    old, new = random.Random(3).randbytes(8 * BLOCK), random.Random(4).randbytes(8 * BLOCK + 7)
+    stream, matched = encoded(tmp_path, old, new)
+    assert matched == 0 and applied(stream, old) == new
+
+
+def test_only_the_given_ranges_are_encoded(tmp_path):
+    old = random.Random(5).randbytes(8 * BLOCK)
+    new = old[:4 * BLOCK] + b"x" * BLOCK + old[5 * BLOCK:]
+    stream, matched = encoded(tmp_path, old, new, ranges=[(2 * BLOCK, 6 * BLOCK)])
+    assert applied(stream, old) == new[2 * BLOCK:6 * BLOCK] and matched == 3 * BLOCK
+
+
+def test_parser_takes_the_stream_in_any_pieces(tmp_path):
+    old = random.Random(6).randbytes(6 * BLOCK + 17)
+    new = old[:BLOCK] + b"changed" + old[BLOCK + 7:]
+    stream, matched = encoded(tmp_path, old, new)
+    assert applied(stream, old, piece=1) == applied(stream, old, piece=5) == new
+
+
+@pytest.mark.parametrize("stream", [
+    b"X",
+    delta.COPY.pack(b"C", 3, 2),  # past the last of 4 blocks
+    delta.COPY.pack(b"C", 0, 0),
+    delta.LITERAL.pack(b"L", 0),
+])
+def test_invalid_streams_are_refused(stream):
+    with pytest.raises(ValueError):
+        DeltaParser(BLOCK, 4 * BLOCK).feed(stream)
+
+
+def test_block_sizes():
+    assert delta.block_size_for(0) == delta.MIN_BLOCK_SIZE
+    assert delta.block_size_for(1 << 40) == delta.MAX_BLOCK_SIZE
+    assert delta.block_size_for(64 << 20) == 8 << 10
+    assert delta.valid_block_size(4096) and not delta.valid_block_size(3000)
+    assert not delta.valid_block_size(True) and not delta.valid_block_size(1 << 20)
+    assert delta.chunk_blocks([1], 4 * BLOCK, BLOCK, 6 * BLOCK + 1) == [4, 5, 6]
+
+
+def test_weak_checksum_matches_the_signatures():
+    data = random.Random(7).randbytes(3 * BLOCK)
+    index = SignatureIndex(block_signatures(data, BLOCK), BLOCK, len(data))
+    assert all(delta.weak_checksum(data[start:start + BLOCK]) in index.blocks for start in range(0, len(data), BLOCK))
+    with pytest.raises(ValueError):
+        SignatureIndex(block_signatures(data, BLOCK), BLOCK, 5 * BLOCK)
@@ -0,0 +1,43 @@
+"""
+Round trips of the frame format in Common/protocol.py.
+
+    python -m pytest -q
+"""
+import pytest
+
+from Common import protocol
+from Common.protocol import ProtocolError
+
+
+def split(frame):
+    opcode, flags, stream_id, length = protocol.unpack_header(frame[:protocol.HEADER_SIZE])
+    payload = frame[protocol.HEADER_SIZE:]
+    assert len(payload) == length
+    return opcode, flags, stream_id, protocol.decode_message(payload)
+
+
+def test_message_round_trip():
+    fields = {"filename": "résumé.txt", "size": 5 << 30, "ranges": [[0, 10], [20, 30]]}
+    frame = protocol.encode_message(protocol.DOWNLOAD, fields, protocol.FLAG_END_STREAM, stream_id=7)
+    assert split(frame) == (protocol.DOWNLOAD, protocol.FLAG_END_STREAM, 7, fields)
+
+
+def test_empty_message():
+    frame = protocol.encode_message(protocol.DISCONNECT)
+    assert split(frame) == (protocol.DISCONNECT, 0, protocol.CONTROL_STREAM, {})
+
+
+def test_data_header():
+    header = protocol.pack_header(protocol.DATA, protocol.MAX_DATA_FRAME, protocol.FLAG_END_STREAM, 3)
+    assert len(header) == protocol.HEADER_SIZE
+    assert protocol.unpack_header(header) == (protocol.DATA, protocol.FLAG_END_STREAM, 3, protocol.MAX_DATA_FRAME)
+
+
+@pytest.mark.parametrize("header, error", [
+    (protocol.HEADER.pack(b"XX", protocol.PROTOCOL_VERSION, protocol.OK, 0, 0, 0), "magic"),
+    (protocol.HEADER.pack(protocol.MAGIC, protocol.PROTOCOL_VERSION + 1, protocol.OK, 0, 0, 0), "version"),
+    (protocol.HEADER.pack(protocol.MAGIC, protocol.PROTOCOL_VERSION, 0xEE, 0, 0, 0), "opcode"),
+])
+def test_bad_headers(header, error):
+    with pytest.raises(ProtocolError, match=error):
+        protocol.unpack_header(header)
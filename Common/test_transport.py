@@ -0,0 +1,80 @@
+"""
+Length-prefixed frames over a socket pair (Common/transport.py).
+"""
+import asyncio
+import os
+import socket
+
+import pytest
+
+from Common import protocol
+from Common.protocol import ProtocolError
+from Common.transport import AsyncConnection, parse_address
+
+
+def connection_pair(loop):
+    left, right = socket.socketpair()
+    for sock in (left, right):
+        sock.setblocking(False)
+    return AsyncConnection(loop, left), AsyncConnection(loop, right)
+
+
+def test_messages_and_data_arrive_in_order():
+    data = os.urandom(300 * 1024)  # larger than the read-ahead buffer, so it is read directly
+
+    async def scenario():
+        sender, receiver = connection_pair(asyncio.get_running_loop())
+        try:
+            frames = protocol.encode_message(protocol.UPLOAD, {"filename": "a.bin", "size": len(data)}, stream_id=1)
+            frames += protocol.pack_header(protocol.DATA, len(data), protocol.FLAG_END_STREAM, 1) + data
+            frames += protocol.encode_message(protocol.LIST, {"prefix": "a"}, stream_id=3)
+            sending = asyncio.ensure_future(sender.send(frames))
+
+            assert await receiver.read_message() == (protocol.UPLOAD, {"filename": "a.bin", "size": len(data)})
+            opcode, flags, stream_id, length = await receiver.read_header()
+            assert (opcode, flags, stream_id, length) == (protocol.DATA, protocol.FLAG_END_STREAM, 1, len(data))
+            received = bytearray(length)
+            await receiver.readinto(memoryview(received))
+            assert received == data
+            assert await receiver.read_message() == (protocol.LIST, {"prefix": "a"})
+            await sending
+        finally:
+            sender.close()
+            receiver.close()
+
+    asyncio.run(scenario())
+
+
+def test_oversized_control_payload_is_refused():
+    async def scenario():
+        sender, receiver = connection_pair(asyncio.get_running_loop())
+        try:
+            await sender.send(protocol.pack_header(protocol.LIST, protocol.MAX_CONTROL_PAYLOAD + 1))
+            with pytest.raises(ProtocolError, match="too large"):
+                await receiver.read_message()
+        finally:
+            sender.close()
+            receiver.close()
+
+    asyncio.run(scenario())
+
+
+def test_closed_peer_ends_the_read():
+    async def scenario():
+        sender, receiver = connection_pair(asyncio.get_running_loop())
+        try:
+            await sender.send(protocol.encode_message(protocol.OK, {"message": "x"})[:5])  # half a header
+            sender.close()
+            with pytest.raises(ConnectionError):
+                await receiver.read_message()
+        finally:
+            receiver.close()
+
+    asyncio.run(scenario())
+
+
+def test_parse_address():
+    assert parse_address("replica.local:9000") == ("replica.local", 9000)
+    for text in ("9000", "host:", "host:port"):
+        with pytest.raises(ValueError):
+            parse_address(text)
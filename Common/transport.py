@@ -0,0 +1,172 @@
+"""
+Frame-level connections over a TCP socket.
+
+AsyncConnection drives a non-blocking socket through the event loop's socket
+API. It keeps a small read-ahead buffer for headers and control messages, and
+reads bulk payloads straight into the caller's buffer with recv_into.
+
+Outgoing file contents go through sendfile(), which uses the kernel's
+zero-copy path (os.sendfile) where the platform has one and falls back to a
+plain buffered read/send loop everywhere else.
+
+Writes are not serialized here; Common.multiplex holds the write lock when
+several streams share one connection.
+"""
+import asyncio
+
+from Common import protocol
+from Common.protocol import HEADER_SIZE, MAX_CONTROL_PAYLOAD, ProtocolError
+
+READ_AHEAD_SIZE = 64 * 1024  # buffer for headers and small control payloads
+DIRECT_READ_THRESHOLD = 16 * 1024  # payload reads at least this large bypass the read-ahead buffer
+SEND_BUFFER_SIZE = 256 * 1024  # chunk size of the buffered sendfile fallback
+SENDFILE_MIN_SIZE = 256 * 1024  # below this, sendfile's setup cost outweighs the copy it saves
+
+
+def parse_address(text):
+    """
+    Returns (host, port) of a "host:port" command line argument.
+    """
+    host, _, port = text.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"expected HOST:PORT, not '{text}'")
+    return host, int(port)
+
+
+class _ReadBuffer:
+    """
+    Read-ahead buffer for headers and control payloads.
+    """
+
+    def __init__(self, size=READ_AHEAD_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def available(self):
+        return self.end - self.start
+
+    def take(self, count):
+        data = bytes(self.view[self.start:self.start + count])
+        self.start += count
+        return data
+
+    def copy_into(self, target):
+        count = min(len(target), self.available())
+        target[:count] = self.view[self.start:self.start + count]
+        self.start += count
+        return count
+
+    def free_tail(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start and len(self.buffer) - self.end < HEADER_SIZE:
+            # compact so there is always room for at least one header
+            remaining = self.end - self.start
+            self.view[:remaining] = self.view[self.start:self.end]
+            self.start, self.end = 0, remaining
+        return self.view[self.end:]
+
+
+class AsyncConnection:
+    """
+    Frame reader/writer for a non-blocking socket driven by an asyncio loop.
+    """
+
+    def __init__(self, loop, sock):
+        self.loop = loop
+        self.sock = sock
+        self._rbuf = _ReadBuffer()
+
+    async def _fill(self):
+        received = await self.loop.sock_recv_into(self.sock, self._rbuf.free_tail())
+        if not received:
+            raise ConnectionError("connection closed by peer")
+        self._rbuf.end += received
+
+    async def _read_exact(self, count):
+        while self._rbuf.available() < count:
+            await self._fill()
+        return self._rbuf.take(count)
+
+    async def read_header(self):
+        """
+        Returns (opcode, flags, stream_id, length) of the next frame.
+        """
+        return protocol.unpack_header(await self._read_exact(HEADER_SIZE))
+
+    async def readinto(self, target):
+        """
+        Fills ``target`` (a writable memoryview) completely.
+        """
+        filled = self._rbuf.copy_into(target)
+        total = len(target)
+        while filled < total:
+            if total - filled >= DIRECT_READ_THRESHOLD:
+                received = await self.loop.sock_recv_into(self.sock, target[filled:])
+                if not received:
+                    raise ConnectionError("connection closed by peer")
+                filled += received
+            else:
+                await self._fill()
+                filled += self._rbuf.copy_into(target[filled:])
+        return filled
+
+    async def read_payload(self, length):
+        if length > MAX_CONTROL_PAYLOAD:
+            raise ProtocolError(f"control payload of {length} bytes is too large")
+        payload = bytearray(length)
+        await self.readinto(memoryview(payload))
+        return bytes(payload)
+
+    async def read_message(self):
+        """
+        Reads one control frame and returns (opcode, fields).
+        """
+        opcode, flags, stream_id, length = await self.read_header()
+        return opcode, protocol.decode_message(await self.read_payload(length))
+
+    async def send(self, data):
+        await self.loop.sock_sendall(self.sock, data)
+
+    async def send_message(self, opcode, fields=None, flags=0):
+        await self.send(protocol.encode_message(opcode, fields, flags))
+
+    async def send_error(self, message):
+        await self.send_message(protocol.ERROR, {"message": message})
+
+    async def discard(self, count):
+        """
+        Reads and drops ``count`` payload bytes.
+        """
+        scratch = memoryview(bytearray(min(count, READ_AHEAD_SIZE) or 1))
+        while count:
+            piece = scratch[:min(count, len(scratch))]
+            await self.readinto(piece)
+            count -= len(piece)
+
+    async def sendfile(self, file, offset, count, zero_copy=True):
+        """
+        Sends ``count`` bytes of ``file`` starting at ``offset``.
+        """
+        if zero_copy and count >= SENDFILE_MIN_SIZE:
+            try:
+                sent = await self.loop.sock_sendfile(self.sock, file, offset, count, fallback=False)
+                if sent != count:
+                    raise EOFError("file ended before the announced size was sent")
+                return
+            except asyncio.SendfileNotAvailableError:
+                pass  # no kernel sendfile for this socket/platform, copy through userspace instead
+        view = memoryview(bytearray(min(count, SEND_BUFFER_SIZE) or 1))
+        file.seek(offset)
+        remaining = count
+        while remaining:
+            read = file.readinto(view[:min(remaining, len(view))])
+            if not read:
+                raise EOFError("file ended before the announced size was sent")
+            await self.loop.sock_sendall(self.sock, view[:read])
+            remaining -= read
+
+    def close(self):
+        self.sock.close()
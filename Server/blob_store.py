@@ -0,0 +1,662 @@
+"""
+Content-addressed chunk storage for the server.
+
+Files are not stored under their names. Every CHUNK_SIZE piece of an upload
+becomes a blob named after its SHA-256, and the catalog keeps each file's
+recipe: the ordered list of its chunk digests. Identical chunks, whether in
+two versions of one file or in files of different users, are stored once.
+
+Blobs are reference counted. The catalog counts one reference per chunk a
+stored file lists (persistently, in the same transaction as the file row).
+Work in progress pins blobs in memory instead: a partial upload pins every
+chunk it has already received and a download pins the chunks it is sending.
+A blob is deleted once it is neither referenced nor pinned. Worker
+processes sharing one store also record their pins in the catalog
+(SharedPins, see Server/workers.py), and a blob is only deleted while that
+record is locked and shows no pin of any process.
+
+Blobs may be stored compressed: with an at-rest codec, a chunk that
+compresses well is kept as ``<digest>.<codec>`` and decompressed when a
+download reads it. Blobs written with another setting stay readable.
+
+Blobs live in fan-out directories named after the leading hex digits of
+their digest, ``ab/cd/abcd...``, so no directory grows beyond a few
+hundred entries however many blobs there are, and creating or looking up
+one costs the same in a store of millions. Older versions kept every blob
+directly in the root; such a store stays readable (``flat``) and
+Server/migrate_layout.py moves its blobs into place, also while the server runs.
+"""
+import asyncio
+import collections
+import contextlib
+import functools
+import hashlib
+import mmap
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from Common import compression
+from Common.chunks import CHUNK_SIZE, file_checksum
+from Common.fileio import preallocate, write_all
+
+BLOB_DIRECTORY = ".blobs"  # inside the storage directory
+MAX_PENDING_CHUNKS = 16  # completed chunks an upload may have waiting for fdatasync before it stops reading
+SHARD_LEVELS = 2  # fan-out directories above a blob, each named after the next two hex digits of its digest
+
+_DIGEST = re.compile(r"[0-9a-f]{64}\Z")
+
+
+def is_digest(value):
+    return isinstance(value, str) and _DIGEST.match(value) is not None
+
+
+def content_version(digests):
+    """
+    Version tag of a file: changes exactly when its content does.
+    """
+    return hashlib.sha256("".join(digests).encode()).hexdigest()[:32]
+
+
+def blob_name(name):
+    """
+    Returns (digest, codec) if ``name`` is the file name of a blob, else None.
+    """
+    digest, dot, codec = name.partition(".")
+    if is_digest(digest) and (not dot or codec in compression.CODECS):
+        return digest, codec or None
+    return None
+
+
+def has_flat_blobs(root):
+    """
+    True if ``root`` holds blobs in the flat layout of older versions. Stops at the first one.
+    """
+    try:
+        with os.scandir(root) as entries:
+            return any(blob_name(entry.name) for entry in entries if entry.is_file())
+    except FileNotFoundError:
+        return False
+
+
+def received_digests(manifest):
+    """
+    Digests of the chunks a partial upload already holds references for.
+    """
+    return [digest for digest, received in zip(manifest.digests, manifest.received) if received and digest]
+
+
+class BlobStore:
+    """
+    Directory of immutable chunk blobs plus the in-memory pins on them.
+    ``referenced(digest)`` tells whether the catalog still uses a blob.
+    New blobs are compressed with ``codec`` when that saves space.
+    ``on_remove(digest)`` is called for every deleted blob.
+    """
+
+    def __init__(self, root, referenced, codec=None, on_remove=None, shared=None, flat=False):
+        self.root = root
+        self.referenced = referenced
+        self.codec = codec  # at-rest compression of new blobs, None to store them as they are
+        self.on_remove = on_remove  # e.g. drops the blob from a read cache
+        self.shared = shared  # pins of other processes using the store (SharedPins), or None
+        self.flat = flat  # blobs may still be in the root, where older versions kept them
+        self.pins = collections.Counter()  # digest -> pins held by partial uploads and downloads
+        self.recording = collections.Counter()  # digest -> chunk pins (pin_chunk) not yet recorded in ``shared``
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, digest, codec=None):
+        shards = [digest[2 * level:2 * level + 2] for level in range(SHARD_LEVELS)]
+        return os.path.join(self.root, *shards, digest if codec is None else f"{digest}.{codec}")
+
+    def flat_path(self, digest, codec=None):
+        return os.path.join(self.root, digest if codec is None else f"{digest}.{codec}")
+
+    def _places(self):
+        # the migration only ever moves blobs from the flat place to the sharded one, so looking there second
+        # finds a blob that moved in between
+        return (self.flat_path, self.path) if self.flat else (self.path,)
+
+    def locate(self, digest):
+        """
+        Returns (path, codec) of a stored blob, codec None if it is stored uncompressed, or None if it is missing.
+        """
+        for place in self._places():
+            for codec in dict.fromkeys((None, self.codec, *compression.CODECS)):  # the likeliest forms first
+                path = place(digest, codec)
+                if os.path.exists(path):
+                    return path, codec
+        return None
+
+    def open_blob(self, digest):
+        """
+        Opens a stored blob for reading. Returns (file, codec), or None if it
+        is missing. A blob the layout migration moved meanwhile is found again.
+        """
+        for _ in range(2):
+            located = self.locate(digest)
+            if located is None:
+                return None
+            try:
+                return open(located[0], "rb"), located[1]
+            except FileNotFoundError:
+                continue
+        return None
+
+    def has(self, digest):
+        return self.locate(digest) is not None
+
+    def add(self, temp_path, digest):
+        """
+        Moves a finished chunk file into the store (runs in an executor thread).
+        With an at-rest codec the file has not been synced yet; the store
+        writes and syncs the compressed copy, or syncs the file itself if it
+        does not compress.
+        """
+        if self.has(digest):
+            os.remove(temp_path)  # identical content is already stored
+            return
+        if self.codec is not None:
+            with open(temp_path, "rb") as file:
+                packed = self._pack(file.read())
+            if packed is not None:
+                self._write(self.path(digest, self.codec), packed)
+                os.remove(temp_path)
+                return
+            fd = os.open(temp_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        path = self.path(digest)
+        try:
+            os.replace(temp_path, path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)  # the first blob of its directory
+            os.replace(temp_path, path)
+
+    def _pack(self, data):
+        """
+        Compressed form of a chunk, or None if the at-rest codec does not save enough to bother.
+        """
+        if self.codec is None:
+            return None
+        packed = compression.compress(self.codec, data)
+        return packed if len(packed) <= len(data) * (1 - compression.MIN_SAVINGS) else None
+
+    @staticmethod
+    def _write(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as blob:
+            blob.write(data)
+            blob.flush()
+            os.fsync(blob.fileno())
+        os.replace(temp_path, path)
+
+    def load(self, digest):
+        """
+        Returns a whole blob for a read cache: an mmap of the file if it is
+        stored uncompressed, else the decompressed bytes (runs in an executor thread).
+        """
+        opened = self.open_blob(digest)
+        if opened is None:
+            raise FileNotFoundError(f"blob {digest} is missing")
+        file, codec = opened
+        with file:
+            if codec is not None:
+                try:
+                    return compression.decompress(codec, file.read())
+                except ValueError as e:
+                    raise OSError(f"blob {digest} is damaged: {e}")
+            if not os.fstat(file.fileno()).st_size:
+                return b""  # an empty file cannot be mapped
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)  # stays valid after the file is closed
+
+    def pin(self, digests):
+        if self.shared is not None:
+            first = [digest for digest in dict.fromkeys(digests) if digest not in self.pins or digest in self.recording]
+            if first:
+                self.shared.pin(first)  # recorded before the caller looks for the blobs
+        self.pins.update(digests)
+
+    def pin_chunk(self, digest):
+        """
+        Pins a received chunk before it is committed. Returns True if the
+        commit, in its disk thread, must record the pin in ``shared`` with
+        record_chunk_pin() first; the event loop does not wait for that
+        write, of which an upload would otherwise make one per chunk.
+        """
+        record = self.shared is not None and digest not in self.pins
+        self.pins[digest] += 1
+        if record:
+            self.recording[digest] += 1
+        return record
+
+    def record_chunk_pin(self, digest):
+        self.shared.pin_from_thread([digest])
+
+    def chunk_pin_recorded(self, digest):
+        self.recording[digest] -= 1
+        if self.recording[digest] <= 0:
+            del self.recording[digest]
+
+    def unpin(self, digests, collect=True):
+        """
+        Drops one pin per digest; blobs that end up unpinned and unreferenced
+        are deleted, unless ``collect`` is False (for blobs that were never stored).
+        """
+        unpinned = []
+        for digest in digests:
+            self.pins[digest] -= 1
+            if self.pins[digest] <= 0:
+                del self.pins[digest]
+                unpinned.append(digest)
+        if self.shared is not None and unpinned:
+            self.shared.unpin(unpinned)
+        if collect:
+            self.collect([digest for digest in unpinned if not self.referenced(digest)])
+
+    def collect(self, digests):
+        """
+        Deletes blobs the catalog no longer references, unless something still pins them.
+        """
+        digests = [digest for digest in digests if digest not in self.pins]
+        if self.shared is None:
+            for digest in digests:
+                self._remove(digest)
+        elif digests:
+            with self.shared.collectable(digests) as unused:
+                for digest in unused:
+                    self._remove(digest)
+
+    def _remove(self, digest):
+        for place in self._places():
+            for codec in (None, *compression.CODECS):
+                try:
+                    os.remove(place(digest, codec))
+                except FileNotFoundError:
+                    pass
+        if self.on_remove is not None:
+            self.on_remove(digest)
+
+    def sweep(self):
+        """
+        Deletes blobs (and leftover temp files) that nothing references or
+        pins, e.g. after a crash. Returns the number of files removed.
+        """
+        removed = 0
+        for entry in self._entries(self.root, SHARD_LEVELS):
+            blob = blob_name(entry.name)
+            if blob is not None and (blob[0] in self.pins or self.referenced(blob[0])):
+                continue
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def _entries(self, directory, levels):
+        """
+        Files in ``directory`` and in its fan-out directories ``levels`` deep
+        (flat blobs of older versions included).
+        """
+        with os.scandir(directory) as entries:
+            for entry in list(entries):
+                if entry.is_dir(follow_symlinks=False):
+                    if levels and re.fullmatch(r"[0-9a-f]{2}", entry.name):
+                        yield from self._entries(entry.path, levels - 1)
+                else:
+                    yield entry
+
+    def unflatten(self):
+        """
+        Moves blobs of the flat layout into their fan-out directories, one
+        rename each, so a running server finds every blob in one of the two
+        places throughout. Yields the digest of every blob moved.
+        """
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                blob = blob_name(entry.name) if entry.is_file(follow_symlinks=False) else None
+                if blob is None:
+                    continue
+                path = self.path(*blob)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                try:
+                    os.rename(entry.path, path)
+                except FileNotFoundError:
+                    continue  # deleted meanwhile
+                yield blob[0]
+
+    def ingest_file(self, path, chunk_size=CHUNK_SIZE):
+        """
+        Copies an existing file into the store and returns its chunk digests.
+        Used to migrate files stored by name before the blob store existed.
+        """
+        digests = []
+        with open(path, "rb") as file:
+            while True:
+                data = file.read(chunk_size)
+                if not data:
+                    break
+                digest = hashlib.sha256(data).hexdigest()
+                if not self.has(digest):
+                    packed = self._pack(data)
+                    if packed is not None:
+                        self._write(self.path(digest, self.codec), packed)
+                    else:
+                        self._write(self.path(digest), data)
+                digests.append(digest)
+        return digests
+
+
+class SharedPins:
+    """
+    The pins of one worker process, recorded in the catalog's pins table
+    under ``holder`` so the other processes using the store see them. A
+    catalog that stays locked beyond its busy timeout is reported as OSError,
+    like a failing disk.
+    """
+
+    def __init__(self, catalog, holder):
+        self.catalog = catalog
+        self.holder = holder
+        self._thread_db = None  # connection of the disk threads, opened on first use
+        self._thread_lock = threading.Lock()
+
+    def pin(self, digests):
+        self._record(self.catalog.pin, digests, self.holder)
+
+    def pin_from_thread(self, digests):
+        with self._thread_lock:
+            if self._thread_db is None:
+                self._thread_db = self.catalog.connect()
+            self._record(self.catalog.pin, digests, self.holder, self._thread_db)
+
+    def unpin(self, digests):
+        self._record(self.catalog.unpin, digests, self.holder)
+
+    @staticmethod
+    def _record(method, *args):
+        try:
+            method(*args)
+        except sqlite3.OperationalError as e:  # e.g. "database is locked" while other processes write
+            raise OSError(f"cannot record blob pins: {str(e)}") from e
+
+    def close(self):
+        with self._thread_lock:
+            if self._thread_db is not None:
+                self._thread_db.close()
+                self._thread_db = None
+
+    @contextlib.contextmanager
+    def collectable(self, digests):
+        """
+        Yields the digests no file references and no process pins, with the
+        catalog locked for writing until the caller has deleted their blobs.
+        """
+        with self.catalog.transaction():
+            yield [digest for digest in digests
+                   if not self.catalog.is_referenced(digest) and not self.catalog.is_pinned(digest)]
+
+
+class ChunkIngest:
+    """
+    Turns the DATA of an upload into blobs. The stream must cover ``ranges``
+    in order; ranges start and end on chunk boundaries, as
+    ChunkManifest.missing_ranges() returns them.
+
+    Each chunk is written to a staging file and hashed as it arrives. When it
+    is complete it is pinned in the store, synced and renamed to its digest
+    in an executor thread, and only then marked in ``manifest``, so a saved
+    manifest never claims a chunk that is not durably stored. If the client
+    announced digests (``expected``), every chunk is checked against them;
+    otherwise the stream's TRAILER is checked against checksum().
+
+    The disk work runs through ``disk(func, *args)``, which returns a future
+    of its result: a DiskScheduler's, or by default the loop's executor.
+    """
+
+    def __init__(self, loop, store, manifest, ranges, staging_prefix, expected=None, disk_latency=None, disk=None):
+        self.loop = loop
+        self.store = store
+        self.disk_latency = disk_latency  # optional Histogram of write and commit (sync + rename) latencies
+        self.disk = disk or functools.partial(loop.run_in_executor, None)
+        self.manifest = manifest
+        self.expected = expected
+        self.staging_prefix = staging_prefix
+        self.ranges = [tuple(r) for r in ranges]
+        self.remaining = sum(end - start for start, end in self.ranges)
+        self._range = 0
+        self._position = self.ranges[0][0] if self.ranges else 0
+        self._index = None  # chunk being received
+        self._fd = None  # its staging file
+        self._hash = None
+        self._pending = []  # (index, digest, future) of chunks being committed to the store
+        self.delivered = []  # (index, digest) of the chunks this ingest marked, in the order they arrived
+
+    def _staging_path(self, index):
+        return f"{self.staging_prefix}.{index}"
+
+    async def write(self, view):
+        """
+        Consumes ``view`` and returns the number of chunks newly marked in the manifest.
+        """
+        if len(view) > self.remaining:
+            raise ValueError("more data than the requested ranges")
+        while view:
+            if self._fd is None:
+                self._index = self._position // self.manifest.chunk_size
+                self._fd = await self.disk(self._open_staging, self._index)
+                self._hash = hashlib.sha256()
+            chunk_end = self.manifest.chunk_range(self._index)[1]
+            count = min(len(view), chunk_end - self._position)
+            # disk write and hashing run in a worker thread (both release the GIL), so the event loop
+            # keeps moving frames and uploads of different files proceed in parallel
+            elapsed = await self.disk(self._append, view[:count])
+            if self.disk_latency is not None:
+                self.disk_latency.observe(elapsed, ("write",))
+            self._position += count
+            self.remaining -= count
+            view = view[count:]
+            if self._position == chunk_end:
+                self._finish_chunk()
+                if self._position == self.ranges[self._range][1] and self._range + 1 < len(self.ranges):
+                    self._range += 1
+                    self._position = self.ranges[self._range][0]
+        if len(self._pending) >= MAX_PENDING_CHUNKS:
+            await asyncio.wait([self._pending[0][2]])  # let the disk catch up before reading more
+        return self._reap()
+
+    def _open_staging(self, index):
+        fd = os.open(self._staging_path(index), os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0),
+                     0o644)
+        start, end = self.manifest.chunk_range(index)
+        preallocate(fd, end - start)
+        return fd
+
+    def _append(self, view):
+        started = time.perf_counter()
+        write_all(self._fd, view)
+        elapsed = time.perf_counter() - started
+        self._hash.update(view)
+        return elapsed
+
+    def _finish_chunk(self):
+        index, fd, self._fd = self._index, self._fd, None
+        staging_path = self._staging_path(index)
+        digest = self._hash.hexdigest()
+        if self.expected is not None and self.expected[index] != digest:
+            os.close(fd)
+            os.remove(staging_path)
+            raise ValueError(f"chunk {index} does not match its announced SHA-256")
+        record = self.store.pin_chunk(digest)  # pinned before it lands, so a concurrent delete cannot collect it
+        future = self.disk(self._commit, fd, staging_path, digest, record)
+        if record:
+            future.add_done_callback(lambda _: self.store.chunk_pin_recorded(digest))
+        self._pending.append((index, digest, future))
+
+    def _commit(self, fd, staging_path, digest, record):
+        started = time.perf_counter()
+        try:
+            if record:
+                try:
+                    self.store.record_chunk_pin(digest)  # other processes see the pin before add() looks for the blob
+                except OSError:
+                    os.remove(staging_path)
+                    raise
+            if self.store.codec is None:  # otherwise the store syncs whichever copy it keeps
+                getattr(os, "fdatasync", os.fsync)(fd)
+        finally:
+            os.close(fd)
+        self.store.add(staging_path, digest)
+        return time.perf_counter() - started
+
+    def _reap(self):
+        completed = 0
+        while self._pending and self._pending[0][2].done():
+            index, digest, future = self._pending.pop(0)
+            if future.exception() is not None:
+                self.store.unpin([digest])
+                raise future.exception()
+            self._committed(future)
+            self.manifest.mark(index, digest)
+            self.delivered.append((index, digest))
+            completed += 1
+        return completed
+
+    async def flush(self):
+        """
+        Waits until every completed chunk is in the store. Returns the number newly marked.
+        """
+        if self._pending:
+            await asyncio.wait([future for index, digest, future in self._pending])
+        return self._reap()
+
+    async def abort(self):
+        """
+        Drops a half-received chunk and settles the commits still in flight.
+        Safe to call after a successful flush().
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            try:
+                os.remove(self._staging_path(self._index))
+            except OSError:
+                pass
+        if self._pending:
+            await asyncio.wait([future for index, digest, future in self._pending])
+        for index, digest, future in self._pending:
+            if future.exception() is None:
+                self._committed(future)
+                self.manifest.mark(index, digest)
+                self.delivered.append((index, digest))
+            else:
+                self.store.unpin([digest])
+        self._pending.clear()
+
+    def _committed(self, future):
+        if self.disk_latency is not None:
+            self.disk_latency.observe(future.result(), ("commit",))
+
+    def checksum(self):
+        """
+        file_checksum() of the chunks this ingest delivered, as the sender computes it for a TRAILER.
+        """
+        return file_checksum([digest for index, digest in self.delivered])
+
+    def discard(self):
+        """
+        Unmarks every chunk this ingest delivered, so they are received again;
+        for data that failed its end-to-end check. Call after flush() or abort().
+        """
+        for index, digest in self.delivered:
+            self.manifest.unmark(index)
+            self.store.unpin([digest])
+        self.delivered = []
+
+
+class DeltaIngest:
+    """
+    Feeds a ChunkIngest from a delta against a stored file (see
+    Common/delta.py): literal data is passed through and copied blocks are
+    read from the stored file with ``read_base(start, end)``, an async
+    iterator over views of that byte range. Has the write() and remaining
+    of a ChunkIngest, so an upload receives either the same way.
+    """
+
+    def __init__(self, ingest, parser, read_base):
+        self.ingest = ingest
+        self.parser = parser
+        self.read_base = read_base
+        self.copied = 0  # bytes taken from the stored file
+
+    @property
+    def remaining(self):
+        return self.ingest.remaining or int(self.parser.pending)  # a delta cut off mid-operation is short too
+
+    async def write(self, view):
+        """
+        Applies the operations in ``view`` and returns the number of chunks newly marked in the manifest.
+        """
+        completed = 0
+        for operation in self.parser.feed(view):
+            if operation[0] == "literal":
+                completed += await self.ingest.write(operation[1])
+                continue
+            start, end = operation[1:]
+            async for piece in self.read_base(start, end):
+                completed += await self.ingest.write(piece)
+            self.copied += end - start
+        return completed
+
+
+class BundleIngest:
+    """
+    Feeds the ChunkIngests of a bundle upload, one per file, from a single
+    stream that covers their ranges back to back, in order. Has the write()
+    and remaining of a ChunkIngest. At most MAX_PENDING_CHUNKS files that
+    are fully received may still be committing before it stops reading,
+    so a bundle of many small files keeps few staging files open.
+    """
+
+    def __init__(self, ingests):
+        self.ingests = ingests
+        self.remaining = sum(ingest.remaining for ingest in ingests)
+        self._current = 0
+        self._settling = collections.deque()  # fully received ingests whose chunks may still be committing
+
+    async def write(self, view):
+        """
+        Consumes ``view`` and returns the number of chunks newly marked in the manifests.
+        """
+        if len(view) > self.remaining:
+            raise ValueError("more data than the bundle's files")
+        completed = 0
+        while view:
+            ingest = self.ingests[self._current]
+            count = min(len(view), ingest.remaining)
+            if count:
+                completed += await ingest.write(view[:count])
+                view = view[count:]
+                self.remaining -= count
+            if not ingest.remaining:
+                self._current += 1
+                self._settling.append(ingest)
+                while len(self._settling) > MAX_PENDING_CHUNKS:
+                    completed += await self._settling.popleft().flush()
+        return completed
+
+    async def flush(self):
+        """
+        Waits until every completed chunk of every file is in the store. Returns the number newly marked.
+        """
+        return sum([await ingest.flush() for ingest in self.ingests])
+
+    async def abort(self):
+        for ingest in self.ingests:
+            await ingest.abort()
@@ -0,0 +1,381 @@
+"""
+Persistent file catalog, stored in SQLite.
+
+The database lives in the storage directory and runs in WAL mode, so every
+upload or delete is one small transaction that touches only the rows it
+changes, a crash leaves either the old or the new state, and opening the
+catalog does not read it into memory.
+
+Tables:
+
+* files: one row per stored file, keyed by the client-visible name
+  ("<owner>_<filename>"); ``chunks`` is the concatenation of the file's
+  32-byte chunk digests and ``checksum`` the file_checksum() of them, which
+  clients compare to verify a download or to skip an identical upload.
+  Indexes by owner and modification time let LIST read one page without
+  scanning the table.
+* blobs: how many chunk references the files table holds for each blob.
+  It is updated in the same transaction as the file row, so the blob store
+  knows when the last file using a chunk is gone.
+* meta: small key/value settings, e.g. whether the last shutdown was clean
+  and whether the blob store has left the flat layout behind.
+* changes: the change log replicas follow (see Server/replication.py):
+  the latest change of every name, as the entry written or, for a delete,
+  NULL, under a sequence number that grows with every change. Older
+  changes of a name are dropped as newer ones arrive (log compaction), so
+  the log is bounded by the names ever stored and a new replica copies
+  the catalog by reading it from the start.
+* pins: blobs that work in progress in a worker process holds (see
+  Server/workers.py), one row per blob and holder, so a worker does not
+  delete a blob another one is still using. A single-process server keeps
+  its pins in memory and leaves this table empty.
+
+Several processes may open the catalog at once: SQLite serializes their
+write transactions and WAL readers never wait for a writer.
+"""
+import collections
+import contextlib
+import json
+import secrets
+import sqlite3
+
+from Common.chunks import file_checksum
+
+CATALOG_FILE = "catalog.db"  # inside the storage directory
+DIGEST_SIZE = 32  # bytes of a SHA-256 chunk digest
+LIST_SORTS = {"name": ("name",), "modified": ("modified", "name")}  # LIST orders and the columns of their cursors
+CHANGES_BATCH_BYTES = 256 << 10  # entry JSON per changes_after() batch, far below a control frame
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    chunk_size INTEGER NOT NULL,
+    chunks BLOB NOT NULL,
+    version TEXT NOT NULL,
+    modified REAL NOT NULL,
+    checksum TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_by_owner ON files (owner, name);
+CREATE INDEX IF NOT EXISTS files_by_modified ON files (modified, name);
+CREATE INDEX IF NOT EXISTS files_by_owner_modified ON files (owner, modified, name);
+CREATE TABLE IF NOT EXISTS blobs (
+    digest BLOB PRIMARY KEY,
+    refs INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    owner TEXT NOT NULL,
+    entry TEXT
+);
+CREATE TABLE IF NOT EXISTS pins (
+    digest BLOB NOT NULL,
+    holder TEXT NOT NULL,
+    PRIMARY KEY (digest, holder)
+) WITHOUT ROWID;
+"""
+
+
+def _pack_chunks(digests):
+    return b"".join(bytes.fromhex(digest) for digest in digests)
+
+
+def _unpack_chunks(data):
+    return [data[i:i + DIGEST_SIZE].hex() for i in range(0, len(data), DIGEST_SIZE)]
+
+
+def _prefix_end(prefix):
+    """
+    Smallest string that sorts after every string starting with ``prefix``.
+    """
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class Catalog:
+    """
+    Files and blob reference counts. Entries are dicts with "name", "owner",
+    "size", "chunk_size", "chunks" (hex digests), "version", "modified" and "checksum".
+    """
+
+    def __init__(self, path, track_shutdown=True, on_change=None):
+        self.path = path
+        self.track_shutdown = track_shutdown  # False for worker processes: the supervisor records shutdowns
+        self.on_change = on_change  # called after a change is committed (e.g. to wake up waiting replicas)
+        self.db = sqlite3.connect(path, isolation_level=None)  # autocommit; multi-statement changes use transaction()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")  # WAL stays consistent after a crash without an fsync per commit
+        self.db.executescript(SCHEMA)
+        self._add_checksums()
+        self._add_change_log()
+        self.clean_shutdown = self._get_meta("clean_shutdown") != "0"  # False after a crash; a new catalog is clean
+        if track_shutdown:
+            self._set_meta("clean_shutdown", "0")
+
+    def close(self, clean=True):
+        """
+        Closes the database; ``clean`` records a clean shutdown, unless shutdowns are not tracked.
+        """
+        if clean and self.track_shutdown:
+            self._set_meta("clean_shutdown", "1")
+        self.db.close()
+
+    def connect(self):
+        """
+        Opens another connection to the database, for use from other threads than the one that opened the catalog.
+        """
+        db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    @contextlib.contextmanager
+    def transaction(self, db=None):
+        db = db or self.db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _add_checksums(self):
+        """
+        Adds the checksum column to a catalog written by an older version; it is derived from the stored chunks.
+        """
+        if any(row[1] == "checksum" for row in self.db.execute("PRAGMA table_info(files)")):
+            return
+        with self.transaction():
+            self.db.execute("ALTER TABLE files ADD COLUMN checksum TEXT NOT NULL DEFAULT ''")
+            for name, chunks in self.db.execute("SELECT name, chunks FROM files").fetchall():
+                self.db.execute("UPDATE files SET checksum = ? WHERE name = ?",
+                                (file_checksum(_unpack_chunks(chunks)), name))
+
+    def _add_change_log(self):
+        """
+        Starts the change log of a catalog, with the files an older version stored as its first changes.
+        """
+        if self._get_meta("log_id") is not None:
+            return
+        with self.transaction():
+            if self._get_meta("log_id") is not None:
+                return  # another process started it meanwhile
+            for row in self.db.execute("SELECT name FROM files ORDER BY name").fetchall():
+                self._log_change(self.get(row[0]))
+            self._set_meta("log_id", secrets.token_hex(8))
+
+    @property
+    def sharded(self):
+        """
+        True once no blob is left in the flat layout of older versions (Server/blob_store.py).
+        """
+        return self._get_meta("blob_layout") == "sharded"
+
+    def mark_sharded(self):
+        self._set_meta("blob_layout", "sharded")
+
+    def _get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    # ------------------------------------------------------------------ files
+
+    def get(self, name):
+        row = self.db.execute("SELECT name, owner, size, chunk_size, chunks, version, modified, checksum FROM files "
+                              "WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        return {"name": row[0], "owner": row[1], "size": row[2], "chunk_size": row[3],
+                "chunks": _unpack_chunks(row[4]), "version": row[5], "modified": row[6], "checksum": row[7]}
+
+    def checksum(self, name):
+        """
+        Returns (size, checksum) of a file, or None, without reading its chunk list.
+        """
+        return self.db.execute("SELECT size, checksum FROM files WHERE name = ?", (name,)).fetchone()
+
+    def exists(self, name):
+        return self.db.execute("SELECT 1 FROM files WHERE name = ?", (name,)).fetchone() is not None
+
+    def list_files(self, owner=None, prefix=None, modified_after=None, modified_before=None, sort="name",
+                   after=None, limit=1000):
+        """
+        Returns up to ``limit`` files as {"file", "owner", "size", "modified", "checksum"}
+        in ``sort`` order, starting after the row whose sort columns equal
+        ``after`` (keyset pagination: the cost depends on the page, not the catalog).
+        """
+        columns = LIST_SORTS[sort]
+        clauses, params = [], []
+        if owner is not None:
+            clauses.append("owner = ?")
+            params.append(owner)
+        if prefix:
+            clauses.append("name >= ? AND name < ?")  # a range on the primary key, unlike LIKE
+            params += [prefix, _prefix_end(prefix)]
+        if modified_after is not None:
+            clauses.append("modified >= ?")
+            params.append(modified_after)
+        if modified_before is not None:
+            clauses.append("modified < ?")
+            params.append(modified_before)
+        if after is not None:
+            clauses.append(f"({', '.join(columns)}) > ({', '.join('?' * len(columns))})")
+            params += list(after)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self.db.execute(f"SELECT name, owner, size, modified, checksum FROM files{where} "
+                               f"ORDER BY {', '.join(columns)} LIMIT ?", params + [limit])
+        return [{"file": name, "owner": owner, "size": size, "modified": modified, "checksum": checksum}
+                for name, owner, size, modified, checksum in rows]
+
+    def put(self, entry):
+        """
+        Adds or replaces a file. Returns the digests of blobs no file references any more.
+        """
+        return self.put_many([entry])
+
+    def put_many(self, entries):
+        """
+        Adds or replaces several files in one transaction, so readers see all
+        of them or none (a bundle upload). Returns the digests of blobs no
+        file references any more.
+        """
+        with self.transaction():
+            replaced = []
+            for entry in entries:
+                row = self.db.execute("SELECT chunks FROM files WHERE name = ?", (entry["name"],)).fetchone()
+                self.db.execute("INSERT OR REPLACE INTO files (name, owner, size, chunk_size, chunks, version, "
+                                "modified, checksum) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                (entry["name"], entry["owner"], entry["size"], entry["chunk_size"],
+                                 _pack_chunks(entry["chunks"]), entry["version"], entry["modified"],
+                                 entry.get("checksum") or file_checksum(entry["chunks"])))
+                self._add_refs(entry["chunks"], 1)
+                self._log_change(entry)
+                if row:
+                    replaced += _unpack_chunks(row[0])
+            # the old versions' references go last, so chunks any new version shares never hit 0
+            freed = self._add_refs(replaced, -1)
+        self._changed()
+        return freed
+
+    def delete(self, name, owner):
+        """
+        Removes a file owned by ``owner``. Returns the digests of blobs no file
+        references any more, or None if there is no such file.
+        """
+        with self.transaction():
+            rows = self.db.execute("DELETE FROM files WHERE name = ? AND owner = ? RETURNING chunks",
+                                   (name, owner)).fetchall()
+            if not rows:
+                return None
+            self._log_change({"name": name, "owner": owner}, deleted=True)
+            freed = self._add_refs(_unpack_chunks(rows[0][0]), -1)
+        self._changed()
+        return freed
+
+    def names(self):
+        """
+        Returns (name, owner) of every file.
+        """
+        return self.db.execute("SELECT name, owner FROM files").fetchall()
+
+    # ------------------------------------------------------------------ change log
+
+    def _log_change(self, entry, deleted=False):
+        # replacing the name's row drops its older change and gives the new one the next sequence number
+        logged = None if deleted else json.dumps(dict(entry, checksum=entry.get("checksum")
+                                                      or file_checksum(entry["chunks"])))
+        self.db.execute("INSERT OR REPLACE INTO changes (name, owner, entry) VALUES (?, ?, ?)",
+                        (entry["name"], entry["owner"], logged))
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    @property
+    def log_id(self):
+        """
+        Identifies this catalog's change log; a replica that followed another log starts over.
+        """
+        return self._get_meta("log_id")
+
+    def head(self):
+        """
+        Sequence number of the latest change, 0 if there is none.
+        """
+        return self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+    def changes_after(self, seq, max_bytes=CHANGES_BATCH_BYTES):
+        """
+        Returns the changes after ``seq`` in order, as {"seq", "name", "owner",
+        "entry"} (entry None for a delete), about ``max_bytes`` of entries at most but at least one.
+        """
+        changes, size = [], 0
+        for seq, name, owner, entry in self.db.execute("SELECT seq, name, owner, entry FROM changes WHERE seq > ? "
+                                                       "ORDER BY seq", (seq,)):
+            size += len(entry or "") + len(name) + len(owner)
+            if changes and size > max_bytes:
+                break
+            changes.append({"seq": seq, "name": name, "owner": owner, "entry": json.loads(entry) if entry else None})
+        return changes
+
+    def replica_position(self):
+        """
+        Returns (log id, sequence number) of the last change applied from a primary's log, or (None, 0).
+        """
+        position = self._get_meta("replica_position")
+        return tuple(json.loads(position)) if position else (None, 0)
+
+    def set_replica_position(self, log_id, seq):
+        self._set_meta("replica_position", json.dumps([log_id, seq]))
+
+    # ------------------------------------------------------------------ blob references
+
+    def _add_refs(self, digests, delta):
+        freed = []
+        for digest, count in collections.Counter(digests).items():
+            key = bytes.fromhex(digest)
+            self.db.execute("INSERT INTO blobs (digest, refs) VALUES (?, ?) "
+                            "ON CONFLICT (digest) DO UPDATE SET refs = refs + excluded.refs", (key, count * delta))
+            if delta < 0 and self.db.execute("DELETE FROM blobs WHERE digest = ? AND refs <= 0 RETURNING digest",
+                                             (key,)).fetchall():
+                freed.append(digest)
+        return freed
+
+    def is_referenced(self, digest):
+        return self.db.execute("SELECT 1 FROM blobs WHERE digest = ?", (bytes.fromhex(digest),)).fetchone() is not None
+
+    # ------------------------------------------------------------------ pins of worker processes
+
+    def pin(self, digests, holder, db=None):
+        """
+        Records pins of ``holder``, on ``db`` if given (a connection of another thread, see connect()).
+        """
+        db = db or self.db
+        with self.transaction(db):
+            db.executemany("INSERT OR IGNORE INTO pins (digest, holder) VALUES (?, ?)",
+                           ((bytes.fromhex(digest), holder) for digest in digests))
+
+    def unpin(self, digests, holder):
+        with self.transaction():
+            self.db.executemany("DELETE FROM pins WHERE digest = ? AND holder = ?",
+                                ((bytes.fromhex(digest), holder) for digest in digests))
+
+    def clear_pins(self, holder=None):
+        """
+        Drops the pins of ``holder`` (a worker that is starting over), or all of them.
+        """
+        if holder is None:
+            self.db.execute("DELETE FROM pins")
+        else:
+            self.db.execute("DELETE FROM pins WHERE holder = ?", (holder,))
+
+    def is_pinned(self, digest):
+        return self.db.execute("SELECT 1 FROM pins WHERE digest = ?", (bytes.fromhex(digest),)).fetchone() is not None
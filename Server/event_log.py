@@ -0,0 +1,158 @@
+"""
+Structured, bounded and rate-limited logging for the server.
+
+The engine logs through the ``fileserver`` logger with
+``log_message(message, level, **fields)``; the fields travel with the
+record and are rendered as ``key=value`` pairs or as one JSON object per
+line. Logging must never hold up the event loop, so:
+
+  * a RateLimiter filter on the logger lets through at most ``rate``
+    records per second (bursts up to ``burst``) and counts what it drops;
+    the next record that passes reports how many were suppressed;
+  * start_logging() puts a BoundedQueueHandler on the logger: records go
+    to a bounded queue and a listener thread does the formatting and the
+    writing, so a slow terminal or disk only costs that thread. A full
+    queue drops records instead of blocking;
+  * observers (the GUI) get records through an EventQueueHandler, which
+    also drops rather than blocks when its queue is full.
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+LOGGER_NAME = "fileserver"
+LOG_RATE = 200  # records per second let through on average
+LOG_BURST = 1000  # records let through at once after a quiet period
+LOG_QUEUE_SIZE = 10000  # records waiting for the writer thread
+
+
+class RateLimiter(logging.Filter):
+    """
+    Token bucket over log records.
+    """
+
+    def __init__(self, rate=LOG_RATE, burst=LOG_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.suppressed = 0  # dropped since the last record that passed
+        self.total_suppressed = 0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()  # records may come from executor threads too
+
+    def filter(self, record):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                self.total_suppressed += 1
+                return False
+            self.tokens -= 1
+            if self.suppressed:
+                record.fields = dict(getattr(record, "fields", None) or {}, suppressed=self.suppressed)
+                self.suppressed = 0
+        return True
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that drops records when its queue is full instead of blocking.
+    """
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        return record  # formatting is the listener thread's job
+
+
+class EventQueueHandler(logging.Handler):
+    """
+    Publishes records as {"event": "log", ...} dicts on an observer's queue.Queue, dropping them when it is full.
+    """
+
+    def __init__(self, events):
+        super().__init__()
+        self.events = events
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            self.events.put_nowait({"event": "log", "message": record.getMessage(),
+                                    "level": record.levelname, "time": record.created,
+                                    "fields": getattr(record, "fields", None) or {}})
+        except queue.Full:
+            self.dropped += 1
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Renders a record with its fields, as text or as a JSON object per line.
+    """
+
+    def __init__(self, json_lines=False):
+        super().__init__("%(asctime)s %(levelname)s %(message)s")
+        self.json_lines = json_lines
+
+    def format(self, record):
+        fields = getattr(record, "fields", None) or {}
+        if self.json_lines:
+            entry = {"time": round(record.created, 3), "level": record.levelname, "message": record.getMessage()}
+            entry.update(fields)
+            if record.exc_info:
+                entry["exception"] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+        text = super().format(record)
+        if fields:
+            text += " " + " ".join(f"{key}={json.dumps(value, default=str)}" for key, value in fields.items())
+        return text
+
+
+def start_logging(handlers=None, json_lines=False, rate=LOG_RATE, burst=LOG_BURST, queue_size=LOG_QUEUE_SIZE):
+    """
+    Sends the server's log records through a bounded queue to ``handlers``
+    (default: stderr), written by a listener thread. Returns the listener;
+    call its stop() to flush and end it.
+    """
+    if handlers is None:
+        handlers = [logging.StreamHandler(sys.stderr)]
+    formatter = StructuredFormatter(json_lines)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    records = queue.Queue(queue_size)
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(BoundedQueueHandler(records))
+    logger.addFilter(RateLimiter(rate, burst))
+    listener.start()
+    return listener
+
+
+def stop_logging(listener):
+    """
+    Flushes what the listener still has queued and detaches it from the logger.
+    """
+    listener.stop()
+    logger = logging.getLogger(LOGGER_NAME)
+    for handler in list(logger.handlers):
+        if isinstance(handler, BoundedQueueHandler) and handler.queue is listener.queue:
+            logger.removeHandler(handler)
+    for log_filter in list(logger.filters):
+        if isinstance(log_filter, RateLimiter):
+            logger.removeFilter(log_filter)
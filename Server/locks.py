@@ -0,0 +1,69 @@
+"""
+Per-file locking for the server's request handlers.
+
+All server state is owned by the event loop, so a single dict update or
+catalog call is already atomic. What needs a lock is a sequence of steps on
+one file with awaits in between, e.g. committing an upload while the data is
+still being synced. Those sequences take the file's RWLock: any number of
+readers or one writer. Locks are striped, so a fixed pool of RWLocks covers
+any number of files and operations on different files almost never wait
+for each other.
+"""
+import asyncio
+import contextlib
+
+FILE_LOCK_STRIPES = 256
+
+
+class RWLock:
+    """
+    Asyncio reader/writer lock. Waiting writers block new readers, so a
+    steady stream of downloads cannot starve a delete.
+    """
+
+    def __init__(self):
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+        self._changed = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def read(self):
+        async with self._changed:
+            await self._changed.wait_for(lambda: not self._writer and not self._waiting_writers)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            async with self._changed:
+                self._readers -= 1
+                self._changed.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def write(self):
+        async with self._changed:
+            self._waiting_writers += 1
+            try:
+                await self._changed.wait_for(lambda: not self._writer and not self._readers)
+            finally:
+                self._waiting_writers -= 1
+                self._changed.notify_all()  # readers held back by a writer that gave up may proceed
+            self._writer = True
+        try:
+            yield
+        finally:
+            async with self._changed:
+                self._writer = False
+                self._changed.notify_all()
+
+
+class LockStripes:
+    """
+    Fixed pool of RWLocks; a key always maps to the same lock.
+    """
+
+    def __init__(self, count=FILE_LOCK_STRIPES):
+        self._locks = [RWLock() for _ in range(count)]
+
+    def __call__(self, key):
+        return self._locks[hash(key) % len(self._locks)]
@@ -0,0 +1,245 @@
+"""
+Counters, gauges and latency histograms for the server, and a small HTTP
+endpoint that exposes them.
+
+Metrics are plain objects updated from the event loop, so recording a
+value is a dict update and never takes a lock. Values that already live
+somewhere else (the number of connected clients, a queue's length) are not
+copied into metrics on every change: such a metric gets a ``collect``
+callable that is only evaluated when the metrics are scraped.
+
+The endpoint answers ``GET /metrics`` in the Prometheus text format and
+``GET /metrics.json`` with the same values (plus p50/p90/p99 estimates for
+histograms) as JSON.
+"""
+import asyncio
+import bisect
+import json
+import math
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                   60.0)  # seconds
+QUANTILES = (0.5, 0.9, 0.99)  # reported for histograms in the JSON snapshot
+REQUEST_TIMEOUT = 5  # seconds a scraper has to send its request
+
+
+class Metric:
+    """
+    A named family of values, one per combination of label values.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect  # called at scrape time: returns the value, or a dict of label values -> value
+        self.values = {}  # label values (a tuple) -> value
+
+    def items(self):
+        """
+        Returns (label values, value) pairs, sorted by labels.
+        """
+        if self.collect is None:
+            values = self.values
+        else:
+            values = self.collect()
+            if not isinstance(values, dict):
+                values = {(): values}
+        return sorted(values.items())
+
+    def label_text(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{key}="{_escape(str(value))}"' for key, value in pairs) + "}"
+
+
+class Counter(Metric):
+    """
+    A value that only goes up, e.g. requests handled or bytes sent.
+    """
+
+    kind = "counter"
+
+    def inc(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, e.g. open connections.
+    """
+
+    kind = "gauge"
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values (latencies in seconds) over fixed buckets.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]  # per bucket (+Inf last), sum, count
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def quantile(self, q, labels=()):
+        """
+        Estimates the ``q`` quantile from the buckets, interpolating linearly
+        inside the bucket it falls in. None if nothing was observed.
+        """
+        state = self.values.get(labels)
+        if state is None or not state[2]:
+            return None
+        rank, seen = q * state[2], 0
+        for index, count in enumerate(state[0]):
+            if count and seen + count >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]  # beyond the last bound, nothing better to say
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    """
+    The metrics of one server, in registration order.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=(), collect=None):
+        return self._register(Counter(name, help, labels, collect))
+
+    def gauge(self, name, help, labels=(), collect=None):
+        return self._register(Gauge(name, help, labels, collect))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {_escape(metric.help, quotes=False)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for labels, value in metric.items():
+                if metric.kind != "histogram":
+                    lines.append(f"{metric.name}{metric.label_text(labels)} {_number(value)}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets + (math.inf,), counts):
+                    cumulative += bucket_count
+                    bound = "+Inf" if bound == math.inf else _number(bound)
+                    lines.append(f"{metric.name}_bucket{metric.label_text(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{metric.name}_sum{metric.label_text(labels)} {_number(total)}")
+                lines.append(f"{metric.name}_count{metric.label_text(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        Returns every metric as JSON-ready data: name -> {type, help, values}.
+        """
+        snapshot = {}
+        for metric in self.metrics.values():
+            values = []
+            for labels, value in metric.items():
+                sample = {"labels": dict(zip(metric.labels, labels))}
+                if metric.kind == "histogram":
+                    sample.update(count=value[2], sum=value[1])
+                    sample.update((f"p{round(q * 100)}", metric.quantile(q, labels)) for q in QUANTILES)
+                else:
+                    sample["value"] = value
+                values.append(sample)
+            snapshot[metric.name] = {"type": metric.kind, "help": metric.help, "values": values}
+        return snapshot
+
+
+class MetricsServer:
+    """
+    Serves a registry over HTTP: /metrics (Prometheus text) and /metrics.json.
+    Bind it to a local address; it has no authentication.
+    """
+
+    def __init__(self, registry, host="127.0.0.1", port=0):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]  # resolve port 0 to the real port
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT)
+            method, path = (request.split(b"\r\n", 1)[0].split(b" ") + [b"", b""])[:2]
+            path = path.split(b"?", 1)[0]
+            if method != b"GET":
+                status, content_type, body = "405 Method Not Allowed", "text/plain", "GET only\n"
+            elif path == b"/metrics":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4", self.registry.render()
+            elif path == b"/metrics.json":
+                status, content_type, body = "200 OK", "application/json", json.dumps(self.registry.snapshot())
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", "try /metrics or /metrics.json\n"
+            body = body.encode()
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+            pass  # the scraper went away or sent garbage
+        finally:
+            writer.close()
+
+
+def _escape(text, quotes=True):
+    text = text.replace("\\", "\\\\").replace("\n", "\\n")
+    return text.replace('"', '\\"') if quotes else text
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
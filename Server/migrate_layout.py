@@ -0,0 +1,70 @@
+"""
+Moves the blobs of a storage directory from the flat layout of older
+versions into fan-out directories (see Server/blob_store.py).
+
+    python Server/migrate_layout.py --storage /srv/files
+
+The server may keep running meanwhile: every blob is moved with one rename,
+and the server looks in both places until it is restarted after the
+migration. --rate limits the blobs moved per second, to leave the disk to
+the server. The migration can be interrupted and run again; when it is
+complete it records in the catalog that the store is sharded.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # make the project root importable
+
+from Server.blob_store import BLOB_DIRECTORY, BlobStore, has_flat_blobs
+from Server.catalog import CATALOG_FILE, Catalog
+
+PROGRESS_INTERVAL = 10000  # blobs between progress lines
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--storage", required=True, help="storage directory of the server")
+    parser.add_argument("--rate", type=float, default=0, help="blobs moved per second at most (0: no limit)")
+    return parser.parse_args(argv)
+
+
+def migrate(storage_directory, rate=0, progress=print):
+    """
+    Moves every flat blob into place and marks the catalog sharded. Returns the number of blobs moved.
+    """
+    catalog = Catalog(os.path.join(storage_directory, CATALOG_FILE), track_shutdown=False)  # the server's to record
+    try:
+        # referenced is never asked: the migration only moves blobs, it deletes none
+        store = BlobStore(os.path.join(storage_directory, BLOB_DIRECTORY), catalog.is_referenced, flat=True)
+        moved = 0
+        started = time.monotonic()
+        for _ in store.unflatten():
+            moved += 1
+            if moved % PROGRESS_INTERVAL == 0:
+                progress(f"{moved} blobs moved ({moved / (time.monotonic() - started):.0f}/s)")
+            if rate:
+                delay = started + moved / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        if has_flat_blobs(store.root):  # a server of an older version wrote more meanwhile
+            progress("New blobs appeared in the flat layout; run the migration again once no older server runs.")
+        else:
+            catalog.mark_sharded()
+        return moved
+    finally:
+        catalog.close()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.exists(os.path.join(args.storage, CATALOG_FILE)):
+        print(f"error: no catalog in {args.storage}", file=sys.stderr)
+        sys.exit(2)
+    moved = migrate(args.storage, args.rate)
+    print(f"{moved} blobs moved into fan-out directories.")
+
+
+if __name__ == "__main__":
+    main()
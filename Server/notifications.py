@@ -0,0 +1,230 @@
+"""
+Notification fan-out for the server.
+
+A subscriber connects to the notification port and sends one SUBSCRIBE
+frame, {"username", "topics"}, answered with OK. Topics:
+
+  my-files  events about the subscriber's own files (e.g. downloads)
+  uploads   every completed upload
+  deletes   every deletion
+
+publish() never waits on a socket. It puts the event on the bounded queue
+of every matching subscriber, and each subscriber has its own writer task
+that sends queued events in batches, so a slow or stalled consumer only
+delays itself. When a consumer falls behind, queued events with the same
+coalescing key are merged (their count goes up), and once the queue is full
+the oldest event is dropped; the subscriber is told how many it missed.
+
+A worker process (Server/workers.py) has no notification connections: its
+NotificationRelay forwards what it publishes to the supervisor's bus.
+"""
+import asyncio
+import collections
+
+from Common import protocol
+from Common.transport import AsyncConnection
+
+TOPICS = frozenset(("my-files", "uploads", "deletes"))
+DEFAULT_TOPICS = ("my-files",)
+QUEUE_LIMIT = 256  # undelivered events kept per subscriber
+SEND_BATCH = 64  # events written with one send
+SUBSCRIBE_TIMEOUT = 10  # seconds a new connection has to send SUBSCRIBE
+
+
+def owner_topic(owner):
+    """
+    Key of the my-files topic of ``owner``.
+    """
+    return f"my-files:{owner}"
+
+
+class Subscriber:
+    """
+    One notification connection and its queue of undelivered events.
+    """
+
+    def __init__(self, conn, username, topics, queue_limit=QUEUE_LIMIT):
+        self.conn = conn
+        self.username = username
+        self.topics = topics
+        self.queue_limit = queue_limit
+        self.queue = collections.OrderedDict()  # key -> [event, frame, count], oldest first
+        self.dropped = 0  # events dropped since the last delivery
+        self.ready = asyncio.Event()
+        self._sequence = 0  # keys for events that are never coalesced
+
+    def topic_keys(self):
+        return [owner_topic(self.username) if topic == "my-files" else topic for topic in self.topics]
+
+    def offer(self, event, frame, key=None):
+        """
+        Queues an event (and its encoded NOTIFY frame) without blocking.
+        Returns False if an older event had to be dropped.
+        """
+        if key is not None and key in self.queue:
+            self.queue[key][2] += 1  # same thing happened again before the last one was delivered
+            return True
+        accepted = True
+        if len(self.queue) >= self.queue_limit:
+            self.queue.popitem(last=False)
+            self.dropped += 1
+            accepted = False
+        if key is None:
+            self._sequence += 1
+            key = self._sequence
+        self.queue[key] = [event, frame, 1]
+        self.ready.set()
+        return accepted
+
+    async def run_writer(self):
+        """
+        Sends queued events until the connection fails.
+        """
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.queue:
+                frames = []
+                if self.dropped:
+                    frames.append(self._frame({"event": "dropped", "count": self.dropped,
+                                               "message": f"NOTIFICATION: {self.dropped} notifications were "
+                                                          f"dropped because this client fell behind."}))
+                    self.dropped = 0
+                while self.queue and len(frames) < SEND_BATCH:
+                    key, (event, frame, count) = self.queue.popitem(last=False)
+                    if count > 1:
+                        frame = self._frame(dict(event, count=count, message=f"{event['message']} ({count} times)"))
+                    frames.append(frame)
+                await self.conn.send(b"".join(frames))
+
+    @staticmethod
+    def _frame(event):
+        return protocol.encode_message(protocol.NOTIFY, event)
+
+
+class NotificationBus:
+    """
+    Topic subscriptions of every notification connection.
+    """
+
+    def __init__(self, loop, log=None, queue_limit=QUEUE_LIMIT):
+        self.loop = loop
+        self.log = log or (lambda message: None)
+        self.queue_limit = queue_limit
+        self.topics = collections.defaultdict(set)  # topic key -> subscribers
+        self.subscribers = set()
+
+    def publish(self, topic, event, key=None):
+        """
+        Queues ``event`` for every subscriber of ``topic``. ``key`` lets events
+        that are still waiting for delivery be coalesced.
+        """
+        subscribers = self.topics.get(topic)
+        if not subscribers:
+            return
+        frame = Subscriber._frame(event)  # encoded once, shared by every queue
+        for subscriber in subscribers:
+            subscriber.offer(event, frame, key)
+
+    def _register(self, subscriber):
+        self.subscribers.add(subscriber)
+        for topic in subscriber.topic_keys():
+            self.topics[topic].add(subscriber)
+
+    def _unregister(self, subscriber):
+        self.subscribers.discard(subscriber)
+        for topic in subscriber.topic_keys():
+            subscribers = self.topics.get(topic)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.topics[topic]
+
+    @staticmethod
+    def _parse(fields):
+        username = fields.get("username")
+        topics = fields.get("topics", list(DEFAULT_TOPICS))
+        if not isinstance(username, str) or not username:
+            raise protocol.ProtocolError("SUBSCRIBE needs a username")
+        if not isinstance(topics, list) or not all(topic in TOPICS for topic in topics):
+            raise protocol.ProtocolError(f"topics must be a list drawn from {sorted(TOPICS)}")
+        return username, tuple(dict.fromkeys(topics))
+
+    async def serve(self, sock):
+        """
+        Handles one notification connection from SUBSCRIBE until it closes.
+        """
+        conn = AsyncConnection(self.loop, sock)
+        subscriber = writer = None
+        try:
+            opcode, fields = await asyncio.wait_for(conn.read_message(), SUBSCRIBE_TIMEOUT)
+            if opcode != protocol.SUBSCRIBE:
+                raise protocol.ProtocolError("expected SUBSCRIBE")
+            username, topics = self._parse(fields)
+            subscriber = Subscriber(conn, username, topics, self.queue_limit)
+            await conn.send_message(protocol.OK, {"topics": list(topics)})
+            self._register(subscriber)
+            self.log(f"Notification socket connected for {username}.")
+
+            reader = asyncio.current_task()
+
+            def writer_done(task):
+                if not task.cancelled():
+                    task.exception()  # the send failed; ending the session is all there is to do about it
+                    reader.cancel()
+
+            writer = self.loop.create_task(subscriber.run_writer())
+            writer.add_done_callback(writer_done)
+            while True:  # the subscriber may change its topics; EOF means it went away
+                opcode, fields = await conn.read_message()
+                if opcode == protocol.DISCONNECT:
+                    break
+                if opcode == protocol.SUBSCRIBE:
+                    username, topics = self._parse(fields)
+                    self._unregister(subscriber)
+                    subscriber.username, subscriber.topics = username, topics
+                    self._register(subscriber)
+        except protocol.ProtocolError as e:
+            self.log(f"Bad notification subscription: {str(e)}")
+            try:
+                await conn.send_error(str(e))
+            except OSError:
+                pass
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            if writer is not None:
+                writer.cancel()
+            if subscriber is not None:
+                self._unregister(subscriber)
+                self.log(f"Notification socket closed for {subscriber.username}.")
+            conn.close()
+
+
+class NotificationRelay:
+    """
+    Stands in for the bus in a worker process: publish() queues the event
+    and a writer task passes it to ``send(topic, event, key)``, which
+    forwards it to the process that has the notification connections.
+    """
+
+    subscribers = frozenset()  # they are all in the other process
+
+    def __init__(self, send, queue_limit=QUEUE_LIMIT):
+        self.send = send
+        self.queue = collections.deque(maxlen=queue_limit)  # the oldest event goes once it is full
+        self.ready = asyncio.Event()
+
+    def publish(self, topic, event, key=None):
+        self.queue.append((topic, event, key))
+        self.ready.set()
+
+    async def run(self):
+        """
+        Forwards queued events until cancelled.
+        """
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.queue:
+                await self.send(*self.queue.popleft())
@@ -0,0 +1,140 @@
+"""
+In-memory cache of hot blobs for downloads.
+
+Entries are whole blobs keyed by digest: an mmap of the blob file if it is
+stored uncompressed (the kernel shares the pages with its page cache), or
+the decompressed bytes if it is stored compressed, so a popular file is
+neither opened nor decompressed again for every request. The cache holds at
+most ``budget`` bytes and evicts the least recently used blob first.
+
+A blob is admitted on its second request among the last SEEN_LIMIT misses
+(or when several downloads wait for the same read), so one large download
+streaming through does not flush the files that are actually popular.
+Concurrent requests for a blob that is being read share that one read.
+
+Blobs are immutable, so an entry can never be stale: an overwrite stores
+new digests. Deleted blobs are dropped through invalidate() only to give
+their memory back.
+"""
+import asyncio
+import collections
+
+SEEN_LIMIT = 4096  # recently missed digests remembered for admission
+
+
+class ReadCache:
+    """
+    LRU cache of whole blobs with a byte budget, single-flight loading and hit/miss statistics.
+    """
+
+    def __init__(self, loop, budget):
+        self.loop = loop
+        self.budget = budget  # bytes; 0 disables the cache
+        self.entries = collections.OrderedDict()  # digest -> memoryview of the blob, least recently used first
+        self.size = 0  # bytes held by entries
+        self._seen = collections.OrderedDict()  # digests missed recently, for admission
+        self._loading = {}  # digest -> [future, waiters] of a read in progress
+        self.hits = 0  # requests served from memory
+        self.misses = 0  # requests that had to go to disk (or joined a read in progress)
+        self.coalesced = 0  # misses that waited for another request's read instead of reading
+        self.loads = 0  # blob reads done by the cache
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, digest):
+        """
+        Returns the cached blob as a memoryview, or None.
+        """
+        view = self.entries.get(digest)
+        if view is not None:
+            self.entries.move_to_end(digest)
+            self.hits += 1
+        return view
+
+    def wanted(self, digest):
+        """
+        Tells whether a blob that is not cached should be loaded into the
+        cache rather than read directly: it was requested recently or is
+        being loaded right now. Records the request otherwise.
+        """
+        if not self.budget:
+            return False
+        if digest in self._seen or digest in self._loading:
+            return True
+        self.misses += 1
+        self._remember(digest)
+        return False
+
+    async def load(self, digest, loader, disk=None):
+        """
+        Returns the blob as a memoryview, reading it with ``loader()`` (in an
+        executor thread, or through ``disk(loader)``) unless a read of it is
+        already in progress. The result is kept if the blob qualifies for the cache.
+        """
+        while True:
+            view = self.get(digest)
+            if view is not None:
+                return view
+            self.misses += 1
+            loading = self._loading.get(digest)
+            if loading is None:
+                break
+            self.coalesced += 1
+            loading[1] += 1
+            await asyncio.wait([loading[0]])  # not the future itself: this waiter's cancellation must not cancel it
+            if not loading[0].cancelled():
+                return loading[0].result()
+            self.misses -= 1  # the reader was cancelled; read it here instead
+
+        future = self.loop.create_future()
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())  # waiters get it, if any
+        loading = self._loading[digest] = [future, 0]
+        try:
+            self.loads += 1
+            view = memoryview(await (disk(loader) if disk else self.loop.run_in_executor(None, loader)))
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._loading[digest]
+        if self.budget and len(view) <= self.budget and (digest in self._seen or loading[1]):
+            self._insert(digest, view)
+        else:
+            self._remember(digest)
+        future.set_result(view)
+        return view
+
+    def _remember(self, digest):
+        self._seen[digest] = None
+        self._seen.move_to_end(digest)
+        if len(self._seen) > SEEN_LIMIT:
+            self._seen.popitem(last=False)
+
+    def _insert(self, digest, view):
+        self._seen.pop(digest, None)
+        self.entries[digest] = view
+        self.size += len(view)
+        while self.size > self.budget:
+            digest, view = self.entries.popitem(last=False)
+            self.size -= len(view)  # an mmap is unmapped once the downloads still sending from it let go
+            self.evictions += 1
+
+    def invalidate(self, digest):
+        """
+        Drops a deleted blob.
+        """
+        view = self.entries.pop(digest, None)
+        if view is not None:
+            self.size -= len(view)
+            self.invalidations += 1
+        self._seen.pop(digest, None)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "loads": self.loads,
+                "hit_ratio": self.hits / requests if requests else 0.0, "evictions": self.evictions,
+                "invalidations": self.invalidations, "entries": len(self.entries), "bytes": self.size,
+                "budget": self.budget}
@@ -0,0 +1,288 @@
+"""
+Asynchronous replication from a primary server to read-only replicas.
+
+Every change to a catalog is also recorded in its change log (see
+Server/catalog.py). A replica (FileServer with ``replica_of``) connects to
+its primary like a client and asks with REPLICATE for the changes after the
+last one it applied; the primary answers at once if there are any and
+otherwise holds the request until there are (long polling), so a change
+reaches the replicas within a round trip. For a new or replaced file the
+replica fetches the chunks it does not have yet with a ranged DOWNLOAD of
+that version, stores them as blobs like an upload and then commits the
+primary's entry; a version the primary replaced meanwhile is skipped, as
+its newer change follows in the log. Deletes are applied as they are.
+
+The replica keeps its position in the primary's log in its own catalog,
+so after a lost connection or a restart it catches up from there. A replica
+that followed another log (a new replica, or one whose primary was
+replaced) reads the whole log and then removes the files the primary does
+not have; chunks it has already are not fetched again.
+
+Replicas serve LIST and DOWNLOAD and refuse UPLOAD and DELETE. A replica
+restarted without ``replica_of`` is a primary with everything it had
+applied, which is how a replica takes over when its primary fails.
+"""
+import asyncio
+import logging
+import secrets
+import socket
+
+from Common import protocol
+from Common.chunks import ChunkManifest
+from Common.multiplex import Multiplexer
+from Common.protocol import ProtocolError
+from Common.transport import AsyncConnection
+from Server.blob_store import ChunkIngest, received_digests
+
+REPLICATION_CLIENT = "replication"  # name the replicator's disk work and rate limits are accounted under
+REPLICATION_COMPRESSION = ["zlib"]  # codecs offered to the primary for chunk data
+POLL_WAIT = 10.0  # seconds the primary may hold a REPLICATE request without changes
+MAX_POLL_WAIT = 30.0
+RECONNECT_DELAYS = (0.5, 10.0)  # first and longest wait before reconnecting to the primary
+CATCH_UP_WAIT = 2.0  # seconds a read waits for the replica to apply the change it asks for
+APPLY_CONCURRENCY = 8  # changes of a batch applied at once, so fetches overlap
+
+
+class ReplicationError(Exception):
+    """
+    The primary refused a replication request.
+    """
+
+
+class Replicator:
+    """
+    Applies the change log of the primary at (``host``, ``port``) to ``server``.
+    """
+
+    def __init__(self, server, host, port):
+        self.server = server
+        self.host = host
+        self.port = port
+        self.log_id, self.position = server.catalog.replica_position()  # last change applied from the primary
+        self.head = None  # latest change of the primary's log, as last reported
+        self.connected = False
+        self.mux = None
+        self._reader = None
+        self._advanced = asyncio.Event()  # set (and replaced) whenever the position moves
+        self._resync = None  # (head to reach, names seen) while reading another log from the start
+
+    @property
+    def lag(self):
+        """
+        Changes of the primary's log not applied yet (0 until the primary answered).
+        """
+        return max(0, self.head - self.position) if self.head is not None else 0
+
+    async def caught_up(self, change, timeout=CATCH_UP_WAIT):
+        """
+        Waits until the change ``change`` of the primary's log is applied.
+        Returns False if that takes longer than ``timeout`` seconds.
+        """
+        if not isinstance(change, int):
+            return True  # the read does not depend on a change
+        deadline = asyncio.get_running_loop().time() + timeout
+        while self.position < change or self._resync is not None:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._advanced.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def run(self):
+        """
+        Follows the primary until cancelled, reconnecting with backoff when the connection is lost.
+        """
+        delay = RECONNECT_DELAYS[0]
+        while True:
+            try:
+                await self._connect()
+                self.server.log_message(f"Replicating from {self.host}:{self.port} after change {self.position}.",
+                                        primary=f"{self.host}:{self.port}", position=self.position)
+                delay = RECONNECT_DELAYS[0]
+                await self._follow()
+            except (OSError, ProtocolError, ReplicationError) as e:
+                self.server.log_message(f"Replication from {self.host}:{self.port} interrupted: {str(e)}; retrying "
+                                        f"in {delay:g} s.", logging.WARNING, primary=f"{self.host}:{self.port}",
+                                        error=str(e))
+            finally:
+                await self._close()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_DELAYS[1])
+
+    async def _connect(self):
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            await loop.sock_connect(sock, (self.host, self.port))
+            conn = AsyncConnection(loop, sock)
+            # a name of its own per connection, so a reconnect does not collide with a session the primary still holds
+            await conn.send_message(protocol.HELLO, {"username": f"{REPLICATION_CLIENT}-{secrets.token_hex(4)}"})
+            opcode, response = await conn.read_message()
+        except BaseException:
+            sock.close()
+            raise
+        if opcode != protocol.WELCOME:
+            sock.close()
+            raise ReplicationError(response.get("message", "connection rejected"))
+        self.mux = Multiplexer(conn, self.server.buffer_pool, first_stream_id=1)
+        self._reader = loop.create_task(self.mux.run())
+        self.connected = True
+
+    async def _close(self):
+        self.connected = False
+        if self._reader is not None:
+            self._reader.cancel()
+            await asyncio.gather(self._reader, return_exceptions=True)
+            self._reader = None
+        if self.mux is not None:
+            self.mux.conn.close()
+            self.mux = None
+
+    async def _request(self, opcode, fields):
+        if self.mux is None or self.mux.closed:
+            raise ConnectionError("lost the connection to the primary")
+        stream = self.mux.open_stream()
+        await stream.send_message(opcode, fields, end=True)
+        return stream
+
+    @staticmethod
+    def _check(opcode, reply):
+        if opcode == protocol.ERROR:
+            raise ReplicationError(reply.get("message", "request failed"))
+        return reply
+
+    async def _follow(self):
+        while True:
+            stream = await self._request(protocol.REPLICATE, {"after": self.position, "log": self.log_id,
+                                                              "wait": POLL_WAIT})
+            try:
+                opcode, flags, reply = await stream.receive_message()
+            finally:
+                stream.close()
+            self._check(opcode, reply)
+            if reply["log"] != self.log_id:
+                # another log: the primary sent it from the start, and whatever it does not list goes
+                self.server.log_message(f"Copying the catalog of {self.host}:{self.port} ({reply['head']} changes).",
+                                        primary=f"{self.host}:{self.port}", head=reply["head"])
+                self.log_id, self.position = reply["log"], 0
+                self._resync = (reply["head"], set())
+            self.head = reply["head"]
+            changes = reply["changes"]
+            if changes:
+                await self._apply_all(changes)
+                self.position = changes[-1]["seq"]
+                if self._resync is not None:
+                    self._resync[1].update(change["name"] for change in changes if change["entry"] is not None)
+            if self._resync is not None and self.position >= self._resync[0]:
+                await self._remove_unlisted(self._resync[1])
+                self._resync = None
+            if self._resync is None:
+                self.server.catalog.set_replica_position(self.log_id, self.position)
+            self._advanced.set()
+            self._advanced = asyncio.Event()
+
+    async def _apply_all(self, changes):
+        """
+        Applies a batch of changes, APPLY_CONCURRENCY at a time: the log holds
+        one change per name, so they touch different files and their fetches
+        may overlap. If one fails, the batch is applied again after a
+        reconnect (applying a change twice does no harm).
+        """
+        semaphore = asyncio.Semaphore(APPLY_CONCURRENCY)
+
+        async def apply(change):
+            async with semaphore:
+                await self._apply(change)
+
+        tasks = [asyncio.get_running_loop().create_task(apply(change)) for change in changes]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def _apply(self, change):
+        name, entry = change["name"], change["entry"]
+        if entry is None:
+            await self._delete(name, change["owner"])
+            return
+        catalog, blobs = self.server.catalog, self.server.blobs
+        digests = entry["chunks"]
+        manifest = ChunkManifest(entry["size"], entry["chunk_size"])
+        # pinned before looking, as for an upload: a chunk found here must not be collected meanwhile
+        blobs.pin(digests)
+        absent = []
+        for index, digest in enumerate(digests):
+            if blobs.has(digest):
+                manifest.mark(index, digest)
+            else:
+                absent.append(digest)
+        blobs.unpin(absent, collect=False)
+        try:
+            missing = manifest.missing_ranges()
+            if missing and not await self._fetch(entry, manifest, missing):
+                return
+            async with self.server.file_locks(name).write():
+                blobs.collect(catalog.put(entry))
+        finally:
+            blobs.unpin(received_digests(manifest))
+
+    async def _fetch(self, entry, manifest, missing):
+        """
+        Downloads the missing ranges of a file's version into the blob store.
+        Returns False if the primary no longer has that version.
+        """
+        name = entry["name"]
+        stream = await self._request(protocol.DOWNLOAD, {"filename": name, "version": entry["version"],
+                                                         "ranges": missing, "part": True,
+                                                         "compression": REPLICATION_COMPRESSION})
+        ingest = None
+        try:
+            opcode, flags, reply = await stream.receive_message()
+            if opcode == protocol.ERROR and reply.get("message", "").endswith("File not found."):
+                return False  # deleted since; the delete follows in the log
+            self._check(opcode, reply)
+            if reply["version"] != entry["version"]:
+                await stream.cancel()  # replaced since; the new version follows in the log
+                return False
+            ingest = ChunkIngest(self.server.loop, self.server.blobs, manifest, missing,
+                                 self.server.partial_path(f"{REPLICATION_CLIENT}-{name}"), expected=entry["chunks"],
+                                 disk_latency=self.server.disk_seconds,
+                                 disk=self.server.disk.bind(REPLICATION_CLIENT))
+            await self.server._receive_upload(stream, REPLICATION_CLIENT, f"replication of '{name}'", ingest,
+                                              reply.get("compression"), lambda: None)
+            await ingest.flush()
+            if not manifest.complete():
+                raise ProtocolError(f"replication of '{name}' ended incomplete")
+            return True
+        except BaseException:
+            if not stream.cancelled and not self.mux.closed:
+                await stream.cancel()
+            raise
+        finally:
+            if ingest is not None:
+                await ingest.abort()  # settles chunks still being committed
+            stream.close()
+
+    async def _delete(self, name, owner):
+        async with self.server.file_locks(name).write():
+            freed = self.server.catalog.delete(name, owner)
+            if freed is not None:
+                self.server.blobs.collect(freed)
+
+    async def _remove_unlisted(self, listed):
+        removed = 0
+        for name, owner in self.server.catalog.names():
+            if name not in listed:
+                await self._delete(name, owner)
+                removed += 1
+        self.server.log_message(f"Caught up with {self.host}:{self.port}; removed {removed} files it does not have.",
+                                primary=f"{self.host}:{self.port}", removed=removed)
+
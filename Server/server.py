@@ -0,0 +1,135 @@
+"""
+Runs the file server without a display.
+
+    python Server/server.py --port 9000 --storage /srv/files --metrics-port 9100
+    python Server/server.py --port 9000 --storage /srv/files --workers 4
+
+With --workers, connections are served by that many worker processes
+behind one port (see Server/workers.py); each serves its metrics on its own
+port, --metrics-port + its index.
+
+With --replica-of, the server is a read-only replica of another one (see
+Server/replication.py), e.g. on one machine:
+
+    python Server/server.py --port 9000 --notification-port 9001 --storage /srv/primary
+    python Server/server.py --port 9010 --notification-port 9011 --storage /srv/replica1 --replica-of 127.0.0.1:9000
+
+Restarted without --replica-of, a replica takes over as the primary.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # make the project root importable
+
+from Common.compression import CODECS
+from Common.fileio import DEFAULT_BUFFER_SIZE
+from Common.transport import parse_address
+from Server.event_log import LOG_RATE, start_logging, stop_logging
+from Server.server_core import (DEFAULT_MAX_CLIENT_TRANSFERS, DEFAULT_MAX_TRANSFERS, DEFAULT_NOTIFICATION_PORT,
+                                DEFAULT_READ_CACHE_SIZE, DEFAULT_SO_RCVBUF, FileServer)
+from Server.shaping import DEFAULT_DISK_WORKERS
+from Server.workers import Supervisor
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Headless cloud file storage server.")
+    parser.add_argument("--host", default="", help="interface to bind (default: all)")
+    parser.add_argument("--port", type=int, required=True, help="port for client connections")
+    parser.add_argument("--notification-port", type=int, default=DEFAULT_NOTIFICATION_PORT,
+                        help="port for notification connections")
+    parser.add_argument("--storage", required=True, help="directory where uploaded files are stored")
+    parser.add_argument("--no-zero-copy", action="store_true",
+                        help="serve downloads with a buffered read/send loop instead of sendfile")
+    parser.add_argument("--recv-buffer", type=int, default=DEFAULT_BUFFER_SIZE,
+                        help="bytes read per recv_into/write during uploads")
+    parser.add_argument("--so-rcvbuf", type=int, default=DEFAULT_SO_RCVBUF,
+                        help="kernel receive buffer for client sockets in bytes (0 keeps the OS default)")
+    parser.add_argument("--compress-at-rest", choices=sorted(CODECS), default=None,
+                        help="store new blobs compressed with this codec when they compress well")
+    parser.add_argument("--read-cache-mb", type=int, default=DEFAULT_READ_CACHE_SIZE >> 20,
+                        help="MiB of hot blobs kept in memory for downloads (0 disables the cache)")
+    parser.add_argument("--client-rate-mb", type=float, default=0,
+                        help="MiB/s each client may upload, and download, at most (0: no limit)")
+    parser.add_argument("--total-rate-mb", type=float, default=0,
+                        help="MiB/s all clients together may upload, and download, at most (0: no limit)")
+    parser.add_argument("--max-transfers", type=int, default=DEFAULT_MAX_TRANSFERS,
+                        help="uploads and downloads running at once; more wait for a slot (0: no limit)")
+    parser.add_argument("--max-client-transfers", type=int, default=DEFAULT_MAX_CLIENT_TRANSFERS,
+                        help="of those, for one client (0: no limit)")
+    parser.add_argument("--disk-workers", type=int, default=DEFAULT_DISK_WORKERS,
+                        help="threads doing the disk work of transfers, shared fairly between clients "
+                             "(per worker process)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes serving clients; more than one spreads the users over that many cores")
+    parser.add_argument("--replica-of", type=parse_address, default=None, metavar="HOST:PORT",
+                        help="serve as a read-only replica of the server at this address")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve metrics at http://<metrics-host>:<port>/metrics (and /metrics.json)")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="interface for the metrics endpoint")
+    parser.add_argument("--log-format", choices=("text", "json"), default="text",
+                        help="log lines as text with key=value fields, or one JSON object per line")
+    parser.add_argument("--log-rate", type=int, default=LOG_RATE,
+                        help="log records per second written at most; the rest are counted and dropped")
+    args = parser.parse_args(argv)
+    if args.replica_of and args.workers > 1:
+        parser.error("a replica runs as one process; --replica-of cannot be combined with --workers")
+    return args
+
+
+def server_options(args):
+    """
+    FileServer options from the command line (those of every worker, with --workers).
+    """
+    return dict(zero_copy=not args.no_zero_copy, recv_buffer_size=args.recv_buffer, so_rcvbuf=args.so_rcvbuf,
+                compress_at_rest=args.compress_at_rest, read_cache_size=args.read_cache_mb << 20,
+                metrics_port=args.metrics_port, metrics_host=args.metrics_host,
+                client_rate=int(args.client_rate_mb * (1 << 20)) or None,
+                total_rate=int(args.total_rate_mb * (1 << 20)) or None, max_transfers=args.max_transfers or None,
+                max_client_transfers=args.max_client_transfers or None, disk_workers=max(1, args.disk_workers))
+
+
+def log_options(args):
+    return dict(json_lines=args.log_format == "json", rate=args.log_rate, burst=args.log_rate * 5)
+
+
+async def run(args):
+    if args.workers > 1:
+        server = Supervisor(args.port, args.storage, args.workers, host=args.host,
+                            notification_port=args.notification_port, log_options=log_options(args),
+                            **server_options(args))
+    else:
+        server = FileServer(args.port, args.storage, host=args.host, notification_port=args.notification_port,
+                            replica_of=args.replica_of, **server_options(args))
+    await server.start()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, lambda: loop.create_task(server.stop()))  # shut down cleanly
+        except (NotImplementedError, RuntimeError):
+            pass  # not supported on this platform (e.g. Windows); Ctrl+C still works
+    try:
+        await server.serve_forever()
+    finally:
+        if server.server_running:
+            await server.stop()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(args.storage, exist_ok=True)
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")  # other libraries
+    listener = start_logging(**log_options(args))
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_logging(listener)  # writes out what is still queued
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1426 @@
+"""
+Headless asyncio engine for the file server.
+
+The engine owns every socket and all server state. It never touches Tkinter:
+anything that wants to follow what the server is doing (the GUI, a console)
+attaches a handler to the ``fileserver`` logger (see Server/event_log.py) or
+scrapes the metrics endpoint instead.
+
+A FileServer normally serves alone. As one of several worker processes
+(``worker``, see Server/workers.py) it does not listen: the supervisor hands
+it the connections of its share of the users, it forwards notifications to
+the supervisor, and it shares the blob store's pins through the catalog.
+
+With ``replica_of`` it is a read-only replica of another server, which it
+follows in the background (see Server/replication.py).
+"""
+import asyncio
+import contextlib
+import functools
+import json
+import logging
+import math
+import os
+import secrets
+import socket
+import sqlite3
+import time
+
+from Common import compression, delta, protocol
+from Common.chunks import CHUNK_SIZE, ChunkManifest, file_checksum
+from Common.fileio import DEFAULT_BUFFER_SIZE, BufferPool
+from Common.multiplex import Multiplexer, StreamCancelled
+from Common.protocol import DEFAULT_NOTIFICATION_PORT, ProtocolError
+from Common.transport import AsyncConnection
+from Server.blob_store import (BLOB_DIRECTORY, BlobStore, BundleIngest, ChunkIngest, DeltaIngest, SharedPins,
+                               content_version, has_flat_blobs, is_digest, received_digests)
+from Server.catalog import CATALOG_FILE, LIST_SORTS, Catalog
+from Server.event_log import LOGGER_NAME, BoundedQueueHandler, EventQueueHandler, RateLimiter
+from Server.locks import LockStripes
+from Server.metrics import MetricsRegistry, MetricsServer
+from Server.notifications import NotificationBus, NotificationRelay, owner_topic
+from Server.read_cache import ReadCache
+from Server.replication import MAX_POLL_WAIT, Replicator
+from Server.shaping import DEFAULT_DISK_WORKERS, Admission, DiskScheduler, Shaper
+
+logger = logging.getLogger(LOGGER_NAME)
+
+PARTIAL_DIRECTORY = ".partial"  # interrupted uploads and their chunk manifests, inside the storage directory
+LEGACY_CATALOG_FILE = "uploaded_files.json"  # catalog of older versions, written to the working directory
+PARTIAL_UPLOAD_TTL = 7 * 24 * 3600  # seconds an interrupted upload is kept for resuming
+LIST_PAGE_SIZE = 1000  # files per LIST page unless the client asks for another size
+MAX_LIST_PAGE_SIZE = 10000
+LIST_BATCH_SIZE = 256  # files per OK frame while a LIST page is streamed
+MANIFEST_FLUSH_CHUNKS = 64  # persist upload progress every this many completed chunks
+DEFAULT_SO_RCVBUF = 4 << 20  # kernel receive buffer requested for client sockets (0 keeps the OS default)
+DEFAULT_READ_CACHE_SIZE = 128 << 20  # bytes of hot blobs kept in memory for downloads (0 disables the cache)
+THROUGHPUT_INTERVAL = 1.0  # seconds over which the bytes per second gauge is measured
+DEFAULT_MAX_TRANSFERS = 256  # uploads and downloads running at once; more wait for a slot
+DEFAULT_MAX_CLIENT_TRANSFERS = 32  # of them for one client
+REPLICATION_POLL = 0.5  # seconds between looks at the change log while a REPLICATE request waits (other processes'
+#                         changes do not wake it up)
+
+
+def listen(host, port, so_rcvbuf=0):
+    """
+    Returns a non-blocking TCP socket listening on (host, port).
+    """
+    listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if so_rcvbuf:
+        # must be set before listen() so the advertised TCP window scale accounts for it
+        listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, so_rcvbuf)
+    listening_socket.bind((host, port))
+    listening_socket.listen(socket.SOMAXCONN)  # deep backlog so bursts of connects are not refused
+    listening_socket.setblocking(False)
+    return listening_socket
+
+
+class UploadSession:
+    """
+    A parallel upload in progress. Its part streams, on any of the owner's
+    connections, each receive different chunks into the shared manifest.
+    """
+
+    def __init__(self, owner, manifest, part_path, expected, codec, save_progress):
+        self.owner = owner
+        self.manifest = manifest
+        self.part_path = part_path  # prefix of the chunk staging files
+        self.expected = expected  # chunk digests the client announced, or None
+        self.codec = codec  # compression of every part stream
+        self.save_progress = save_progress
+        self.claimed = set()  # chunk indexes a running part is receiving
+        self.tasks = set()  # handler tasks of the running parts
+
+    def claim(self, ranges):
+        """
+        Claims the chunks covered by ``ranges`` for one part and returns their
+        indexes, or None unless the ranges are chunk-aligned and every chunk
+        is still missing and unclaimed.
+        """
+        manifest = self.manifest
+        chunk_size = manifest.chunk_size
+        if not isinstance(ranges, list) or not ranges:
+            return None
+        indexes = []
+        for r in ranges:
+            if not (isinstance(r, list) and len(r) == 2 and all(type(value) is int for value in r)):
+                return None
+            start, end = r
+            if not 0 <= start < end <= manifest.size or start % chunk_size \
+                    or (end % chunk_size and end != manifest.size):
+                return None
+            indexes += range(start // chunk_size, -(-end // chunk_size))
+        if len(set(indexes)) != len(indexes) \
+                or any(manifest.received[index] or index in self.claimed for index in indexes):
+            return None
+        self.claimed.update(indexes)
+        return indexes
+
+    def release(self, indexes):
+        self.claimed.difference_update(indexes)  # received chunks stay out of reach through the manifest
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+class FileServer:
+    """
+    Serves UPLOAD/LIST/DELETE/DOWNLOAD/DISCONNECT for many clients on one event loop.
+
+    The state below is only touched from the event loop. Operations on one
+    file that await between steps hold that file's lock from ``file_locks``.
+    """
+
+    def __init__(self, port, storage_directory, host="", notification_port=DEFAULT_NOTIFICATION_PORT,
+                 zero_copy=True, recv_buffer_size=DEFAULT_BUFFER_SIZE, so_rcvbuf=DEFAULT_SO_RCVBUF,
+                 compress_at_rest=None, read_cache_size=DEFAULT_READ_CACHE_SIZE, metrics_port=None,
+                 metrics_host="127.0.0.1", client_rate=None, total_rate=None, max_transfers=DEFAULT_MAX_TRANSFERS,
+                 max_client_transfers=DEFAULT_MAX_CLIENT_TRANSFERS, disk_workers=DEFAULT_DISK_WORKERS, worker=None,
+                 replica_of=None):
+        self.host = host
+        self.port = port  # port for client communication
+        self.notification_port = notification_port  # port used for notifications
+        self.file_storage_directory = storage_directory  # directory where files are saved
+        self.zero_copy = zero_copy  # serve downloads with sendfile instead of a read/send loop
+        self.buffer_pool = BufferPool(recv_buffer_size)  # upload receive buffers, recycled between transfers
+        self.so_rcvbuf = so_rcvbuf  # SO_RCVBUF for client sockets, set on the listener so it is inherited
+        self.compress_at_rest = compress_at_rest  # codec new blobs are stored with, None to store them uncompressed
+        self.read_cache_size = read_cache_size
+        self.shaper = Shaper(client_rate, total_rate)  # bytes per second per client and in total, each direction
+        self.admission = Admission(max_transfers, max_client_transfers)  # transfers running at once
+        self.disk_workers = disk_workers
+        self.worker = worker  # this process's place among the supervisor's workers (Server/workers.Worker), or None
+        self.replica_of = replica_of  # (host, port) of the primary this server replicates, or None
+        self.replicator = None  # Server/replication.Replicator following the primary
+        self.connected_clients = {}  # tracks connected clients by username
+        self.client_sessions = {}  # username -> token that lets the client open extra data connections
+        self.data_connections = {}  # username -> {multiplexer: handler task} of its extra data connections
+        self.active_uploads = set()  # names of files currently being received
+        self.upload_sessions = {}  # upload id -> UploadSession of a parallel upload
+        self.file_locks = LockStripes()  # per-file reader/writer locks, striped by name
+        self.catalog = None  # uploaded files and blob references, in the storage directory
+        self.blobs = None  # content-addressed chunk store under the storage directory
+        self.read_cache = None  # hot blobs in memory, shared by all downloads
+        self.disk = None  # DiskScheduler for the disk work of transfers, fair between clients
+        self.notifications = None  # topic subscriptions of notification clients, with per-subscriber queues
+        self.server_socket = None  # main listening socket
+        self.notification_server_socket = None  # listening socket for notification clients
+        self.server_running = False  # indicates if the server is currently running
+        self.loop = None
+        self._tasks = set()  # accept loops and per-client tasks still running
+        self._stopped = None
+        self._catalog_changed = None  # set (and replaced) whenever this process commits a catalog change
+        self.metrics = MetricsRegistry()
+        self.metrics_server = None  # HTTP endpoint for the metrics, if a port was given
+        if metrics_port is not None:
+            self.metrics_server = MetricsServer(self.metrics, metrics_host, metrics_port)
+        self._register_metrics()
+
+    # ------------------------------------------------------------------ lifecycle
+
+    async def start(self):
+        """
+        Loads the catalog and starts listening for clients and notification clients
+        (a worker takes its connections from the supervisor instead).
+        """
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self._catalog_changed = asyncio.Event()
+        self.read_cache = ReadCache(self.loop, self.read_cache_size)
+        self.disk = DiskScheduler(self.loop, self.disk_workers)
+        self.open_storage()
+
+        if self.worker is None:
+            self.server_socket = self._listen(self.port, self.so_rcvbuf)
+            self.port = self.server_socket.getsockname()[1]  # resolve port 0 to the real port
+            self.notification_server_socket = self._listen(self.notification_port)
+            self.notification_port = self.notification_server_socket.getsockname()[1]
+            self.notifications = NotificationBus(self.loop, self.log_message)
+        else:
+            self.notifications = NotificationRelay(
+                lambda topic, event, key: self.worker.channel.send({"notify": [topic, event, key]}))
+
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+            self.log_message(f"Metrics at http://{self.metrics_server.host}:{self.metrics_server.port}/metrics",
+                             port=self.metrics_server.port)
+        self.server_running = True
+        if self.replica_of is not None:
+            self.replicator = Replicator(self, *self.replica_of)
+            self._spawn(self.replicator.run())
+        if self.worker is None:
+            self.log_message(f"Server started on port {self.port}. Waiting for connections...", port=self.port)
+            self._spawn(self.accept_clients())
+            self._spawn(self.accept_notification_clients())
+        else:
+            self.log_message("Worker started. Waiting for connections...")
+            self._spawn(self.receive_clients())
+            self._spawn(self.notifications.run())
+        self._spawn(self._sample_throughput())
+
+    def open_storage(self):
+        """
+        Opens the catalog and the blob store and tidies them up: imports an
+        older version's catalog, expires stale partial uploads, pins the rest
+        and, after an unclean shutdown, removes orphaned blobs. A worker only
+        pins its own users' partial uploads; the supervisor did the tidying
+        (with this method) before it started the workers.
+        """
+        self.load_uploaded_files()  # open the catalog of previously uploaded files
+        shared = None
+        if self.worker is not None:
+            holder = f"worker{self.worker.index}"
+            self.catalog.clear_pins(holder)  # left behind by this worker's previous process
+            shared = SharedPins(self.catalog, holder)
+        blob_directory = os.path.join(self.file_storage_directory, BLOB_DIRECTORY)
+        flat = not self.catalog.sharded and has_flat_blobs(blob_directory)
+        if not flat and not self.catalog.sharded:
+            self.catalog.mark_sharded()  # a new store, or one the migration finished
+        elif flat and self.worker is None:
+            self.log_message("Blobs are stored in the flat layout of older versions; run Server/migrate_layout.py to "
+                             "move them into fan-out directories (the server may keep running).", logging.WARNING)
+        self.blobs = BlobStore(blob_directory, self.catalog.is_referenced, self.compress_at_rest,
+                               on_remove=self.read_cache.invalidate if self.read_cache else None, shared=shared,
+                               flat=flat)
+        if self.worker is None:
+            self.migrate_stored_files()
+            self.cleanup_partial_uploads()
+        self.pin_partial_uploads()
+        if self.worker is None and not self.catalog.clean_shutdown:
+            removed = self.blobs.sweep()  # blobs of uploads that were cut off by the crash
+            if removed:
+                self.log_message(f"Removed {removed} unreferenced blobs.", removed=removed)
+
+    async def serve_forever(self):
+        """
+        Starts the server and waits until stop() is called.
+        """
+        if not self.server_running:
+            await self.start()
+        await self._stopped.wait()
+
+    async def stop(self):
+        """
+        Disconnects every client, closes the listening sockets and saves the catalog.
+        """
+        if not self.server_running:
+            self.log_message("Server is not running.")
+            return
+        self.server_running = False  # stop accepting new connections
+
+        for client_name, mux in list(self.connected_clients.items()):
+            try:
+                await mux.send_control(protocol.DISCONNECT, {"message": "DISCONNECTING"})  # notify the client
+            except OSError as e:
+                self.log_message(f"Error disconnecting client {client_name}: {str(e)}", logging.WARNING,
+                                 client=client_name, error=str(e))
+            mux.conn.close()
+        self.connected_clients.clear()
+        for tasks in self.data_connections.values():
+            for task in tasks.values():
+                task.cancel()  # the handler closes its socket once it stopped reading from it
+        self.data_connections.clear()
+        self.client_sessions.clear()
+
+        for listening_socket in (self.server_socket, self.notification_server_socket):
+            if listening_socket is None:
+                continue  # a worker has none
+            try:
+                listening_socket.close()
+            except OSError as e:
+                self.log_message(f"Error closing server socket: {str(e)}", logging.WARNING, error=str(e))
+
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        self.disk.shutdown()
+
+        if self.blobs is not None and self.blobs.shared is not None:
+            self.blobs.shared.close()
+        self.catalog.close()
+        stats = self.read_cache.stats()
+        self.log_message(f"Read cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_ratio']:.1%} hit "
+                         f"ratio), {stats['coalesced']} coalesced, {stats['loads']} loads, {stats['evictions']} "
+                         f"evictions.", **{f"read_cache_{key}": value for key, value in stats.items()})
+        self.log_message("Server stopped.")
+        self._stopped.set()
+
+    def _listen(self, port, so_rcvbuf=0):
+        return listen(self.host, port, so_rcvbuf)
+
+    def _spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    # ------------------------------------------------------------------ metrics
+
+    def _register_metrics(self):
+        """
+        Creates the server's metrics. Hot paths update counters and histograms;
+        everything that can be read off existing state is collected when scraped.
+        """
+        metrics = self.metrics
+        self.requests_total = metrics.counter("fileserver_requests_total", "Requests handled, by command and outcome.",
+                                              ("command", "outcome"))
+        self.request_seconds = metrics.histogram("fileserver_request_seconds",
+                                                 "Time from a request's first frame to its end, by command.",
+                                                 ("command",))
+        self.bytes_total = metrics.counter("fileserver_bytes_total",
+                                           "File data moved over client connections, as sent on the wire.",
+                                           ("direction",))
+        self.throughput = metrics.gauge("fileserver_bytes_per_second",
+                                        f"File data moved over the last {THROUGHPUT_INTERVAL:g} s, per second.",
+                                        ("direction",))
+        self.disk_seconds = metrics.histogram("fileserver_disk_write_seconds",
+                                              "Latency of upload chunk writes and of their commits (sync and rename).",
+                                              ("operation",))
+        metrics.gauge("fileserver_connected_clients", "Clients with a control connection.",
+                      collect=lambda: len(self.connected_clients))
+        metrics.gauge("fileserver_data_connections", "Extra connections of parallel transfers.",
+                      collect=lambda: sum(len(muxes) for muxes in self.data_connections.values()))
+        metrics.gauge("fileserver_notification_subscribers", "Open notification connections.",
+                      collect=lambda: len(self.notifications.subscribers) if self.notifications else 0)
+        metrics.gauge("fileserver_active_uploads", "Uploads being received.", collect=lambda: len(self.active_uploads))
+        metrics.gauge("fileserver_transfers", "Uploads and downloads holding a transfer slot.",
+                      collect=lambda: self.admission.total)
+        metrics.counter("fileserver_throttled_seconds_total", "Time transfers waited for their rate limits, by limit.",
+                        ("limit",), collect=self.shaper.delayed)
+        metrics.gauge("fileserver_queue_depth", "Items waiting in the server's queues.", ("queue",),
+                      collect=self._queue_depths)
+        metrics.counter("fileserver_log_records_dropped_total", "Log records dropped to protect the event loop.",
+                        ("reason",), collect=self._dropped_log_records)
+        metrics.counter("fileserver_read_cache_requests_total", "Blob reads of downloads, by read cache result.",
+                        ("result",), collect=lambda: {("hit",): self.read_cache.hits, ("miss",): self.read_cache.misses}
+                        if self.read_cache else {})
+        metrics.gauge("fileserver_read_cache_bytes", "Bytes of blobs held by the read cache.",
+                      collect=lambda: self.read_cache.size if self.read_cache else 0)
+        metrics.gauge("fileserver_replication_lag", "Changes of the primary's log a replica has not applied yet.",
+                      collect=lambda: self.replicator.lag if self.replicator else 0)
+        metrics.gauge("fileserver_replication_connected", "1 while a replica is connected to its primary.",
+                      collect=lambda: int(self.replicator.connected) if self.replicator else 0)
+
+    def _queue_depths(self):
+        subscribers = self.notifications.subscribers if self.notifications else ()
+        depths = [len(subscriber.queue) for subscriber in subscribers]
+        log_queue = sum(handler.queue.qsize() for handler in logger.handlers
+                        if isinstance(handler, BoundedQueueHandler))
+        return {("notifications",): sum(depths), ("notifications_max",): max(depths, default=0),
+                ("log",): log_queue, ("upload_sessions",): len(self.upload_sessions),
+                ("admission",): len(self.admission.waiters), ("disk",): self.disk.queued if self.disk else 0}
+
+    @staticmethod
+    def _dropped_log_records():
+        dropped = {("rate_limited",): 0, ("queue_full",): 0}
+        for log_filter in logger.filters:
+            if isinstance(log_filter, RateLimiter):
+                dropped[("rate_limited",)] += log_filter.total_suppressed
+        for handler in logger.handlers:
+            if isinstance(handler, (BoundedQueueHandler, EventQueueHandler)):
+                dropped[("queue_full",)] += handler.dropped
+        return dropped
+
+    async def _sample_throughput(self):
+        """
+        Keeps the bytes per second gauge up to date from the byte counters.
+        """
+        last = {direction: self.bytes_total.get((direction,)) for direction in ("received", "sent")}
+        while True:
+            await asyncio.sleep(THROUGHPUT_INTERVAL)
+            for direction, previous in last.items():
+                last[direction] = self.bytes_total.get((direction,))
+                self.throughput.set((last[direction] - previous) / THROUGHPUT_INTERVAL, (direction,))
+
+    # ------------------------------------------------------------------ accept loops
+
+    async def accept_notification_clients(self):
+        while self.server_running:
+            try:
+                client_socket, address = await self.loop.sock_accept(self.notification_server_socket)
+                client_socket.setblocking(False)
+                self._spawn(self.notifications.serve(client_socket))  # reads the SUBSCRIBE frame off the accept loop
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self.server_running:
+                    self.log_message(f"Error in notification client connection: {e}", logging.ERROR, error=str(e))
+                break
+
+    async def accept_clients(self):
+        while self.server_running:
+            try:
+                client_conn, client_addr = await self.loop.sock_accept(self.server_socket)
+                client_conn.setblocking(False)
+                client_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # replies go out without delay
+                self._spawn(self.handle_client(client_conn, client_addr))  # one task, not one thread, per client
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self.server_running:
+                    self.log_message(f"Error accepting clients: {str(e)}", logging.ERROR, error=str(e))
+                break
+
+    async def receive_clients(self):
+        """
+        Serves the connections the supervisor hands this worker, until it goes away.
+        """
+        while self.server_running:
+            message, fds = await self.worker.channel.receive()
+            if message is None:
+                self.log_message("Supervisor went away; stopping.", logging.WARNING)
+                self.loop.create_task(self.stop())  # not one of _tasks: stop() cancels those
+                return
+            client_conn = socket.socket(fileno=fds[0])
+            client_conn.setblocking(False)
+            self._spawn(self.handle_client(client_conn, tuple(message["address"]), message["hello"]))
+
+    # ------------------------------------------------------------------ command handlers
+
+    async def handle_client(self, client_conn, client_addr, hello=None):
+        conn = AsyncConnection(self.loop, client_conn)
+        client_name = None
+        try:
+            opcode = protocol.HELLO
+            if hello is None:  # a worker gets the HELLO the supervisor read along with the connection
+                opcode, hello = await conn.read_message()  # the first frame must carry the client's username
+            if opcode != protocol.HELLO or not hello.get("username"):
+                await conn.send_error("Expected HELLO with a username.")
+                conn.close()
+                return
+            client_name = hello["username"]
+            data_connection = "session" in hello  # an extra connection for parallel transfers of a connected client
+            if data_connection and hello["session"] != self.client_sessions.get(client_name):
+                await conn.send_error("Unknown session.")
+                conn.close()
+                return
+            if not data_connection and client_name in self.connected_clients:
+                await conn.send_error("Name already in use.")  # reject duplicate usernames
+                conn.close()
+                return
+
+            # every request the client sends opens a stream with its own handler task
+            mux = Multiplexer(conn, self.buffer_pool,
+                              on_request=lambda stream: self._spawn(self.handle_request(stream, client_name)))
+            if data_connection:
+                self.data_connections.setdefault(client_name, {})[mux] = asyncio.current_task()
+            else:
+                self.connected_clients[client_name] = mux  # register the client
+                self.client_sessions[client_name] = secrets.token_hex(16)
+                self.log_message(f"Client '{client_name}' connected from {client_addr}.", client=client_name,
+                                 address=client_addr[0])
+            await conn.send_message(protocol.WELCOME, {"message": "Successfully",
+                                                       "session": self.client_sessions[client_name]})
+
+            await mux.run()  # returns when the client sends DISCONNECT
+            if data_connection:
+                self._drop_data_connection(mux, client_name)
+            else:
+                self.handle_disconnect(mux, client_name)
+        except asyncio.CancelledError:
+            conn.close()
+            raise
+        except Exception as e:
+            self.log_message(f"Error with client {client_addr}: {str(e)}", logging.WARNING, client=client_name,
+                             address=client_addr[0], error=str(e))
+            registered = self.connected_clients.get(client_name)
+            if registered is not None and registered.conn is conn:
+                self.handle_disconnect(registered, client_name)
+            for mux in list(self.data_connections.get(client_name, ())):
+                if mux.conn is conn:
+                    self._drop_data_connection(mux, client_name)
+            conn.close()
+
+    async def handle_request(self, stream, client_name):
+        command, outcome = "unknown", "cancelled"
+        started = time.perf_counter()
+        try:
+            opcode, flags, request = await stream.receive_message()
+            if not isinstance(request, dict):
+                raise ProtocolError("request fields must be a JSON object")
+            if self.replicator is not None and opcode in (protocol.UPLOAD, protocol.DELETE):
+                command = "read_only"
+                await stream.send_error(f"READ ONLY: This server is a replica of {self.replicator.host}:"
+                                        f"{self.replicator.port}; send changes there.")
+            elif self.replicator is not None and opcode in (protocol.LIST, protocol.DOWNLOAD) \
+                    and not await self.replicator.caught_up(request.get("after_change")):
+                command = "replica_behind"
+                await stream.send_error("REPLICA BEHIND: This replica has not caught up with your changes yet.")
+            elif opcode == protocol.UPLOAD and "upload_id" in request:
+                command = "upload_part"
+                await self.handle_upload_part(stream, client_name, request)
+            elif opcode == protocol.UPLOAD and "bundle" in request:
+                command = "upload_bundle"
+                await self._admitted(self.handle_bundle_upload, stream, client_name, request)
+            elif opcode == protocol.UPLOAD:
+                command = "upload"
+                await self._admitted(self.handle_upload, stream, client_name, request)
+            elif opcode == protocol.LIST:
+                command = "list"
+                await self.handle_list_request(stream, request)
+            elif opcode == protocol.DELETE:
+                command = "delete"
+                await self.handle_delete(stream, client_name, request)
+            elif opcode == protocol.DOWNLOAD and "bundle" in request:
+                command = "download_bundle"
+                await self._admitted(self.handle_bundle_download, stream, client_name, request)
+            elif opcode == protocol.DOWNLOAD:
+                command = "download"
+                await self._admitted(self.handle_download, stream, client_name, request)
+            elif opcode == protocol.REPLICATE:
+                command = "replicate"
+                await self.handle_replicate(stream, request)
+            outcome = "error" if stream.failed else "ok"
+        except ProtocolError as e:
+            outcome = "bad_request"
+            self.log_message(f"Bad request from '{client_name}': {str(e)}", logging.WARNING, client=client_name,
+                             command=command, error=str(e))
+            with contextlib.suppress(OSError):
+                await stream.send_error(str(e))
+        except ConnectionError as e:
+            outcome = "abandoned"
+            self.log_message(f"Request from '{client_name}' abandoned: {str(e)}", logging.WARNING,
+                             client=client_name, command=command, error=str(e))
+        except Exception as e:
+            # a bug in one handler must not leave its client waiting for a reply that never comes
+            outcome = "failed"
+            self.log_message(f"Error handling {command} request from '{client_name}': {e!r}", logging.ERROR,
+                             client=client_name, command=command, error=repr(e))
+            if not stream.cancelled and not stream.mux.closed:
+                with contextlib.suppress(OSError):
+                    await stream.send_error(f"SERVER ERROR: The {command} request failed.")
+        finally:
+            stream.close()
+            self.requests_total.inc(1, (command, outcome))
+            self.request_seconds.observe(time.perf_counter() - started, (command,))
+
+    async def _admitted(self, handler, stream, client_name, request):
+        """
+        Runs a transfer's handler once it has a transfer slot, or refuses it as busy.
+        The parts of a parallel upload run in their upload's slot.
+        """
+        if not await self.admission.acquire(client_name):
+            await stream.send_error("SERVER BUSY: Too many transfers are running; try again later.")
+            return
+        try:
+            await handler(stream, client_name, request)
+        finally:
+            self.admission.release(client_name)
+
+    async def handle_upload(self, stream, client_name, request):
+        filename = request.get("filename", "")
+        size = request.get("size")
+        source = request.get("source")  # client's identity for the local file; enables resuming
+        digests = request.get("chunks")  # optional SHA-256 of every chunk; chunks the server has are skipped
+        checksum = request.get("checksum")  # optional file_checksum() of those digests
+        block_size = request.get("delta")  # optional: send the data as a delta against the stored copy
+        name = f"{client_name}_{filename}"  # the name other clients see
+        if not isinstance(filename, str) or not filename or os.path.basename(filename) != filename \
+                or type(size) is not int or size < 0:
+            await stream.send_error("Invalid upload request.")
+            return
+        if digests is not None and (not isinstance(digests, list) or len(digests) != -(-size // CHUNK_SIZE)
+                                    or not all(is_digest(digest) for digest in digests)):
+            await stream.send_error("Invalid chunk list.")
+            return
+        if checksum is not None and not isinstance(checksum, str):
+            await stream.send_error("Invalid checksum.")
+            return
+        if block_size is not None and (digests is None or not delta.valid_block_size(block_size)):
+            await stream.send_error("Invalid delta request.")  # the announced digests are what checks a delta
+            return
+        if name in self.active_uploads:
+            await stream.send_error(f"UPLOAD ERROR: '{filename}' is already being uploaded.")
+            return
+        if checksum is not None and self.catalog.checksum(name) == (size, checksum):
+            # the stored file already has this content: no transfer, no new version, no notification
+            await stream.send_message(protocol.OK, {"status": "Unchanged", "missing": [], "checksum": checksum,
+                                                    "message": "UPLOAD SKIPPED: The file is unchanged."}, end=True)
+            return
+
+        # received chunks go straight into the blob store and are recorded in a manifest; an interrupted
+        # upload of the same source continues where it stopped, and the old version stays readable meanwhile
+        part_path = self.partial_path(name)
+        manifest_path = part_path + ".json"
+        manifest = ChunkManifest.load(manifest_path)
+        resumed = manifest is not None and source is not None and manifest.source == source \
+            and manifest.size == size and manifest.chunk_size == CHUNK_SIZE \
+            and (digests is None or all(old in (None, new) for old, new in zip(manifest.digests, digests)))
+        if manifest is not None and not resumed:
+            self.blobs.unpin(received_digests(manifest))  # a different file: forget the old attempt
+            self._remove_quietly(manifest_path)
+        if not resumed:
+            manifest = ChunkManifest(size, source=source, owner=client_name)
+        resumed_bytes = manifest.received_bytes()
+        deduplicated_bytes = 0
+        wanted = [index for index, received in enumerate(manifest.received) if digests and not received]
+        # pinned before looking, so a blob found here cannot be collected, by this process or another, meanwhile
+        self.blobs.pin([digests[index] for index in wanted])
+        absent = []
+        for index in wanted:
+            if self.blobs.has(digests[index]):
+                manifest.mark(index, digests[index])
+                start, end = manifest.chunk_range(index)
+                deduplicated_bytes += end - start
+            else:
+                absent.append(digests[index])
+        self.blobs.unpin(absent, collect=False)
+
+        def save_progress():
+            if source:
+                self._save_manifest(manifest, manifest_path)
+
+        self.active_uploads.add(name)
+        missing = manifest.missing_ranges()
+        # the client offers codecs only for data its samples say will compress
+        codec = compression.negotiate(request.get("compression")) if missing else None
+        # a parallel upload's data arrives in part streams, possibly on other connections; this stream only commits
+        session = upload_id = None
+        if request.get("parallel") is True and missing:
+            upload_id = secrets.token_hex(8)
+            session = self.upload_sessions[upload_id] = UploadSession(client_name, manifest, part_path, digests, codec,
+                                                                      save_progress)
+        ingest = ChunkIngest(self.loop, self.blobs, manifest, [] if session else missing, part_path, expected=digests,
+                             disk_latency=self.disk_seconds, disk=self.disk.bind(client_name))
+        # a delta upload rebuilds the missing ranges from the stored copy's blocks plus the literal data the client
+        # sends; the stored copy's chunks stay pinned until then, whatever happens to it meanwhile. Only the chunks
+        # the new version does not reuse as they are get signatures: the changed data is what moved or was edited
+        base = self.catalog.get(name) if block_size is not None and missing and not session else None
+        reused = set(digests or ())
+        described = [index for index, digest in enumerate(base["chunks"]) if digest not in reused] \
+            if base is not None else []
+        if not described:
+            base = None  # nothing to copy from
+        if base is not None:
+            self.blobs.pin(base["chunks"])
+            ingest = DeltaIngest(ingest, delta.DeltaParser(block_size, base["size"]),
+                                 functools.partial(self._read_stored, client_name, base))
+        try:
+            # check if the file already exists and notify the client accordingly
+            status = "Override" if self.catalog.exists(name) else "New"
+            if status == "Override":
+                self.log_message(f"Client '{client_name}' attempted to re-upload '{filename}'.", client=client_name,
+                                 file=name)
+            if resumed_bytes:
+                self.log_message(f"Resuming upload of '{filename}' by '{client_name}' at "
+                                 f"{resumed_bytes} of {size} bytes.", client=client_name, file=name,
+                                 resumed_bytes=resumed_bytes)
+            reply = {"status": status, "missing": missing, "resumed_bytes": resumed_bytes,
+                     "deduplicated_bytes": deduplicated_bytes, "compression": codec}
+            if upload_id is not None:
+                reply["upload_id"] = upload_id
+            if base is not None:
+                reply["delta"] = {"block_size": block_size, "size": base["size"], "chunk_size": base["chunk_size"],
+                                  "chunks": described}
+            await stream.send_message(protocol.OK, reply)
+            if base is not None:
+                await self._send_signatures(stream, client_name, base, described, block_size)
+
+            trailer = await self._receive_upload(stream, client_name, f"upload of '{filename}'", ingest,
+                                                 None if session else codec, save_progress)
+            if session is not None and session.tasks:
+                raise ProtocolError("upload ended while parts were still being received")
+            copied = 0
+            if base is not None:
+                copied, ingest = ingest.copied, ingest.ingest
+            async with self.file_locks(name).write():  # a delete of the old version waits for the commit
+                await ingest.flush()
+                self._verify_trailer(ingest, trailer, f"upload of '{filename}'")
+                if not manifest.complete():
+                    raise ProtocolError(f"upload ended {size - manifest.received_bytes()} bytes short of the "
+                                        f"announced size")
+                received_checksum = file_checksum(manifest.digests)
+                if checksum is not None and checksum != received_checksum:
+                    raise ProtocolError(f"upload of '{filename}' does not match its announced checksum")
+                entry = {"name": name, "owner": client_name, "size": size, "chunk_size": CHUNK_SIZE,
+                         "chunks": manifest.digests, "version": content_version(manifest.digests),
+                         "modified": time.time(), "checksum": received_checksum}
+                try:
+                    freed = self.catalog.put(entry)  # one transaction; the old version's chunks lose their references
+                except sqlite3.Error as e:
+                    await stream.send_error(f"UPLOAD ERROR: {str(e)}")
+                    self.log_message(f"Error recording upload: {str(e)}", logging.ERROR, client=client_name, file=name,
+                                     error=str(e))
+                    return
+                self.blobs.collect(freed)
+            self.notifications.publish("uploads", {
+                "event": "uploaded", "file": name, "owner": client_name, "size": size, "time": entry["modified"],
+                "message": f"NOTIFICATION: '{client_name}' uploaded '{name}'."}, key=("uploaded", name))
+        except ConnectionError:
+            raise
+        except OSError as e:
+            await stream.send_error(f"UPLOAD ERROR: {str(e)}")
+            self.log_message(f"Error during file upload: {str(e)}", logging.ERROR, client=client_name, file=name,
+                             error=str(e))
+            return
+        finally:
+            try:
+                if session is not None:
+                    del self.upload_sessions[upload_id]
+                    await session.close()  # parts still running are cancelled and settle their chunks
+                if isinstance(ingest, DeltaIngest):
+                    ingest = ingest.ingest
+                await ingest.abort()  # settles chunks still being committed
+                if base is not None:
+                    self.blobs.unpin(base["chunks"])
+                if manifest.complete():
+                    self._remove_quietly(manifest_path)
+                elif source:
+                    self._save_manifest(manifest, manifest_path)  # keep progress (and its blobs) for a resume
+                # the catalog references a committed upload's chunks; other pins go unless a resume needs them
+                if manifest.complete() or not source:
+                    self.blobs.unpin(received_digests(manifest))
+            finally:
+                self.active_uploads.discard(name)  # only now may a retry pick up the saved progress
+
+        await stream.send_message(protocol.OK, {"message": "UPLOAD SUCCESS", "deduplicated_bytes": deduplicated_bytes,
+                                                "copied_bytes": copied, "checksum": entry["checksum"],
+                                                "change": self.catalog.head()}, end=True)
+        self.log_message(f"Uploaded file '{filename}' by '{client_name}'.", client=client_name, file=name, size=size,
+                         copied_bytes=copied)
+
+    async def handle_upload_part(self, stream, client_name, request):
+        """
+        Receives one part of a parallel upload: chunk-aligned ranges of the
+        file, marked in the upload's shared manifest. The stream that started
+        the upload commits the file once every part is in.
+        """
+        session = self.upload_sessions.get(request.get("upload_id"))
+        if session is None or session.owner != client_name:
+            await stream.send_error("UPLOAD ERROR: Unknown upload.")
+            return
+        ranges = request.get("ranges")
+        indexes = session.claim(ranges)
+        if indexes is None:
+            await stream.send_error("UPLOAD ERROR: Invalid part ranges.")
+            return
+        task = asyncio.current_task()
+        session.tasks.add(task)
+        ingest = ChunkIngest(self.loop, self.blobs, session.manifest, ranges, session.part_path,
+                             expected=session.expected, disk_latency=self.disk_seconds, disk=self.disk.bind(client_name))
+        try:
+            trailer = await self._receive_upload(stream, client_name, "upload part", ingest, session.codec,
+                                                 session.save_progress)
+            await ingest.flush()
+            self._verify_trailer(ingest, trailer, "upload part")
+        except asyncio.CancelledError:
+            with contextlib.suppress(OSError):
+                await stream.send_error("UPLOAD ERROR: The upload was abandoned.")  # its announcing stream ended
+            raise
+        except ConnectionError:
+            raise
+        except OSError as e:
+            await stream.send_error(f"UPLOAD ERROR: {str(e)}")
+            self.log_message(f"Error during file upload: {str(e)}", logging.ERROR, client=client_name, error=str(e))
+            return
+        finally:
+            session.tasks.discard(task)
+            await ingest.abort()
+            session.release(indexes)  # chunks that did not arrive may be sent again in another part
+        await stream.send_message(protocol.OK, {"message": "PART RECEIVED"}, end=True)
+
+    async def handle_bundle_upload(self, stream, client_name, request):
+        """
+        Receives many files in one request. The request lists every file's
+        name, size and chunk digests; the OK answers with each one's status
+        and missing ranges (chunks the store has and files that did not
+        change are not sent); the DATA that follows is the missing ranges of
+        every file back to back, in order. The files are committed to the
+        catalog in one transaction, all of them or none, so nothing is kept
+        for a resume: a failed bundle is sent again.
+        """
+        files = request.get("bundle")
+        if not isinstance(files, list) or not 0 < len(files) <= protocol.MAX_BUNDLE_FILES \
+                or not all(self._valid_bundle_file(entry) for entry in files):
+            await stream.send_error("UPLOAD ERROR: Invalid bundle.")
+            return
+        names = [f"{client_name}_{entry['filename']}" for entry in files]
+        if len(set(names)) != len(names):
+            await stream.send_error("UPLOAD ERROR: The bundle names a file twice.")
+            return
+        busy = next((entry["filename"] for entry, name in zip(files, names) if name in self.active_uploads), None)
+        if busy is not None:
+            await stream.send_error(f"UPLOAD ERROR: '{busy}' is already being uploaded.")
+            return
+
+        statuses = []
+        manifests = {}  # position in the bundle -> manifest, for the files whose content changed
+        for position, (entry, name) in enumerate(zip(files, names)):
+            stored = self.catalog.checksum(name)
+            if stored == (entry["size"], file_checksum(entry["chunks"])):
+                statuses.append("Unchanged")
+            else:
+                statuses.append("Override" if stored is not None else "New")
+                manifests[position] = ChunkManifest(entry["size"], owner=client_name)
+        # as for a single upload, chunks are pinned before looking, and those the store has are not sent
+        self.blobs.pin([digest for position in manifests for digest in files[position]["chunks"]])
+        absent = []
+        deduplicated_bytes = 0
+        for position, manifest in manifests.items():
+            for index, digest in enumerate(files[position]["chunks"]):
+                if self.blobs.has(digest):
+                    manifest.mark(index, digest)
+                    start, end = manifest.chunk_range(index)
+                    deduplicated_bytes += end - start
+                else:
+                    absent.append(digest)
+        self.blobs.unpin(absent, collect=False)
+
+        missing = {position: manifest.missing_ranges() for position, manifest in manifests.items()}
+        codec = compression.negotiate(request.get("compression")) if any(missing.values()) else None
+        ingest = BundleIngest([ChunkIngest(self.loop, self.blobs, manifests[position], ranges,
+                                           self.partial_path(names[position]), expected=files[position]["chunks"],
+                                           disk_latency=self.disk_seconds, disk=self.disk.bind(client_name))
+                               for position, ranges in missing.items() if ranges])
+        self.active_uploads.update(names)
+        try:
+            await stream.send_message(protocol.OK, {
+                "files": [{"status": status, "missing": missing.get(position, [])}
+                          for position, status in enumerate(statuses)],
+                "deduplicated_bytes": deduplicated_bytes, "compression": codec})
+            # every chunk is checked against its announced digest, so a TRAILER would add nothing
+            await self._receive_upload(stream, client_name, "bundle upload", ingest, codec, lambda: None)
+            await ingest.flush()
+            if not all(manifest.complete() for manifest in manifests.values()):
+                raise ProtocolError("bundle upload ended short of its files' sizes")
+            modified = time.time()
+            entries = [{"name": names[position], "owner": client_name, "size": manifest.size,
+                        "chunk_size": CHUNK_SIZE, "chunks": manifest.digests,
+                        "version": content_version(manifest.digests), "modified": modified,
+                        "checksum": file_checksum(manifest.digests)} for position, manifest in manifests.items()]
+            # from here on nothing awaits, so no other request sees part of the bundle, and a delete of one of
+            # its files goes entirely before or after the commit
+            try:
+                freed = self.catalog.put_many(entries)
+            except sqlite3.Error as e:
+                await stream.send_error(f"UPLOAD ERROR: {str(e)}")
+                self.log_message(f"Error recording bundle upload: {str(e)}", logging.ERROR, client=client_name,
+                                 error=str(e))
+                return
+            self.blobs.collect(freed)
+            for entry in entries:
+                self.notifications.publish("uploads", {
+                    "event": "uploaded", "file": entry["name"], "owner": client_name, "size": entry["size"],
+                    "time": modified, "message": f"NOTIFICATION: '{client_name}' uploaded '{entry['name']}'."},
+                    key=("uploaded", entry["name"]))
+        except ConnectionError:
+            raise
+        except OSError as e:
+            await stream.send_error(f"UPLOAD ERROR: {str(e)}")
+            self.log_message(f"Error during bundle upload: {str(e)}", logging.ERROR, client=client_name,
+                             error=str(e))
+            return
+        finally:
+            self.active_uploads.difference_update(names)
+            await ingest.abort()  # settles chunks still being committed
+            for manifest in manifests.values():
+                self.blobs.unpin(received_digests(manifest))  # committed chunks are referenced, the rest go
+
+        await stream.send_message(protocol.OK, {"message": "UPLOAD SUCCESS", "committed": len(entries),
+                                                "deduplicated_bytes": deduplicated_bytes,
+                                                "change": self.catalog.head()}, end=True)
+        self.log_message(f"Uploaded a bundle of {len(files)} files by '{client_name}' ({len(entries)} changed).",
+                         client=client_name, files=len(files), committed=len(entries),
+                         size=sum(entry["size"] for entry in entries))
+
+    @staticmethod
+    def _valid_bundle_file(entry):
+        if not isinstance(entry, dict):
+            return False
+        filename, size, digests = entry.get("filename"), entry.get("size"), entry.get("chunks")
+        return isinstance(filename, str) and filename and os.path.basename(filename) == filename \
+            and type(size) is int and size >= 0 and isinstance(digests, list) \
+            and len(digests) == -(-size // CHUNK_SIZE) and all(is_digest(digest) for digest in digests)
+
+    async def _receive_upload(self, stream, client_name, what, ingest, codec, save_progress):
+        """
+        Feeds the DATA of an upload stream into ``ingest`` until END_STREAM,
+        decompressing it first if the transfer is compressed. Returns the
+        stream's TRAILER, or None if its last DATA frame ended it. Over a
+        rate limit, the credit for a piece is returned only once it may be.
+        """
+        decoder = compression.Decoder(codec) if codec else None
+        unsaved_chunks = 0
+        while True:  # DATA arrives in pooled buffers, one frame at a time
+            opcode, flags, piece = await stream.receive()
+            if opcode == protocol.TRAILER and flags & protocol.FLAG_END_STREAM:
+                trailer, piece = piece, memoryview(b"")  # ends the stream like an empty DATA frame
+            elif opcode == protocol.DATA:
+                trailer = None
+            else:
+                raise StreamCancelled(f"{what} was cancelled")
+            try:
+                self.bytes_total.inc(len(piece), ("received",))
+                if self.shaper.enabled:
+                    await self.shaper.throttle(client_name, "received", len(piece))
+                if decoder is None:
+                    unsaved_chunks += await ingest.write(piece)
+                else:
+                    unsaved_chunks += await self._decode_into(ingest, decoder, piece)
+            except ValueError as e:
+                raise ProtocolError(str(e))
+            finally:
+                stream.consumed(piece)  # buffer back to the pool, credit back to the client
+            if unsaved_chunks >= MANIFEST_FLUSH_CHUNKS:
+                save_progress()
+                unsaved_chunks = 0
+            if flags & protocol.FLAG_END_STREAM:
+                if ingest.remaining:
+                    raise ProtocolError(f"{what} ended {ingest.remaining} bytes short")
+                if decoder is not None and not decoder.eof:
+                    raise ProtocolError(f"compressed {what} ended before the end of its stream")
+                return trailer
+
+    @staticmethod
+    def _verify_trailer(ingest, trailer, what):
+        """
+        Compares a stream's TRAILER with the chunks it delivered (after flush());
+        on a mismatch they are dropped, to be sent again.
+        """
+        if trailer is not None and trailer.get("checksum") != ingest.checksum():
+            ingest.discard()
+            raise ProtocolError(f"{what} does not match its checksum; the data was corrupted in transit")
+
+    async def _decode_into(self, ingest, decoder, piece):
+        """
+        Decompresses one DATA frame of a compressed upload into ``ingest``.
+        Returns the number of chunks completed.
+        """
+        completed = 0
+        decoder.feed(piece)
+        while True:
+            data = await self.loop.run_in_executor(None, decoder.read)  # at most DECODE_LIMIT bytes at a time
+            if not data:
+                return completed
+            completed += await ingest.write(memoryview(data))
+
+    async def _send_signatures(self, stream, client_name, entry, chunks, block_size):
+        """
+        Sends the block signatures of the given chunks of a stored file for a
+        delta upload, as DATA frames the client reads before it sends the delta.
+        """
+        for index in chunks:
+            view = await self._load_blob(client_name, entry["chunks"][index])
+            signatures = await self.loop.run_in_executor(None, delta.block_signatures, view, block_size)
+            await stream.send_data(signatures, end=False)
+            self.bytes_total.inc(len(signatures), ("sent",))
+
+    async def _read_stored(self, client_name, entry, start, end):
+        """
+        Yields views of bytes [start, end) of a stored file, a blob at a time.
+        """
+        chunk_size = entry["chunk_size"]
+        while start < end:
+            index = start // chunk_size
+            offset = start - index * chunk_size
+            count = min(end, (index + 1) * chunk_size) - start
+            view = await self._load_blob(client_name, entry["chunks"][index])
+            if len(view) < offset + count:
+                raise OSError(f"blob {entry['chunks'][index]} is shorter than expected")
+            yield view[offset:offset + count]
+            start += count
+
+    async def _load_blob(self, client_name, digest):
+        """
+        Returns a whole blob as a memoryview, through the read cache (read in the client's disk queue).
+        """
+        view = self.read_cache.get(digest)
+        if view is None:
+            view = await self.read_cache.load(digest, functools.partial(self.blobs.load, digest),
+                                              self.disk.bind(client_name))
+        return view
+
+    def partial_path(self, name):
+        return os.path.join(self.file_storage_directory, PARTIAL_DIRECTORY, name + ".part")
+
+    def _save_manifest(self, manifest, manifest_path):
+        # chunks are only marked once their blob is synced, so the manifest never claims data that is not on disk
+        try:
+            manifest.save(manifest_path)
+        except OSError as e:
+            self.log_message(f"Error saving upload progress: {str(e)}", logging.WARNING, error=str(e))
+
+    @staticmethod
+    def _remove_quietly(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def cleanup_partial_uploads(self):
+        """
+        Removes partial uploads nobody resumed within PARTIAL_UPLOAD_TTL. Their
+        blobs are no longer pinned and go with the next sweep.
+        """
+        directory = os.path.join(self.file_storage_directory, PARTIAL_DIRECTORY)
+        os.makedirs(directory, exist_ok=True)
+        expiry = time.time() - PARTIAL_UPLOAD_TTL
+        for entry in os.scandir(directory):
+            try:
+                if entry.stat().st_mtime < expiry:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def pin_partial_uploads(self):
+        """
+        Pins the chunks interrupted uploads have already received, so they
+        survive until resumed. A worker pins those of its own users (and
+        those of unknown owner, from older versions).
+        """
+        directory = os.path.join(self.file_storage_directory, PARTIAL_DIRECTORY)
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".part.json"):
+                manifest = ChunkManifest.load(entry.path)
+                if manifest is not None and (self.worker is None or manifest.owner is None
+                                             or self.worker.serves(manifest.owner)):
+                    self.blobs.pin(received_digests(manifest))
+
+    async def handle_list_request(self, stream, request):
+        """
+        Sends one page of the catalog, optionally filtered by owner, name
+        prefix and modification time. The page is streamed as several OK
+        frames; the last one (END) carries the cursor for the next page, or
+        None when there is none.
+        """
+        sort = request.get("sort", "name")
+        limit = request.get("limit", LIST_PAGE_SIZE)
+        cursor = request.get("cursor")
+        filters = {key: request.get(key) for key in ("owner", "prefix", "modified_after", "modified_before")}
+        if not isinstance(sort, str) or sort not in LIST_SORTS \
+                or type(limit) is not int or not 0 < limit <= MAX_LIST_PAGE_SIZE \
+                or not (cursor is None or isinstance(cursor, list) and len(cursor) == len(LIST_SORTS[sort])) \
+                or not all(filters[key] is None or isinstance(filters[key], str) for key in ("owner", "prefix")) \
+                or not all(filters[key] is None or isinstance(filters[key], (int, float))
+                           for key in ("modified_after", "modified_before")):
+            await stream.send_error("LIST ERROR: Invalid list request.")
+            return
+        try:
+            files = self.catalog.list_files(sort=sort, after=cursor, limit=limit + 1, **filters)
+        except sqlite3.Error as e:
+            await stream.send_error(f"LIST ERROR: {str(e)}")
+            self.log_message(f"Error handling list request: {str(e)}", logging.ERROR, error=str(e))
+            return
+
+        next_cursor = None
+        if len(files) > limit:  # one extra row tells whether another page follows
+            del files[limit:]
+            last = files[-1]
+            next_cursor = [last["modified"], last["file"]] if sort == "modified" else [last["file"]]
+        batches = [files[start:start + LIST_BATCH_SIZE] for start in range(0, len(files), LIST_BATCH_SIZE)] or [[]]
+        for batch in batches[:-1]:
+            await stream.send_message(protocol.OK, {"files": batch})
+        await stream.send_message(protocol.OK, {"files": batches[-1], "cursor": next_cursor}, end=True)
+
+    async def handle_delete(self, stream, client_name, request):
+        filename = request.get("filename")
+        if not isinstance(filename, str) or not filename:
+            await stream.send_error("DELETE ERROR: Invalid delete request.")
+            return
+        try:
+            async with self.file_locks(filename).write():
+                freed = self.catalog.delete(filename, client_name)  # only the owner's own files match
+                if freed is not None:
+                    self.blobs.collect(freed)  # chunks no other file shares are deleted
+            if freed is None:
+                await stream.send_error("DELETE ERROR: File not found or unauthorized.")
+                return
+            self.notifications.publish("deletes", {
+                "event": "deleted", "file": filename, "owner": client_name, "time": time.time(),
+                "message": f"NOTIFICATION: '{client_name}' deleted '{filename}'."}, key=("deleted", filename))
+            await stream.send_message(protocol.OK, {"message": "DELETE SUCCESS", "change": self.catalog.head()},
+                                      end=True)
+            self.log_message(f"File '{filename}' deleted by '{client_name}'.", client=client_name, file=filename)
+        except ConnectionError:
+            raise
+        except Exception as e:
+            await stream.send_error(f"DELETE ERROR: {str(e)}")
+            self.log_message(f"Error handling delete: {str(e)}", logging.ERROR, client=client_name, error=str(e))
+
+    async def handle_download(self, stream, client_name, request):
+        filename = request.get("filename")
+        if not isinstance(filename, str) or not filename:
+            await stream.send_error("DOWNLOAD ERROR: Invalid download request.")
+            return
+        entry = await self._pinned_entry(filename)
+        if entry is None:
+            await stream.send_error("DOWNLOAD ERROR: File not found.")
+            return
+        try:
+            await self._send_entry(stream, client_name, filename, entry, request)
+        finally:
+            self.blobs.unpin(entry["chunks"])
+
+    async def _pinned_entry(self, filename):
+        """
+        Returns the catalog entry of a file to send with its chunks pinned, or None if there is no such file.
+        """
+        async with self.file_locks(filename).read():
+            while True:
+                entry = self.catalog.get(filename)
+                if entry is None:
+                    return None
+                self.blobs.pin(entry["chunks"])  # an overwrite or delete during the transfer must not collect them
+                if self.worker is None or self.catalog.checksum(filename) == (entry["size"], entry["checksum"]):
+                    return entry
+                # another worker replaced or deleted the file before the pins were recorded; its chunks may be gone
+                self.blobs.unpin(entry["chunks"])
+
+    async def handle_bundle_download(self, stream, client_name, request):
+        """
+        Sends many files in one request. The OK lists the size, version and
+        checksum of every requested file, or why it cannot be sent, and is
+        followed by the contents of the files found, back to back in the
+        order requested, as one (possibly compressed) stream.
+        """
+        names = request.get("bundle")
+        if not isinstance(names, list) or not 0 < len(names) <= protocol.MAX_BUNDLE_FILES \
+                or not all(isinstance(name, str) for name in names):
+            await stream.send_error("DOWNLOAD ERROR: Invalid bundle.")
+            return
+        entries = [await self._pinned_entry(name) for name in names]
+        found = [entry for entry in entries if entry is not None]
+        try:
+            pieces = {entry["name"]: [(digest, 0, min(entry["chunk_size"], entry["size"] - index * entry["chunk_size"]))
+                                      for index, digest in enumerate(entry["chunks"])] for entry in found}
+            every_piece = [piece for entry in found for piece in pieces[entry["name"]]]
+            codec = compression.negotiate(request.get("compression")) if every_piece else None
+            if codec is not None and not await self.disk.run(client_name, self._compressible, every_piece):
+                codec = None
+            encoder = compression.Encoder(codec) if codec else None
+            await stream.send_message(protocol.OK, {"files": [
+                {"file": name, "size": entry["size"], "version": entry["version"], "checksum": entry["checksum"]}
+                if entry is not None else {"file": name, "error": "File not found."}
+                for name, entry in zip(names, entries)], "compression": codec})
+            for entry in found:
+                self.notifications.publish(owner_topic(entry["owner"]), {
+                    "event": "downloaded", "file": entry["name"], "by": client_name, "time": time.time(),
+                    "message": f"NOTIFICATION: Your file '{entry['name']}' was downloaded by '{client_name}'."},
+                    key=("downloaded", entry["name"], client_name))
+            if not found:
+                await stream.send_data(b"", end=True)
+            for position, entry in enumerate(found):
+                if not await self._send_pieces(stream, client_name, entry["name"], pieces[entry["name"]], encoder,
+                                               end=position == len(found) - 1):
+                    return
+        finally:
+            for entry in found:
+                self.blobs.unpin(entry["chunks"])
+        self.log_message(f"Bundle of {len(found)} files sent to client '{client_name}'.", client=client_name,
+                         files=len(found), size=sum(entry["size"] for entry in found))
+
+    async def handle_replicate(self, stream, request):
+        """
+        Answers a replica with the changes of the catalog after "after", or
+        if there are none yet, with those that arrive within "wait" seconds.
+        A replica that followed another log (or none) gets the log from the start.
+        """
+        after, wait = request.get("after", 0), request.get("wait", 0)
+        if type(after) is not int or after < 0 or type(wait) not in (int, float) or not math.isfinite(wait):
+            await stream.send_error("REPLICATE ERROR: Invalid replication request.")
+            return
+        log_id = self.catalog.log_id
+        if request.get("log") != log_id:
+            after = 0
+        deadline = self.loop.time() + min(max(wait, 0), MAX_POLL_WAIT)
+        while True:
+            changed = self._catalog_changed
+            changes = self.catalog.changes_after(after)
+            remaining = deadline - self.loop.time()
+            if changes or remaining <= 0:
+                break
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(changed.wait(), min(remaining, REPLICATION_POLL))
+        await stream.send_message(protocol.OK, {"log": log_id, "head": self.catalog.head(), "changes": changes},
+                                  end=True)
+
+    async def _send_entry(self, stream, client_name, filename, entry, request):
+        size = entry["size"]
+        version = entry["version"]  # changes whenever the content does
+        ranges = request.get("ranges")
+        if ranges is None or request.get("version", version) != version:
+            ranges = [[0, size]]  # whole file; a resume against an older version starts over
+        elif not isinstance(ranges, list) or not all(
+                isinstance(r, list) and len(r) == 2 and all(type(value) is int for value in r)
+                and 0 <= r[0] <= r[1] <= size for r in ranges):
+            await stream.send_error(f"DOWNLOAD ERROR: Invalid byte ranges for a {size} byte file.")
+            return
+
+        if request.get("if_none_match") is not None and request["if_none_match"] == version:
+            # the client has a copy of this version (e.g. in its download cache): it only needs to know it is current
+            await stream.send_message(protocol.OK, {"status": "Not Modified", "size": size, "version": version,
+                                                    "checksum": entry["checksum"]}, end=True)
+            self.log_message(f"File '{filename}' is unchanged for client '{client_name}'.", client=client_name,
+                             file=filename, size=size, not_modified=True)
+            return
+
+        # notify the file owner; queued for the owner's notification writers, never waited on. The parts
+        # of a parallel download are announced once, by the request that looked the file up first
+        if not request.get("part"):
+            self.notifications.publish(owner_topic(entry["owner"]), {
+                "event": "downloaded", "file": filename, "by": client_name, "time": time.time(),
+                "message": f"NOTIFICATION: Your file '{filename}' was downloaded by '{client_name}'."},
+                key=("downloaded", filename, client_name))
+
+        # map the byte ranges onto the file's chunks: (digest, offset in the blob, byte count)
+        chunk_size = entry["chunk_size"]
+        pieces = []
+        for start, end in ranges:
+            while start < end:
+                index = start // chunk_size
+                count = min(end, (index + 1) * chunk_size) - start
+                pieces.append((entry["chunks"][index], start - index * chunk_size, count))
+                start += count
+
+        codec = compression.negotiate(request.get("compression")) if pieces else None
+        if codec is not None and not await self.disk.run(client_name, self._compressible, pieces):
+            codec = None  # already compressed data would only cost CPU
+        encoder = compression.Encoder(codec) if codec else None
+
+        await stream.send_message(protocol.OK, {"message": "FILENAME RECEIVED", "size": size, "version": version,
+                                                "checksum": entry["checksum"], "ranges": ranges,
+                                                "compression": codec})
+        if not await self._send_pieces(stream, client_name, filename, pieces, encoder):
+            return
+        if not request.get("part"):
+            self.log_message(f"File '{filename}' sent to client '{client_name}'.", client=client_name, file=filename,
+                             size=size)
+
+    async def _send_pieces(self, stream, client_name, filename, pieces, encoder, end=True):
+        """
+        Sends the (digest, offset in the blob, byte count) pieces of a file,
+        through ``encoder`` if the transfer is compressed; ``end`` ends the
+        stream with the last one. Returns False if the stored data could not
+        be read (the stream then ends with an ERROR).
+        """
+        try:
+            # the requested ranges go out back to back as flow-controlled DATA frames. Cold uncompressed blobs of
+            # an uncompressed transfer are sent with sendfile; hot blobs come from the read cache, and anything
+            # else is read (once, however many downloads want it) through the cache and recoded. Over a rate limit,
+            # each piece waits for its tokens before it goes out
+            if not pieces and end:
+                await stream.send_data(encoder.compress(b"", final=True) if encoder is not None else b"", end=True)
+            for index, (digest, offset, count) in enumerate(pieces):
+                last = end and index == len(pieces) - 1
+                view = self.read_cache.get(digest)
+                if view is None:
+                    try:
+                        opened = self.blobs.open_blob(digest)
+                    except OSError as e:
+                        self.log_message(f"Error reading '{filename}': {str(e)}", logging.ERROR, file=filename,
+                                         error=str(e))
+                        await stream.send_error("DOWNLOAD ERROR: Stored data is unavailable.")
+                        return False
+                    if opened is None:
+                        self.log_message(f"Error reading '{filename}': blob {digest} is missing.", logging.ERROR,
+                                         file=filename, blob=digest)
+                        await stream.send_error("DOWNLOAD ERROR: Stored data is unavailable.")
+                        return False
+                    blob, stored_codec = opened
+                    with blob:
+                        if encoder is None and stored_codec is None and not self.read_cache.wanted(digest):
+                            if self.shaper.enabled:
+                                await self.shaper.throttle(client_name, "sent", count)
+                            await stream.send_file(blob, offset, count, end=last, zero_copy=self.zero_copy)
+                            self.bytes_total.inc(count, ("sent",))
+                            continue
+                    try:
+                        view = await self.read_cache.load(digest, functools.partial(self.blobs.load, digest),
+                                                          self.disk.bind(client_name))
+                    except OSError as e:
+                        self.log_message(f"Error reading '{filename}': {str(e)}", logging.ERROR, file=filename,
+                                         error=str(e))
+                        await stream.send_error("DOWNLOAD ERROR: Stored data is unavailable.")
+                        return False
+                if len(view) < offset + count:
+                    raise EOFError(f"blob {digest} is shorter than expected")
+                data = view[offset:offset + count]
+                if encoder is not None:
+                    data = await self.loop.run_in_executor(None, encoder.compress, data, last)
+                if data or last:
+                    if self.shaper.enabled:
+                        await self.shaper.throttle(client_name, "sent", len(data))
+                    await stream.send_data(data, end=last)
+                    self.bytes_total.inc(len(data), ("sent",))
+        except EOFError:
+            raise ConnectionError(f"a blob of '{filename}' is shorter than its catalog entry")
+        return True
+
+    def _compressible(self, pieces):
+        """
+        Samples the pieces of a download to decide whether compressing it is worthwhile (executor).
+        """
+        samples = []
+        for digest, offset, count in pieces[::max(1, len(pieces) // compression.SAMPLE_COUNT)]:
+            opened = self.blobs.open_blob(digest)
+            if opened is None:
+                continue
+            blob, stored_codec = opened
+            with blob:
+                if stored_codec is not None:
+                    return True  # the store kept it compressed because it compressed well
+                blob.seek(offset)
+                samples.append(blob.read(min(count, compression.SAMPLE_SIZE)))
+            if len(samples) == compression.SAMPLE_COUNT:
+                break
+        return compression.compressible(samples)
+
+    def handle_disconnect(self, mux, client_name):
+        try:
+            del self.connected_clients[client_name]  # remove the client from the server's tracking
+            del self.client_sessions[client_name]
+            self.shaper.forget(client_name)
+            mux.conn.close()
+            for task in self.data_connections.pop(client_name, {}).values():
+                # extra connections end with the session; closing their sockets under a pending read would let
+                # the event loop confuse them with the next connection that reuses the descriptor
+                task.cancel()
+            self.log_message(f"Client '{client_name}' disconnected.", client=client_name)
+        except Exception as e:
+            self.log_message(f"Error handling disconnect: {str(e)}", logging.ERROR, client=client_name, error=str(e))
+
+    def _drop_data_connection(self, mux, client_name):
+        mux.conn.close()
+        muxes = self.data_connections.get(client_name)
+        if muxes is not None:
+            muxes.pop(mux, None)
+            if not muxes:
+                del self.data_connections[client_name]
+
+    # ------------------------------------------------------------------ catalog persistence
+
+    def load_uploaded_files(self):
+        """
+        Opens the catalog. Nothing is read up front, so this is quick however many files are stored.
+        """
+        os.makedirs(self.file_storage_directory, exist_ok=True)
+        # the supervisor of worker processes records whether they all shut down cleanly
+        self.catalog = Catalog(os.path.join(self.file_storage_directory, CATALOG_FILE),
+                               track_shutdown=self.worker is None, on_change=self._on_catalog_change)
+        if self.worker is None and not self.catalog.clean_shutdown:
+            self.log_message("Catalog opened after an unclean shutdown; checking for orphaned blobs.", logging.WARNING)
+
+    def _on_catalog_change(self):
+        if self._catalog_changed is not None:
+            self._catalog_changed.set()  # wakes up the REPLICATE requests waiting for a change
+            self._catalog_changed = asyncio.Event()
+
+    def migrate_stored_files(self):
+        """
+        Imports the uploaded_files.json catalog older versions kept in the
+        working directory. Files stored by name are moved into the blob store.
+        """
+        if not os.path.exists(LEGACY_CATALOG_FILE):
+            return
+        try:
+            with open(LEGACY_CATALOG_FILE) as file:
+                legacy = json.load(file)
+        except (OSError, ValueError) as e:
+            self.log_message(f"Error reading {LEGACY_CATALOG_FILE}: {str(e)}", logging.ERROR, error=str(e))
+            return
+
+        storage = os.path.abspath(self.file_storage_directory)
+        imported, foreign, stored_by_name = 0, 0, []
+        for file_path, entry in legacy.items():
+            name = os.path.basename(file_path)
+            if os.path.dirname(os.path.abspath(file_path)) != storage:
+                foreign += 1  # belongs to a server with another storage directory
+                continue
+            if self.catalog.exists(name):
+                continue
+            if not isinstance(entry, str):  # the legacy catalog maps each path to its owner's name
+                self.log_message(f"Skipping '{name}' from {LEGACY_CATALOG_FILE}: its owner is not a name.",
+                                 logging.WARNING, file=name)
+                continue
+            try:
+                chunks = self.blobs.ingest_file(file_path)
+                entry = {"name": name, "owner": entry, "size": os.path.getsize(file_path),
+                         "chunk_size": CHUNK_SIZE, "chunks": chunks, "version": content_version(chunks),
+                         "modified": os.path.getmtime(file_path)}
+            except OSError as e:
+                self.log_message(f"Skipping '{name}' from {LEGACY_CATALOG_FILE}: {str(e)}", logging.WARNING,
+                                 file=name, error=str(e))
+                continue
+            stored_by_name.append(file_path)
+            self.catalog.put(entry)
+            imported += 1
+        for file_path in stored_by_name:
+            self._remove_quietly(file_path)  # only once the catalog points at the blobs
+        if not foreign:
+            os.replace(LEGACY_CATALOG_FILE, LEGACY_CATALOG_FILE + ".migrated")
+        self.log_message(f"Imported {imported} files from {LEGACY_CATALOG_FILE}.")
+
+    # ------------------------------------------------------------------ observers
+
+    def log_message(self, message, level=logging.INFO, **fields):
+        """
+        Logs a message with structured ``fields`` (client, file, error, ...) through the server's logger.
+        """
+        if self.worker is not None:
+            fields["worker"] = self.worker.index
+        logger.log(level, message, extra={"fields": fields})
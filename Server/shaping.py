@@ -0,0 +1,217 @@
+"""
+Keeping one client's transfers from starving everybody else's.
+
+Three mechanisms (the rate limits are off unless configured):
+
+  * Shaper: token buckets for the bytes transfers move, one per client and
+    direction and one per direction for the whole server. A transfer takes
+    tokens for every piece before it is sent or before its credit is
+    returned to the sender, so an upload over its rate is slowed down by
+    the protocol's own flow control rather than by buffering.
+  * DiskScheduler: the disk work of transfers (chunk writes, syncs, blob
+    reads) runs on its own threads, and jobs are taken from the clients
+    that queued them in turn, so a client with many large uploads waits
+    for its own chunks, not everybody else's.
+  * Admission: a limit on the transfers running at once, in total and per
+    client. A transfer over a limit waits for a slot, in the order they
+    asked, and is refused as busy if none frees up in time.
+
+LIST and DELETE go through none of them: they are answered from the
+catalog on the event loop, and their replies go out ahead of queued DATA
+(Common/multiplex.py).
+"""
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import time
+
+BURST_SECONDS = 0.25  # seconds of traffic a bucket lets through at once after being idle
+DEFAULT_DISK_WORKERS = 4  # threads doing the disk work of transfers
+ADMISSION_TIMEOUT = 30.0  # seconds a transfer waits for a slot before it is refused as busy
+
+
+class TokenBucket:
+    """
+    ``rate`` bytes per second with bursts of up to ``burst`` bytes. A take
+    larger than the tokens left goes into debt and waits it off, so pieces
+    of any size pass; takers are served in the order they came.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate * BURST_SECONDS
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.delayed = 0.0  # seconds takers spent waiting
+        self._lock = asyncio.Lock()
+
+    async def take(self, count):
+        async with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count
+            if self.tokens < 0:
+                delay = -self.tokens / self.rate
+                self.delayed += delay
+                await asyncio.sleep(delay)  # the next taker queues behind this one
+
+
+class Shaper:
+    """
+    Per-client and server-wide rate limits in bytes per second for each
+    direction ("received", "sent"); None leaves that limit off.
+    """
+
+    def __init__(self, client_rate=None, total_rate=None):
+        self.client_rate = client_rate
+        self.total = {direction: TokenBucket(total_rate) for direction in ("received", "sent")} if total_rate else {}
+        self.clients = {}  # (client, direction) -> TokenBucket
+
+    @property
+    def enabled(self):
+        return bool(self.client_rate or self.total)
+
+    async def throttle(self, client, direction, count):
+        """
+        Waits until ``client`` may move ``count`` more bytes in ``direction``.
+        """
+        if self.client_rate:
+            bucket = self.clients.get((client, direction))
+            if bucket is None:
+                bucket = self.clients[client, direction] = TokenBucket(self.client_rate)
+            await bucket.take(count)
+        if self.total:
+            await self.total[direction].take(count)  # after the client's own limit, so waiting on it holds nobody up
+
+    def forget(self, client):
+        for direction in ("received", "sent"):
+            self.clients.pop((client, direction), None)
+
+    def delayed(self):
+        """
+        Seconds transfers were held back, by "client" and "total" limit.
+        """
+        return {("client",): sum(bucket.delayed for bucket in self.clients.values()),
+                ("total",): sum(bucket.delayed for bucket in self.total.values())}
+
+
+class DiskScheduler:
+    """
+    Runs blocking disk work on ``workers`` threads, round-robin over the
+    keys (clients) that queued it and in order within a key.
+    """
+
+    def __init__(self, loop, workers=DEFAULT_DISK_WORKERS):
+        self.loop = loop
+        self.workers = workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="disk")
+        self.queues = collections.OrderedDict()  # key -> deque of (future, func, args); next key to serve first
+        self.running = 0
+
+    def run(self, key, func, *args):
+        """
+        Queues ``func(*args)`` for ``key``; returns an asyncio future of its result, like run_in_executor().
+        """
+        future = self.loop.create_future()
+        self.queues.setdefault(key, collections.deque()).append((future, func, args))
+        self._dispatch()
+        return future
+
+    def bind(self, key):
+        """
+        run() for one key, as a ``disk(func, *args)`` callable.
+        """
+        return functools.partial(self.run, key)
+
+    @property
+    def queued(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def _dispatch(self):
+        while self.running < self.workers and self.queues:
+            key, queue = next(iter(self.queues.items()))
+            future, func, args = queue.popleft()
+            if queue:
+                self.queues.move_to_end(key)  # its next job waits for every other key's turn
+            else:
+                del self.queues[key]
+            if future.cancelled():
+                continue  # the caller stopped waiting before it started
+            self.running += 1
+            job = self.loop.run_in_executor(self.executor, func, *args)
+            job.add_done_callback(functools.partial(self._finished, future))
+
+    def _finished(self, future, job):
+        self.running -= 1
+        if not future.cancelled():
+            if job.exception() is not None:
+                future.set_exception(job.exception())
+            else:
+                future.set_result(job.result())
+        self._dispatch()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class Admission:
+    """
+    Transfer slots: at most ``limit`` transfers at once and ``client_limit``
+    per client (None: no limit). Waiting transfers get slots in the order
+    they asked, skipping those whose client is at its own limit.
+    """
+
+    def __init__(self, limit=None, client_limit=None, timeout=ADMISSION_TIMEOUT):
+        self.limit = limit
+        self.client_limit = client_limit
+        self.timeout = timeout
+        self.running = collections.Counter()  # client -> transfers holding a slot
+        self.total = 0
+        self.waiters = collections.deque()  # (client, future) in the order they asked
+
+    def _fits(self, client):
+        return (not self.limit or self.total < self.limit) \
+            and (not self.client_limit or self.running[client] < self.client_limit)
+
+    def _take(self, client):
+        self.running[client] += 1
+        self.total += 1
+
+    async def acquire(self, client):
+        """
+        Takes a slot for ``client``, waiting up to the timeout. Returns False if none freed up.
+        """
+        if self._fits(client):  # whoever is waiting does not fit, or release() would have let them in
+            self._take(client)
+            return True
+        waiter = (client, asyncio.get_running_loop().create_future())
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], self.timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        except BaseException:
+            if waiter[1].done() and not waiter[1].cancelled():
+                self.release(client)  # granted just as the wait was cancelled
+            raise
+        finally:
+            with contextlib.suppress(ValueError):
+                self.waiters.remove(waiter)
+
+    def release(self, client):
+        self.running[client] -= 1
+        if self.running[client] <= 0:
+            del self.running[client]
+        self.total -= 1
+        for waiter in list(self.waiters):
+            if self.limit and self.total >= self.limit:
+                break
+            client, future = waiter
+            if not future.done() and self._fits(client):
+                self.waiters.remove(waiter)
+                self._take(client)
+                future.set_result(None)
@@ -0,0 +1,121 @@
+"""
+Reference counting of chunk blobs between the catalog and the blob store.
+"""
+import hashlib
+import os
+
+import pytest
+
+from Common.chunks import CHUNK_SIZE, file_checksum
+from Server.blob_store import BlobStore
+from Server.catalog import Catalog
+
+
+@pytest.fixture
+def storage(tmp_path):
+    catalog = Catalog(str(tmp_path / "catalog.db"))
+    blobs = BlobStore(str(tmp_path / "blobs"), catalog.is_referenced)
+    yield catalog, blobs
+    catalog.close()
+
+
+def stored(blobs, path, data, name, owner="alice"):
+    with open(path, "wb") as file:
+        file.write(data)
+    chunks = blobs.ingest_file(str(path))
+    return {"name": name, "owner": owner, "size": len(data), "chunk_size": CHUNK_SIZE, "chunks": chunks,
+            "version": file_checksum(chunks), "modified": 0.0}
+
+
+def test_shared_chunk_outlives_first_file(storage, tmp_path):
+    catalog, blobs = storage
+    shared, first_only, second_only = (os.urandom(CHUNK_SIZE) for _ in range(3))
+    first = stored(blobs, tmp_path / "a", shared + first_only, "alice_a")
+    second = stored(blobs, tmp_path / "b", shared + second_only, "alice_b")
+    assert catalog.put(first) == [] and catalog.put(second) == []
+
+    freed = catalog.delete("alice_a", "alice")
+    assert freed == [first["chunks"][1]]  # the shared chunk is still referenced by the second file
+    blobs.collect(freed)
+    assert not blobs.has(first["chunks"][1])
+    assert blobs.has(first["chunks"][0]) and blobs.has(second["chunks"][1])
+
+    blobs.collect(catalog.delete("alice_b", "alice"))
+    assert not any(blobs.has(digest) for digest in second["chunks"])
+
+
+def test_delete_needs_owner(storage, tmp_path):
+    catalog, blobs = storage
+    catalog.put(stored(blobs, tmp_path / "a", b"data", "alice_a"))
+    assert catalog.delete("alice_a", "bob") is None
+    assert catalog.exists("alice_a")
+
+
+def test_overwrite_frees_replaced_chunks(storage, tmp_path):
+    catalog, blobs = storage
+    old = stored(blobs, tmp_path / "old", b"old contents", "alice_a")
+    new = stored(blobs, tmp_path / "new", b"new contents", "alice_a")
+    catalog.put(old)
+    assert catalog.put(new) == old["chunks"]
+    assert catalog.get("alice_a")["chunks"] == new["chunks"]
+
+
+def test_pinned_blob_is_not_collected(storage, tmp_path):
+    catalog, blobs = storage
+    entry = stored(blobs, tmp_path / "a", b"being downloaded", "alice_a")
+    catalog.put(entry)
+    blobs.pin(entry["chunks"])  # e.g. a download in progress
+    blobs.collect(catalog.delete("alice_a", "alice"))
+    assert blobs.has(entry["chunks"][0])
+    blobs.unpin(entry["chunks"])  # the last pin of an unreferenced blob deletes it
+    assert not blobs.has(entry["chunks"][0])
+
+
+def migrated_during(monkeypatch, blobs, name):
+    """
+    Replaces ``os.<name>`` so that the layout migration runs right after the
+    first call the store makes, i.e. between its look in one place and the other.
+    """
+    module, attribute = (os.path, "exists") if name == "exists" else (os, name)
+    real, moved = getattr(module, attribute), []
+
+    def call(path, *args, **kwargs):
+        try:
+            return real(path, *args, **kwargs)
+        finally:
+            if not moved:
+                moved.append(path)
+                moved.extend(blobs.unflatten())
+
+    monkeypatch.setattr(module, attribute, call)
+    return moved
+
+
+@pytest.fixture
+def flat_store(tmp_path):
+    catalog = Catalog(str(tmp_path / "catalog.db"))
+    blobs = BlobStore(str(tmp_path / "blobs"), catalog.is_referenced, flat=True)
+    data = b"stored by an older version"
+    digest = hashlib.sha256(data).hexdigest()
+    with open(blobs.flat_path(digest), "wb") as blob:
+        blob.write(data)
+    yield blobs, digest, data
+    catalog.close()
+
+
+def test_blob_moved_during_lookup_is_found(flat_store, monkeypatch):
+    blobs, digest, data = flat_store
+    moved = migrated_during(monkeypatch, blobs, "exists")
+    file, codec = blobs.open_blob(digest)
+    with file:
+        assert file.read() == data and codec is None
+    assert moved[1:] == [digest] and file.name == blobs.path(digest)
+
+
+def test_blob_moved_during_removal_is_removed(flat_store, monkeypatch):
+    blobs, digest, data = flat_store
+    moved = migrated_during(monkeypatch, blobs, "remove")
+    blobs.collect([digest])
+    monkeypatch.undo()
+    assert moved and not blobs.has(digest)
+    assert not os.path.exists(blobs.path(digest)) and not os.path.exists(blobs.flat_path(digest))
@@ -0,0 +1,94 @@
+"""
+Bundles: many small files uploaded and downloaded in one request each.
+"""
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+from Common import protocol
+from Server.testing import REPLY_TIMEOUT, ask, connected, serving, write_file
+
+
+@pytest.fixture(autouse=True)
+def scratch_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the server looks for an older version's catalog in the working directory
+
+
+def small_files(tmp_path, count):
+    contents = {f"note{index}.txt": f"note number {index}\n".encode() * (index + 1) for index in range(count)}
+    contents["empty.txt"] = b""
+    return contents, [write_file(tmp_path / name, data) for name, data in contents.items()]
+
+
+def test_bundle_round_trip(tmp_path):
+    contents, paths = small_files(tmp_path, 5)
+
+    async def scenario():
+        async with serving(str(tmp_path)) as server, connected(server, compression=["zlib"]) as client:
+            results = await client.upload_bundle(paths)
+            assert [result["status"] for result in results] == ["New"] * len(paths)
+            names = [f"alice_{name}" for name in contents] + ["alice_missing.txt"]
+            os.makedirs(tmp_path / "down")
+            return await client.download_bundle(names, str(tmp_path / "down"))
+
+    results = asyncio.run(scenario())
+    assert results[-1] == {"file": "alice_missing.txt", "error": "File not found."}
+    for result, (name, data) in zip(results, contents.items()):
+        assert result["file"] == f"alice_{name}"
+        with open(result["path"], "rb") as file:
+            assert file.read() == data
+
+
+def test_unchanged_files_are_not_sent_again(tmp_path):
+    contents, paths = small_files(tmp_path, 3)
+
+    async def scenario():
+        async with serving(str(tmp_path)) as server, connected(server) as client:
+            await client.upload_bundle(paths)
+            write_file(paths[1], b"rewritten")
+            results = await client.upload_bundle([paths[0], paths[1], (paths[2], "copy.txt")])
+            assert await client.read_range("alice_note1.txt", 0, 9) == b"rewritten"
+            return [(result["status"], result["deduplicated_bytes"]) for result in results]
+
+    assert asyncio.run(scenario()) == [("Unchanged", 0), ("Override", 0), ("New", len(contents["note2.txt"]))]
+
+
+def test_interrupted_bundle_stores_nothing(tmp_path):
+    first, second = b"a" * 1000, b"b" * 1000
+    request = {"bundle": [{"filename": name, "size": len(data), "chunks": [hashlib.sha256(data).hexdigest()]}
+                          for name, data in (("first.txt", first), ("second.txt", second))]}
+
+    async def scenario():
+        async with serving(str(tmp_path)) as server, connected(server) as client:
+            stream = await client._request(protocol.UPLOAD, request, end=False)
+            opcode, flags, ack = await asyncio.wait_for(stream.receive_message(), REPLY_TIMEOUT)
+            assert [entry["missing"] for entry in ack["files"]] == [[[0, 1000]], [[0, 1000]]]
+            await stream.send_data(first + second[:10], end=True)  # the second file ends short
+            opcode, flags, reply = await asyncio.wait_for(stream.receive_message(), REPLY_TIMEOUT)
+            stream.close()
+            assert opcode == protocol.ERROR
+            assert await client.list_files() == []  # all of the bundle or none of it
+            assert not server.blobs.has(hashlib.sha256(first).hexdigest())
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("opcode, fields", [
+    (protocol.UPLOAD, {"bundle": "a.txt"}),
+    (protocol.UPLOAD, {"bundle": []}),
+    (protocol.UPLOAD, {"bundle": [{"filename": "a.txt", "size": 1, "chunks": []}]}),
+    (protocol.UPLOAD, {"bundle": [{"filename": "../a.txt", "size": 0, "chunks": []}]}),
+    (protocol.UPLOAD, {"bundle": [{"filename": "a.txt", "size": 0, "chunks": []}] * 2}),
+    (protocol.DOWNLOAD, {"bundle": [7]}),
+    (protocol.DOWNLOAD, {"bundle": ["x"] * (protocol.MAX_BUNDLE_FILES + 1)}),
+])
+def test_invalid_bundles_are_answered(tmp_path, opcode, fields):
+    async def scenario():
+        async with serving(str(tmp_path)) as server, connected(server) as client:
+            reply_opcode, reply = await ask(client, opcode, fields)
+            assert reply_opcode == protocol.ERROR, reply
+            assert await client.list_files() == []
+
+    asyncio.run(scenario())
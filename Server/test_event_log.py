@@ -0,0 +1,63 @@
+"""
+The server's structured, rate-limited and non-blocking logging.
+"""
+import json
+import logging
+import queue
+
+from Server import event_log
+
+
+class Collecting(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+def record(message, **fields):
+    entry = logging.LogRecord(event_log.LOGGER_NAME, logging.INFO, __file__, 1, message, None, None)
+    entry.fields = fields
+    return entry
+
+
+def test_rate_limiter_reports_what_it_suppressed():
+    limiter = event_log.RateLimiter(rate=0.001, burst=2)
+    passed = [limiter.filter(record(f"line {number}")) for number in range(5)]
+    assert passed == [True, True, False, False, False]
+    limiter.tokens = 1  # as if time had passed
+    late = record("later", client="alice")
+    assert limiter.filter(late)
+    assert late.fields == {"client": "alice", "suppressed": 3} and limiter.total_suppressed == 3
+
+
+def test_formats():
+    entry = record("Upload done.", file="a.txt", size=5)
+    text = event_log.StructuredFormatter().format(entry)
+    assert text.endswith('INFO Upload done. file="a.txt" size=5')
+    line = json.loads(event_log.StructuredFormatter(json_lines=True).format(entry))
+    assert (line["level"], line["message"], line["file"], line["size"]) == ("INFO", "Upload done.", "a.txt", 5)
+
+
+def test_full_queues_drop_instead_of_blocking():
+    handler = event_log.BoundedQueueHandler(queue.Queue(1))
+    events = event_log.EventQueueHandler(queue.Queue(1))
+    for number in range(3):
+        handler.handle(record(f"line {number}"))
+        events.handle(record(f"line {number}"))
+    assert handler.dropped == 2 and events.dropped == 2
+    assert events.events.get_nowait()["message"] == "line 0"
+
+
+def test_listener_thread_writes_the_records():
+    collected = Collecting()
+    listener = event_log.start_logging([collected], json_lines=True)
+    try:
+        logging.getLogger(event_log.LOGGER_NAME).info("Server started.", extra={"fields": {"port": 9000}})
+    finally:
+        event_log.stop_logging(listener)  # flushes the queue
+    assert [json.loads(line)["port"] for line in collected.lines] == [9000]
+    logger = logging.getLogger(event_log.LOGGER_NAME)
+    assert not logger.handlers and not logger.filters
@@ -0,0 +1,82 @@
+"""
+LIST: catalog queries with keyset pagination, and their paging over the wire.
+"""
+import asyncio
+
+import pytest
+
+from Common import protocol
+from Server.catalog import Catalog
+from Server.testing import ask, connected, serving, write_file
+
+
+@pytest.fixture(autouse=True)
+def scratch_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the server looks for an older version's catalog in the working directory
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = Catalog(str(tmp_path / "catalog.db"))
+    files = [("alice_a.txt", 3.0), ("alice_b.txt", 1.0), ("alice_c.txt", 1.0), ("bob_a.txt", 2.0), ("bobby.txt", 5.0)]
+    for name, modified in files:
+        catalog.put({"name": name, "owner": name.split("_")[0], "size": 1, "chunk_size": 1, "chunks": [],
+                     "version": "", "modified": modified})
+    yield catalog
+    catalog.close()
+
+
+def pages(catalog, limit, **filters):
+    """
+    Names of every matching file, fetched ``limit`` at a time the way the LIST handler does.
+    """
+    columns = {"name": ("file",), "modified": ("modified", "file")}[filters.get("sort", "name")]
+    names, after = [], None
+    while True:
+        page = catalog.list_files(after=after, limit=limit, **filters)
+        names += [file["file"] for file in page]
+        if len(page) < limit:
+            return names
+        after = [page[-1][column] for column in columns]
+
+
+def test_pages_cover_every_file_once(catalog):
+    assert pages(catalog, 2) == ["alice_a.txt", "alice_b.txt", "alice_c.txt", "bob_a.txt", "bobby.txt"]
+    # ties on the modified time are broken by name, so no file is skipped at a page boundary
+    assert pages(catalog, 1, sort="modified") == ["alice_b.txt", "alice_c.txt", "bob_a.txt", "alice_a.txt",
+                                                  "bobby.txt"]
+
+
+def test_filters(catalog):
+    assert pages(catalog, 10, prefix="bob_") == ["bob_a.txt"]
+    assert pages(catalog, 10, prefix="bob") == ["bob_a.txt", "bobby.txt"]
+    assert pages(catalog, 10, owner="alice", modified_after=1.0, modified_before=3.0) == ["alice_b.txt",
+                                                                                           "alice_c.txt"]
+
+
+def test_list_pages_over_the_wire(tmp_path):
+    names = [f"file{index:02}.txt" for index in range(7)]
+
+    async def scenario():
+        async with serving(str(tmp_path)) as server, connected(server) as client:
+            for name in names:
+                await client.upload(write_file(tmp_path / name, name.encode()))
+            files, cursor = await client.list_page(limit=3)
+            assert len(files) == 3 and cursor is not None
+            listed = await client.list_files(limit=3)
+            assert [file["file"] for file in listed] == [f"alice_{name}" for name in names]
+            assert len(await client.list_files(prefix="alice_file0", limit=2, sort="modified")) == len(names)
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("fields", [{"sort": ["name"]}, {"sort": "size"}, {"limit": True}, {"limit": 0},
+                                    {"cursor": "x"}, {"prefix": 7}, {"modified_after": "yesterday"}])
+def test_malformed_list_requests_are_answered(tmp_path, fields):
+    async def scenario():
+        async with serving(str(tmp_path)) as server, connected(server) as client:
+            opcode, reply = await ask(client, protocol.LIST, fields)
+            assert opcode == protocol.ERROR, reply
+            assert (await client.list_page())[0] == []
+
+    asyncio.run(scenario())
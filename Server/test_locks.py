@@ -0,0 +1,95 @@
+"""
+Striped reader/writer locks, and requests that name a file badly.
+"""
+import asyncio
+
+import pytest
+
+from Common import protocol
+from Server.locks import LockStripes, RWLock
+from Server.testing import ask, connected, serving
+
+
+@pytest.fixture(autouse=True)
+def scratch_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the server looks for an older version's catalog in the working directory
+
+
+def test_readers_share_and_writer_excludes():
+    async def scenario():
+        lock, events = RWLock(), []
+
+        async def reader(name, hold):
+            async with lock.read():
+                events.append(f"{name} in")
+                await asyncio.sleep(hold)
+                events.append(f"{name} out")
+
+        async def writer():
+            async with lock.write():
+                events.append("writer in")
+                events.append("writer out")
+
+        first = asyncio.create_task(reader("r1", 0.05))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(reader("r2", 0.01))
+        await asyncio.sleep(0)
+        await asyncio.gather(first, second, writer())
+        return events
+
+    events = asyncio.run(scenario())
+    assert events[:2] == ["r1 in", "r2 in"]  # both readers hold the lock at once
+    assert events[-2:] == ["writer in", "writer out"]  # the writer waits for both
+
+
+def test_waiting_writer_blocks_new_readers():
+    async def scenario():
+        lock, events = RWLock(), []
+        held = asyncio.Event()
+
+        async def first_reader():
+            async with lock.read():
+                held.set()
+                await asyncio.sleep(0.02)
+
+        async def writer():
+            async with lock.write():
+                events.append("writer")
+
+        async def late_reader():
+            async with lock.read():
+                events.append("reader")
+
+        tasks = [asyncio.create_task(first_reader())]
+        await held.wait()
+        tasks.append(asyncio.create_task(writer()))
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(late_reader()))
+        await asyncio.gather(*tasks)
+        return events
+
+    assert asyncio.run(scenario()) == ["writer", "reader"]
+
+
+def test_a_key_always_maps_to_the_same_lock():
+    stripes = LockStripes(4)
+    assert stripes("alice_a.txt") is stripes("alice_a.txt")
+    assert len({id(stripes(f"file{index}")) for index in range(100)}) == 4
+
+
+@pytest.mark.parametrize("opcode, fields", [
+    (protocol.DOWNLOAD, {}),
+    (protocol.DOWNLOAD, {"filename": ["alice_a.txt"]}),
+    (protocol.DOWNLOAD, {"filename": ""}),
+    (protocol.DELETE, {"filename": {"name": "x"}}),
+    (protocol.DELETE, {"filename": 7}),
+    (protocol.DELETE, {}),
+])
+def test_invalid_file_names_are_answered(tmp_path, opcode, fields):
+    async def scenario():
+        async with serving(str(tmp_path)) as server, connected(server) as client:
+            reply_opcode, reply = await ask(client, opcode, fields)
+            assert reply_opcode == protocol.ERROR and "Invalid" in reply["message"], reply
+            assert (await client.list_page())[0] == []
+
+    asyncio.run(scenario())
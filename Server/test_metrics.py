@@ -0,0 +1,88 @@
+"""
+The metrics registry, its HTTP endpoint, and the server's request counters.
+"""
+import asyncio
+import json
+
+import pytest
+
+from Server.metrics import MetricsRegistry, MetricsServer
+from Server.testing import connected, serving, write_file
+
+
+@pytest.fixture(autouse=True)
+def scratch_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the server looks for an older version's catalog in the working directory
+
+
+def test_prometheus_text():
+    registry = MetricsRegistry()
+    requests = registry.counter("requests_total", "Requests.", ("command",))
+    requests.inc(labels=("list",))
+    requests.inc(2, labels=('say "hi"\n',))
+    registry.gauge("clients", "Clients.", collect=lambda: 3)
+    latency = registry.histogram("seconds", "Latency.", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        latency.observe(value)
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests.", "# TYPE requests_total counter",
+        'requests_total{command="list"} 1', 'requests_total{command="say \\"hi\\"\\n"} 2',
+        "# HELP clients Clients.", "# TYPE clients gauge", "clients 3",
+        "# HELP seconds Latency.", "# TYPE seconds histogram",
+        'seconds_bucket{le="0.1"} 1', 'seconds_bucket{le="1"} 2', 'seconds_bucket{le="+Inf"} 3',
+        "seconds_sum 5.55", "seconds_count 3"]
+    with pytest.raises(ValueError):
+        registry.counter("clients", "Registered twice.")
+
+
+def test_histogram_quantiles():
+    registry = MetricsRegistry()
+    latency = registry.histogram("seconds", "Latency.", buckets=(1.0, 2.0, 4.0))
+    assert latency.quantile(0.5) is None
+    for value in (0.5, 1.5, 1.5, 3.0):
+        latency.observe(value)
+    assert latency.quantile(0.5) == pytest.approx(1.5)  # halfway through the (1, 2] bucket
+    assert latency.quantile(1.0) == 4.0
+    sample = registry.snapshot()["seconds"]["values"][0]
+    assert (sample["count"], sample["sum"], sample["p50"]) == (4, 6.5, pytest.approx(1.5))
+
+
+async def get(port, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} HTTP/1.0\r\n\r\n".encode())
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    return head.split(b"\r\n")[0], body
+
+
+def test_server_counts_requests(tmp_path):
+    async def scenario():
+        async with serving(str(tmp_path), metrics_port=0) as server, connected(server) as client:
+            await client.upload(write_file(tmp_path / "a.txt", b"hello"))
+            await client.list_page()
+            await client.list_page()
+            status, text = await get(server.metrics_server.port, "/metrics")
+            assert status.endswith(b"200 OK")
+            assert b'fileserver_requests_total{command="list",outcome="ok"} 2' in text.splitlines()
+            status, body = await get(server.metrics_server.port, "/metrics.json")
+            snapshot = json.loads(body)
+            assert snapshot["fileserver_connected_clients"]["values"] == [{"labels": {}, "value": 1}]
+            assert (await get(server.metrics_server.port, "/other"))[0].endswith(b"404 Not Found")
+
+    asyncio.run(scenario())
+
+
+def test_metrics_server_alone():
+    async def scenario():
+        registry = MetricsRegistry()
+        registry.counter("hits_total", "Hits.").inc()
+        metrics = MetricsServer(registry)
+        await metrics.start()
+        try:
+            return await get(metrics.port, "/metrics?ignored=1")
+        finally:
+            await metrics.stop()
+
+    status, body = asyncio.run(scenario())
+    assert status.endswith(b"200 OK") and b"hits_total 1" in body.splitlines()
@@ -0,0 +1,107 @@
+"""
+Notification fan-out: per-subscriber queues, coalescing, and delivery by topic.
+"""
+import asyncio
+import os
+
+import pytest
+
+from Common import protocol
+from Common.protocol import HEADER_SIZE
+from Server.notifications import NotificationBus, Subscriber, owner_topic
+from Server.testing import REPLY_TIMEOUT, connected, serving, write_file
+
+
+@pytest.fixture(autouse=True)
+def scratch_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the server looks for an older version's catalog in the working directory
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, data):
+        self.sent.append(data)
+
+    def events(self):
+        data, events = b"".join(self.sent), []
+        while data:
+            opcode, flags, stream_id, length = protocol.unpack_header(data[:HEADER_SIZE])
+            events.append(protocol.decode_message(data[HEADER_SIZE:HEADER_SIZE + length]))
+            data = data[HEADER_SIZE + length:]
+        return events
+
+
+def event(text):
+    return {"event": "uploaded", "message": text}
+
+
+def test_repeated_events_are_coalesced():
+    async def scenario():
+        conn = RecordingConnection()
+        subscriber = Subscriber(conn, "alice", ("uploads",))
+        for _ in range(3):
+            subscriber.offer(event("a.txt"), Subscriber._frame(event("a.txt")), key="a.txt")
+        subscriber.offer(event("b.txt"), Subscriber._frame(event("b.txt")), key="b.txt")
+        writer = asyncio.create_task(subscriber.run_writer())
+        await asyncio.sleep(0.01)
+        writer.cancel()
+        return conn
+
+    conn = asyncio.run(scenario())
+    assert len(conn.sent) == 1  # one batch
+    assert [(fields["message"], fields.get("count")) for fields in conn.events()] == [("a.txt (3 times)", 3),
+                                                                                      ("b.txt", None)]
+
+
+def test_full_queue_drops_the_oldest_and_says_so():
+    async def scenario():
+        conn = RecordingConnection()
+        subscriber = Subscriber(conn, "alice", ("uploads",), queue_limit=2)
+        accepted = [subscriber.offer(event(name), Subscriber._frame(event(name))) for name in "abc"]
+        writer = asyncio.create_task(subscriber.run_writer())
+        await asyncio.sleep(0.01)
+        writer.cancel()
+        return accepted, conn.events()
+
+    accepted, events = asyncio.run(scenario())
+    assert accepted == [True, True, False]
+    assert events[0]["event"] == "dropped" and events[0]["count"] == 1
+    assert [fields["message"] for fields in events[1:]] == ["b", "c"]
+
+
+def test_publish_reaches_only_the_topic():
+    async def scenario():
+        bus = NotificationBus(asyncio.get_running_loop())
+        alice, bob = Subscriber(None, "alice", ("my-files",)), Subscriber(None, "bob", ("my-files", "deletes"))
+        bus._register(alice)
+        bus._register(bob)
+        bus.publish(owner_topic("alice"), event("alice's file"))
+        bus.publish("deletes", event("gone"))
+        bus.publish("uploads", event("nobody listens"))
+        bus._unregister(bob)
+        assert "deletes" not in bus.topics
+        return alice, bob
+
+    alice, bob = asyncio.run(scenario())
+    assert [entry[0]["message"] for entry in alice.queue.values()] == ["alice's file"]
+    assert [entry[0]["message"] for entry in bob.queue.values()] == ["gone"]
+
+
+def test_subscribers_hear_uploads_and_downloads(tmp_path):
+    async def scenario():
+        async with serving(str(tmp_path)) as server, connected(server, "alice") as alice, \
+                connected(server, "bob") as bob:
+            heard = {"alice": asyncio.Queue(), "bob": asyncio.Queue()}
+            await alice.subscribe(["my-files"], heard["alice"].put_nowait)
+            await bob.subscribe(["uploads"], heard["bob"].put_nowait)
+            await alice.upload(write_file(tmp_path / "a.txt", b"hello"))
+            uploaded = await asyncio.wait_for(heard["bob"].get(), REPLY_TIMEOUT)
+            assert uploaded["file"] == "alice_a.txt"
+            os.makedirs(tmp_path / "down")
+            await bob.download("alice_a.txt", str(tmp_path / "down"))
+            downloaded = await asyncio.wait_for(heard["alice"].get(), REPLY_TIMEOUT)
+            assert downloaded["event"] == "downloaded" and "bob" in downloaded["message"]
+
+    asyncio.run(scenario())
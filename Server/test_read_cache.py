@@ -0,0 +1,110 @@
+"""
+The hot-blob read cache: admission, LRU eviction and single-flight loading.
+"""
+import asyncio
+import os
+
+from Common.chunks import CHUNK_SIZE
+from Server.read_cache import ReadCache
+from Server.testing import connected, serving, write_file
+
+
+def loader_of(data, calls):
+    def load():
+        calls.append(data)
+        return data
+    return load
+
+
+def test_blob_is_admitted_on_its_second_request():
+    async def scenario():
+        cache, calls = ReadCache(asyncio.get_running_loop(), 100), []
+        assert not cache.wanted("a")  # first miss: read directly, only remembered
+        assert cache.wanted("a")
+        assert bytes(await cache.load("a", loader_of(b"aaaa", calls))) == b"aaaa"
+        assert bytes(cache.get("a")) == b"aaaa" and calls == [b"aaaa"]
+        return cache.stats()
+
+    stats = asyncio.run(scenario())
+    assert (stats["hits"], stats["misses"], stats["loads"], stats["entries"], stats["bytes"]) == (1, 2, 1, 1, 4)
+
+
+def test_least_recently_used_blob_is_evicted():
+    async def scenario():
+        cache, calls = ReadCache(asyncio.get_running_loop(), 10), []
+        for digest in "abc":
+            cache.wanted(digest)
+            await cache.load(digest, loader_of(digest.encode() * 4, calls))
+            cache.get("a")  # keeps "a" recently used
+        return cache
+
+    cache = asyncio.run(scenario())
+    assert list(cache.entries) == ["c", "a"] and cache.size == 8 and cache.evictions == 1
+    cache.invalidate("a")
+    assert list(cache.entries) == ["c"] and cache.size == 4 and cache.invalidations == 1
+
+
+def test_blob_larger_than_the_budget_is_not_kept():
+    async def scenario():
+        cache = ReadCache(asyncio.get_running_loop(), 3)
+        cache.wanted("a")
+        assert bytes(await cache.load("a", loader_of(b"toolarge", []))) == b"toolarge"
+        return cache
+
+    assert asyncio.run(scenario()).entries == {}
+
+
+def test_concurrent_requests_share_one_read():
+    async def scenario():
+        cache, calls, release = ReadCache(asyncio.get_running_loop(), 100), [], asyncio.Event()
+
+        async def slow_disk(loader):
+            await release.wait()
+            return loader()
+
+        readers = [asyncio.create_task(cache.load("a", loader_of(b"data", calls), slow_disk)) for _ in range(5)]
+        await asyncio.sleep(0)
+        release.set()
+        views = await asyncio.gather(*readers)
+        return cache, calls, views
+
+    cache, calls, views = asyncio.run(scenario())
+    assert calls == [b"data"] and all(bytes(view) == b"data" for view in views)
+    assert cache.coalesced == 4 and "a" in cache.entries  # admitted because others waited for it
+
+
+def test_waiters_read_themselves_when_the_reader_is_cancelled():
+    async def scenario():
+        cache, calls, release = ReadCache(asyncio.get_running_loop(), 100), [], asyncio.Event()
+
+        async def slow_disk(loader):
+            await release.wait()
+            return loader()
+
+        first = asyncio.create_task(cache.load("a", loader_of(b"data", calls), slow_disk))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(cache.load("a", loader_of(b"data", calls), slow_disk))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return bytes(await second), first.cancelled(), calls
+
+    assert asyncio.run(scenario()) == (b"data", True, [b"data"])
+
+
+def test_repeated_downloads_are_served_from_memory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the server looks for an older version's catalog in the working directory
+    data = os.urandom(CHUNK_SIZE + 100)
+
+    async def scenario():
+        async with serving(str(tmp_path)) as server, connected(server) as client:
+            await client.upload(write_file(tmp_path / "hot.bin", data))
+            for _ in range(3):
+                assert await client.read_range("alice_hot.bin", 0, len(data)) == data
+            stats = server.read_cache.stats()
+            assert stats["hits"] and stats["entries"] == 2
+            await client.delete("alice_hot.bin")
+            assert server.read_cache.stats()["entries"] == 0  # deleted blobs give their memory back
+
+    asyncio.run(scenario())
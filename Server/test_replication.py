@@ -0,0 +1,114 @@
+"""
+A replica following a primary on localhost: catch-up, live changes and reads through the client's replicas.
+"""
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+from Client.client_core import AsyncClient, ServerError
+from Common import protocol
+from Server.server_core import FileServer
+from Server.testing import ask, connected, serving
+
+CATCH_UP_TIMEOUT = 10.0  # seconds a replica may take to apply a change here
+
+
+@pytest.fixture(autouse=True)
+def scratch_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the server looks for an older version's catalog in the working directory
+
+
+async def started(directory, **options):
+    server = FileServer(0, directory, host="127.0.0.1", notification_port=0, **options)
+    await server.start()
+    return server
+
+
+async def caught_up(replica, primary):
+    await asyncio.wait_for(replica.replicator.caught_up(primary.catalog.head(), CATCH_UP_TIMEOUT), CATCH_UP_TIMEOUT)
+    assert replica.replicator.position == primary.catalog.head()
+
+
+def stored_names(server):
+    return sorted(name for name, owner in server.catalog.names())
+
+
+def test_replica_catches_up_and_follows(tmp_path):
+    files = {f"file{index}.bin": os.urandom(size) for index, size in enumerate((0, 100, 3 << 20))}
+
+    async def scenario():
+        primary = await started(str(tmp_path / "primary"))
+        replica = None
+        client = AsyncClient("127.0.0.1", primary.port, "alice", compression=[])
+        try:
+            await client.connect()
+            for name, data in files.items():  # stored before the replica exists: it copies the whole catalog
+                with open(tmp_path / name, "wb") as file:
+                    file.write(data)
+                await client.upload(str(tmp_path / name))
+
+            replica = await started(str(tmp_path / "replica"), replica_of=("127.0.0.1", primary.port))
+            await caught_up(replica, primary)
+            assert stored_names(replica) == stored_names(primary)
+            for name in files:
+                assert replica.catalog.get(f"alice_{name}") == primary.catalog.get(f"alice_{name}")
+
+            await client.delete("alice_file1.bin")  # live changes arrive through the long poll
+            with open(tmp_path / "file0.bin", "wb") as file:
+                file.write(b"replaced")
+            await client.upload(str(tmp_path / "file0.bin"))
+            await caught_up(replica, primary)
+            assert stored_names(replica) == ["alice_file0.bin", "alice_file2.bin"]
+            assert replica.catalog.get("alice_file0.bin")["size"] == len(b"replaced")
+            # the deleted file's chunk is gone from the replica's store too
+            assert not replica.blobs.has(hashlib.sha256(files["file1.bin"]).hexdigest())
+        finally:
+            await client.disconnect()
+            if replica is not None:
+                await replica.stop()
+            await primary.stop()
+
+    asyncio.run(scenario())
+
+
+def test_client_reads_its_writes_through_replicas(tmp_path):
+    async def scenario():
+        primary = await started(str(tmp_path / "primary"))
+        replica = await started(str(tmp_path / "replica"), replica_of=("127.0.0.1", primary.port))
+        client = AsyncClient("127.0.0.1", primary.port, "alice", compression=[],
+                             replicas=[("127.0.0.1", replica.port)])
+        try:
+            await client.connect()
+            assert client.replicas[0].connected
+            os.makedirs(tmp_path / "down")
+            for attempt in range(5):  # each read must see the upload just before it, wherever it is served
+                data = os.urandom(1000 + attempt)
+                with open(tmp_path / "note.txt", "wb") as file:
+                    file.write(data)
+                await client.upload(str(tmp_path / "note.txt"))
+                await client.download("alice_note.txt", str(tmp_path / "down"))
+                assert (tmp_path / "down" / "alice_note.txt").read_bytes() == data
+            replica_client = client.replicas[0]
+            with pytest.raises(ServerError, match="READ ONLY"):
+                await replica_client.upload(str(tmp_path / "note.txt"))
+        finally:
+            await client.disconnect()
+            await replica.stop()
+            await primary.stop()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("fields", [{"after": "0"}, {"after": True}, {"after": -1}, {"after": 1.0}, {"wait": "5"},
+                                    {"wait": True}, {"wait": float("nan")}, {"wait": float("inf")}])
+def test_invalid_replication_requests_are_answered(tmp_path, fields):
+    async def scenario():
+        async with serving(str(tmp_path)) as server, connected(server) as client:
+            opcode, reply = await ask(client, protocol.REPLICATE, fields)
+            assert opcode == protocol.ERROR and "Invalid replication request" in reply["message"], reply
+            opcode, reply = await ask(client, protocol.REPLICATE, {"after": 0, "wait": 0.01})
+            assert opcode == protocol.OK and reply["changes"] == []
+
+    asyncio.run(scenario())
@@ -0,0 +1,80 @@
+"""
+Resumable uploads and ranged downloads against a FileServer on localhost.
+"""
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+from Common import protocol
+from Common.chunks import CHUNK_SIZE
+from Server.testing import REPLY_TIMEOUT, ask, connected, serving, write_file
+
+
+@pytest.fixture(autouse=True)
+def scratch_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the server looks for an older version's catalog in the working directory
+
+
+def test_interrupted_upload_resumes(tmp_path):
+    size = 2 * CHUNK_SIZE + 500
+    data = os.urandom(size)
+    request = {"filename": "big.bin", "size": size, "source": "test:big.bin"}
+
+    async def scenario():
+        async with serving(str(tmp_path)) as server, connected(server) as client:
+            stream = await client._request(protocol.UPLOAD, request, end=False)
+            opcode, flags, reply = await stream.receive_message()
+            assert reply["missing"] == [[0, size]]
+            await stream.send_data(data[:CHUNK_SIZE + 1000], end=False)
+            while not server.blobs.has(hashlib.sha256(data[:CHUNK_SIZE]).hexdigest()):  # the first chunk is stored
+                await asyncio.sleep(0.01)
+            await stream.cancel()
+            stream.close()
+
+            while True:  # until the server has settled the abandoned upload
+                stream = await client._request(protocol.UPLOAD, request, end=False)
+                opcode, flags, reply = await stream.receive_message()
+                if opcode == protocol.OK:
+                    break
+                assert "already being uploaded" in reply["message"]
+                stream.close()
+                await asyncio.sleep(0.01)
+            assert reply["resumed_bytes"] == CHUNK_SIZE
+            assert reply["missing"] == [[CHUNK_SIZE, size]]
+            await stream.send_data(data[CHUNK_SIZE:], end=True)
+            opcode, flags, reply = await asyncio.wait_for(stream.receive_message(), REPLY_TIMEOUT)
+            stream.close()
+            assert opcode == protocol.OK, reply
+            assert await client.read_range("alice_big.bin", 0, size) == data
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("ranges", [[["a", 10]], [[0.5, 10]], [[True, 10]], [[0, 10, 20]], [[5, 2]], [[0, 10 ** 9]],
+                                    "0-10", 7])
+def test_invalid_download_ranges(tmp_path, ranges):
+    async def scenario():
+        async with serving(str(tmp_path)) as server, connected(server) as client:
+            await client.upload(write_file(tmp_path / "small.txt", b"0123456789" * 10))
+            opcode, reply = await ask(client, protocol.DOWNLOAD, {"filename": "alice_small.txt", "ranges": ranges})
+            assert opcode == protocol.ERROR
+            assert "Invalid byte ranges" in reply["message"]
+            # the connection stays usable
+            assert await client.read_range("alice_small.txt", 2, 3) == b"234"
+
+    asyncio.run(scenario())
+
+
+def test_read_range_spans_chunks(tmp_path):
+    data = os.urandom(3 * CHUNK_SIZE)
+
+    async def scenario():
+        async with serving(str(tmp_path)) as server, connected(server) as client:
+            await client.upload(write_file(tmp_path / "big.bin", data))
+            start, count = CHUNK_SIZE - 10, CHUNK_SIZE + 20
+            assert await client.read_range("alice_big.bin", start, count) == data[start:start + count]
+            assert await client.read_range("alice_big.bin", len(data) - 5, 5) == data[-5:]
+
+    asyncio.run(scenario())
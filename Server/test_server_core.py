@@ -0,0 +1,68 @@
+"""
+Requests against a FileServer on localhost: transfers over one multiplexed
+connection, and malformed requests, which must be answered with an ERROR
+and never left without a reply.
+"""
+import asyncio
+import os
+
+import pytest
+
+from Common import protocol
+from Common.chunks import CHUNK_SIZE
+from Server.testing import ask, connected, serving, write_file
+
+
+@pytest.fixture(autouse=True)
+def scratch_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the server looks for an older version's catalog in the working directory
+
+
+def test_upload_download_round_trip(tmp_path):
+    data = os.urandom(2 * CHUNK_SIZE + 123)
+
+    async def scenario():
+        async with serving(str(tmp_path)) as server, connected(server) as client:
+            await client.upload(write_file(tmp_path / "report.bin", data))
+            os.makedirs(tmp_path / "down")
+            await client.download("alice_report.bin", str(tmp_path / "down"))
+            files, cursor = await client.list_page()
+            assert [file["file"] for file in files] == ["alice_report.bin"] and cursor is None
+
+    asyncio.run(scenario())
+    assert (tmp_path / "down" / "alice_report.bin").read_bytes() == data
+
+
+def test_concurrent_requests_share_one_connection(tmp_path):
+    files = {f"f{index}.bin": os.urandom(CHUNK_SIZE // 2 + index) for index in range(6)}
+
+    async def scenario():
+        async with serving(str(tmp_path)) as server, connected(server) as client:
+            await asyncio.gather(*(client.upload(write_file(tmp_path / name, data)) for name, data in files.items()))
+            os.makedirs(tmp_path / "down")
+            await asyncio.gather(*(client.download(f"alice_{name}", str(tmp_path / "down")) for name in files),
+                                 client.list_page(), client.delete("alice_f0.bin"))
+            assert len(server.connected_clients) == 1
+
+    asyncio.run(scenario())
+    for name, data in files.items():
+        assert (tmp_path / "down" / f"alice_{name}").read_bytes() == data
+
+
+@pytest.mark.parametrize("opcode, fields", [
+    (protocol.UPLOAD, ["not", "an", "object"]),
+    (protocol.LIST, "text"),
+    (protocol.DOWNLOAD, 42),
+    (protocol.UPLOAD, {"filename": ["a.txt"], "size": 3}),
+    (protocol.UPLOAD, {"filename": "a.txt", "size": True}),
+    (protocol.UPLOAD, {"filename": "../a.txt", "size": 3}),
+    (protocol.UPLOAD, {"upload_id": ["x"], "ranges": [[0, 1]]}),
+])
+def test_malformed_requests_are_answered(tmp_path, opcode, fields):
+    async def scenario():
+        async with serving(str(tmp_path)) as server, connected(server) as client:
+            reply_opcode, reply = await ask(client, opcode, fields)
+            assert reply_opcode == protocol.ERROR, reply
+            assert (await client.list_page())[0] == []  # and the server carries on
+
+    asyncio.run(scenario())
@@ -0,0 +1,119 @@
+"""
+Rate limits, fair disk scheduling and transfer admission.
+"""
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from Server.shaping import Admission, DiskScheduler, Shaper, TokenBucket
+from Server.testing import connected, serving, write_file
+
+
+@pytest.fixture(autouse=True)
+def scratch_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the server looks for an older version's catalog in the working directory
+
+
+async def timed(awaitable):
+    started = time.monotonic()
+    await awaitable
+    return time.monotonic() - started
+
+
+def test_bucket_lets_a_burst_through_then_paces():
+    async def scenario():
+        bucket = TokenBucket(1_000_000)
+        assert await timed(bucket.take(250_000)) < 0.05  # the burst
+        assert await timed(bucket.take(100_000)) >= 0.08
+        return bucket.delayed
+
+    assert asyncio.run(scenario()) >= 0.08
+
+
+def test_one_client_over_its_rate_does_not_slow_another():
+    async def scenario():
+        shaper = Shaper(client_rate=1_000_000)
+        slow = asyncio.create_task(shaper.throttle("alice", "sent", 500_000))  # twice the burst
+        await asyncio.sleep(0)
+        assert await timed(shaper.throttle("bob", "sent", 100_000)) < 0.05
+        await slow
+        shaper.forget("alice")
+        return shaper
+
+    shaper = asyncio.run(scenario())
+    assert list(shaper.clients) == [("bob", "sent")] and not Shaper().enabled
+
+
+def test_disk_jobs_take_turns_between_clients():
+    async def scenario():
+        disk, order, gate = DiskScheduler(asyncio.get_running_loop(), workers=1), [], threading.Event()
+        try:
+            blocker = disk.run("x", gate.wait)  # occupies the only thread while the others queue
+            jobs = [disk.run(key, order.append, name) for key, name in
+                    [("alice", "a1"), ("alice", "a2"), ("alice", "a3"), ("bob", "b1")]]
+            cancelled = disk.run("bob", order.append, "b2")
+            cancelled.cancel()
+            failing = disk.bind("carol")(int, "not a number")
+            assert disk.queued == 6
+            gate.set()
+            await asyncio.gather(blocker, *jobs)
+            with pytest.raises(ValueError):
+                await failing
+            return order
+        finally:
+            disk.shutdown()
+
+    assert asyncio.run(scenario()) == ["a1", "b1", "a2", "a3"]
+
+
+def test_admission_limits_and_order():
+    async def scenario():
+        admission = Admission(limit=2, client_limit=1, timeout=5)
+        assert await admission.acquire("alice")
+        second = asyncio.create_task(admission.acquire("alice"))  # over alice's own limit
+        await asyncio.sleep(0)
+        assert await admission.acquire("bob")
+        carol = asyncio.create_task(admission.acquire("carol"))  # over the total limit
+        await asyncio.sleep(0)
+        admission.release("alice")
+        assert await second and "carol" not in admission.running  # the first to ask goes first
+        admission.release("bob")
+        assert await carol
+        return admission
+
+    admission = asyncio.run(scenario())
+    assert admission.total == 2 and dict(admission.running) == {"alice": 1, "carol": 1}
+
+
+def test_admission_times_out_and_cancels_cleanly():
+    async def scenario():
+        admission = Admission(limit=1, timeout=0.05)
+        assert await admission.acquire("alice")
+        assert not await admission.acquire("bob")
+        waiting = asyncio.create_task(admission.acquire("carol"))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        admission.release("alice")
+        return admission
+
+    admission = asyncio.run(scenario())
+    assert admission.total == 0 and not admission.waiters
+
+
+def test_rate_limited_upload_leaves_others_responsive(tmp_path):
+    data = os.urandom(1 << 20)
+
+    async def scenario():
+        async with serving(str(tmp_path), client_rate=2 << 20) as server, connected(server, "alice") as alice, \
+                connected(server, "bob") as bob:
+            upload = asyncio.create_task(alice.upload(write_file(tmp_path / "big.bin", data)))
+            await asyncio.sleep(0.05)
+            assert await timed(bob.list_page()) < 0.2
+            assert await timed(upload) >= 0.2  # about 1 MiB at 2 MiB/s after the burst
+            assert server.shaper.delayed()[("client",)] > 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,45 @@
+"""
+Compression negotiated per transfer, and blobs compressed at rest.
+"""
+import asyncio
+import os
+
+import pytest
+
+from Server.testing import connected, serving, write_file
+
+
+@pytest.fixture(autouse=True)
+def scratch_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the server looks for an older version's catalog in the working directory
+
+
+def test_only_compressible_uploads_are_compressed(tmp_path):
+    text, noise = b"the same sentence again\n" * 50000, os.urandom(300000)
+
+    async def scenario():
+        async with serving(str(tmp_path)) as server, connected(server, compression=["brotli", "zlib"]) as client:
+            assert (await client.upload(write_file(tmp_path / "text.txt", text)))["compression"] == "zlib"
+            assert (await client.upload(write_file(tmp_path / "noise.bin", noise)))["compression"] is None
+            async with connected(server, "bob") as plain:  # offers nothing
+                assert (await plain.upload(write_file(tmp_path / "other.txt", text.upper())))["compression"] is None
+            assert await client.read_range("alice_text.txt", 0, len(text)) == text
+
+    asyncio.run(scenario())
+
+
+def test_blobs_compressed_at_rest_download_intact(tmp_path):
+    text = b"".join(b"record %d\n" % number for number in range(100000))
+
+    async def scenario():
+        async with serving(str(tmp_path), compress_at_rest="lzma") as server:
+            async with connected(server, compression=["zlib"]) as client:
+                await client.upload(write_file(tmp_path / "records.txt", text))
+                os.makedirs(tmp_path / "down")
+                await client.download("alice_records.txt", str(tmp_path / "down"))
+                assert await client.read_range("alice_records.txt", 5000, 100) == text[5000:5100]
+            async with connected(server, "bob") as plain:
+                assert await plain.read_range("alice_records.txt", 0, len(text)) == text
+
+    asyncio.run(scenario())
+    assert (tmp_path / "down" / "alice_records.txt").read_bytes() == text
@@ -0,0 +1,71 @@
+"""
+Worker mode: passing connections over SCM_RIGHTS, picking a user's worker,
+and a supervisor with two worker processes sharing one storage directory.
+"""
+import asyncio
+import os
+import socket
+
+import pytest
+
+from Server.testing import REPLY_TIMEOUT, connected, write_file
+from Server.workers import Channel, Supervisor, worker_for, worker_options
+
+
+@pytest.fixture(autouse=True)
+def scratch_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the server looks for an older version's catalog in the working directory
+
+
+def test_channel_passes_file_descriptors(tmp_path):
+    path = tmp_path / "passed.txt"
+    path.write_bytes(b"through the socket pair")
+
+    async def scenario():
+        ours, theirs = (Channel(sock) for sock in socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET))
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            await ours.send({"file": "passed.txt"}, [fd])
+        finally:
+            os.close(fd)  # the receiver has its own descriptor of the file
+        message, fds = await theirs.receive()
+        with os.fdopen(fds[0], "rb") as file:
+            contents = file.read()
+        ours.close()
+        closed = await theirs.receive()
+        theirs.close()
+        return message, contents, closed
+
+    assert asyncio.run(scenario()) == ({"file": "passed.txt"}, b"through the socket pair", (None, []))
+
+
+def test_every_user_has_one_worker():
+    assert all(worker_for(f"user{index}", 3) == worker_for(f"user{index}", 3) for index in range(50))
+    assert {worker_for(f"user{index}", 3) for index in range(50)} == {0, 1, 2}
+
+
+def test_server_wide_limits_are_split():
+    options = worker_options({"total_rate": 10, "max_transfers": 64, "client_rate": 5, "metrics_port": 9100}, 2, 3)
+    assert options == {"total_rate": 4, "max_transfers": 22, "client_rate": 5, "metrics_port": 9102}
+
+
+def test_workers_share_the_storage(tmp_path):
+    alice = "alice"  # and a user of the other worker:
+    bob = next(name for name in ("bob", "carol", "dave", "erin") if worker_for(name, 2) != worker_for(alice, 2))
+
+    async def scenario():
+        supervisor = Supervisor(0, str(tmp_path / "storage"), 2, host="127.0.0.1", notification_port=0)
+        await supervisor.start()
+        try:
+            async with connected(supervisor, alice) as first, connected(supervisor, bob) as second:
+                heard = asyncio.Queue()
+                await second.subscribe(["uploads"], heard.put_nowait)
+                await first.upload(write_file(tmp_path / "a.txt", b"from the first worker"))
+                assert (await asyncio.wait_for(heard.get(), REPLY_TIMEOUT))["file"] == "alice_a.txt"
+                assert await second.read_range("alice_a.txt", 0, 21) == b"from the first worker"
+                assert [file["file"] for file in await second.list_files()] == ["alice_a.txt"]
+        finally:
+            await supervisor.stop()
+        return [process.exitcode for process in supervisor.processes]
+
+    assert asyncio.run(scenario()) == [0, 0]
@@ -0,0 +1,53 @@
+"""
+Helpers for the tests that run a FileServer in-process on localhost.
+"""
+import asyncio
+import contextlib
+import os
+
+from Client.client_core import AsyncClient
+from Server.server_core import FileServer
+
+REPLY_TIMEOUT = 5.0  # seconds a test waits for an answer before calling it a hang
+
+
+@contextlib.asynccontextmanager
+async def serving(directory, **options):
+    """
+    A FileServer with its storage in ``directory``, on free ports.
+    """
+    server = FileServer(0, os.path.join(directory, "storage"), host="127.0.0.1", notification_port=0, **options)
+    await server.start()
+    try:
+        yield server
+    finally:
+        await server.stop()
+
+
+@contextlib.asynccontextmanager
+async def connected(server, username="alice", **options):
+    client = AsyncClient("127.0.0.1", server.port, username, notification_port=server.notification_port,
+                         compression=options.pop("compression", []), **options)
+    await client.connect()
+    try:
+        yield client
+    finally:
+        await client.disconnect()
+
+
+async def ask(client, opcode, fields):
+    """
+    Sends one raw request and returns the (opcode, fields) of its first reply.
+    """
+    stream = await client._request(opcode, fields)
+    try:
+        opcode, flags, reply = await asyncio.wait_for(stream.receive_message(), REPLY_TIMEOUT)
+        return opcode, reply
+    finally:
+        stream.close()
+
+
+def write_file(path, data):
+    with open(path, "wb") as file:
+        file.write(data)
+    return str(path)
@@ -0,0 +1,388 @@
+"""
+Running the file server as several worker processes, to use more than one core.
+
+A supervisor process listens on the client and notification ports. For
+every client connection it reads the HELLO frame, picks the worker of that
+username (a hash of the name modulo the number of workers) and passes the
+socket, with the HELLO it read, to that worker over a Unix socket pair
+(SCM_RIGHTS). Every connection of one user, control and data, therefore
+lands in the same worker, which keeps the server's per-user state (the
+username check, sessions, parallel uploads, transfer limits) in one process.
+
+The workers share the storage directory. The catalog is an SQLite database
+in WAL mode, which several processes may write; the blob pins of work in
+progress are recorded in its pins table (Server/blob_store.SharedPins), so
+no worker deletes a blob another one is using. Notification connections stay
+with the supervisor: workers send the events they publish up their socket
+pair and the supervisor's NotificationBus delivers them.
+
+The supervisor tidies the storage up before it starts the workers (what a
+single server does at startup), restarts a worker that died, and on
+shutdown stops them with SIGTERM and records a clean shutdown in the catalog
+only if every worker exited cleanly.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import zlib
+
+from Common import protocol
+from Common.protocol import HEADER_SIZE
+from Server.catalog import CATALOG_FILE, Catalog
+from Server.event_log import LOGGER_NAME, start_logging, stop_logging
+from Server.notifications import NotificationBus
+from Server.server_core import FileServer, listen
+
+logger = logging.getLogger(LOGGER_NAME)
+
+HELLO_TIMEOUT = 10  # seconds a new connection has to send HELLO
+MAX_MESSAGE_SIZE = 64 << 10  # bytes of one message between the supervisor and a worker; also bounds HELLO
+RESTART_DELAY = 1.0  # seconds before a worker that died is started again
+STOP_TIMEOUT = 30  # seconds workers get to shut down before they are killed
+SPLIT_OPTIONS = ("total_rate", "max_transfers", "read_cache_size")  # server-wide limits, divided between workers
+
+
+def worker_for(username, count):
+    """
+    Index of the worker that serves ``username``.
+    """
+    return zlib.crc32(username.encode()) % count
+
+
+class Channel:
+    """
+    One end of the socket pair between the supervisor and a worker: JSON
+    messages, each of which may carry file descriptors.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self._send_lock = asyncio.Lock()
+
+    async def send(self, message, fds=()):
+        data = json.dumps(message).encode()
+        async with self._send_lock:  # one waiter for the socket to become writable at a time
+            while True:
+                try:
+                    socket.send_fds(self.sock, [data], list(fds))
+                    return
+                except BlockingIOError:
+                    await self._wait(writable=True)
+
+    async def receive(self):
+        """
+        Returns (message, file descriptors), or (None, []) once the other end has closed.
+        """
+        while True:
+            try:
+                data, fds, flags, address = socket.recv_fds(self.sock, MAX_MESSAGE_SIZE, 1)
+            except BlockingIOError:
+                await self._wait(writable=False)
+                continue
+            except ConnectionError:
+                return None, []
+            if not data:
+                return None, []
+            return json.loads(data), fds
+
+    async def _wait(self, writable):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        add, remove = (loop.add_writer, loop.remove_writer) if writable else (loop.add_reader, loop.remove_reader)
+        fd = self.sock.fileno()  # the socket may be closed before the wait ends
+        add(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(fd)
+
+    def close(self):
+        self.sock.close()
+
+
+class Worker:
+    """
+    A worker process's place among ``count`` workers, as its FileServer sees it.
+    """
+
+    def __init__(self, index, count, channel):
+        self.index = index
+        self.count = count
+        self.channel = channel  # to the supervisor
+
+    def serves(self, username):
+        return worker_for(username, self.count) == self.index
+
+
+def worker_options(options, index, count):
+    """
+    FileServer options of one worker: the server-wide limits are split evenly
+    and every worker serves its metrics on its own port (metrics_port + index).
+    """
+    options = dict(options)
+    for key in SPLIT_OPTIONS:
+        if options.get(key):
+            options[key] = -(-options[key] // count)
+    if options.get("metrics_port"):
+        options["metrics_port"] += index
+    return options
+
+
+def run_worker(index, count, sock, port, storage_directory, options, log_options):
+    """
+    Body of a worker process: serves connections from the supervisor until
+    SIGTERM or until the supervisor goes away.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C reaches the whole process group; the supervisor stops us
+    listener = start_logging(**log_options)
+    try:
+        asyncio.run(_serve_worker(Worker(index, count, Channel(sock)), port, storage_directory, options))
+    finally:
+        stop_logging(listener)
+
+
+async def _serve_worker(worker, port, storage_directory, options):
+    server = FileServer(port, storage_directory, worker=worker, **options)
+    await server.start()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, lambda: loop.create_task(server.stop()))
+    try:
+        await server.serve_forever()
+    finally:
+        if server.server_running:
+            await server.stop()
+        worker.channel.close()
+
+
+class Supervisor:
+    """
+    Accepts the connections of ``count`` worker processes (see the module
+    docstring). ``options`` are the FileServer options of the workers;
+    ``log_options`` the start_logging() arguments of their logging.
+    """
+
+    def __init__(self, port, storage_directory, count, host="", notification_port=protocol.DEFAULT_NOTIFICATION_PORT,
+                 log_options=None, **options):
+        self.port = port
+        self.storage_directory = storage_directory
+        self.count = count
+        self.host = host
+        self.notification_port = notification_port
+        self.log_options = log_options or {}
+        self.options = options
+        self.processes = [None] * count  # multiprocessing.Process of each worker, None while it is restarted
+        self.channels = [None] * count  # Channel to each worker, None while it is restarted
+        self.server_socket = None
+        self.notification_server_socket = None
+        self.notifications = None  # the notification connections of all workers' clients
+        self.server_running = False
+        self.loop = None
+        self._context = multiprocessing.get_context("spawn")  # a fresh interpreter: no inherited loop, sockets or locks
+        self._crashed = False  # a worker died; the blobs of its interrupted uploads are swept at the next start
+        self._tasks = set()
+        self._stopped = None
+
+    # ------------------------------------------------------------------ lifecycle
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        # what a single server does at startup, done once for all workers; the pins it took die with it
+        storage = FileServer(self.port, self.storage_directory, **dict(self.options, metrics_port=None))
+        storage.open_storage()
+        storage.catalog.clear_pins()
+        storage.catalog.close(clean=False)  # recorded as clean once every worker shut down cleanly
+
+        self.server_socket = listen(self.host, self.port, self.options.get("so_rcvbuf", 0))
+        self.port = self.server_socket.getsockname()[1]  # resolve port 0 to the real port
+        self.notification_server_socket = listen(self.host, self.notification_port)
+        self.notification_port = self.notification_server_socket.getsockname()[1]
+        self.notifications = NotificationBus(self.loop, self.log_message)
+
+        self.server_running = True
+        for index in range(self.count):
+            self._start_worker(index)
+        self.log_message(f"Server started on port {self.port} with {self.count} workers. Waiting for connections...",
+                         port=self.port, workers=self.count)
+        self._spawn(self.accept_clients())
+        self._spawn(self.accept_notification_clients())
+
+    async def serve_forever(self):
+        if not self.server_running:
+            await self.start()
+        await self._stopped.wait()
+
+    async def stop(self):
+        """
+        Stops accepting connections, stops the workers (they disconnect their
+        clients) and records in the catalog whether the shutdown was clean.
+        """
+        if not self.server_running:
+            return
+        self.server_running = False
+        for listening_socket in (self.server_socket, self.notification_server_socket):
+            with contextlib.suppress(OSError):
+                listening_socket.close()
+        for task in list(self._tasks):
+            task.cancel()  # including the watchers, so nothing restarts the workers
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        processes = [process for process in self.processes if process is not None]
+        for process in processes:
+            process.terminate()  # SIGTERM: the worker stops like a single server does
+        for process in processes:
+            try:
+                await asyncio.wait_for(self._exited(process), STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.log_message(f"Worker {process.name} did not stop; killing it.", logging.ERROR)
+                process.kill()
+                process.join()
+        for channel in self.channels:
+            if channel is not None:
+                channel.close()
+
+        clean = not self._crashed and len(processes) == self.count \
+            and all(process.exitcode == 0 for process in processes)
+        Catalog(os.path.join(self.storage_directory, CATALOG_FILE)).close(clean=clean)
+        self.log_message("Server stopped.")
+        self._stopped.set()
+
+    def _spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    # ------------------------------------------------------------------ workers
+
+    def _start_worker(self, index):
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        process = self._context.Process(
+            target=run_worker, name=f"fileserver-worker{index}",
+            args=(index, self.count, theirs, self.port, self.storage_directory,
+                  worker_options(self.options, index, self.count), self.log_options))
+        process.start()
+        theirs.close()  # the worker has its own copy
+        self.processes[index] = process
+        self.channels[index] = channel = Channel(ours)
+        self._spawn(self._watch(index, process, channel))
+
+    async def _watch(self, index, process, channel):
+        """
+        Delivers the worker's notifications while it runs, and starts it again if it dies.
+        """
+        relay = self._spawn(self._relay_notifications(channel))
+        try:
+            await self._exited(process)
+        finally:
+            relay.cancel()
+            await asyncio.gather(relay, return_exceptions=True)
+        channel.close()
+        self.processes[index] = self.channels[index] = None
+        self._crashed = True
+        self.log_message(f"Worker {index} exited with code {process.exitcode}; restarting it.", logging.ERROR,
+                         worker=index, exitcode=process.exitcode)
+        await asyncio.sleep(RESTART_DELAY)
+        self._start_worker(index)
+
+    async def _exited(self, process):
+        exited = self.loop.create_future()
+        self.loop.add_reader(process.sentinel, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            self.loop.remove_reader(process.sentinel)
+        process.join()
+
+    async def _relay_notifications(self, channel):
+        while True:
+            message, fds = await channel.receive()
+            if message is None:
+                return  # the worker is gone; its watcher takes over
+            topic, event, key = message["notify"]
+            self.notifications.publish(topic, event, tuple(key) if key is not None else None)
+
+    # ------------------------------------------------------------------ connections
+
+    async def accept_notification_clients(self):
+        while self.server_running:
+            try:
+                client_socket, address = await self.loop.sock_accept(self.notification_server_socket)
+                client_socket.setblocking(False)
+                self._spawn(self.notifications.serve(client_socket))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self.server_running:
+                    self.log_message(f"Error in notification client connection: {e}", logging.ERROR, error=str(e))
+                break
+
+    async def accept_clients(self):
+        while self.server_running:
+            try:
+                client_conn, client_addr = await self.loop.sock_accept(self.server_socket)
+                client_conn.setblocking(False)
+                client_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # kept when handed over
+                self._spawn(self.hand_over(client_conn, client_addr))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self.server_running:
+                    self.log_message(f"Error accepting clients: {str(e)}", logging.ERROR, error=str(e))
+                break
+
+    async def hand_over(self, client_conn, client_addr):
+        """
+        Reads the connection's HELLO and passes both to the worker of its username.
+        """
+        try:
+            opcode, hello = await asyncio.wait_for(self._read_hello(client_conn), HELLO_TIMEOUT)
+            username = hello.get("username") if opcode == protocol.HELLO and isinstance(hello, dict) else None
+            if not isinstance(username, str) or not username:
+                await self._refuse(client_conn, "Expected HELLO with a username.")
+                return
+            channel = self.channels[worker_for(username, self.count)]
+            try:
+                if channel is None:
+                    raise ConnectionError("worker is restarting")
+                await channel.send({"address": list(client_addr), "hello": hello}, [client_conn.fileno()])
+            except OSError:
+                await self._refuse(client_conn, "SERVER BUSY: The server is restarting a worker; try again later.")
+        except (ConnectionError, asyncio.TimeoutError):
+            pass  # gone, or never said HELLO
+        except (protocol.ProtocolError, ValueError) as e:
+            self.log_message(f"Error with client {client_addr}: {str(e)}", logging.WARNING, address=client_addr[0],
+                             error=str(e))
+        finally:
+            client_conn.close()  # the worker holds its own descriptor of a connection it was given
+
+    async def _read_hello(self, client_conn):
+        """
+        Reads exactly the first frame, so nothing the client sends after it is left behind in this process.
+        """
+        opcode, flags, stream_id, length = protocol.unpack_header(await self._read_exact(client_conn, HEADER_SIZE))
+        if length > MAX_MESSAGE_SIZE // 2:
+            raise protocol.ProtocolError(f"HELLO of {length} bytes is too large")
+        return opcode, protocol.decode_message(await self._read_exact(client_conn, length))
+
+    async def _read_exact(self, client_conn, count):
+        data = bytearray()
+        while len(data) < count:
+            received = await self.loop.sock_recv(client_conn, count - len(data))
+            if not received:
+                raise ConnectionError("connection closed by peer")
+            data += received
+        return bytes(data)
+
+    async def _refuse(self, client_conn, message):
+        with contextlib.suppress(OSError):
+            await self.loop.sock_sendall(client_conn, protocol.encode_message(protocol.ERROR, {"message": message}))
+
+    def log_message(self, message, level=logging.INFO, **fields):
+        logger.log(level, message, extra={"fields": fields})